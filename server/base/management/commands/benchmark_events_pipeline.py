@@ -0,0 +1,300 @@
+import json
+import logging
+import random
+import socket
+import time
+import tracemalloc
+import uuid
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from zentral.contrib.inventory.events import InventoryHeartbeat
+from zentral.contrib.inventory.models import MachineSnapshotCommit
+from zentral.contrib.munki.events import MunkiEvent
+from zentral.contrib.osquery.events import OsqueryResultEvent
+from zentral.contrib.santa.events import SantaEventEvent
+from zentral.core.events import event_from_event_d
+from zentral.core.events.pipeline import enrich_event, process_event
+from zentral.core.probes.conf import all_probes
+from zentral.core.probes.models import ProbeSource
+from zentral.core.queues.backends.kombu import EnrichWorker, EventQueues, PreprocessWorker, ProcessWorker, StoreWorker
+from zentral.core.stores.backends.base import BaseEventStore
+
+
+logger = logging.getLogger("zentral.server.base.management.commands.benchmark_events_pipeline")
+
+
+# synthetic events
+
+
+def build_osquery_result_payload(serial_number, idx):
+    return {"name": "pack/benchmark/query_{}".format(idx % 5),
+            "action": random.choice(("added", "removed")),
+            "hostIdentifier": serial_number,
+            "unixTime": str(int(time.time())),
+            "columns": {"pid": str(idx), "path": "/usr/local/bin/tool_{}".format(idx % 50)}}
+
+
+def build_santa_event_payload(serial_number, idx):
+    return {"decision": random.choice(("ALLOW_BINARY", "ALLOW_CERTIFICATE", "BLOCK_BINARY")),
+            "file_name": "tool_{}".format(idx % 50),
+            "file_path": "/usr/local/bin",
+            "file_sha256": uuid.uuid5(uuid.NAMESPACE_OID, str(idx % 50)).hex * 2,
+            "file_bundle_id": "io.zentral.benchmark.tool{}".format(idx % 50),
+            "file_bundle_name": "Tool {}".format(idx % 50),
+            "current_sessions": ["benchmark@console"],
+            "executing_user": "benchmark"}
+
+
+def build_munki_event_payload(serial_number, idx):
+    return {"type": random.choice(("install", "removal")),
+            "name": "Package {}".format(idx % 20),
+            "version": "1.{}".format(idx % 3),
+            "status": 0,
+            "run_type": "auto",
+            "munki_version": "5.2.2"}
+
+
+def build_inventory_heartbeat_payload(serial_number, idx):
+    return {"source": {"module": "zentral.contrib.benchmark", "name": "Benchmark"}}
+
+
+EVENT_TYPES = {
+    OsqueryResultEvent.event_type: (OsqueryResultEvent, build_osquery_result_payload),
+    SantaEventEvent.event_type: (SantaEventEvent, build_santa_event_payload),
+    MunkiEvent.event_type: (MunkiEvent, build_munki_event_payload),
+    InventoryHeartbeat.event_type: (InventoryHeartbeat, build_inventory_heartbeat_payload),
+}
+
+
+PAYLOAD_FILTERS = {
+    OsqueryResultEvent.event_type: [{"attribute": "name", "operator": "IN", "values": ["pack/benchmark/query_0"]}],
+    SantaEventEvent.event_type: [{"attribute": "decision", "operator": "IN", "values": ["BLOCK_BINARY"]}],
+    MunkiEvent.event_type: [{"attribute": "type", "operator": "IN", "values": ["install"]}],
+}
+
+
+# pipeline stand-ins
+
+
+class BenchmarkPreprocessor(object):
+    routing_key = "benchmark_events"
+
+    def process_raw_event(self, raw_event):
+        yield event_from_event_d(raw_event)
+
+
+class BenchmarkEventStore(BaseEventStore):
+    """Event store stub, deserializing and serializing the events like the real stores."""
+    max_batch_size = 1000
+
+    def __init__(self, config_d):
+        super().__init__(config_d)
+        self.stored_events = 0
+
+    def store(self, event):
+        if isinstance(event, dict):
+            event = event_from_event_d(event)
+        json.dumps(event.serialize(machine_metadata=True))
+        self.stored_events += 1
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    return sorted_values[int(round(p / 100 * (len(sorted_values) - 1)))]
+
+
+class Command(BaseCommand):
+    help = ("Benchmark the events pipeline workers, with the kombu in-memory transport and stub event stores. "
+            "All the database changes are rolled back at the end of the run.")
+    DRAIN_TIMEOUT = 0.1  # seconds
+
+    def add_arguments(self, parser):
+        parser.add_argument("--events", type=int, default=1000, help="number of events")
+        parser.add_argument("--event-type", action="append", dest="event_types", choices=sorted(EVENT_TYPES),
+                            help="event type to generate. Can be repeated. Default: all")
+        parser.add_argument("--machines", type=int, default=100, help="number of machines")
+        parser.add_argument("--probes", type=int, default=10, help="number of active probes")
+        parser.add_argument("--incidents", action="store_true", help="the probes open incidents")
+        parser.add_argument("--stores", type=int, default=1, help="number of stub event stores")
+        parser.add_argument("--store-batch-size", type=int, default=1, help="batch size of the stub event stores")
+        parser.add_argument("--prefetch-count", type=int,
+                            help="prefetch count of the preprocess, enrich and process workers")
+        parser.add_argument("--ack-batch-size", type=int, default=1,
+                            help="ack batch size of the preprocess, enrich and process workers")
+        parser.add_argument("--tracemalloc", action="store_true", help="trace the memory allocations")
+        parser.add_argument("--seed", type=int, default=0, help="random seed")
+        parser.add_argument("--json", action="store_true", dest="json_output", help="output the results in JSON")
+
+    # setup
+
+    def create_machines(self, count):
+        source = {"module": "zentral.contrib.benchmark", "name": "Benchmark"}
+        serial_numbers = []
+        for idx in range(count):
+            serial_number = "BENCH{:07d}".format(idx)
+            MachineSnapshotCommit.objects.commit_machine_snapshot_tree({
+                "source": source,
+                "serial_number": serial_number,
+                "os_version": {"name": "macOS", "major": 10, "minor": 15, "patch": idx % 7},
+                "system_info": {"computer_name": "benchmark-{}".format(idx)},
+            })
+            serial_numbers.append(serial_number)
+        return serial_numbers
+
+    def create_probes(self, count, event_types, incidents):
+        for idx in range(count):
+            event_type = event_types[idx % len(event_types)]
+            filters = {"metadata": [{"event_types": [event_type]}]}
+            if idx % 3 == 1 and event_type in PAYLOAD_FILTERS:
+                filters["payload"] = [PAYLOAD_FILTERS[event_type]]
+            elif idx % 3 == 2:
+                filters["inventory"] = [{"platforms": ["MACOS"]}]
+            body = {"filters": filters}
+            if incidents:
+                body["incident_severity"] = 100
+            ProbeSource.objects.create(model="BaseProbe", name="Benchmark probe {}".format(idx),
+                                       status=ProbeSource.ACTIVE, body=body)
+        all_probes.clear()
+
+    def build_events(self, count, event_types, serial_numbers):
+        for idx in range(count):
+            event_cls, build_payload = EVENT_TYPES[event_types[idx % len(event_types)]]
+            serial_number = serial_numbers[idx % len(serial_numbers)] if serial_numbers else None
+            ip = "10.{}.{}.{}".format(idx % 7, idx % 251, idx % 13)
+            yield from event_cls.build_from_machine_request_payloads(
+                serial_number, "benchmark/1.0", ip, [build_payload(serial_number, idx)]
+            )
+
+    # run
+
+    def drain(self, stage, worker, callback_name, trace_malloc):
+        durations = []
+        callback = getattr(worker, callback_name)
+
+        def timed_callback(body, message):
+            t0 = time.perf_counter()
+            callback(body, message)
+            durations.append(time.perf_counter() - t0)
+
+        setattr(worker, callback_name, timed_callback)
+        if trace_malloc:
+            tracemalloc.start()
+        with CaptureQueriesContext(connection) as queries:
+            start = last_message = time.perf_counter()
+            with worker.Consumer() as (conn, _, _):
+                while True:
+                    try:
+                        conn.drain_events(timeout=self.DRAIN_TIMEOUT)
+                    except socket.timeout:
+                        break
+                    last_message = time.perf_counter()
+            if getattr(worker, "batch", None):
+                worker.flush_batch()
+                last_message = time.perf_counter()
+            if getattr(worker, "pending_acks", None):
+                worker.flush_acks()
+                last_message = time.perf_counter()
+        result = {"stage": stage,
+                  "messages": len(durations),
+                  "duration": last_message - start,
+                  "queries": len(queries)}
+        if trace_malloc:
+            result["allocated_kib"], result["peak_allocated_kib"] = (v / 1024 for v in tracemalloc.get_traced_memory())
+            tracemalloc.stop()
+        result["messages_per_second"] = result["messages"] / result["duration"] if result["duration"] else 0
+        durations.sort()
+        result["p50_ms"] = 1000 * percentile(durations, 50)
+        result["p99_ms"] = 1000 * percentile(durations, 99)
+        return result
+
+    def run_benchmark(self, options, event_types, serial_numbers):
+        event_queues = EventQueues({"backend_url": "memory://",
+                                    "high_throughput": {"prefetch_count": options["prefetch_count"],
+                                                        "ack_batch_size": options["ack_batch_size"]}})
+        high_throughput_settings = event_queues.high_throughput_settings
+        preprocess_worker = PreprocessWorker(event_queues._get_connection(), high_throughput_settings)
+        preprocess_worker.preprocessors = {BenchmarkPreprocessor.routing_key: BenchmarkPreprocessor()}
+        stages = [
+            ("preprocess", preprocess_worker, "do_preprocess_raw_event"),
+            ("enrich", EnrichWorker(event_queues._get_connection(), enrich_event, high_throughput_settings),
+             "do_enrich_event"),
+            ("process", ProcessWorker(event_queues._get_connection(), process_event, high_throughput_settings),
+             "do_process_event"),
+        ]
+        event_stores = []
+        for idx in range(options["stores"]):
+            event_store = BenchmarkEventStore({"store_name": "benchmark {}".format(idx),
+                                               "batch_size": options["store_batch_size"]})
+            event_stores.append(event_store)
+            store_worker = StoreWorker(event_queues._get_connection(), event_store)
+            if event_store.batch_size > 1:
+                callback_name = "do_add_event_to_batch"
+            else:
+                callback_name = "do_store_event"
+            stages.append(("store {}".format(idx), store_worker, callback_name))
+
+        # declare the queues before publishing
+        for _, worker, _ in stages:
+            worker.setup_metrics_exporter()
+            with worker.Consumer():
+                pass
+
+        events = list(self.build_events(options["events"], event_types, serial_numbers))
+        start = time.perf_counter()
+        for event in events:
+            event_queues.post_raw_event(BenchmarkPreprocessor.routing_key, event.serialize(machine_metadata=False))
+        results = [{"stage": "publish",
+                    "messages": len(events),
+                    "duration": time.perf_counter() - start}]
+        results[0]["messages_per_second"] = len(events) / results[0]["duration"] if events else 0
+
+        for stage, worker, callback_name in stages:
+            results.append(self.drain(stage, worker, callback_name, options["tracemalloc"]))
+
+        total_duration = sum(result["duration"] for result in results)
+        return {"events": len(events),
+                "event_types": event_types,
+                "machines": len(serial_numbers),
+                "probes": options["probes"],
+                "stored_events": {event_store.name: event_store.stored_events for event_store in event_stores},
+                "duration": total_duration,
+                "events_per_second": len(events) / total_duration if total_duration else 0,
+                "stages": results}
+
+    # output
+
+    def print_results(self, results):
+        self.stdout.write("{events} events, {machines} machines, {probes} probes. "
+                          "Event types: {}".format(", ".join(results["event_types"]), **results))
+        header = ("stage", "messages", "duration (s)", "msg/s", "p50 (ms)", "p99 (ms)", "queries", "alloc. (KiB)")
+        self.stdout.write("{:<12}{:>10}{:>14}{:>10}{:>10}{:>10}{:>9}{:>14}".format(*header))
+        for result in results["stages"]:
+            self.stdout.write("{:<12}{:>10}{:>14.3f}{:>10.0f}{:>10}{:>10}{:>9}{:>14}".format(
+                result["stage"], result["messages"], result["duration"], result["messages_per_second"],
+                "{:.3f}".format(result["p50_ms"]) if "p50_ms" in result else "-",
+                "{:.3f}".format(result["p99_ms"]) if "p99_ms" in result else "-",
+                result.get("queries", "-"),
+                "{:.0f}".format(result["allocated_kib"]) if "allocated_kib" in result else "-",
+            ))
+        self.stdout.write("Total: {duration:.3f}s, {events_per_second:.0f} events/s".format(**results))
+        for store_name, stored_events in results["stored_events"].items():
+            if stored_events != results["events"]:
+                self.stderr.write("Store {}: {} stored event(s)".format(store_name, stored_events))
+
+    def handle(self, *args, **options):
+        random.seed(options["seed"])
+        event_types = options["event_types"] or sorted(EVENT_TYPES)
+        with transaction.atomic():
+            try:
+                serial_numbers = self.create_machines(options["machines"])
+                self.create_probes(options["probes"], event_types, options["incidents"])
+                results = self.run_benchmark(options, event_types, serial_numbers)
+            finally:
+                transaction.set_rollback(True)
+                all_probes.clear()
+        if options["json_output"]:
+            self.stdout.write(json.dumps(results, indent=2))
+        else:
+            self.print_results(results)
@@ -0,0 +1,69 @@
+import logging
+from django.core.management.base import BaseCommand, CommandError
+from zentral.core.stores import stores
+from zentral.core.stores.backends.elasticsearch import EventStore as ElasticsearchEventStore
+
+
+logger = logging.getLogger("zentral.server.base.management.commands.migrate_event_store_to_rollover")
+
+
+class Command(BaseCommand):
+    help = ('Migrate a single index Elasticsearch event store to the rollover indices. '
+            'The store must already be configured with a rollover section. '
+            'The existing index is kept, and added to the read alias.')
+
+    def add_arguments(self, parser):
+        parser.add_argument("store_name", help="name of the Elasticsearch event store")
+        parser.add_argument("--block-writes", action="store_true",
+                            help="block the writes on the existing index")
+        parser.add_argument("--dry-run", action="store_true", help="only display the migration steps")
+
+    def get_event_store(self, store_name):
+        for event_store in stores:
+            if event_store.name == store_name:
+                break
+        else:
+            raise CommandError("Unknown store {}".format(store_name))
+        if not isinstance(event_store, ElasticsearchEventStore):
+            raise CommandError("Store {} is not an Elasticsearch event store".format(store_name))
+        if not event_store.rollover_conditions:
+            raise CommandError("Store {} is not configured for the rollover indices".format(store_name))
+        return event_store
+
+    def handle(self, *args, **options):
+        event_store = self.get_event_store(options["store_name"])
+        dry_run = options["dry_run"]
+        es = event_store._es
+        legacy_index = event_store.index
+
+        # lifecycle policy, index template, write index
+        self.stdout.write("Lifecycle policy {}, index template {}, write alias {}".format(
+            event_store.index, event_store.index, event_store.write_index
+        ))
+        if not dry_run:
+            event_store.wait_and_configure()
+
+        # legacy index
+        if not es.indices.exists(legacy_index) or es.indices.exists_alias(name=legacy_index):
+            self.stdout.write("No single index {} to migrate".format(legacy_index))
+            return
+        if es.indices.exists_alias(index=legacy_index, name=event_store.read_index):
+            self.stdout.write("Index {} already in read alias {}".format(legacy_index, event_store.read_index))
+        else:
+            self.stdout.write("Add index {} to read alias {}".format(legacy_index, event_store.read_index))
+            if not dry_run:
+                es.indices.put_alias(index=legacy_index, name=event_store.read_index)
+        if options["block_writes"]:
+            self.stdout.write("Block writes on index {}".format(legacy_index))
+            if not dry_run:
+                es.indices.put_settings(index=legacy_index, body={"index.blocks.write": True})
+
+        # retention
+        if event_store.retention:
+            r = es.search(index=legacy_index,
+                          body={"size": 0, "aggs": {"max_created_at": {"max": {"field": "created_at"}}}})
+            last_event_created_at = r["aggregations"]["max_created_at"].get("value_as_string")
+            self.stdout.write("Index {} is not managed by the lifecycle policy. Last event: {}. "
+                              "Delete it manually when it is older than the {} retention.".format(
+                                  legacy_index, last_event_created_at or "-", event_store.retention
+                              ))
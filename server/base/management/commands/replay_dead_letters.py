@@ -0,0 +1,94 @@
+import json
+import logging
+import os
+import re
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.text import get_valid_filename
+from zentral.core.stores import stores
+from zentral.core.stores.backends.base import get_event_key
+
+
+logger = logging.getLogger("zentral.server.base.management.commands.replay_dead_letters")
+
+
+DEAD_LETTER_RE = re.compile(r"^.*_event_store_(?P<store>.+)_error\.json$")
+
+
+class Command(BaseCommand):
+    help = 'Replay the event store dead letters.'
+
+    def add_arguments(self, parser):
+        parser.add_argument("--directory", default="/tmp/zentral_dead_letters",
+                            help="dead letters directory")
+        parser.add_argument("--store", action="append", dest="store_names",
+                            help="only replay the dead letters of this store. Can be repeated.")
+        parser.add_argument("--batch-size", type=int, default=100)
+        parser.add_argument("--keep", action="store_true", help="do not remove the replayed dead letters")
+        parser.add_argument("--dry-run", action="store_true", help="only list the dead letters to replay")
+
+    def iter_dead_letters(self, directory, event_stores):
+        for dirpath, _, filenames in os.walk(directory):
+            for filename in sorted(filenames):
+                m = DEAD_LETTER_RE.match(filename)
+                if not m:
+                    continue
+                event_store = event_stores.get(m.group("store"))
+                if not event_store:
+                    continue
+                yield event_store, os.path.join(dirpath, filename)
+
+    def replay_batch(self, event_store, batch, keep):
+        try:
+            stored_event_keys = set(event_store.bulk_store([event_d for _, event_d in batch]))
+        except Exception:
+            logger.exception("Could not replay %s dead letter(s) in store %s", len(batch), event_store.name)
+            stored_event_keys = set()
+        replayed = 0
+        for filepath, event_d in batch:
+            if get_event_key(event_d) in stored_event_keys:
+                replayed += 1
+                if not keep:
+                    os.unlink(filepath)
+            else:
+                self.stderr.write("Could not replay {}".format(filepath))
+        return replayed
+
+    def handle(self, *args, **options):
+        directory = options["directory"]
+        if not os.path.isdir(directory):
+            raise CommandError("Unknown directory {}".format(directory))
+        store_names = options["store_names"]
+        event_stores = {get_valid_filename(event_store.name): event_store
+                        for event_store in stores
+                        if not store_names or event_store.name in store_names}
+        if not event_stores:
+            raise CommandError("No stores")
+        batch_size = max(options["batch_size"], 1)
+        batches = {}
+        counters = {event_store.name: [0, 0] for event_store in event_stores.values()}
+        for event_store, filepath in self.iter_dead_letters(directory, event_stores):
+            counters[event_store.name][0] += 1
+            if options["dry_run"]:
+                self.stdout.write("{}: {}".format(event_store.name, filepath))
+                continue
+            try:
+                with open(filepath, "r", encoding="utf-8") as f:
+                    event_d = json.load(f)
+                get_event_key(event_d)
+            except Exception:
+                self.stderr.write("Invalid dead letter {}".format(filepath))
+                continue
+            batch = batches.setdefault(event_store.name, [])
+            batch.append((filepath, event_d))
+            if len(batch) >= min(batch_size, event_store.max_batch_size):
+                counters[event_store.name][1] += self.replay_batch(event_store, batch, options["keep"])
+                batches[event_store.name] = []
+        for event_store in event_stores.values():
+            batch = batches.get(event_store.name)
+            if batch:
+                counters[event_store.name][1] += self.replay_batch(event_store, batch, options["keep"])
+        for store_name, (found, replayed) in counters.items():
+            if options["dry_run"]:
+                self.stdout.write("Store {}: {} dead letter(s)".format(store_name, found))
+            else:
+                self.stdout.write("Store {}: {}/{} dead letter(s) replayed".format(store_name, replayed, found))
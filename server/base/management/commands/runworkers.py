@@ -4,7 +4,8 @@ from multiprocessing import Process
 import random
 import time
 import yaml
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from zentral.conf import settings
 from zentral.core.queues.workers import get_workers
 
 
@@ -39,10 +40,38 @@ class Command(BaseCommand):
         parser.add_argument("--statsd-port", type=int, default=9125)
         parser.add_argument("--statsd-prefix", default="zentral")
 
+        # worker processes
+        parser.add_argument("--concurrency", action="append", default=[], metavar="WORKER_NAME=N",
+                            help="number of processes to start for a worker. "
+                                 "Can be repeated. Overrides the workers.concurrency config section.")
+
         parser.add_argument("worker", nargs="*")
 
-    def start_worker(self, idx, worker):
-        logger.info("Starting worker '%s'", worker.name)
+    @staticmethod
+    def get_concurrency(options):
+        concurrency = {}
+        for worker_name, number in settings.get("workers", {}).get("concurrency", {}).items():
+            concurrency[worker_name] = number
+        for concurrency_arg in options["concurrency"]:
+            worker_name, sep, number = concurrency_arg.rpartition("=")
+            if not sep or not worker_name:
+                raise CommandError("Invalid --concurrency value '{}'".format(concurrency_arg))
+            concurrency[worker_name] = number
+        for worker_name, number in list(concurrency.items()):
+            try:
+                number = int(number)
+                if number < 1:
+                    raise ValueError
+            except (TypeError, ValueError):
+                raise CommandError("Invalid concurrency for worker '{}'".format(worker_name))
+            concurrency[worker_name] = number
+        return concurrency
+
+    def start_worker(self, idx, worker, process_idx=0):
+        process_name = worker.name
+        if self.concurrency.get(worker.name, 1) > 1:
+            process_name = "{} #{}".format(worker.name, process_idx)
+        logger.info("Starting worker '%s'", process_name)
         metrics_exporter = None
         if self.prometheus:
             from zentral.utils.prometheus import PrometheusMetricsExporter
@@ -51,16 +80,19 @@ class Command(BaseCommand):
         elif self.statsd:
             from zentral.utils.statsd import StatsdMetricsExporter
             metrics_exporter = StatsdMetricsExporter(self.statsd_host, self.statsd_port, self.statsd_prefix)
+        # the worker connections are only opened in the run method,
+        # so each forked process gets its own broker connection
         p = Process(target=worker.run,
                     kwargs={"metrics_exporter": metrics_exporter},
-                    name=worker.name)
+                    name=process_name)
         p.daemon = 1
         p.start()
-        self.processes[idx] = (worker, p)
+        self.processes[idx] = (worker, process_idx, p)
         if self.prometheus:
             self.prometheus_targets[idx] = {
                 "targets": ["{}:{}".format(self.external_hostname, prometheus_port)],
-                "labels": {"job": worker.name}
+                "labels": {"job": worker.name,
+                           "worker_process": str(process_idx)}
             }
 
     def write_prometheus_sd_file(self):
@@ -71,7 +103,7 @@ class Command(BaseCommand):
     def watch_workers(self):
         while True:
             time.sleep(random.uniform(1, 3))
-            for idx, (worker, p) in self.processes.items():
+            for idx, (worker, process_idx, p) in self.processes.items():
                 if idx in self.processes_to_restart:
                     continue
                 if not p.is_alive() or (p.exitcode is not None and p.exitcode < 0):
@@ -84,19 +116,18 @@ class Command(BaseCommand):
                     except ValueError:
                         # TODO the proc is not dead?
                         # should not happen
-                        logger.error("The worker '%s' is not really dead.", worker.name)
+                        logger.error("The worker '%s' is not really dead.", p.name)
                         proc_is_dead = False
                     if proc_is_dead:
                         delay = random.uniform(*self.RESTART_DELAY)
                         logger.error("Worker '%s' is dead. Exit code %s. Restarting in %ss",
-                                     worker.name,  -1 * p_exitcode, int(delay))
-                        self.processes_to_restart[idx] = (time.time() + delay, worker)
+                                     p.name,  -1 * p_exitcode, int(delay))
+                        self.processes_to_restart[idx] = (time.time() + delay, worker, process_idx)
                 else:
-                    logger.debug("Worker '%s' OK", worker.name)
-            for idx, (deadline, worker) in list(self.processes_to_restart.items()):
+                    logger.debug("Worker '%s' OK", p.name)
+            for idx, (deadline, worker, process_idx) in list(self.processes_to_restart.items()):
                 if deadline < time.time():
-                    print("OUPS", flush=True)
-                    self.start_worker(idx, worker)
+                    self.start_worker(idx, worker, process_idx)
                     self.processes_to_restart.pop(idx)
 
     def handle(self, *args, **options):
@@ -115,15 +146,27 @@ class Command(BaseCommand):
         self.statsd_port = options['statsd_port']
         self.statsd_prefix = options['statsd_prefix']
 
+        # worker processes
+        self.concurrency = self.get_concurrency(options)
+
         workers = options['worker']
         all_workers = []
-        for idx, worker in enumerate(sorted(get_workers(), key=lambda w: w.name)):
+        # one index per worker process, used to compute the prometheus ports
+        idx = 0
+        for worker in sorted(get_workers(), key=lambda w: w.name):
             if list_workers:
                 all_workers.append(worker.name)
                 continue
-            elif workers and worker.name not in workers:
+            worker_concurrency = self.concurrency.get(worker.name, 1)
+            if workers and worker.name not in workers:
+                idx += worker_concurrency
                 continue
-            self.start_worker(idx, worker)
+            for process_idx in range(worker_concurrency):
+                self.start_worker(idx, worker, process_idx)
+                idx += 1
+        for worker_name in set(self.concurrency) - set(worker.name for worker, _, _ in self.processes.values()):
+            if not list_workers and (not workers or worker_name in workers):
+                logger.warning("Unknown worker '%s' in the concurrency settings", worker_name)
         if list_workers:
             if json_output:
                 print(json.dumps({"workers": all_workers}))
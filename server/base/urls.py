@@ -8,4 +8,5 @@ urlpatterns = [
     re_path(r'^health_check/$', views.HealthCheckView.as_view(), name='health_check'),
     re_path(r'^app/(?P<app>\S+)/hist_data/(?P<interval>\S+)/(?P<bucket_number>\d+)/$',
             views.AppHistogramDataView.as_view(), name='app_hist_data'),
+    re_path(r'^prometheus_metrics/$', views.PrometheusMetricsView.as_view(), name='prometheus_metrics'),
 ]
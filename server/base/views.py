@@ -4,6 +4,8 @@ from django.contrib.auth.mixins import LoginRequiredMixin
 from django.http import Http404, HttpResponse, JsonResponse
 from django.views.generic import TemplateView, View
 from zentral.core.stores import frontend_store
+from zentral.core.stores.cache import CachedEventStore
+from zentral.utils.prometheus import BasePrometheusMetricsView
 
 
 logger = logging.getLogger("server.base.views")
@@ -69,3 +71,10 @@ class AppHistogramDataView(LoginRequiredMixin, View):
         return JsonResponse({"app": app,
                              "labels": labels,
                              "datasets": datasets})
+
+
+class PrometheusMetricsView(BasePrometheusMetricsView):
+    def get_registry(self):
+        if isinstance(frontend_store, CachedEventStore):
+            # process local cache
+            return frontend_store.get_prometheus_metrics()
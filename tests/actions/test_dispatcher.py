@@ -0,0 +1,171 @@
+from smtplib import SMTPRecipientsRefused, SMTPResponseException, SMTPServerDisconnected
+import threading
+import time
+from unittest.mock import Mock, patch
+from django.test import SimpleTestCase
+import requests
+from zentral.core.actions.backends.email import Action as EmailAction
+from zentral.core.actions.dispatcher import ActionDispatcher, ActionExecutor, TokenBucket
+
+
+class FakeAction(object):
+    def __init__(self, name="fake", dispatcher_config=None, exceptions=None, delay=0):
+        self.name = name
+        self.dispatcher_config = dispatcher_config
+        self.exceptions = list(exceptions or [])
+        self.delay = delay
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def trigger(self, event, probe, action_config_d):
+        if self.delay:
+            time.sleep(self.delay)
+        with self.lock:
+            self.calls.append((event, probe, action_config_d))
+            if self.exceptions:
+                raise self.exceptions.pop(0)
+
+
+def build_event(event_type="base", serial_number="0123456789"):
+    event = Mock()
+    event.event_type = event_type
+    event.metadata.machine_serial_number = serial_number
+    return event
+
+
+def build_probe(pk=1):
+    probe = Mock()
+    probe.pk = pk
+    return probe
+
+
+def build_http_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    return requests.HTTPError(response=response)
+
+
+class ActionDispatcherTestCase(SimpleTestCase):
+    def test_dispatch_does_not_block(self):
+        action = FakeAction(delay=0.2)
+        dispatcher = ActionDispatcher({"max_workers": 1})
+        start = time.monotonic()
+        for i in range(3):
+            self.assertTrue(dispatcher.dispatch(action, build_event(), build_probe(i), {}))
+        self.assertTrue(time.monotonic() - start < 0.2)
+        dispatcher.stop()
+        self.assertEqual(len(action.calls), 3)
+
+    def test_action_dispatcher_config(self):
+        action = FakeAction(dispatcher_config={"max_workers": 3, "coalesce_window": 10})
+        dispatcher = ActionDispatcher({"enabled": True, "max_workers": 1})
+        executor = dispatcher.get_executor(action)
+        self.assertEqual(executor.max_workers, 3)
+        self.assertEqual(executor.coalesce_window, 10)
+        self.assertEqual(len(executor._threads), 3)
+        dispatcher.stop()
+
+    def test_retries(self):
+        action = FakeAction(exceptions=[build_http_error(503), requests.ConnectionError()])
+        executor = ActionExecutor(action, max_retries=3, retry_backoff=0.01)
+        executor.trigger(build_event(), build_probe(), {})
+        self.assertEqual(len(action.calls), 3)
+
+    def test_no_retry_on_client_error(self):
+        action = FakeAction(exceptions=[build_http_error(400)])
+        executor = ActionExecutor(action, max_retries=3, retry_backoff=0.01)
+        with self.assertRaises(requests.HTTPError):
+            executor.trigger(build_event(), build_probe(), {})
+        self.assertEqual(len(action.calls), 1)
+
+    def test_max_retries(self):
+        action = FakeAction(exceptions=[build_http_error(429)] * 3)
+        executor = ActionExecutor(action, max_retries=2, retry_backoff=0.01)
+        with self.assertRaises(requests.HTTPError):
+            executor.trigger(build_event(), build_probe(), {})
+        self.assertEqual(len(action.calls), 3)
+
+    def test_smtp_retries(self):
+        action = FakeAction(exceptions=[SMTPServerDisconnected(), SMTPResponseException(451, b"try later")])
+        executor = ActionExecutor(action, max_retries=3, retry_backoff=0.01)
+        executor.trigger(build_event(), build_probe(), {})
+        self.assertEqual(len(action.calls), 3)
+
+    def test_no_retry_on_permanent_smtp_error(self):
+        for exception in (SMTPResponseException(550, b"no such user"),
+                          SMTPRecipientsRefused({"yolo@example.com": (550, b"no such user")})):
+            action = FakeAction(exceptions=[exception])
+            executor = ActionExecutor(action, max_retries=3, retry_backoff=0.01)
+            with self.assertRaises(type(exception)):
+                executor.trigger(build_event(), build_probe(), {})
+            self.assertEqual(len(action.calls), 1)
+
+    @patch("zentral.core.actions.backends.email.contact_groups", {"yolo": [{"email": "yolo@example.com"}]})
+    @patch("zentral.core.actions.backends.email.SMTP_SSL")
+    def test_email_smtp_errors_retried(self, smtp_ssl):
+        conn = smtp_ssl.return_value
+        conn.sendmail.side_effect = [SMTPResponseException(421, b"service not available"), {}]
+        action = EmailAction({"action_name": "email", "email_from": "zentral@example.com",
+                              "smtp_host": "smtp.example.com", "smtp_port": 465})
+        event = build_event()
+        event.get_notification_body.return_value = "body"
+        event.get_notification_subject.return_value = "subject"
+        executor = ActionExecutor(action, max_retries=3, retry_backoff=0.01)
+        executor.trigger(event, build_probe(), {"groups": ["yolo"]})
+        self.assertEqual(conn.sendmail.call_count, 2)
+        # new connection after the error
+        self.assertEqual(smtp_ssl.call_count, 2)
+        conn.quit.assert_called_once_with()
+
+    def test_coalescing(self):
+        action = FakeAction()
+        metrics_exporter = Mock()
+        executor = ActionExecutor(action, coalesce_window=60, metrics_exporter=metrics_exporter)
+        event, probe = build_event(), build_probe()
+        self.assertTrue(executor.submit(event, probe, {"groups": ["a"]}))
+        self.assertFalse(executor.submit(event, probe, {"groups": ["a"]}))
+        self.assertTrue(executor.submit(event, probe, {"groups": ["b"]}))
+        self.assertTrue(executor.submit(build_event(serial_number="1"), probe, {"groups": ["a"]}))
+        self.assertEqual(executor.queue.qsize(), 3)
+        metrics_exporter.inc.assert_any_call("dispatched_actions", "fake", "coalesced", value=1)
+        metrics_exporter.set.assert_called_with("dispatched_actions_queue_depth", "fake", value=3)
+
+    def test_full_queue(self):
+        action = FakeAction()
+        executor = ActionExecutor(action, max_queue_size=1, enqueue_timeout=0.01)
+        self.assertTrue(executor.submit(build_event(), build_probe(), {}))
+        self.assertFalse(executor.submit(build_event(), build_probe(), {}))
+
+    def test_full_queue_not_coalesced(self):
+        action = FakeAction()
+        executor = ActionExecutor(action, max_queue_size=1, enqueue_timeout=0.01, coalesce_window=60)
+        self.assertTrue(executor.submit(build_event(), build_probe(1), {}))
+        # dropped, not recorded for the coalescing
+        self.assertFalse(executor.submit(build_event(), build_probe(2), {}))
+        executor.queue.get()
+        self.assertTrue(executor.submit(build_event(), build_probe(2), {}))
+        self.assertFalse(executor.submit(build_event(), build_probe(2), {}))
+
+    def test_failed_action_metrics(self):
+        action = FakeAction(exceptions=[ValueError("yolo")])
+        metrics_exporter = Mock()
+        dispatcher = ActionDispatcher({"max_retries": 0})
+        dispatcher.setup_metrics_exporter(metrics_exporter)
+        dispatcher.dispatch(action, build_event(), build_probe(), {})
+        dispatcher.dispatch(action, build_event(), build_probe(), {})
+        dispatcher.stop()
+        statuses = [c[0][2] for c in metrics_exporter.inc.call_args_list if c[0][0] == "dispatched_actions"]
+        self.assertEqual(sorted(statuses), ["failed", "queued", "queued", "succeeded"])
+        metrics_exporter.add_histogram.assert_called_once_with("dispatched_actions_latency_seconds", ["action"])
+        self.assertEqual([c[0][:2] for c in metrics_exporter.observe.call_args_list],
+                         2 * [("dispatched_actions_latency_seconds", "fake")])
+
+
+class TokenBucketTestCase(SimpleTestCase):
+    def test_rate_limit(self):
+        token_bucket = TokenBucket(rate=100, burst=2)
+        self.assertEqual(token_bucket.acquire(), 0)
+        self.assertEqual(token_bucket.acquire(), 0)
+        start = time.monotonic()
+        self.assertTrue(token_bucket.acquire() > 0)
+        self.assertTrue(time.monotonic() - start >= 0.005)
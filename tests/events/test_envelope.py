@@ -0,0 +1,102 @@
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from django.test import TestCase
+from zentral.core.events.base import (BaseEvent, EventEnvelope, is_event_envelope_d, iter_event_envelope_event_ds,
+                                      register_event_type)
+from zentral.core.events.pipeline import enrich_event
+from zentral.core.probes.conf import all_probes
+
+
+class TestEnvelopeEvent(BaseEvent):
+    event_type = "event_type_envelope"
+    tags = ["yolo"]
+
+
+register_event_type(TestEnvelopeEvent)
+
+
+def get_created_at(payload):
+    return datetime(2020, 1, 1) + timedelta(seconds=payload["idx"])
+
+
+def build_payloads(count):
+    return [{"idx": idx, "columns": {"path": "/usr/local/bin/tool_{}".format(idx)}} for idx in range(count)]
+
+
+def without_id(event_d):
+    event_d["_zentral"].pop("id")
+    return event_d
+
+
+class EventEnvelopeTestCase(TestCase):
+    def _build_envelopes(self, payloads, max_payloads, **kwargs):
+        return list(TestEnvelopeEvent.build_envelopes_from_machine_request_payloads(
+            "0123456789", "godzilla", "203.0.113.1", payloads, max_payloads=max_payloads, **kwargs
+        ))
+
+    def _build_event_ds(self, payloads, **kwargs):
+        return [without_id(event.serialize(machine_metadata=False))
+                for event in TestEnvelopeEvent.build_from_machine_request_payloads(
+                    "0123456789", "godzilla", "203.0.113.1", payloads, **kwargs
+                )]
+
+    def test_envelope_chunks(self):
+        payloads = build_payloads(25)
+        envelopes = self._build_envelopes(payloads, 10)
+        self.assertEqual([len(envelope.payloads) for envelope in envelopes], [10, 10, 5])
+        self.assertTrue(all(isinstance(envelope, EventEnvelope) for envelope in envelopes))
+        self.assertEqual([envelope.metadata.index for envelope in envelopes], [0, 10, 20])
+
+    def test_single_payload_regular_event(self):
+        envelopes = self._build_envelopes(build_payloads(11), 10)
+        self.assertIsInstance(envelopes[0], EventEnvelope)
+        self.assertIsInstance(envelopes[1], TestEnvelopeEvent)
+        self.assertEqual(envelopes[1].metadata.index, 10)
+        self.assertEqual(envelopes[1].payload["idx"], 10)
+
+    def test_expansion(self):
+        payloads = build_payloads(25)
+        envelope_ds = [envelope.serialize(machine_metadata=False)
+                       for envelope in self._build_envelopes(payloads, 10, get_created_at=get_created_at)]
+        self.assertTrue(all(is_event_envelope_d(envelope_d) for envelope_d in envelope_ds))
+        event_ds = [without_id(event_d)
+                    for envelope_d in envelope_ds
+                    for event_d in iter_event_envelope_event_ds(envelope_d)]
+        self.assertEqual(event_ds, self._build_event_ds(payloads, get_created_at=get_created_at))
+        self.assertEqual(event_ds[7]["_zentral"]["created_at"], "2020-01-01T00:00:07")
+        self.assertEqual(event_ds[7]["_zentral"]["tags"], ["yolo"])
+
+    def test_expansion_without_created_at(self):
+        payloads = build_payloads(3)
+        envelope_d = self._build_envelopes(payloads, 10)[0].serialize()
+        event_ds = list(iter_event_envelope_event_ds(envelope_d))
+        self.assertEqual([event_d["_zentral"]["index"] for event_d in event_ds], [0, 1, 2])
+        self.assertEqual(len(set(event_d["_zentral"]["created_at"] for event_d in event_ds)), 1)
+        self.assertEqual(len(set(event_d["_zentral"]["id"] for event_d in event_ds)), 1)
+
+    @patch("zentral.core.events.base.event_envelope_max_payloads", 100)
+    @patch("zentral.core.events.base.queues")
+    def test_post_machine_request_payloads(self, queues):
+        TestEnvelopeEvent.post_machine_request_payloads("0123456789", "godzilla", "203.0.113.1",
+                                                        build_payloads(250), get_created_at)
+        self.assertEqual(queues.post_event.call_count, 3)
+        self.assertEqual([len(call_args[0][0].payloads) for call_args in queues.post_event.call_args_list],
+                         [100, 100, 50])
+
+    @patch("zentral.core.events.base.queues")
+    def test_post_machine_request_payloads_without_envelopes(self, queues):
+        TestEnvelopeEvent.post_machine_request_payloads("0123456789", "godzilla", "203.0.113.1",
+                                                        build_payloads(5), get_created_at)
+        self.assertEqual(queues.post_event.call_count, 5)
+
+    def test_enrich_envelope(self):
+        # the probes loaded by enrich_event must not be reused by the other tests
+        all_probes.clear()
+        self.addCleanup(all_probes.clear)
+        payloads = build_payloads(5)
+        envelope_d = self._build_envelopes(payloads, 10)[0].serialize(machine_metadata=False, timing=True)
+        events = list(enrich_event(envelope_d))
+        self.assertEqual(len(events), 5)
+        self.assertEqual([event.payload for event in events], payloads)
+        self.assertEqual([event.metadata.index for event in events], list(range(5)))
+        self.assertTrue(all(event.metadata.request.user_agent == "godzilla" for event in events))
@@ -0,0 +1,77 @@
+from unittest.mock import call, Mock
+from django.test import SimpleTestCase
+from geoip2.errors import AddressNotFoundError
+from geoip2.models import City
+from zentral.core.events import pipeline
+from zentral.core.events.base import EventRequest
+from zentral.core.events.geo import inc_geo_cache_counters
+
+
+class FakeCityDBReader:
+    def __init__(self):
+        self.lookups = []
+
+    def city(self, ip):
+        self.lookups.append(ip)
+        if ip != "1.2.3.4":
+            raise AddressNotFoundError("The address {} is not in the database.".format(ip))
+        return City({"city": {"names": {"en": "Hamburg"}},
+                     "country": {"iso_code": "DE", "names": {"en": "Germany"}},
+                     "location": {"latitude": 53.55, "longitude": 10.0}},
+                    ["en"])
+
+
+class GeoCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        self.saved_city_db_reader = pipeline.city_db_reader
+        pipeline.city_db_reader = self.city_db_reader = FakeCityDBReader()
+        pipeline.geo_cache.clear()
+
+    def tearDown(self):
+        pipeline.city_db_reader = self.saved_city_db_reader
+        pipeline.geo_cache.clear()
+
+    def test_found_ip_cached(self):
+        geo = pipeline.get_geo("1.2.3.4")
+        self.assertEqual(geo.city_name, "Hamburg")
+        self.assertEqual(geo.country_iso_code, "DE")
+        self.assertEqual(geo.location, {"lat": 53.55, "lon": 10.0})
+        self.assertEqual(pipeline.get_geo("1.2.3.4"), geo)
+        self.assertEqual(self.city_db_reader.lookups, ["1.2.3.4"])
+
+    def test_not_found_ip_cached(self):
+        self.assertIsNone(pipeline.get_geo("10.0.0.1"))
+        self.assertIsNone(pipeline.get_geo("10.0.0.1"))
+        self.assertEqual(self.city_db_reader.lookups, ["10.0.0.1"])
+
+    def test_cache_counters(self):
+        hits, misses = pipeline.geo_cache.hits, pipeline.geo_cache.misses
+        for ip in ("1.2.3.4", "10.0.0.1", "1.2.3.4", "10.0.0.1", "1.2.3.4"):
+            pipeline.get_geo(ip)
+        self.assertEqual(pipeline.geo_cache.hits - hits, 3)
+        self.assertEqual(pipeline.geo_cache.misses - misses, 2)
+
+    def test_inc_geo_cache_counters(self):
+        inc_geo_cache_counters(None)
+        metrics_exporter = Mock()
+        # previous lookups
+        inc_geo_cache_counters(metrics_exporter)
+        metrics_exporter.reset_mock()
+        for ip in ("1.2.3.4", "10.0.0.1", "1.2.3.4"):
+            pipeline.get_geo(ip)
+        inc_geo_cache_counters(metrics_exporter)
+        self.assertEqual(metrics_exporter.inc.call_args_list,
+                         [call("geoip2_city_cache_lookups", "hit", value=1),
+                          call("geoip2_city_cache_lookups", "miss", value=2)])
+        # only the new lookups
+        metrics_exporter.reset_mock()
+        pipeline.get_geo("1.2.3.4")
+        inc_geo_cache_counters(metrics_exporter)
+        metrics_exporter.inc.assert_called_once_with("geoip2_city_cache_lookups", "hit", value=1)
+
+    def test_request_geo_cleared_cache(self):
+        pipeline.get_geo("1.2.3.4")
+        pipeline.geo_cache.clear()
+        request = EventRequest(user_agent="godzilla", ip="1.2.3.4", geo=pipeline.get_geo("1.2.3.4"))
+        self.assertEqual(request.serialize()["geo"]["city_name"], "Hamburg")
+        self.assertEqual(self.city_db_reader.lookups, ["1.2.3.4", "1.2.3.4"])
@@ -1,6 +1,9 @@
+from datetime import datetime, timezone
+from django.core.cache import cache
 from django.test import TestCase
 from zentral.contrib.inventory.models import MachineSnapshotCommit
-from zentral.core.events.base import EventMetadata, EventRequest, BaseEvent, register_event_type
+from zentral.core.events.base import (EventMetadata, EventObserver, EventRequest, EventRequestGeo,
+                                      BaseEvent, parse_created_at, register_event_type)
 
 
 class TestEvent3(BaseEvent):
@@ -73,6 +76,14 @@ class EventSerializationTestCase(TestCase):
         event2 = TestEvent3.deserialize(d)
         self.assertEqual(event2.metadata.machine.serial_number, self.ms.serial_number)
 
+    def test_event_with_embedded_machine_metadata(self):
+        d = make_event(with_msn=True).serialize()
+        cache.clear()
+        event2 = TestEvent3.deserialize(d)
+        with self.assertNumQueries(0):
+            d2 = event2.serialize()
+        self.assertEqual(d2["_zentral"]["machine"], d["_zentral"]["machine"])
+
     def test_event_with_request(self):
         event = make_event(ip="10.1.2.3")
         d = event.serialize()
@@ -88,3 +99,43 @@ class EventSerializationTestCase(TestCase):
         d = event.serialize()
         metadata = d["_zentral"]
         self.assertNotIn("request", metadata)
+
+    def test_lazy_deserialization(self):
+        event = make_event(ip="10.1.2.3", ua="YO! ua")
+        event.metadata.observer = EventObserver("godzilla.example.com", "Zentral", "test", None, None)
+        d = event.serialize(machine_metadata=False)
+        event2 = TestEvent3.deserialize(d)
+        # kept serialized
+        self.assertEqual(event2.metadata._created_at, d["_zentral"]["created_at"])
+        self.assertEqual(event2.metadata._request, d["_zentral"]["request"])
+        self.assertEqual(event2.metadata._observer, d["_zentral"]["observer"])
+        # passed through
+        self.assertEqual(event2.serialize(machine_metadata=False), d)
+        # deserialized on first access
+        self.assertEqual(event2.metadata.created_at, event.metadata.created_at)
+        self.assertEqual(event2.metadata.request.ip, "10.1.2.3")
+        self.assertEqual(event2.metadata.observer.hostname, "godzilla.example.com")
+        self.assertIsInstance(event2.metadata._request, EventRequest)
+        event2.metadata.request.geo = EventRequestGeo(city_name="Hamburg")
+        d2 = event2.serialize(machine_metadata=False)
+        self.assertEqual(d2["_zentral"]["request"]["geo"], {"city_name": "Hamburg"})
+        self.assertEqual(d2["_zentral"]["created_at"], d["_zentral"]["created_at"])
+
+    def test_parse_created_at(self):
+        self.assertEqual(parse_created_at("2020-01-02T03:04:05.123456"),
+                         datetime(2020, 1, 2, 3, 4, 5, 123456))
+        self.assertEqual(parse_created_at("2020-01-02T03:04:05"),
+                         datetime(2020, 1, 2, 3, 4, 5))
+        # slow path
+        self.assertEqual(parse_created_at("2020-01-02T03:04:05.123Z"),
+                         datetime(2020, 1, 2, 3, 4, 5, 123000, tzinfo=timezone.utc))
+        # not kept serialized when not deserialized
+        metadata = EventMetadata(TestEvent3.event_type, created_at="2020-01-02 03:04:05")
+        self.assertEqual(metadata.serialize()["created_at"], "2020-01-02T03:04:05")
+
+    def test_metadata_slots(self):
+        event = make_event(ip="10.1.2.3")
+        with self.assertRaises(AttributeError):
+            event.metadata.yolo = 1
+        with self.assertRaises(AttributeError):
+            event.metadata.request.yolo = 1
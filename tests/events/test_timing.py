@@ -0,0 +1,48 @@
+from datetime import datetime, timedelta
+import time
+from django.test import SimpleTestCase
+from zentral.core.events import event_from_event_d
+from zentral.core.events.base import BaseEvent, EventMetadata
+from zentral.core.events.timing import INGESTED, iter_event_d_lags, pop_event_d_timing, stamp_event
+
+
+class EventTimingTestCase(SimpleTestCase):
+    def _build_event(self, created_at=None):
+        return BaseEvent(EventMetadata("base", created_at=created_at), {"yolo": "fomo"})
+
+    def test_stamp_event(self):
+        event = self._build_event()
+        self.assertEqual(event.metadata.timing, {})
+        stamp_event(event, "preprocess")
+        self.assertEqual(set(event.metadata.timing.keys()), {INGESTED, "preprocess"})
+        ingested_at = event.metadata.timing[INGESTED]
+        stamp_event(event, "enrich")
+        self.assertEqual(event.metadata.timing[INGESTED], ingested_at)
+        self.assertTrue(event.metadata.timing["enrich"] >= ingested_at)
+
+    def test_serialization(self):
+        event = self._build_event()
+        stamp_event(event, INGESTED)
+        self.assertNotIn("timing", event.serialize()["_zentral"])
+        event_d = event.serialize(machine_metadata=False, timing=True)
+        self.assertEqual(event_d["_zentral"]["timing"], event.metadata.timing)
+        # kept between the stages
+        self.assertEqual(event_from_event_d(event_d).metadata.timing, event.metadata.timing)
+        # removed before storage
+        self.assertEqual(pop_event_d_timing(event_d), event.metadata.timing)
+        self.assertNotIn("timing", event_d["_zentral"])
+        self.assertEqual(pop_event_d_timing(event_d), {})
+
+    def test_lags(self):
+        event = self._build_event(created_at=datetime.utcnow() - timedelta(seconds=30))
+        now = time.time()
+        event.metadata.timing = {INGESTED: now - 20, "enrich": now - 5}
+        lags = dict(iter_event_d_lags(event.serialize(machine_metadata=False, timing=True)))
+        self.assertAlmostEqual(lags["event_created_lag_seconds"], 30, delta=1)
+        self.assertAlmostEqual(lags["event_ingested_lag_seconds"], 20, delta=1)
+        self.assertAlmostEqual(lags["event_queued_seconds"], 5, delta=1)
+
+    def test_lags_without_timing(self):
+        event_d = self._build_event().serialize(machine_metadata=False)
+        event_d["_zentral"]["created_at"] = event_d["_zentral"]["created_at"][:19]
+        self.assertEqual([name for name, _ in iter_event_d_lags(event_d)], ["event_created_lag_seconds"])
@@ -2,6 +2,7 @@ from django.test import TestCase
 from zentral.contrib.inventory.models import MetaBusinessUnit, Tag
 from zentral.core.events.base import BaseEvent, EventMetadata
 from zentral.core.events.pipeline import enrich_event
+from zentral.core.incidents.cache import open_incident_cache
 from zentral.core.incidents.events import IncidentEvent, MachineIncidentEvent
 from zentral.core.incidents.models import (Incident, MachineIncident,
                                            SEVERITY_CRITICAL,
@@ -29,6 +30,10 @@ class IncidentTestCase(TestCase):
         )
         cls.probe = cls.probe_source.load()
 
+    def setUp(self):
+        # the incidents are rolled back after each test
+        open_incident_cache.clear()
+
     def test_create_open_incident(self):
         event_metadata = EventMetadata(event_type="test")
         event = BaseEvent(event_metadata, {"joe": "jackson"})
@@ -0,0 +1,127 @@
+import time
+import uuid
+from django.test import TestCase
+from zentral.core.incidents.cache import OpenIncidentCache
+from zentral.core.incidents.models import (Incident, MachineIncident,
+                                           SEVERITY_CRITICAL, SEVERITY_MAJOR,
+                                           STATUS_CLOSED, STATUS_IN_PROGRESS, STATUS_OPEN)
+from zentral.core.incidents.sync import OpenIncidentCacheSync
+from zentral.core.incidents.utils import update_incident_status
+from zentral.core.probes.models import ProbeSource
+
+
+class OpenIncidentCacheTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.probe_source = ProbeSource.objects.create(
+            model="BaseProbe",
+            name="base probe",
+            status=ProbeSource.ACTIVE,
+            body={"incident_severity": SEVERITY_MAJOR,
+                  "filters": {"metadata": [{"event_types": ["test"]}]}}
+        )
+
+    def setUp(self):
+        self.cache = OpenIncidentCache(with_sync=False)
+
+    def test_open_incident_hit(self):
+        incident, event_payloads = self.cache.update_or_create_open_incident(self.probe_source, SEVERITY_MAJOR,
+                                                                             uuid.uuid4())
+        self.assertEqual(event_payloads[0]["action"], "created")
+        with self.assertNumQueries(0):
+            incident2, event_payloads = self.cache.update_or_create_open_incident(self.probe_source, SEVERITY_MAJOR,
+                                                                                  uuid.uuid4())
+        self.assertEqual(incident2, incident)
+        self.assertEqual(event_payloads, [])
+
+    def test_open_incident_higher_severity(self):
+        self.cache.update_or_create_open_incident(self.probe_source, SEVERITY_MAJOR, uuid.uuid4())
+        incident, event_payloads = self.cache.update_or_create_open_incident(self.probe_source, SEVERITY_CRITICAL,
+                                                                             uuid.uuid4())
+        self.assertEqual(event_payloads[0]["action"], "updated")
+        self.assertEqual(incident.severity, SEVERITY_CRITICAL)
+        with self.assertNumQueries(0):
+            self.cache.update_or_create_open_incident(self.probe_source, SEVERITY_MAJOR, uuid.uuid4())
+
+    def test_open_incident_invalidation(self):
+        incident, _ = self.cache.update_or_create_open_incident(self.probe_source, SEVERITY_MAJOR, uuid.uuid4())
+        update_incident_status(incident, STATUS_CLOSED)
+        # postgres notification
+        OpenIncidentCacheSync(self.cache).handle_notifications(
+            ['{{"probe_source_id": {}}}'.format(self.probe_source.pk)]
+        )
+        incident2, event_payloads = self.cache.update_or_create_open_incident(self.probe_source, SEVERITY_MAJOR,
+                                                                              uuid.uuid4())
+        self.assertNotEqual(incident2, incident)
+        self.assertEqual(event_payloads[0]["action"], "created")
+        self.assertEqual(Incident.objects.filter(probe_source=self.probe_source).count(), 2)
+
+    def test_clear_notification(self):
+        self.cache.update_or_create_open_incident(self.probe_source, SEVERITY_MAJOR, uuid.uuid4())
+        OpenIncidentCacheSync(self.cache).handle_notifications([""])
+        self.assertEqual(len(self.cache._cache), 0)
+
+    def test_ttl(self):
+        cache = OpenIncidentCache(ttl=0.01, with_sync=False)
+        cache.update_or_create_open_incident(self.probe_source, SEVERITY_MAJOR, uuid.uuid4())
+        time.sleep(0.02)
+        with self.assertNumQueries(3):
+            cache.update_or_create_open_incident(self.probe_source, SEVERITY_MAJOR, uuid.uuid4())
+
+    def test_disabled(self):
+        cache = OpenIncidentCache(ttl=0, with_sync=False)
+        cache.update_or_create_open_incident(self.probe_source, SEVERITY_MAJOR, uuid.uuid4())
+        with self.assertNumQueries(3):
+            cache.update_or_create_open_incident(self.probe_source, SEVERITY_MAJOR, uuid.uuid4())
+        self.assertEqual(len(cache._cache), 0)
+
+    def test_open_machine_incident_hit(self):
+        machine_incident, event_payloads = self.cache.update_or_create_open_machine_incident(
+            self.probe_source, SEVERITY_MAJOR, "YOLOFOMO", uuid.uuid4()
+        )
+        self.assertEqual(len(event_payloads), 2)
+        with self.assertNumQueries(0):
+            machine_incident2, event_payloads = self.cache.update_or_create_open_machine_incident(
+                self.probe_source, SEVERITY_MAJOR, "YOLOFOMO", uuid.uuid4()
+            )
+        self.assertEqual(machine_incident2, machine_incident)
+        self.assertEqual(event_payloads, [])
+        # other machine
+        machine_incident3, event_payloads = self.cache.update_or_create_open_machine_incident(
+            self.probe_source, SEVERITY_MAJOR, "FOMOYOLO", uuid.uuid4()
+        )
+        self.assertEqual(machine_incident3.incident, machine_incident.incident)
+        self.assertEqual([p["action"] for p in event_payloads], ["created"])
+
+    def test_close_machine_incident(self):
+        self.cache.update_or_create_open_machine_incident(self.probe_source, SEVERITY_MAJOR,
+                                                          "YOLOFOMO", uuid.uuid4())
+        machine_incident, event_payloads = self.cache.update_or_create_open_machine_incident(
+            self.probe_source, 0, "YOLOFOMO", uuid.uuid4()
+        )
+        self.assertEqual(machine_incident.status, STATUS_CLOSED)
+        self.assertEqual([p["action"] for p in event_payloads], ["closed", "closed"])
+        # nothing left to close
+        with self.assertNumQueries(0):
+            machine_incident, event_payloads = self.cache.update_or_create_open_machine_incident(
+                self.probe_source, 0, "YOLOFOMO", uuid.uuid4()
+            )
+        self.assertIsNone(machine_incident)
+        self.assertEqual(event_payloads, [])
+
+    def test_machine_incident_in_progress_not_closed(self):
+        machine_incident, _ = self.cache.update_or_create_open_machine_incident(
+            self.probe_source, SEVERITY_MAJOR, "YOLOFOMO", uuid.uuid4()
+        )
+        MachineIncident.objects.filter(pk=machine_incident.pk).update(status=STATUS_IN_PROGRESS)
+        self.cache.invalidate(self.probe_source.pk)
+        self.cache.update_or_create_open_machine_incident(self.probe_source, SEVERITY_MAJOR,
+                                                          "YOLOFOMO", uuid.uuid4())
+        with self.assertNumQueries(0):
+            machine_incident2, event_payloads = self.cache.update_or_create_open_machine_incident(
+                self.probe_source, 0, "YOLOFOMO", uuid.uuid4()
+            )
+        self.assertIsNone(machine_incident2)
+        machine_incident.refresh_from_db()
+        self.assertEqual(machine_incident.status, STATUS_IN_PROGRESS)
+        self.assertEqual(machine_incident.incident.status, STATUS_OPEN)
@@ -0,0 +1,127 @@
+import os
+from unittest.mock import Mock, patch
+import psycopg2
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.utils.crypto import get_random_string
+from zentral.contrib.inventory.cache import (ALL_MACHINES, machine_change_channel,
+                                             ProbeFilteringValuesCache, ProbeFilteringValuesSync)
+from zentral.contrib.inventory.models import (MachineSnapshotCommit, MachineTag,
+                                              MetaBusinessUnit, MetaBusinessUnitTag, MetaMachine, Tag)
+
+
+class MachineChangeNotificationsTestCase(TransactionTestCase):
+    def setUp(self):
+        self.listener = psycopg2.connect(**connection.get_connection_params())
+        self.listener.set_session(autocommit=True)
+        with self.listener.cursor() as cur:
+            cur.execute("LISTEN {}".format(machine_change_channel))
+
+    def tearDown(self):
+        self.listener.close()
+
+    def get_notifications(self):
+        self.listener.poll()
+        payloads = [notify.payload for notify in self.listener.notifies]
+        self.listener.notifies.clear()
+        return payloads
+
+    def test_machine_snapshot_notification(self):
+        serial_number = get_random_string(12)
+        MachineSnapshotCommit.objects.commit_machine_snapshot_tree({
+            "source": {"module": "tests.zentral.io", "name": "Zentral Tests"},
+            "serial_number": serial_number,
+        })
+        self.assertIn(serial_number, self.get_notifications())
+
+    def test_machine_tag_notifications(self):
+        serial_number = get_random_string(12)
+        tag = Tag.objects.create(name=get_random_string(12))
+        machine_tag = MachineTag.objects.create(serial_number=serial_number, tag=tag)
+        self.assertEqual(self.get_notifications(), [serial_number])
+        machine_tag.delete()
+        self.assertEqual(self.get_notifications(), [serial_number])
+
+    def test_meta_business_unit_tag_notification(self):
+        meta_business_unit = MetaBusinessUnit.objects.create(name=get_random_string(12))
+        tag = Tag.objects.create(name=get_random_string(12))
+        MetaBusinessUnitTag.objects.create(meta_business_unit=meta_business_unit, tag=tag)
+        self.assertEqual(self.get_notifications(), [ALL_MACHINES])
+
+
+class ProbeFilteringValuesSyncTestCase(SimpleTestCase):
+    def setUp(self):
+        self.cache = ProbeFilteringValuesCache(10, with_sync=False)
+        self.sync = ProbeFilteringValuesSync(self.cache)
+        self.cache.get("un", lambda: 1)
+        self.cache.get("deux", lambda: 2)
+
+    def test_notification_invalidates_serial_number(self):
+        self.assertTrue(self.sync.handle_notifications(["un", "un", "trois"]))
+        self.assertEqual(self.cache.get("un", lambda: 11), 11)
+        self.assertEqual(self.cache.get("deux", lambda: 22), 2)
+
+    def test_all_machines_notification(self):
+        self.assertTrue(self.sync.handle_notifications(["un", ALL_MACHINES]))
+        self.assertEqual(self.cache.get("un", lambda: 11), 11)
+        self.assertEqual(self.cache.get("deux", lambda: 22), 22)
+
+    def test_error_recovery_clears_cache(self):
+        self.assertTrue(self.sync.handle_error_recovery())
+        self.assertEqual(self.cache.get("deux", lambda: 22), 22)
+
+    def test_cache_gone(self):
+        sync = ProbeFilteringValuesSync(ProbeFilteringValuesCache(10, with_sync=False))
+        self.assertFalse(sync.handle_notifications(["un"]))
+        self.assertFalse(sync.handle_error_recovery())
+
+
+class ProbeFilteringValuesCacheSyncTestCase(SimpleTestCase):
+    @patch("zentral.contrib.inventory.cache.logger")
+    @patch("zentral.contrib.inventory.cache.ProbeFilteringValuesSync")
+    def test_sync_restarted_after_fork(self, sync_cls, logger):
+        cache = ProbeFilteringValuesCache(10, with_sync=True)
+        cache.get("un", lambda: 1)
+        # sync thread of the parent process, not running in the forked process
+        cache.sync = Mock(**{"is_alive.return_value": False})
+        cache._sync_pid = os.getpid() + 1
+        cache.is_active()
+        sync_cls.assert_called_once_with(cache)
+        sync_cls.return_value.start.assert_called_once_with()
+        self.assertEqual(cache._sync_pid, os.getpid())
+        self.assertEqual(cache.get("un", lambda: 11), 11)
+        logger.error.assert_not_called()
+        # same process, running thread
+        cache.is_active()
+        sync_cls.assert_called_once_with(cache)
+
+    @patch("zentral.contrib.inventory.cache.logger")
+    @patch("zentral.contrib.inventory.cache.ProbeFilteringValuesSync")
+    def test_dead_sync_thread_restarted(self, sync_cls, logger):
+        cache = ProbeFilteringValuesCache(10, with_sync=True)
+        cache.sync = Mock(last_heartbeat=None, **{"is_alive.return_value": False})
+        cache._sync_pid = os.getpid()
+        cache.is_active()
+        logger.error.assert_called_once()
+        sync_cls.assert_called_once_with(cache)
+
+
+class CachedProbeFilteringValuesTestCase(TestCase):
+    def test_memoized_and_invalidated(self):
+        serial_number = get_random_string(12)
+        cache = ProbeFilteringValuesCache(10, with_sync=False)
+        with patch("zentral.contrib.inventory.models.probe_filtering_values_cache", cache), \
+             patch.object(cache, "is_active", return_value=True), \
+             patch.object(MetaMachine, "get_probe_filtering_values",
+                          side_effect=[("MACOS", None, {1}, set()), ("MACOS", None, {1}, {2})]) as getter:
+            machine = MetaMachine(serial_number)
+            self.assertEqual(machine.get_cached_probe_filtering_values(), ("MACOS", None, {1}, set()))
+            # memoized on the machine and in the process local cache
+            machine.get_cached_probe_filtering_values()
+            MetaMachine(serial_number).get_cached_probe_filtering_values()
+            self.assertEqual(getter.call_count, 1)
+            # machine change notification
+            ProbeFilteringValuesSync(cache).handle_notifications([serial_number])
+            self.assertEqual(MetaMachine(serial_number).get_cached_probe_filtering_values(),
+                             ("MACOS", None, {1}, {2}))
+            self.assertEqual(getter.call_count, 2)
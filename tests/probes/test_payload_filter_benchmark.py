@@ -0,0 +1,125 @@
+import os
+import timeit
+from unittest import skipUnless
+from django.test import SimpleTestCase
+from zentral.core.probes.base import PayloadFilter
+
+
+# reference implementation, before the payload filters were compiled
+
+
+def legacy_get_flattened_payload_values(payload, attrs):
+    if isinstance(payload, list):
+        for nested_payload in payload:
+            yield from legacy_get_flattened_payload_values(nested_payload, list(attrs))
+    elif isinstance(payload, dict):
+        attr = attrs.pop(0)
+        val = payload.get(attr)
+        if val is None:
+            return
+        if not attrs:
+            if isinstance(val, (set, list)):
+                yield from (str(v) for v in val)
+            else:
+                yield str(val)
+        else:
+            yield from legacy_get_flattened_payload_values(val, attrs)
+
+
+def legacy_test_event_payload(payload_filter, payload):
+    for payload_attribute, operator, filter_value_set in payload_filter.items:
+        payload_value_set = set(legacy_get_flattened_payload_values(payload, payload_attribute.split(".")))
+        common_values = filter_value_set & payload_value_set
+        if operator == PayloadFilter.IN and not common_values:
+            return False
+        if operator == PayloadFilter.NOT_IN and common_values:
+            return False
+    return True
+
+
+OSQUERY_PAYLOAD = {
+    "name": "pack/compliance/processes",
+    "action": "added",
+    "hostIdentifier": "0123456789",
+    "columns": {"pid": "4242", "path": "/usr/local/bin/tool_7", "name": "tool_7", "uid": "501"},
+}
+
+SANTA_PAYLOAD = {
+    "decision": "BLOCK_BINARY",
+    "file_name": "tool_7",
+    "file_path": "/usr/local/bin",
+    "file_sha256": "7" * 64,
+    "file_bundle_id": "io.zentral.tool7",
+    "signing_chain": [{"sha256": "a" * 64, "cn": "Developer ID Application: Zentral"},
+                      {"sha256": "b" * 64, "cn": "Developer ID Certification Authority"},
+                      {"sha256": "c" * 64, "cn": "Apple Root CA"}],
+}
+
+
+def build_payload_filters(attributes, count):
+    payload_filters = []
+    for idx in range(count):
+        payload_filters.append(PayloadFilter([
+            {"attribute": attribute,
+             "operator": PayloadFilter.NOT_IN if idx % 5 == 0 and i == 0 else PayloadFilter.IN,
+             "values": ["value_{}_{}".format(idx, i), "/usr/local/bin/tool_{}".format(idx % 10),
+                        "7" * 64, "a" * 64, "BLOCK_BINARY", "added"]}
+            for i, attribute in enumerate(attributes)
+        ]))
+    return payload_filters
+
+
+def legacy_test_payloads(payload_filters, payload):
+    return [legacy_test_event_payload(payload_filter, payload) for payload_filter in payload_filters]
+
+
+def compiled_test_payloads(payload_filters, payload):
+    # one cache per event, shared by all the payload filters
+    flattened_payload_values = {}
+    return [payload_filter.test_event_payload(payload, flattened_payload_values)
+            for payload_filter in payload_filters]
+
+
+OSQUERY_ATTRIBUTES = ["columns.path", "action"]
+SANTA_ATTRIBUTES = ["file_sha256", "signing_chain.sha256", "decision"]
+
+
+class PayloadFilterTestCase(SimpleTestCase):
+    probe_count = 50
+
+    def test_osquery_payload(self):
+        payload_filters = build_payload_filters(OSQUERY_ATTRIBUTES, self.probe_count)
+        self.assertEqual(compiled_test_payloads(payload_filters, OSQUERY_PAYLOAD),
+                         legacy_test_payloads(payload_filters, OSQUERY_PAYLOAD))
+
+    def test_santa_payload(self):
+        payload_filters = build_payload_filters(SANTA_ATTRIBUTES, self.probe_count)
+        self.assertEqual(compiled_test_payloads(payload_filters, SANTA_PAYLOAD),
+                         legacy_test_payloads(payload_filters, SANTA_PAYLOAD))
+
+    def test_results_without_cache(self):
+        for payload, attributes in ((OSQUERY_PAYLOAD, ["columns.path", "action"]),
+                                    (SANTA_PAYLOAD, ["signing_chain.sha256", "decision"])):
+            for payload_filter in build_payload_filters(attributes, 10):
+                self.assertEqual(payload_filter.test_event_payload(payload),
+                                 legacy_test_event_payload(payload_filter, payload))
+
+
+# wall-clock comparisons, not reliable on loaded CI runners
+@skipUnless(os.environ.get("ZENTRAL_BENCHMARKS"), "set ZENTRAL_BENCHMARKS=1 to run the benchmarks")
+class PayloadFilterBenchmarkTestCase(SimpleTestCase):
+    probe_count = 50
+    number = 200
+
+    def _compare(self, payload, payload_filters):
+        legacy_duration = min(timeit.repeat(lambda: legacy_test_payloads(payload_filters, payload),
+                                            number=self.number, repeat=3))
+        compiled_duration = min(timeit.repeat(lambda: compiled_test_payloads(payload_filters, payload),
+                                              number=self.number, repeat=3))
+        self.assertLess(compiled_duration, legacy_duration)
+
+    def test_osquery_payload(self):
+        self._compare(OSQUERY_PAYLOAD, build_payload_filters(OSQUERY_ATTRIBUTES, self.probe_count))
+
+    def test_santa_payload(self):
+        self._compare(SANTA_PAYLOAD, build_payload_filters(SANTA_ATTRIBUTES, self.probe_count))
@@ -0,0 +1,70 @@
+from django.test import TestCase
+from zentral.core.events.base import BaseEvent, EventMetadata
+from zentral.core.probes.conf import all_probes, ProbeEventIndex
+from zentral.core.probes.models import ProbeSource
+
+
+class ProbeEventIndexTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        def create_probe_source(name, metadata_filters=None):
+            body = {}
+            if metadata_filters is not None:
+                body["filters"] = {"metadata": metadata_filters}
+            return ProbeSource.objects.create(model="BaseProbe", name=name,
+                                              status=ProbeSource.ACTIVE, body=body)
+        cls.probe_sources = {
+            "all": create_probe_source("1 all events"),
+            "type": create_probe_source("2 event type", [{"event_types": ["zentral_command"]}]),
+            "tag": create_probe_source("3 event tag", [{"event_tags": ["heartbeat"]}]),
+            "type_and_tag": create_probe_source("4 event type and tag",
+                                                [{"event_types": ["base"], "event_tags": ["yolo"]}]),
+            "type_or_tag": create_probe_source("5 event type or tag",
+                                               [{"event_types": ["zentral_command"]}, {"event_tags": ["yolo"]}]),
+            "inactive": ProbeSource.objects.create(model="BaseProbe", name="6 inactive",
+                                                   status=ProbeSource.INACTIVE, body={}),
+        }
+
+    def setUp(self):
+        all_probes.clear()
+
+    def _build_event(self, event_type, tags):
+        return BaseEvent(EventMetadata(event_type, tags=tags), {})
+
+    def _probe_names(self, probes):
+        return [probe.name for probe in probes]
+
+    def test_index_buckets(self):
+        index = ProbeEventIndex(list(all_probes))
+        self.assertEqual(self._probe_names(p for _, p in index.unfiltered), ["1 all events"])
+        self.assertEqual(sorted(index.by_event_type.keys()), ["base", "zentral_command"])
+        self.assertEqual(sorted(index.by_event_tag.keys()), ["heartbeat", "yolo"])
+        self.assertEqual(self._probe_names(p for _, p in index.by_event_type["zentral_command"]),
+                         ["2 event type", "5 event type or tag"])
+
+    def test_candidates(self):
+        index = ProbeEventIndex(list(all_probes))
+        self.assertEqual(self._probe_names(index.candidates(self._build_event("base", ["yolo"]))),
+                         ["1 all events", "4 event type and tag", "5 event type or tag"])
+        self.assertEqual(self._probe_names(index.candidates(self._build_event("zentral_command", ["heartbeat"]))),
+                         ["1 all events", "2 event type", "3 event tag", "5 event type or tag"])
+
+    def test_event_filtered(self):
+        for event_type, tags, result in (("base", [], ["1 all events"]),
+                                         ("base", ["yolo"],
+                                          ["1 all events", "4 event type and tag", "5 event type or tag"]),
+                                         ("zentral_command", ["yolo"],
+                                          ["1 all events", "2 event type", "5 event type or tag"]),
+                                         ("zentral_command", ["heartbeat"],
+                                          ["1 all events", "2 event type", "3 event tag", "5 event type or tag"])):
+            event = self._build_event(event_type, tags)
+            self.assertEqual(self._probe_names(all_probes.event_filtered(event)), result)
+
+    def test_event_filtered_after_clear(self):
+        event = self._build_event("base", ["heartbeat"])
+        self.assertEqual(self._probe_names(all_probes.event_filtered(event)), ["1 all events", "3 event tag"])
+        probe_source = self.probe_sources["tag"]
+        probe_source.status = ProbeSource.INACTIVE
+        probe_source.save()
+        all_probes.clear()
+        self.assertEqual(self._probe_names(all_probes.event_filtered(event)), ["1 all events"])
@@ -0,0 +1,84 @@
+import json
+from django.test import TestCase
+from zentral.core.probes.conf import ProbeList
+from zentral.core.probes.models import ProbeSource
+from zentral.core.probes.sync import ProbeViewSync, PROBE_DELETE, PROBE_UPSERT
+
+
+class ProbeViewSyncTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.probe_sources = [
+            ProbeSource.objects.create(model="BaseProbe", name="{} probe".format(i),
+                                       status=ProbeSource.ACTIVE, body={})
+            for i in (1, 3, 5)
+        ]
+
+    def setUp(self):
+        self.probes = ProbeList()
+        self.child = self.probes.filter(lambda p: p.name != "4 probe")
+
+    def _probe_names(self, probe_view):
+        return [probe.name for probe in probe_view]
+
+    def test_parse_payloads(self):
+        self.assertEqual(ProbeViewSync._parse_payloads([json.dumps({"id": 1, "action": PROBE_UPSERT}),
+                                                        json.dumps({"id": 2, "action": PROBE_UPSERT}),
+                                                        json.dumps({"id": 1, "action": PROBE_DELETE})]),
+                         {1: PROBE_DELETE, 2: PROBE_UPSERT})
+        self.assertIsNone(ProbeViewSync._parse_payloads([json.dumps({"id": 1, "action": PROBE_UPSERT}), ""]))
+        self.assertIsNone(ProbeViewSync._parse_payloads([json.dumps({"id": 1, "action": "yolo"})]))
+
+    def test_upsert(self):
+        self.assertEqual(self._probe_names(self.child), ["1 probe", "3 probe", "5 probe"])
+        new_probe_source = ProbeSource.objects.create(model="BaseProbe", name="2 probe",
+                                                      status=ProbeSource.ACTIVE, body={})
+        filtered_probe_source = ProbeSource.objects.create(model="BaseProbe", name="4 probe",
+                                                           status=ProbeSource.ACTIVE, body={})
+        updated_probe_source = self.probe_sources[2]
+        updated_probe_source.name = "0 probe"
+        updated_probe_source.save()
+        with self.assertNumQueries(1):
+            self.probes.update_probes({new_probe_source.pk: PROBE_UPSERT,
+                                       filtered_probe_source.pk: PROBE_UPSERT,
+                                       updated_probe_source.pk: PROBE_UPSERT})
+        with self.assertNumQueries(0):
+            self.assertEqual(self._probe_names(self.probes),
+                             ["0 probe", "1 probe", "2 probe", "3 probe", "4 probe"])
+            self.assertEqual(self._probe_names(self.child),
+                             ["0 probe", "1 probe", "2 probe", "3 probe"])
+
+    def test_deactivate(self):
+        self.assertEqual(len(self.child), 3)
+        probe_source = self.probe_sources[1]
+        probe_source.status = ProbeSource.INACTIVE
+        probe_source.save()
+        self.probes.update_probes({probe_source.pk: PROBE_UPSERT})
+        with self.assertNumQueries(0):
+            self.assertEqual(self._probe_names(self.child), ["1 probe", "5 probe"])
+
+    def test_delete(self):
+        self.assertEqual(len(self.child), 3)
+        probe_source = self.probe_sources[0]
+        pk = probe_source.pk
+        probe_source.delete()
+        with self.assertNumQueries(0):
+            self.probes.update_probes({pk: PROBE_DELETE})
+            self.assertEqual(self._probe_names(self.probes), ["3 probe", "5 probe"])
+            self.assertEqual(self._probe_names(self.child), ["3 probe", "5 probe"])
+
+    def test_event_index_rebuilt(self):
+        self.probes._load()
+        self.probes._event_index = object()
+        self.probes.update_probes({self.probe_sources[0].pk: PROBE_DELETE})
+        self.assertIsNone(self.probes._event_index)
+
+    def test_not_loaded(self):
+        with self.assertNumQueries(1):
+            self.probes.update_probes({self.probe_sources[0].pk: PROBE_UPSERT})
+        self.assertIsNone(self.probes._probes)
+        self.assertEqual(len(self.probes), 3)
+
+    def test_child_update(self):
+        with self.assertRaises(ValueError):
+            self.child.update_probes({self.probe_sources[0].pk: PROBE_DELETE})
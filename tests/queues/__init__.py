@@ -0,0 +1,36 @@
+from zentral.core.stores.backends.base import BaseEventStore, get_event_key
+
+
+def build_event_d(idx):
+    return {"_zentral": {"id": "0c9a5d0e-6a55-4a3f-9c3b-1f5d2e7c8b{:02d}".format(idx % 100),
+                         "index": idx,
+                         "type": "base"},
+            "idx": idx}
+
+
+class FailingEventStore(BaseEventStore):
+    """Event store stub. Unavailable, or rejecting some events."""
+    max_batch_size = 10
+
+    def __init__(self, config_d):
+        super().__init__(config_d)
+        self.stored_event_ds = []
+        self.unavailable = False
+        self.rejected_idxs = set()
+
+    def _check_event(self, event):
+        if self.unavailable:
+            raise ConnectionRefusedError("yolo")
+        if not isinstance(event, dict):
+            event = event.serialize(machine_metadata=False)
+        if event["idx"] in self.rejected_idxs:
+            raise ValueError("fomo")
+        return event
+
+    def store(self, event):
+        self.stored_event_ds.append(self._check_event(event))
+
+    def bulk_store(self, events):
+        event_ds = [self._check_event(event) for event in events]
+        self.stored_event_ds.extend(event_ds)
+        return [get_event_key(event_d) for event_d in event_ds]
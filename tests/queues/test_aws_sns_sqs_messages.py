@@ -0,0 +1,112 @@
+import queue
+import threading
+import time
+from unittest.mock import patch
+from django.test import SimpleTestCase
+from zentral.core.queues.backends.aws_sns_sqs.message import (CONTENT_ENCODING_ATTRIBUTE, MAX_PAYLOAD_SIZE,
+                                                              MessageDecodingError,
+                                                              decode_message, encode_message)
+from zentral.core.queues.backends.aws_sns_sqs.sqs import BatchSendThread
+
+
+def build_event_d(idx, size=10):
+    return {"_zentral": {"id": "f9fd4ab9-b1e5-4cd5-8b7e-24ebc6d2c2{:02d}".format(idx % 100),
+                         "index": idx,
+                         "type": "osquery_result"},
+            "columns": {"path": "/usr/local/bin/tool_{}".format(idx) * size}}
+
+
+class RecordingBatchSendThread(BatchSendThread):
+    def __init__(self, *args, **kwargs):
+        self.batches = []
+        super().__init__(*args, **kwargs)
+
+    def build_entry(self, entry_id, body, message_attributes):
+        return {"Id": entry_id, "Message": body, "MessageAttributes": message_attributes}
+
+    def send_entries(self, entries):
+        self.batches.append(list(entries.values()))
+
+
+class AWSSNSSQSMessageTestCase(SimpleTestCase):
+    def test_encode_decode(self):
+        event_d = build_event_d(1)
+        body, message_attributes = encode_message("yolo", event_d, compression_threshold=2**20)
+        self.assertNotIn(CONTENT_ENCODING_ATTRIBUTE, message_attributes)
+        self.assertEqual(decode_message({"Body": body, "MessageAttributes": message_attributes}),
+                         ("yolo", event_d))
+
+    def test_encode_decode_compressed(self):
+        event_d = build_event_d(2, size=1000)
+        uncompressed_body, _ = encode_message(None, event_d)
+        body, message_attributes = encode_message(None, event_d, compression_threshold=1024)
+        self.assertEqual(message_attributes[CONTENT_ENCODING_ATTRIBUTE]["StringValue"], "zlib+base64")
+        self.assertLess(len(body), len(uncompressed_body) / 10)
+        self.assertEqual(decode_message({"Body": body, "MessageAttributes": message_attributes}),
+                         (None, event_d))
+
+    def test_decode_errors(self):
+        with self.assertRaises(MessageDecodingError):
+            decode_message({"Body": "{"})
+        body, message_attributes = encode_message(None, build_event_d(3))
+        message_attributes[CONTENT_ENCODING_ATTRIBUTE] = {"DataType": "String", "StringValue": "yolo"}
+        with self.assertRaises(MessageDecodingError):
+            decode_message({"Body": body, "MessageAttributes": message_attributes})
+        message_attributes[CONTENT_ENCODING_ATTRIBUTE]["StringValue"] = "zlib+base64"
+        with self.assertRaises(MessageDecodingError):
+            decode_message({"Body": body, "MessageAttributes": message_attributes})
+
+
+class AWSSNSSQSBatchSendThreadTestCase(SimpleTestCase):
+    def _run_thread(self, event_ds, **kwargs):
+        stop_event = threading.Event()
+        in_queue = queue.Queue()
+        thread = RecordingBatchSendThread(stop_event, in_queue, **kwargs)
+        for idx, event_d in enumerate(event_ds):
+            in_queue.put(("routing_key_{}".format(idx), event_d, time.time()))
+        thread.start()
+        stop_event.set()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+        return thread.batches
+
+    def _decoded_batches(self, batches):
+        return [[decode_message({"Body": entry["Message"], "MessageAttributes": entry["MessageAttributes"]})
+                 for entry in batch]
+                for batch in batches]
+
+    def test_max_number_of_messages(self):
+        event_ds = [build_event_d(idx) for idx in range(25)]
+        batches = self._decoded_batches(self._run_thread(event_ds))
+        self.assertEqual([len(batch) for batch in batches], [10, 10, 5])
+        self.assertEqual([event_d for batch in batches for _, event_d in batch], event_ds)
+        self.assertEqual(batches[0][3][0], "routing_key_3")
+
+    def test_max_payload_size(self):
+        # ~100KB each
+        event_ds = [build_event_d(idx, size=5000) for idx in range(5)]
+        batches = self._run_thread(event_ds)
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        # compressed
+        batches = self._run_thread(event_ds, compression_threshold=1024)
+        self.assertEqual([len(batch) for batch in batches], [5])
+
+    @patch("zentral.core.queues.backends.aws_sns_sqs.sqs.save_dead_letter")
+    def test_message_too_large(self, save_dead_letter):
+        event_d = build_event_d(1, size=MAX_PAYLOAD_SIZE // 20)
+        batches = self._run_thread([build_event_d(0), event_d, build_event_d(2)])
+        self.assertEqual([len(batch) for batch in batches], [2])
+        save_dead_letter.assert_called_once_with(event_d, "event too large")
+
+    def test_batch_delay(self):
+        stop_event = threading.Event()
+        in_queue = queue.Queue()
+        thread = RecordingBatchSendThread(stop_event, in_queue, batch_delay=0.1)
+        thread.start()
+        in_queue.put((None, build_event_d(0), time.time()))
+        time.sleep(0.5)
+        # sent before the stop
+        self.assertEqual(len(thread.batches), 1)
+        stop_event.set()
+        thread.join(5)
+        self.assertEqual(len(thread.batches), 1)
@@ -0,0 +1,106 @@
+import shutil
+import tempfile
+import threading
+import time
+from unittest.mock import patch
+from django.test import SimpleTestCase
+from zentral.core.queues.publisher import BackgroundPublisher
+
+
+class Broker(object):
+    def __init__(self):
+        self.batches = []
+        self.available = True
+        self.lock = threading.Lock()
+
+    def publish_batch(self, batch):
+        with self.lock:
+            if not self.available:
+                raise ConnectionError("broker down")
+            self.batches.append([tuple(message) for message in batch])
+
+    @property
+    def messages(self):
+        with self.lock:
+            return [message for batch in self.batches for message in batch]
+
+
+def build_message(idx):
+    return ("events", None, {"_zentral": {"id": "d6d3e4c9-9f4e-4c5d-8b3b-2c8a1e6b41{:02d}".format(idx % 100),
+                                          "index": idx}})
+
+
+class BackgroundPublisherTestCase(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.broker = Broker()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _get_publisher(self, **kwargs):
+        kwargs.setdefault("spill_log_directory", self.directory)
+        return BackgroundPublisher("test events", self.broker.publish_batch, **kwargs)
+
+    def _wait_for(self, func, timeout=5):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if func():
+                return True
+            time.sleep(0.01)
+        return False
+
+    def test_publish_batches(self):
+        publisher = self._get_publisher(max_batch_size=10, batch_delay=0.2)
+        messages = [build_message(idx) for idx in range(25)]
+        for message in messages:
+            publisher.publish(message)
+        self.assertTrue(self._wait_for(lambda: len(self.broker.messages) == 25))
+        self.assertEqual(self.broker.messages, messages)
+        self.assertEqual([len(batch) for batch in self.broker.batches], [10, 10, 5])
+        publisher.stop()
+
+    def test_stop_flush(self):
+        publisher = self._get_publisher(batch_delay=10)
+        publisher.publish(build_message(0))
+        publisher.stop()
+        self.assertEqual(self.broker.messages, [build_message(0)])
+
+    def test_broker_outage_spill_replay(self):
+        publisher = self._get_publisher(failure_threshold=1, retry_delay=0.1, batch_delay=0)
+        self.broker.available = False
+        for idx in range(5):
+            publisher.publish(build_message(idx))
+        self.assertTrue(self._wait_for(lambda: not publisher._spill_log.is_empty()
+                                       and publisher._buffer.empty()))
+        self.assertEqual(self.broker.messages, [])
+        self.broker.available = True
+        publisher.publish(build_message(5))
+        self.assertTrue(self._wait_for(lambda: len(self.broker.messages) == 6))
+        self.assertEqual(sorted(self.broker.messages, key=lambda m: m[2]["_zentral"]["index"]),
+                         [build_message(idx) for idx in range(6)])
+        self.assertTrue(self._wait_for(lambda: publisher._spill_log.is_empty()))
+        publisher.stop()
+
+    def test_buffer_full_spill(self):
+        self.broker.available = False
+        publisher = self._get_publisher(max_buffer_size=1, enqueue_timeout=0, failure_threshold=1, retry_delay=60)
+        for idx in range(20):
+            publisher.publish(build_message(idx))
+        publisher.stop()
+        self.assertEqual(self.broker.messages, [])
+        # replayed by the next publisher
+        self.broker.available = True
+        publisher = self._get_publisher()
+        publisher.publish(build_message(20))
+        self.assertTrue(self._wait_for(lambda: len(self.broker.messages) == 21))
+        publisher.stop()
+
+    @patch("zentral.core.queues.publisher.save_dead_letter")
+    def test_no_spill_log_dead_letter(self, save_dead_letter):
+        self.broker.available = False
+        publisher = self._get_publisher(spill_log_directory=None, failure_threshold=1, batch_delay=0)
+        publisher.publish(build_message(0))
+        self.assertTrue(self._wait_for(lambda: save_dead_letter.called))
+        save_dead_letter.assert_called_once_with([build_message(0)], "test events publisher")
+        publisher.stop()
@@ -0,0 +1,106 @@
+from concurrent.futures import Future
+from unittest.mock import Mock, patch
+from django.test import SimpleTestCase
+from google.cloud.pubsub_v1.subscriber.scheduler import ThreadScheduler
+from zentral.core.queues.backends.google_pubsub import ack_when_published, EventQueues, StoreWorker
+
+
+def done_future(exception=None):
+    future = Future()
+    if exception:
+        future.set_exception(exception)
+    else:
+        future.set_result("message id")
+    return future
+
+
+class GooglePubSubAckTestCase(SimpleTestCase):
+    def test_no_futures(self):
+        message = Mock()
+        ack_when_published(message, [])
+        message.ack.assert_called_once_with()
+        message.nack.assert_not_called()
+
+    def test_done_futures(self):
+        message = Mock()
+        ack_when_published(message, [done_future(), done_future()])
+        message.ack.assert_called_once_with()
+        message.nack.assert_not_called()
+
+    def test_pending_futures(self):
+        message = Mock()
+        futures = [done_future(), Future(), Future()]
+        ack_when_published(message, futures)
+        futures[1].set_result("message id")
+        message.ack.assert_not_called()
+        futures[2].set_result("message id")
+        message.ack.assert_called_once_with()
+        message.nack.assert_not_called()
+
+    def test_one_failed_future(self):
+        message = Mock()
+        futures = [Future(), done_future(ValueError("yolo")), Future()]
+        ack_when_published(message, futures)
+        futures[0].set_result("message id")
+        message.nack.assert_not_called()
+        futures[2].set_result("message id")
+        message.nack.assert_called_once_with()
+        message.ack.assert_not_called()
+
+    def test_all_failed_futures(self):
+        message = Mock()
+        ack_when_published(message, [done_future(ValueError("yolo")), done_future(ValueError("fomo"))])
+        message.nack.assert_called_once_with()
+        message.ack.assert_not_called()
+
+
+class GooglePubSubSettingsTestCase(SimpleTestCase):
+    def get_event_queues(self, **config):
+        config_d = {"topics": {"raw_events": "projects/yolo/topics/raw-events",
+                               "events": "projects/yolo/topics/events",
+                               "enriched_events": "projects/yolo/topics/enriched-events"}}
+        config_d.update(config)
+        return EventQueues(config_d)
+
+    def test_default_subscriber_settings(self):
+        event_queues = self.get_event_queues()
+        self.assertEqual(event_queues._get_subscriber_settings("store"), {})
+        worker = event_queues.get_store_worker(Mock())
+        self.assertEqual(worker.get_subscribe_kwargs(), {})
+
+    def test_worker_subscriber_settings_merge(self):
+        event_queues = self.get_event_queues(
+            flow_control={"max_messages": 100, "max_bytes": 2**20},
+            callback_threads=4,
+            workers={"store": {"flow_control": {"max_messages": 1000}},
+                     "enrich": {"callback_threads": 8}}
+        )
+        self.assertEqual(event_queues._get_subscriber_settings("preprocess"),
+                         {"flow_control": {"max_messages": 100, "max_bytes": 2**20}, "callback_threads": 4})
+        self.assertEqual(event_queues._get_subscriber_settings("enrich"),
+                         {"flow_control": {"max_messages": 100, "max_bytes": 2**20}, "callback_threads": 8})
+        # the worker flow control replaces the global one
+        self.assertEqual(event_queues._get_subscriber_settings("store"),
+                         {"flow_control": {"max_messages": 1000}, "callback_threads": 4})
+        # copies
+        event_queues._get_subscriber_settings("process")["flow_control"]["max_messages"] = 1
+        self.assertEqual(event_queues.subscriber_settings["flow_control"]["max_messages"], 100)
+
+    def test_subscribe_kwargs(self):
+        worker = StoreWorker("projects/yolo/topics/enriched-events", None, Mock(),
+                             {"flow_control": {"max_messages": 1000}, "callback_threads": 2})
+        subscribe_kwargs = worker.get_subscribe_kwargs()
+        self.assertEqual(subscribe_kwargs["flow_control"].max_messages, 1000)
+        self.assertIsInstance(subscribe_kwargs["scheduler"], ThreadScheduler)
+        subscribe_kwargs["scheduler"].shutdown()
+
+    def test_publisher_client(self):
+        event_queues = self.get_event_queues(batch_settings={"max_messages": 500})
+        with patch("zentral.core.queues.backends.google_pubsub.get_publisher_client") as get_publisher_client:
+            event_queues.post_raw_event("yolo", {"un": 1})
+            event_queues.post_raw_event("yolo", {"deux": 2})
+        get_publisher_client.assert_called_once_with(None, {"max_messages": 500})
+        publisher_client = get_publisher_client.return_value
+        self.assertEqual(publisher_client.publish.call_count, 2)
+        publisher_client.publish.assert_called_with("projects/yolo/topics/raw-events", b'{"deux": 2}',
+                                                    routing_key="yolo")
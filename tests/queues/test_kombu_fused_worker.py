@@ -0,0 +1,176 @@
+import shutil
+import tempfile
+from unittest.mock import Mock, patch
+from django.test import SimpleTestCase
+from kombu import Connection
+from zentral.core.events import event_from_event_d
+from zentral.core.queues.backends.kombu import (EventQueues, FusedWorker, PreprocessWorker, ProcessWorker,
+                                                get_store_events_queue, get_store_worker_name,
+                                                process_events_queue)
+from zentral.core.stores.spill import CircuitBreaker
+from . import build_event_d, FailingEventStore
+
+
+def enrich_event(event_d):
+    if event_d["idx"] < 0:
+        raise ValueError("yolo")
+    yield event_from_event_d(event_d)
+
+
+def build_message():
+    return Mock(name="message")
+
+
+@patch("zentral.core.queues.backends.kombu.save_dead_letter")
+class KombuFusedWorkerTestCase(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.connection = Connection("memory://")
+        self.process_event = Mock()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        self.connection.release()
+
+    def _get_event_store(self, name, batch_size=1):
+        return FailingEventStore({"store_name": name,
+                                  "batch_size": batch_size,
+                                  "spill_log": {"directory": self.directory,
+                                                "failure_threshold": 1,
+                                                "retry_delay": 60}})
+
+    def _get_worker(self, event_stores, unfused_stages=None, **high_throughput_settings):
+        worker = FusedWorker(self.connection, enrich_event, self.process_event, event_stores,
+                             [PreprocessWorker.name] + (unfused_stages or []), high_throughput_settings)
+        worker.setup_metrics_exporter()
+        for store_writer in worker.store_writers:
+            store_writer.open_spill_log()
+            self.addCleanup(store_writer.spill_log.close)
+        self.addCleanup(worker.producer_connection.release)
+        return worker
+
+    def _add_events(self, worker, idxs):
+        messages = []
+        for idx in idxs:
+            message = build_message()
+            worker.do_add_event_to_batch(build_event_d(idx), message)
+            messages.append(message)
+        return messages
+
+    def _get_published_idxs(self, queue):
+        idxs = []
+        with Connection("memory://") as connection:
+            simple_queue = connection.SimpleQueue(queue)
+            while True:
+                try:
+                    message = simple_queue.get(block=False)
+                except simple_queue.Empty:
+                    break
+                idxs.append(message.payload["idx"])
+                message.ack()
+            simple_queue.close()
+        return idxs
+
+    def _stored_idxs(self, event_store):
+        return [event_d["idx"] for event_d in event_store.stored_event_ds]
+
+    def test_fused_steps(self, save_dead_letter):
+        event_store = self._get_event_store("fused yolo")
+        worker = self._get_worker([event_store])
+        self.assertFalse(worker.replaces(PreprocessWorker(self.connection)))
+        self.assertEqual(worker.batch_size, 1)
+        messages = self._add_events(worker, [0, 1])
+        # enrich → process → store, in the same process
+        self.assertEqual([call[0][0].payload["idx"] for call in self.process_event.call_args_list], [0, 1])
+        self.assertEqual(self._stored_idxs(event_store), [0, 1])
+        for message in messages:
+            message.ack.assert_called_once_with()
+        self.assertEqual(worker.output_queues, [])
+        save_dead_letter.assert_not_called()
+
+    def test_batch(self, save_dead_letter):
+        event_store = self._get_event_store("fused batch", batch_size=3)
+        worker = self._get_worker([event_store, self._get_event_store("fused single")], ack_batch_size=10)
+        self.assertEqual(worker.batch_size, 3)
+        messages = self._add_events(worker, [0, 1])
+        self.assertEqual(event_store.stored_event_ds, [])
+        self._add_events(worker, [2])
+        self.assertEqual(self._stored_idxs(event_store), [0, 1, 2])
+        # batched acks
+        self.assertEqual(len(worker.pending_acks), 3)
+        for message in messages:
+            message.ack.assert_not_called()
+
+    def test_publish_to_unfused_queues(self, save_dead_letter):
+        fused_event_store = self._get_event_store("fused fomo")
+        unfused_event_store = self._get_event_store("unfused fomo")
+        store_worker_name = get_store_worker_name(unfused_event_store)
+        worker = self._get_worker([fused_event_store, unfused_event_store],
+                                  [ProcessWorker.name, store_worker_name])
+        self.assertTrue(worker.replaces(Mock(name="enrich worker")))
+        self.assertFalse(worker.replaces(ProcessWorker(self.connection, Mock())))
+        self._add_events(worker, [0, 1, 2])
+        self.process_event.assert_not_called()
+        self.assertEqual(self._stored_idxs(fused_event_store), [0, 1, 2])
+        self.assertEqual(unfused_event_store.stored_event_ds, [])
+        self.assertEqual(self._get_published_idxs(process_events_queue), [0, 1, 2])
+        self.assertEqual(self._get_published_idxs(get_store_events_queue(unfused_event_store)), [0, 1, 2])
+        # the queues are only declared once
+        self.assertEqual(worker.declared_entities,
+                         {("Queue", process_events_queue.name),
+                          ("Queue", get_store_events_queue(unfused_event_store).name)})
+
+    @patch("zentral.core.queues.backends.kombu.time.sleep")
+    def test_enrich_failure_requeue(self, sleep, save_dead_letter):
+        event_store = self._get_event_store("fused requeue", batch_size=3)
+        worker = self._get_worker([event_store])
+        messages = self._add_events(worker, [0, -1, 2])
+        messages[1].requeue.assert_called_once_with()
+        messages[1].ack.assert_not_called()
+        for message in (messages[0], messages[2]):
+            message.ack.assert_called_once_with()
+            message.requeue.assert_not_called()
+        self.assertEqual(self._stored_idxs(event_store), [0, 2])
+        sleep.assert_called_once_with(1)
+
+    def test_store_rejection_dead_letter(self, save_dead_letter):
+        event_store = self._get_event_store("fused rejection", batch_size=3)
+        event_store.rejected_idxs = {1}
+        worker = self._get_worker([event_store])
+        messages = self._add_events(worker, [0, 1, 2])
+        for message in messages:
+            message.ack.assert_called_once_with()
+        self.assertEqual(self._stored_idxs(event_store), [0, 2])
+        save_dead_letter.assert_called_once()
+        self.assertEqual(save_dead_letter.call_args[0][0]["idx"], 1)
+        self.assertEqual(save_dead_letter.call_args[0][1], "event store fused rejection error")
+        store_writer = worker.store_writers[0]
+        self.assertTrue(store_writer.spill_log.is_empty())
+        self.assertTrue(store_writer.circuit_breaker.is_closed())
+
+    def test_store_unavailable_spill_and_replay(self, save_dead_letter):
+        event_store = self._get_event_store("fused outage")
+        worker = self._get_worker([event_store])
+        event_store.unavailable = True
+        messages = self._add_events(worker, [0, 1])
+        for message in messages:
+            message.ack.assert_called_once_with()
+        store_writer = worker.store_writers[0]
+        self.assertEqual(store_writer.circuit_breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(store_writer.spill_log.is_empty())
+        # replayed once the store is back
+        event_store.unavailable = False
+        store_writer.circuit_breaker.opened_at -= 60
+        worker.on_iteration()
+        self.assertEqual(self._stored_idxs(event_store), [0, 1])
+        self.assertTrue(store_writer.spill_log.is_empty())
+        save_dead_letter.assert_not_called()
+
+    def test_event_queues_fused_worker(self, save_dead_letter):
+        event_queues = EventQueues({"backend_url": "memory://",
+                                    "fused_worker": {"unfused_stages": [ProcessWorker.name]},
+                                    "high_throughput": {"prefetch_count": 20}})
+        worker = event_queues.get_fused_worker(enrich_event, self.process_event, [])
+        self.assertEqual(worker.prefetch_count, 20)
+        self.assertEqual(worker.output_queues, [(ProcessWorker.name, process_events_queue)])
+        self.assertIsNone(EventQueues({"backend_url": "memory://"}).get_fused_worker(enrich_event, Mock(), []))
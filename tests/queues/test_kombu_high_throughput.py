@@ -0,0 +1,124 @@
+import signal
+import socket
+import time
+from unittest.mock import Mock, patch
+from django.test import SimpleTestCase
+from kombu import Connection
+from kombu.mixins import ConsumerMixin
+from zentral.core.queues.backends.kombu import EventQueues, ProcessWorker
+
+
+def build_message():
+    return Mock(name="message")
+
+
+class KombuHighThroughputTestCase(SimpleTestCase):
+    def _get_worker(self, multiple_acks=False, **settings):
+        worker = ProcessWorker(Connection("memory://"), Mock(), settings)
+        worker.multiple_acks = multiple_acks
+        return worker
+
+    def test_default_settings(self):
+        worker = self._get_worker()
+        self.assertIsNone(worker.prefetch_count)
+        message = build_message()
+        worker.ack_message(message)
+        message.ack.assert_called_once_with()
+        self.assertEqual(worker.pending_acks, [])
+
+    def test_event_queues_settings(self):
+        event_queues = EventQueues({"backend_url": "memory://",
+                                    "high_throughput": {"prefetch_count": 20, "ack_batch_size": 50}})
+        worker = event_queues.get_process_worker(Mock())
+        self.assertEqual(worker.prefetch_count, 20)
+        # capped, to not stall the consumer
+        self.assertEqual(worker.ack_batch_size, 20)
+        with worker.Consumer() as (_, channel, consumers):
+            self.assertEqual(consumers[0].prefetch_count, 20)
+            self.assertEqual(channel.qos.prefetch_count, 20)
+
+    def test_multiple_acks(self):
+        worker = self._get_worker(multiple_acks=True, ack_batch_size=3)
+        messages = [build_message() for _ in range(4)]
+        for message in messages[:2]:
+            worker.ack_message(message)
+        for message in messages:
+            message.ack.assert_not_called()
+        worker.ack_message(messages[2])
+        messages[2].ack.assert_called_once_with(multiple=True)
+        for message in messages[:2]:
+            message.ack.assert_not_called()
+        worker.ack_message(messages[3])
+        self.assertEqual(worker.pending_acks, [messages[3]])
+
+    def test_single_acks(self):
+        worker = self._get_worker(ack_batch_size=3)
+        messages = [build_message() for _ in range(3)]
+        for message in messages:
+            worker.ack_message(message)
+        for message in messages:
+            message.ack.assert_called_once_with()
+
+    def test_ack_batch_delay(self):
+        worker = self._get_worker(ack_batch_size=10, ack_batch_delay=0.01)
+        message = build_message()
+        worker.ack_message(message)
+        worker.on_iteration()
+        message.ack.assert_not_called()
+        time.sleep(0.02)
+        worker.on_iteration()
+        message.ack.assert_called_once_with()
+
+    def test_publisher_confirms(self):
+        worker = self._get_worker(multiple_acks=True, ack_batch_size=2)
+        worker.confirms_enabled = True
+        worker.unconfirmed_tags = {1, 2, 3}
+        worker.publishing_connection = Mock()
+        worker.publishing_connection.drain_events.side_effect = lambda timeout: worker._on_publisher_ack(3, True)
+        messages = [build_message() for _ in range(2)]
+        for message in messages:
+            worker.ack_message(message)
+        messages[1].ack.assert_called_once_with(multiple=True)
+        self.assertEqual(worker.unconfirmed_tags, set())
+
+    def test_publisher_confirms_nack(self):
+        worker = self._get_worker(ack_batch_size=2)
+        worker.confirms_enabled = True
+        worker.unconfirmed_tags = {1, 2}
+        worker.publishing_connection = Mock()
+        worker.publishing_connection.drain_events.side_effect = lambda timeout: worker._on_publisher_nack(1, False)
+        messages = [build_message() for _ in range(2)]
+        for message in messages:
+            worker.ack_message(message)
+        for message in messages:
+            message.ack.assert_not_called()
+            message.requeue.assert_called_once_with()
+        self.assertFalse(worker.nacked)
+
+    def test_publisher_confirms_timeout(self):
+        worker = self._get_worker(publisher_confirms_timeout=0.05)
+        worker.confirms_enabled = True
+        worker.unconfirmed_tags = {1}
+        worker.publishing_connection = Mock()
+        worker.publishing_connection.drain_events.side_effect = socket.timeout
+        message = build_message()
+        worker.ack_message(message)
+        message.ack.assert_not_called()
+        message.requeue.assert_called_once_with()
+
+    @patch("zentral.core.queues.backends.kombu.signal.signal")
+    @patch("zentral.core.queues.backends.kombu.action_dispatcher")
+    def test_graceful_stop(self, action_dispatcher, signal_signal):
+        worker = self._get_worker()
+
+        def consume(*args, **kwargs):
+            self.assertEqual(set(c[0][0] for c in signal_signal.call_args_list), {signal.SIGTERM, signal.SIGINT})
+            # SIGTERM sent by the runworkers command
+            signal_signal.call_args[0][1](signal.SIGTERM, None)
+            self.assertTrue(worker.should_stop)
+            action_dispatcher.stop.assert_not_called()
+
+        with patch.object(ConsumerMixin, "run", side_effect=consume):
+            worker.run()
+        # the dispatched actions are triggered before the worker process exits
+        action_dispatcher.stop.assert_called_once_with()
@@ -0,0 +1,121 @@
+import shutil
+import tempfile
+from unittest.mock import Mock, patch
+from django.test import SimpleTestCase
+from kombu import Connection
+from zentral.core.queues.backends.kombu import StoreWorker
+from zentral.core.stores.spill import CircuitBreaker
+from . import build_event_d, FailingEventStore
+
+
+@patch("zentral.core.queues.backends.kombu.save_dead_letter")
+class KombuStoreWorkerTestCase(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _get_worker(self, batch_size=1, spill_log=True):
+        config_d = {"store_name": "yolo", "batch_size": batch_size}
+        if spill_log:
+            config_d["spill_log"] = {"directory": self.directory, "failure_threshold": 2, "retry_delay": 60}
+        event_store = FailingEventStore(config_d)
+        worker = StoreWorker(Connection("memory://"), event_store)
+        worker.setup_metrics_exporter()
+        worker.writer.open_spill_log()
+        self.addCleanup(lambda: worker.writer.spill_log and worker.writer.spill_log.close())
+        return worker, event_store
+
+    def _store(self, worker, idxs):
+        batch = [(build_event_d(idx), Mock(name="message")) for idx in idxs]
+        worker.store_events(batch)
+        return [message for _, message in batch]
+
+    def _stored_idxs(self, event_store):
+        return [event_d["idx"] for event_d in event_store.stored_event_ds]
+
+    def test_store_events(self, save_dead_letter):
+        worker, event_store = self._get_worker()
+        messages = self._store(worker, [0, 1])
+        for message in messages:
+            message.ack.assert_called_once_with()
+        self.assertEqual(self._stored_idxs(event_store), [0, 1])
+        self.assertTrue(worker.writer.spill_log.is_empty())
+        save_dead_letter.assert_not_called()
+
+    def test_rejected_event_dead_lettered(self, save_dead_letter):
+        worker, event_store = self._get_worker()
+        event_store.rejected_idxs = {1}
+        for _ in range(3):
+            messages = self._store(worker, [0, 1, 2])
+            messages[0].ack.assert_called_once_with()
+            messages[1].ack.assert_not_called()
+            messages[1].reject.assert_called_once_with()
+            messages[2].ack.assert_called_once_with()
+        # not spilled, and the circuit stays closed
+        self.assertTrue(worker.writer.spill_log.is_empty())
+        self.assertTrue(worker.writer.circuit_breaker.is_closed())
+        self.assertEqual(save_dead_letter.call_count, 3)
+        save_dead_letter.assert_called_with(build_event_d(1), "event store yolo error")
+        self.assertEqual(self._stored_idxs(event_store), 3 * [0, 2])
+
+    def test_rejected_batch_stored_one_by_one(self, save_dead_letter):
+        worker, event_store = self._get_worker(batch_size=10)
+        event_store.rejected_idxs = {1}
+        messages = self._store(worker, [0, 1, 2])
+        self.assertEqual([message.ack.call_count for message in messages], [1, 0, 1])
+        messages[1].reject.assert_called_once_with()
+        save_dead_letter.assert_called_once_with(build_event_d(1), "event store yolo error")
+        self.assertEqual(self._stored_idxs(event_store), [0, 2])
+        self.assertTrue(worker.writer.spill_log.is_empty())
+
+    def test_unavailable_store_spill_and_replay(self, save_dead_letter):
+        worker, event_store = self._get_worker(batch_size=10)
+        event_store.unavailable = True
+        for idxs in ([0, 1], [2], [3]):
+            for message in self._store(worker, idxs):
+                message.ack.assert_called_once_with()
+        # circuit open after 2 failures
+        self.assertEqual(worker.writer.circuit_breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(worker.writer.spill_log.is_empty())
+        self.assertEqual(event_store.stored_event_ds, [])
+        # replay, once the store is back
+        event_store.unavailable = False
+        worker.replay_spill_log()
+        self.assertEqual(event_store.stored_event_ds, [])
+        worker.writer.circuit_breaker.opened_at -= 60
+        worker.replay_spill_log()
+        self.assertEqual(self._stored_idxs(event_store), [0, 1, 2, 3])
+        self.assertTrue(worker.writer.spill_log.is_empty())
+        self.assertTrue(worker.writer.circuit_breaker.is_closed())
+        save_dead_letter.assert_not_called()
+
+    def test_rejected_event_replay_dead_lettered(self, save_dead_letter):
+        worker, event_store = self._get_worker()
+        event_store.unavailable = True
+        self._store(worker, [0])
+        self._store(worker, [1])
+        event_store.unavailable = False
+        event_store.rejected_idxs = {0}
+        worker.writer.circuit_breaker.opened_at -= 60
+        worker.replay_spill_log()
+        # the rejected event does not block the spill log
+        self.assertEqual(self._stored_idxs(event_store), [1])
+        self.assertTrue(worker.writer.spill_log.is_empty())
+        save_dead_letter.assert_called_once_with(build_event_d(0), "event store yolo error")
+
+    def test_unavailable_store_without_spill_log(self, save_dead_letter):
+        worker, event_store = self._get_worker(spill_log=False)
+        event_store.unavailable = True
+        messages = self._store(worker, [0])
+        messages[0].reject.assert_called_once_with()
+        save_dead_letter.assert_called_once_with(build_event_d(0), "event store yolo error")
+
+    def test_spill_log_full(self, save_dead_letter):
+        worker, event_store = self._get_worker()
+        worker.writer.spill_log.max_size = 0
+        event_store.unavailable = True
+        messages = self._store(worker, [0])
+        messages[0].reject.assert_called_once_with()
+        save_dead_letter.assert_called_once_with(build_event_d(0), "event store yolo error")
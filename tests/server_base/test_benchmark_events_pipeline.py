@@ -0,0 +1,32 @@
+from io import StringIO
+import json
+from django.core.management import call_command
+from django.test import TestCase
+from zentral.contrib.inventory.models import MachineSnapshot
+from zentral.core.probes.models import ProbeSource
+
+
+class BenchmarkEventsPipelineTestCase(TestCase):
+    def test_benchmark(self):
+        out = StringIO()
+        call_command("benchmark_events_pipeline", events=40, machines=4, probes=6, stores=2, store_batch_size=10,
+                     json_output=True, stdout=out)
+        results = json.loads(out.getvalue())
+        self.assertEqual(results["events"], 40)
+        self.assertEqual(results["stored_events"], {"benchmark 0": 40, "benchmark 1": 40})
+        self.assertEqual([result["stage"] for result in results["stages"]],
+                         ["publish", "preprocess", "enrich", "process", "store 0", "store 1"])
+        for result in results["stages"]:
+            self.assertEqual(result["messages"], 40)
+        # rolled back
+        self.assertEqual(MachineSnapshot.objects.count(), 0)
+        self.assertEqual(ProbeSource.objects.count(), 0)
+
+    def test_benchmark_high_throughput(self):
+        out = StringIO()
+        call_command("benchmark_events_pipeline", events=25, machines=2, probes=2, prefetch_count=10,
+                     ack_batch_size=10, json_output=True, stdout=out)
+        results = json.loads(out.getvalue())
+        self.assertEqual(results["stored_events"], {"benchmark 0": 25})
+        for result in results["stages"]:
+            self.assertEqual(result["messages"], 25)
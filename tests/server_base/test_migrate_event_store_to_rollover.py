@@ -0,0 +1,70 @@
+from io import StringIO
+from unittest.mock import Mock, patch
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase
+from zentral.core.stores.backends.elasticsearch import EventStore as ElasticsearchEventStore
+
+
+class MigrateEventStoreToRolloverTestCase(SimpleTestCase):
+    def get_event_store(self, rollover=True):
+        config_d = {'servers': ["http://elastic:9200"],
+                    'index': 'zentral-events',
+                    'store_name': 'elasticsearch'}
+        if rollover:
+            config_d["rollover"] = {"max_age": "1d", "retention": "30d"}
+        event_store = ElasticsearchEventStore(config_d)
+        event_store._es = Mock()
+        event_store._es.info.return_value = {"version": {"number": "7.17.1"}}
+        event_store._es.indices.recovery.return_value = {}
+        return event_store
+
+    def call_command(self, event_store, *args):
+        out = StringIO()
+        with patch("base.management.commands.migrate_event_store_to_rollover.stores", [event_store]):
+            call_command("migrate_event_store_to_rollover", "elasticsearch", *args, stdout=out)
+        return out.getvalue()
+
+    def test_unknown_store(self):
+        with self.assertRaises(CommandError):
+            with patch("base.management.commands.migrate_event_store_to_rollover.stores", []):
+                call_command("migrate_event_store_to_rollover", "elasticsearch")
+
+    def test_no_rollover(self):
+        with self.assertRaises(CommandError):
+            self.call_command(self.get_event_store(rollover=False))
+
+    def test_migrate(self):
+        event_store = self.get_event_store()
+        es = event_store._es
+        es.indices.exists.return_value = True
+        # legacy index is not an alias, write alias exists, legacy index not in read alias
+        es.indices.exists_alias.side_effect = lambda index=None, name=None: name == "zentral-events-write"
+        es.search.return_value = {"aggregations": {"max_created_at": {"value": 1,
+                                                                      "value_as_string": "2021-06-01T00:00:00"}}}
+        out = self.call_command(event_store, "--block-writes")
+        es.ilm.put_lifecycle.assert_called_once()
+        es.indices.put_alias.assert_called_once_with(index="zentral-events", name="zentral-events-read")
+        es.indices.put_settings.assert_called_once_with(index="zentral-events", body={"index.blocks.write": True})
+        self.assertIn("Last event: 2021-06-01T00:00:00", out)
+
+    def test_dry_run(self):
+        event_store = self.get_event_store()
+        es = event_store._es
+        es.indices.exists.return_value = True
+        es.indices.exists_alias.return_value = False
+        es.search.return_value = {"aggregations": {"max_created_at": {"value": None}}}
+        out = self.call_command(event_store, "--dry-run", "--block-writes")
+        es.ilm.put_lifecycle.assert_not_called()
+        es.indices.put_alias.assert_not_called()
+        es.indices.put_settings.assert_not_called()
+        self.assertIn("Add index zentral-events to read alias zentral-events-read", out)
+        self.assertIn("Block writes on index zentral-events", out)
+
+    def test_nothing_to_migrate(self):
+        event_store = self.get_event_store()
+        event_store._es.indices.exists.return_value = False
+        event_store._es.indices.exists_alias.return_value = True
+        out = self.call_command(event_store)
+        event_store._es.indices.put_alias.assert_not_called()
+        self.assertIn("No single index zentral-events to migrate", out)
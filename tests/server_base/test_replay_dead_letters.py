@@ -0,0 +1,111 @@
+from io import StringIO
+import json
+import os
+import shutil
+import tempfile
+from unittest.mock import patch
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase
+from zentral.core.stores.backends.base import BaseEventStore
+
+
+def build_event_d(idx):
+    return {"_zentral": {"id": "5b0d3c6e-2f4a-4e8b-9d1c-7a6e5f4d3c{:02d}".format(idx % 100),
+                         "index": idx,
+                         "type": "base"},
+            "idx": idx}
+
+
+class RecordingEventStore(BaseEventStore):
+    max_batch_size = 2
+
+    def __init__(self, config_d):
+        super().__init__(config_d)
+        self.stored_event_ds = []
+        self.rejected_idxs = set()
+
+    def store(self, event_d):
+        if event_d["idx"] in self.rejected_idxs:
+            raise ValueError("yolo")
+        self.stored_event_ds.append(event_d)
+
+
+class ReplayDeadLettersTestCase(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.event_stores = [RecordingEventStore({"store_name": "yolo"}),
+                             RecordingEventStore({"store_name": "fomo store"})]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_dead_letter(self, store_filename, idx, subdirectory="2021/06/01"):
+        dirpath = os.path.join(self.directory, subdirectory)
+        os.makedirs(dirpath, exist_ok=True)
+        filepath = os.path.join(dirpath, "2021-06-01_12.00.00.{:06d}_event_store_{}_error.json".format(
+            idx, store_filename
+        ))
+        with open(filepath, "w", encoding="utf-8") as f:
+            json.dump(build_event_d(idx), f)
+        return filepath
+
+    def call_command(self, *args):
+        stdout = StringIO()
+        stderr = StringIO()
+        with patch("base.management.commands.replay_dead_letters.stores", self.event_stores):
+            call_command("replay_dead_letters", "--directory", self.directory, *args, stdout=stdout, stderr=stderr)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def test_unknown_directory(self):
+        with self.assertRaisesMessage(CommandError, "Unknown directory"):
+            self.call_command("--directory", os.path.join(self.directory, "yolo"))
+
+    def test_no_stores(self):
+        with self.assertRaisesMessage(CommandError, "No stores"):
+            self.call_command("--store", "unknown")
+
+    def test_replay(self):
+        filepaths = [self.write_dead_letter("yolo", idx) for idx in range(3)]
+        fomo_filepath = self.write_dead_letter("fomo_store", 3, subdirectory="2021/06/02")
+        stdout, stderr = self.call_command()
+        self.assertEqual(stderr, "")
+        self.assertIn("Store yolo: 3/3 dead letter(s) replayed", stdout)
+        self.assertIn("Store fomo store: 1/1 dead letter(s) replayed", stdout)
+        self.assertEqual(sorted(event_d["idx"] for event_d in self.event_stores[0].stored_event_ds), [0, 1, 2])
+        self.assertEqual([event_d["idx"] for event_d in self.event_stores[1].stored_event_ds], [3])
+        for filepath in filepaths + [fomo_filepath]:
+            self.assertFalse(os.path.exists(filepath))
+
+    def test_replay_one_store_keep(self):
+        filepath = self.write_dead_letter("yolo", 0)
+        fomo_filepath = self.write_dead_letter("fomo_store", 1)
+        stdout, _ = self.call_command("--store", "yolo", "--keep")
+        self.assertEqual(stdout, "Store yolo: 1/1 dead letter(s) replayed\n")
+        self.assertEqual(len(self.event_stores[0].stored_event_ds), 1)
+        self.assertEqual(self.event_stores[1].stored_event_ds, [])
+        self.assertTrue(os.path.exists(filepath))
+        self.assertTrue(os.path.exists(fomo_filepath))
+
+    def test_rejected_and_invalid_dead_letters(self):
+        self.event_stores[0].rejected_idxs = {1}
+        stored_filepath = self.write_dead_letter("yolo", 0)
+        rejected_filepath = self.write_dead_letter("yolo", 1)
+        invalid_filepath = os.path.join(self.directory, "2021-06-01_12.00.00.000002_event_store_yolo_error.json")
+        with open(invalid_filepath, "w", encoding="utf-8") as f:
+            f.write("{")
+        stdout, stderr = self.call_command("--store", "yolo")
+        self.assertIn("Store yolo: 1/3 dead letter(s) replayed", stdout)
+        self.assertIn("Could not replay {}".format(rejected_filepath), stderr)
+        self.assertIn("Invalid dead letter {}".format(invalid_filepath), stderr)
+        self.assertFalse(os.path.exists(stored_filepath))
+        self.assertTrue(os.path.exists(rejected_filepath))
+
+    def test_dry_run(self):
+        filepath = self.write_dead_letter("yolo", 0)
+        stdout, _ = self.call_command("--dry-run")
+        self.assertIn("yolo: {}".format(filepath), stdout)
+        self.assertIn("Store yolo: 1 dead letter(s)", stdout)
+        self.assertIn("Store fomo store: 0 dead letter(s)", stdout)
+        self.assertEqual(self.event_stores[0].stored_event_ds, [])
+        self.assertTrue(os.path.exists(filepath))
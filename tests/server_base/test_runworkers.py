@@ -0,0 +1,101 @@
+from unittest.mock import Mock, patch
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import SimpleTestCase
+from base.management.commands.runworkers import Command
+
+
+def make_worker(name):
+    worker = Mock()
+    worker.name = name
+    return worker
+
+
+class RunWorkersTestCase(SimpleTestCase):
+    def get_concurrency(self, config_concurrency=None, *concurrency_args):
+        workers_settings = {}
+        if config_concurrency is not None:
+            workers_settings["workers"] = {"concurrency": config_concurrency}
+        with patch("base.management.commands.runworkers.settings", workers_settings):
+            return Command.get_concurrency({"concurrency": list(concurrency_args)})
+
+    def test_concurrency_default(self):
+        self.assertEqual(self.get_concurrency(), {})
+
+    def test_concurrency_config(self):
+        self.assertEqual(self.get_concurrency({"enrich worker": 2, "process worker": "3"}),
+                         {"enrich worker": 2, "process worker": 3})
+
+    def test_concurrency_cli_overrides_config(self):
+        self.assertEqual(self.get_concurrency({"enrich worker": 2, "process worker": 3},
+                                              "enrich worker=4", "store worker es=2"),
+                         {"enrich worker": 4, "process worker": 3, "store worker es": 2})
+
+    def test_concurrency_worker_name_with_equal_sign(self):
+        self.assertEqual(self.get_concurrency(None, "yolo=fomo=2"), {"yolo=fomo": 2})
+
+    def test_invalid_concurrency_arg(self):
+        for concurrency_arg in ("enrich worker", "=2"):
+            with self.assertRaisesMessage(CommandError, "Invalid --concurrency value"):
+                self.get_concurrency(None, concurrency_arg)
+
+    def test_invalid_concurrency_value(self):
+        for concurrency_arg in ("enrich worker=0", "enrich worker=-1", "enrich worker=two"):
+            with self.assertRaisesMessage(CommandError, "Invalid concurrency for worker 'enrich worker'"):
+                self.get_concurrency(None, concurrency_arg)
+        with self.assertRaisesMessage(CommandError, "Invalid concurrency for worker 'process worker'"):
+            self.get_concurrency({"process worker": None})
+
+    def call_command(self, *args, config_concurrency=None):
+        workers = [make_worker("store worker es"), make_worker("enrich worker"), make_worker("process worker")]
+        workers_settings = {}
+        if config_concurrency is not None:
+            workers_settings["workers"] = {"concurrency": config_concurrency}
+        with patch("base.management.commands.runworkers.settings", workers_settings), \
+             patch("base.management.commands.runworkers.get_workers", return_value=workers), \
+             patch("base.management.commands.runworkers.Process") as process_cls, \
+             patch("zentral.utils.prometheus.PrometheusMetricsExporter") as exporter_cls, \
+             patch.object(Command, "watch_workers") as watch_workers, \
+             patch.object(Command, "write_prometheus_sd_file"):
+            command = Command()
+            call_command(command, *args)
+        return command, process_cls, exporter_cls, watch_workers
+
+    def test_start_worker_processes(self):
+        command, process_cls, exporter_cls, watch_workers = self.call_command(
+            "--prometheus", "--concurrency", "enrich worker=2",
+            config_concurrency={"enrich worker": 3, "process worker": 2}
+        )
+        watch_workers.assert_called_once_with()
+        # sorted by worker name, one process per index
+        self.assertEqual([c[1]["name"] for c in process_cls.call_args_list],
+                         ["enrich worker #0", "enrich worker #1",
+                          "process worker #0", "process worker #1",
+                          "store worker es"])
+        self.assertEqual([(worker.name, process_idx) for worker, process_idx, _ in command.processes.values()],
+                         [("enrich worker", 0), ("enrich worker", 1),
+                          ("process worker", 0), ("process worker", 1),
+                          ("store worker es", 0)])
+        # one prometheus port per process
+        self.assertEqual([c[0][0] for c in exporter_cls.call_args_list], [9900, 9901, 9902, 9903, 9904])
+        self.assertEqual(command.prometheus_targets[1],
+                         {"targets": ["localhost:9901"],
+                          "labels": {"job": "enrich worker", "worker_process": "1"}})
+        self.assertEqual(command.prometheus_targets[4],
+                         {"targets": ["localhost:9904"],
+                          "labels": {"job": "store worker es", "worker_process": "0"}})
+
+    def test_start_selected_worker_stable_ports(self):
+        command, process_cls, exporter_cls, _ = self.call_command(
+            "--prometheus", "--concurrency", "enrich worker=2", "process worker"
+        )
+        self.assertEqual([c[1]["name"] for c in process_cls.call_args_list], ["process worker"])
+        # the ports of the other workers processes are skipped
+        exporter_cls.assert_called_once_with(9902)
+        self.assertEqual(list(command.prometheus_targets.keys()), [2])
+
+    def test_start_worker_without_metrics(self):
+        command, process_cls, exporter_cls, _ = self.call_command("process worker")
+        exporter_cls.assert_not_called()
+        self.assertEqual(process_cls.call_args[1]["kwargs"], {"metrics_exporter": None})
+        self.assertEqual(command.prometheus_targets, {})
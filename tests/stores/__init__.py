@@ -1,4 +1,5 @@
 from zentral.core.events.base import EventMetadata, EventRequest, EventRequestUser, BaseEvent, register_event_type
+from zentral.core.stores.backends.base import get_event_key
 
 
 class TestEvent1(BaseEvent):
@@ -52,6 +53,12 @@ class BaseTestEventStore(object):
         e = l[0]
         self.assertEqual(e.serialize(), event.serialize())
 
+    def test_bulk_store(self):
+        events = [make_event(idx=i, with_request=i % 2) for i in range(10)]
+        stored_event_keys = set(self.event_store.bulk_store([e.serialize(machine_metadata=False) for e in events]))
+        self.assertEqual(stored_event_keys, {get_event_key(e) for e in events})
+        self.assertEqual(self.event_store.machine_events_count(events[0].metadata.machine_serial_number), 10)
+
     def test_pagination(self):
         for i in range(100):
             event = make_event(idx=i)
@@ -61,6 +68,25 @@ class BaseTestEventStore(object):
         self.assertEqual(l[0].payload['idx'], 89)
         self.assertEqual(l[1].payload['idx'], 88)
 
+    def test_cursor_pagination(self):
+        for i in range(25):
+            event = make_event(idx=i)
+            self.event_store.store(event)
+        serial_number = event.metadata.machine_serial_number
+        events, next_cursor, previous_cursor = self.event_store.machine_events_fetch_page(serial_number, limit=10)
+        self.assertEqual([e.payload['idx'] for e in events], list(range(24, 14, -1)))
+        self.assertIsNone(previous_cursor)
+        events, next_cursor, previous_cursor = self.event_store.machine_events_fetch_page(serial_number,
+                                                                                          cursor=next_cursor,
+                                                                                          limit=10)
+        self.assertEqual([e.payload['idx'] for e in events], list(range(14, 4, -1)))
+        events, last_cursor, _ = self.event_store.machine_events_fetch_page(serial_number, cursor=next_cursor,
+                                                                            limit=10)
+        self.assertEqual([e.payload['idx'] for e in events], list(range(4, -1, -1)))
+        self.assertIsNone(last_cursor)
+        events, _, _ = self.event_store.machine_events_fetch_page(serial_number, cursor=previous_cursor, limit=10)
+        self.assertEqual([e.payload['idx'] for e in events], list(range(24, 14, -1)))
+
     def test_event_types_usage(self):
         for i in range(100):
             event = make_event(idx=i, first_type=i < 50)
@@ -0,0 +1,149 @@
+import threading
+import time
+import unittest
+from unittest.mock import Mock
+from zentral.core.stores import get_frontend_store
+from zentral.core.stores.cache import CachedEventStore
+
+
+class TestCachedEventStore(unittest.TestCase):
+    def get_cached_store(self, **config):
+        event_store = Mock()
+        event_store.name = "frontend"
+        event_store.get_app_hist_data.return_value = [("2021-06-01", 1, 1)]
+        event_store.machine_events_types_with_usage.return_value = {"yolo": 1}
+        return event_store, CachedEventStore(event_store, config)
+
+    def expire(self, cached_store, age):
+        for key, (value, created_at) in list(cached_store._lru._data.items()):
+            cached_store._lru.set(key, (value, created_at - age))
+
+    def get_totals(self, cached_store):
+        return {result: total for (_, result), total in cached_store._totals.items()}
+
+    def test_frontend_store_cache_disabled_by_default(self):
+        for read_cache_config in (None, {}, {"enabled": False}):
+            event_store = Mock(frontend=True, read_cache_config=read_cache_config)
+            self.assertIs(get_frontend_store([event_store]), event_store)
+
+    def test_frontend_store_cache_enabled(self):
+        event_store = Mock(frontend=True, read_cache_config={"enabled": True, "ttls": {"get_app_hist_data": 0}})
+        cached_store = get_frontend_store([Mock(frontend=False), event_store])
+        self.assertIsInstance(cached_store, CachedEventStore)
+        self.assertIs(cached_store.event_store, event_store)
+        self.assertNotIn("get_app_hist_data", cached_store.ttls)
+
+    def test_proxied_attributes(self):
+        event_store, cached_store = self.get_cached_store()
+        self.assertEqual(cached_store.name, "frontend")
+        cached_store.machine_events_fetch("012356789")
+        cached_store.machine_events_fetch("012356789")
+        self.assertEqual(event_store.machine_events_fetch.call_count, 2)
+
+    def test_hit_miss(self):
+        event_store, cached_store = self.get_cached_store()
+        self.assertEqual(cached_store.machine_events_types_with_usage("012356789"), {"yolo": 1})
+        self.assertEqual(cached_store.machine_events_types_with_usage("012356789"), {"yolo": 1})
+        cached_store.machine_events_types_with_usage("987654321")
+        self.assertEqual(event_store.machine_events_types_with_usage.call_count, 2)
+        self.assertEqual(self.get_totals(cached_store), {"hit": 1, "miss": 2})
+
+    def test_copies(self):
+        _, cached_store = self.get_cached_store()
+        cached_store.machine_events_types_with_usage("012356789")["fomo"] = 2
+        self.assertEqual(cached_store.machine_events_types_with_usage("012356789"), {"yolo": 1})
+
+    def test_expiry(self):
+        event_store, cached_store = self.get_cached_store(ttls={"machine_events_types_with_usage": 10})
+        cached_store.machine_events_types_with_usage("012356789")
+        self.expire(cached_store, 11)
+        cached_store.machine_events_types_with_usage("012356789")
+        self.assertEqual(event_store.machine_events_types_with_usage.call_count, 2)
+
+    def test_disabled_method(self):
+        event_store, cached_store = self.get_cached_store(ttls={"machine_events_types_with_usage": 0})
+        cached_store.machine_events_types_with_usage("012356789")
+        cached_store.machine_events_types_with_usage("012356789")
+        self.assertEqual(event_store.machine_events_types_with_usage.call_count, 2)
+
+    def test_probe_key(self):
+        event_store, cached_store = self.get_cached_store()
+        probe = Mock(pk=1)
+        probe.source.body = {"filters": {"metadata": [{"event_types": ["yolo"]}]}}
+        cached_store.probe_events_aggregations(probe, event_type="yolo")
+        cached_store.probe_events_aggregations(probe, event_type="yolo")
+        self.assertEqual(event_store.probe_events_aggregations.call_count, 1)
+        cached_store.probe_events_aggregations(probe, event_type="fomo")
+        probe.source.body = {"filters": {"metadata": [{"event_types": ["fomo"]}]}}
+        cached_store.probe_events_aggregations(probe, event_type="yolo")
+        self.assertEqual(event_store.probe_events_aggregations.call_count, 3)
+
+    def test_error_not_cached(self):
+        event_store, cached_store = self.get_cached_store()
+        event_store.machine_events_types_with_usage.side_effect = [ValueError("yolo"), {"fomo": 2}]
+        with self.assertRaises(ValueError):
+            cached_store.machine_events_types_with_usage("012356789")
+        self.assertEqual(cached_store.machine_events_types_with_usage("012356789"), {"fomo": 2})
+        self.assertEqual(cached_store._flights, {})
+
+    def test_single_flight(self):
+        event_store, cached_store = self.get_cached_store()
+        started = threading.Event()
+        release = threading.Event()
+
+        def get_app_hist_data(*args, **kwargs):
+            started.set()
+            release.wait(5)
+            return [("2021-06-01", 2, 1)]
+
+        event_store.get_app_hist_data.side_effect = get_app_hist_data
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(cached_store.get_app_hist_data("day", 14)))
+                   for _ in range(4)]
+        threads[0].start()
+        started.wait(5)
+        for thread in threads[1:]:
+            thread.start()
+        while sum(cached_store._totals.values()) < 4:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(results, 4 * [[("2021-06-01", 2, 1)]])
+        self.assertEqual(event_store.get_app_hist_data.call_count, 1)
+        self.assertEqual(self.get_totals(cached_store), {"miss": 1, "coalesced": 3})
+
+    def test_background_refresh(self):
+        event_store, cached_store = self.get_cached_store(ttls={"get_app_hist_data": 10})
+        cached_store.get_app_hist_data("day", 14)
+        event_store.get_app_hist_data.return_value = [("2021-06-01", 2, 2)]
+        self.expire(cached_store, 11)
+        # stale value returned, refreshed in the background
+        self.assertEqual(cached_store.get_app_hist_data("day", 14), [("2021-06-01", 1, 1)])
+        for _ in range(500):
+            if not cached_store._flights:
+                break
+            time.sleep(0.01)
+        self.assertEqual(cached_store.get_app_hist_data("day", 14), [("2021-06-01", 2, 2)])
+        self.assertEqual(event_store.get_app_hist_data.call_count, 2)
+        self.assertEqual(self.get_totals(cached_store), {"miss": 1, "stale": 1, "hit": 1})
+        # too old
+        self.expire(cached_store, 101)
+        event_store.get_app_hist_data.return_value = [("2021-06-01", 3, 3)]
+        self.assertEqual(cached_store.get_app_hist_data("day", 14), [("2021-06-01", 3, 3)])
+
+    def test_prometheus_metrics(self):
+        _, cached_store = self.get_cached_store()
+        cached_store.get_app_hist_data("day", 14)
+        cached_store.get_app_hist_data("day", 14)
+        registry = cached_store.get_prometheus_metrics()
+        labels = {"store": "frontend", "method": "get_app_hist_data"}
+        self.assertEqual(registry.get_sample_value("zentral_frontend_store_cache_requests_total",
+                                                   dict(labels, result="hit")), 1)
+        self.assertEqual(registry.get_sample_value("zentral_frontend_store_cache_requests_total",
+                                                   dict(labels, result="miss")), 1)
+        self.assertEqual(registry.get_sample_value("zentral_frontend_store_cache_entries", {"store": "frontend"}), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
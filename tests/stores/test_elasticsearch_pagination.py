@@ -0,0 +1,122 @@
+import unittest
+from unittest.mock import Mock
+from elasticsearch.exceptions import NotFoundError
+from zentral.core.stores.backends.base import decode_cursor, encode_cursor
+from zentral.core.stores.backends.elasticsearch import EventStore as ElasticsearchEventStore
+from . import make_event
+
+
+class TestElasticsearchEventStorePagination(unittest.TestCase):
+    def setUp(self):
+        self.event_store = ElasticsearchEventStore({'servers': ["http://elastic:9200"],
+                                                    'index': 'zentral-tests-events',
+                                                    'store_name': 'elasticsearch_test'})
+        self.event_store.configured = True
+        self.event_store.use_mapping_types = False
+        self.event_store.version = [7, 17]
+        self.event_store._es = Mock()
+        self.event_store._es.open_point_in_time.return_value = {"id": "PIT0"}
+
+    def _hits(self, count, start=1000, pit_id=None):
+        hits = []
+        for idx in range(count):
+            event = make_event(idx=idx)
+            event_d = event.serialize(machine_metadata=False)
+            source = event_d.pop("_zentral")
+            source[event.event_type] = event_d
+            sort = [start - idx, str(event.metadata.uuid), 0]
+            if pit_id:
+                sort.append(idx)
+            hits.append({"_type": "_doc", "_source": source, "sort": sort})
+        response = {"hits": {"hits": hits}}
+        if pit_id:
+            response["pit_id"] = pit_id
+        return response
+
+    def test_first_page(self):
+        self.event_store._es.search.return_value = self._hits(11)
+        events, next_cursor, previous_cursor = self.event_store.machine_events_fetch_page("0123", limit=10)
+        self.assertEqual([e.payload["idx"] for e in events], list(range(10)))
+        self.assertIsNone(previous_cursor)
+        self.assertEqual(decode_cursor(next_cursor), {"search_after": [991, str(events[-1].metadata.uuid), 0],
+                                                      "pit_id": None})
+        _, kwargs = self.event_store._es.search.call_args
+        self.assertEqual(kwargs["index"], "zentral-tests-events")
+        body = kwargs["body"]
+        self.assertEqual(body["size"], 11)
+        self.assertNotIn("from", body)
+        self.assertNotIn("search_after", body)
+        self.assertEqual(body["sort"][0], {"created_at": "desc"})
+        self.event_store._es.open_point_in_time.assert_not_called()
+
+    def test_last_page(self):
+        self.event_store._es.search.return_value = self._hits(3)
+        events, next_cursor, previous_cursor = self.event_store.machine_events_fetch_page("0123", limit=10)
+        self.assertEqual(len(events), 3)
+        self.assertIsNone(next_cursor)
+        self.assertIsNone(previous_cursor)
+
+    def test_next_page_point_in_time(self):
+        self.event_store._es.search.return_value = self._hits(11, pit_id="PIT1")
+        cursor = encode_cursor({"search_after": [1001, "uuid", 0], "pit_id": None})
+        events, next_cursor, previous_cursor = self.event_store.machine_events_fetch_page("0123", cursor=cursor,
+                                                                                          limit=10)
+        self.event_store._es.open_point_in_time.assert_called_once_with(
+            index="zentral-tests-events", params={"keep_alive": "5m"}
+        )
+        _, kwargs = self.event_store._es.search.call_args
+        self.assertNotIn("index", kwargs)
+        body = kwargs["body"]
+        self.assertEqual(body["pit"], {"id": "PIT0", "keep_alive": "5m"})
+        self.assertEqual(body["search_after"], [1001, "uuid", 0, -1])
+        self.assertEqual(body["sort"][-1], {"_shard_doc": "desc"})
+        self.assertEqual(decode_cursor(next_cursor)["pit_id"], "PIT1")
+        previous_cursor_d = decode_cursor(previous_cursor)
+        self.assertTrue(previous_cursor_d["reverse"])
+        self.assertEqual(previous_cursor_d["search_after"], [1000, str(events[0].metadata.uuid), 0, 0])
+
+    def test_previous_page(self):
+        # reversed order
+        response = self._hits(11, start=1000)
+        response["hits"]["hits"].reverse()
+        self.event_store._es.search.return_value = response
+        cursor = encode_cursor({"search_after": [1011, "uuid", 0], "reverse": True, "pit_id": None})
+        self.event_store.point_in_time_keep_alive = None
+        events, next_cursor, previous_cursor = self.event_store.machine_events_fetch_page("0123", cursor=cursor,
+                                                                                          limit=10)
+        _, kwargs = self.event_store._es.search.call_args
+        self.assertEqual(kwargs["body"]["sort"][0], {"created_at": "asc"})
+        self.assertEqual(kwargs["body"]["search_after"], [1011, "uuid", 0])
+        self.event_store._es.open_point_in_time.assert_not_called()
+        # newest first
+        self.assertEqual([e.payload["idx"] for e in events], list(range(1, 11)))
+        self.assertIsNotNone(next_cursor)
+        self.assertIsNotNone(previous_cursor)
+
+    def test_point_in_time_expired(self):
+        self.event_store._es.search.side_effect = [NotFoundError(404, "search_context_missing_exception"),
+                                                   self._hits(5)]
+        cursor = encode_cursor({"search_after": [1001, "uuid", 0, 12], "pit_id": "PIT_EXPIRED"})
+        events, next_cursor, previous_cursor = self.event_store.incident_events_fetch_page(Mock(pk=1), cursor=cursor,
+                                                                                           limit=10)
+        self.assertEqual(len(events), 5)
+        _, kwargs = self.event_store._es.search.call_args
+        self.assertEqual(kwargs["index"], "zentral-tests-events")
+        self.assertNotIn("pit", kwargs["body"])
+        self.assertEqual(kwargs["body"]["search_after"], [1001, "uuid", 0])
+        self.assertIsNone(decode_cursor(previous_cursor)["pit_id"])
+
+    def test_old_cluster_no_point_in_time(self):
+        self.event_store.version = [7, 9]
+        self.event_store._es.search.return_value = self._hits(2)
+        cursor = encode_cursor({"search_after": [1001, "uuid", 0]})
+        self.event_store.machine_events_fetch_page("0123", cursor=cursor, limit=10)
+        self.event_store._es.open_point_in_time.assert_not_called()
+
+    def test_invalid_cursor(self):
+        self.event_store._es.search.return_value = self._hits(2)
+        events, _, previous_cursor = self.event_store.machine_events_fetch_page("0123", cursor="yolo!!", limit=10)
+        self.assertEqual(len(events), 2)
+        self.assertIsNone(previous_cursor)
+        _, kwargs = self.event_store._es.search.call_args
+        self.assertNotIn("search_after", kwargs["body"])
@@ -0,0 +1,161 @@
+import time
+import unittest
+from unittest.mock import Mock
+from elasticsearch.exceptions import ConnectionError
+from zentral.core.exceptions import ImproperlyConfigured
+from zentral.core.stores.backends.elasticsearch import EventStore as ElasticsearchEventStore
+from . import make_event
+
+
+class TestElasticsearchEventStoreRollover(unittest.TestCase):
+    def get_event_store(self, version="7.17.1", **rollover):
+        event_store = ElasticsearchEventStore({'servers': ["http://elastic:9200"],
+                                               'index': 'zentral-events',
+                                               'store_name': 'elasticsearch_test',
+                                               'rollover': rollover or {"max_age": "7d", "retention": "90d"}})
+        event_store._es = Mock()
+        event_store._es.info.return_value = {"version": {"number": version}}
+        event_store._es.indices.recovery.return_value = {}
+        return event_store
+
+    def test_config(self):
+        event_store = self.get_event_store()
+        self.assertEqual(event_store.rollover_conditions, {"max_age": "7d"})
+        self.assertEqual(event_store.retention, "90d")
+        self.assertEqual(event_store.write_index, "zentral-events-write")
+        self.assertEqual(event_store.read_index, "zentral-events-read")
+
+    def test_default_config(self):
+        event_store = self.get_event_store(retention=None)
+        self.assertEqual(event_store.rollover_conditions, {"max_age": "1d", "max_size": "50gb"})
+        self.assertIsNone(event_store.retention)
+        self.assertEqual(event_store.get_lifecycle_policy(),
+                         {"policy": {"phases": {"hot": {"actions": {"rollover": {"max_age": "1d",
+                                                                                 "max_size": "50gb"}}}}}})
+
+    def test_no_rollover(self):
+        event_store = ElasticsearchEventStore({'servers': ["http://elastic:9200"],
+                                               'index': 'zentral-events',
+                                               'store_name': 'elasticsearch_test'})
+        self.assertIsNone(event_store.rollover_conditions)
+        self.assertEqual(event_store.write_index, "zentral-events")
+        self.assertEqual(event_store.read_index, "zentral-events")
+        self.assertEqual(event_store._get_time_bounded_read_index(0), "zentral-events")
+
+    def test_configure_bootstrap(self):
+        event_store = self.get_event_store()
+        event_store._es.indices.exists_alias.return_value = False
+        event_store.wait_and_configure()
+        self.assertTrue(event_store.configured)
+        self.assertFalse(event_store.use_mapping_types)
+        event_store._es.ilm.put_lifecycle.assert_called_once_with(
+            policy="zentral-events",
+            body={"policy": {"phases": {"hot": {"actions": {"rollover": {"max_age": "7d"}}},
+                                        "delete": {"min_age": "90d", "actions": {"delete": {}}}}}}
+        )
+        _, kwargs = event_store._es.indices.put_template.call_args
+        self.assertEqual(kwargs["name"], "zentral-events")
+        template = kwargs["body"]
+        self.assertEqual(template["index_patterns"], ["zentral-events-*"])
+        self.assertEqual(template["aliases"], {"zentral-events-read": {}})
+        self.assertEqual(template["settings"]["index.lifecycle.name"], "zentral-events")
+        self.assertEqual(template["settings"]["index.lifecycle.rollover_alias"], "zentral-events-write")
+        self.assertEqual(template["mappings"], ElasticsearchEventStore.MAPPINGS)
+        event_store._es.indices.create.assert_called_once_with(
+            "zentral-events-000001",
+            body={"aliases": {"zentral-events-write": {"is_write_index": True}}}
+        )
+        event_store._es.indices.exists.assert_not_called()
+        event_store._es.indices.recovery.assert_called_once_with("zentral-events-write",
+                                                                 params={"active_only": "true"})
+
+    def test_configure_existing_write_alias(self):
+        event_store = self.get_event_store()
+        event_store._es.indices.exists_alias.return_value = True
+        event_store.wait_and_configure()
+        event_store._es.ilm.put_lifecycle.assert_called_once()
+        event_store._es.indices.put_template.assert_called_once()
+        event_store._es.indices.create.assert_not_called()
+
+    def test_configure_old_cluster(self):
+        event_store = self.get_event_store(version="6.8.2")
+        with self.assertRaises(ImproperlyConfigured):
+            event_store.wait_and_configure()
+
+    def test_configure_connection_error_retry(self):
+        event_store = self.get_event_store()
+        event_store._es.indices.exists_alias.side_effect = [ConnectionError("N/A", "yolo", None), True]
+        event_store.MAX_CONNECTION_ATTEMPTS = 2
+        with unittest.mock.patch("zentral.core.stores.backends.elasticsearch.time.sleep"):
+            event_store.wait_and_configure()
+        self.assertTrue(event_store.configured)
+
+    def test_bulk_store_write_alias(self):
+        event_store = self.get_event_store()
+        event_store._es.indices.exists_alias.return_value = True
+        event = make_event()
+        event_store._es.bulk.return_value = {"items": [{"index": {"_id": "{}:0".format(event.metadata.uuid),
+                                                                  "status": 201}}]}
+        event_store._serialize_event = Mock(return_value=("doc", {}))
+        self.assertEqual(list(event_store.bulk_store([event])), [(str(event.metadata.uuid), 0)])
+        _, kwargs = event_store._es.bulk.call_args
+        self.assertEqual(kwargs["body"][0]["index"]["_index"], "zentral-events-write")
+
+    def _set_indices(self, event_store):
+        event_store._es.indices.get_alias.return_value = {
+            "zentral-events": {"aliases": {"zentral-events-read": {}}},
+            "zentral-events-000001": {"aliases": {"zentral-events-read": {},
+                                                  "zentral-events-write": {"is_write_index": False}}},
+            "zentral-events-000002": {"aliases": {"zentral-events-read": {},
+                                                  "zentral-events-write": {"is_write_index": False}}},
+            "zentral-events-000003": {"aliases": {"zentral-events-read": {},
+                                                  "zentral-events-write": {"is_write_index": True}}},
+        }
+        event_store._es.msearch.return_value = {"responses": [
+            {"aggregations": {"max_created_at": {"value": 1000}}},
+            {"aggregations": {"max_created_at": {"value": 2000}}},
+            {"aggregations": {"max_created_at": {"value": None}}},
+        ]}
+
+    def test_time_bounded_read_index(self):
+        event_store = self.get_event_store()
+        self._set_indices(event_store)
+        self.assertEqual(event_store._get_time_bounded_read_index(1500),
+                         "zentral-events-000001,zentral-events-000003")
+        event_store._es.indices.get_alias.assert_called_once_with(index="zentral-events-read")
+        _, kwargs = event_store._es.msearch.call_args
+        self.assertEqual([header["index"] for header in kwargs["body"][::2]],
+                         ["zentral-events", "zentral-events-000001", "zentral-events-000002"])
+        # cached
+        self.assertEqual(event_store._get_time_bounded_read_index(500),
+                         "zentral-events,zentral-events-000001,zentral-events-000003")
+        event_store._es.indices.get_alias.assert_called_once()
+        # expired, only the new indices are queried
+        event_store._index_max_created_at_expiry = time.monotonic() - 1
+        event_store._es.indices.get_alias.return_value["zentral-events-000003"]["aliases"]["zentral-events-write"] = \
+            {"is_write_index": False}
+        event_store._es.indices.get_alias.return_value["zentral-events-000004"] = \
+            {"aliases": {"zentral-events-write": {"is_write_index": True}}}
+        event_store._es.msearch.return_value = {"responses": [
+            {"aggregations": {"max_created_at": {"value": 3000}}},
+        ]}
+        self.assertEqual(event_store._get_time_bounded_read_index(2500),
+                         "zentral-events-000003,zentral-events-000004")
+        _, kwargs = event_store._es.msearch.call_args
+        self.assertEqual(kwargs["body"][0], {"index": "zentral-events-000003"})
+
+    def test_time_bounded_read_index_error(self):
+        event_store = self.get_event_store()
+        event_store._es.indices.get_alias.side_effect = ConnectionError("N/A", "yolo", None)
+        self.assertEqual(event_store._get_time_bounded_read_index(1500), "zentral-events-read")
+
+    def test_app_hist_data(self):
+        event_store = self.get_event_store()
+        event_store.version = [7, 17]
+        event_store.configured = True
+        self._set_indices(event_store)
+        event_store._es.search.return_value = {"aggregations": {"buckets": {"buckets": []}}}
+        self.assertEqual(event_store.get_app_hist_data("day", 14), [])
+        _, kwargs = event_store._es.search.call_args
+        self.assertEqual(kwargs["index"], "zentral-events-000003")
+        self.assertEqual(kwargs["params"], {"ignore_unavailable": "true"})
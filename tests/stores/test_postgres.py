@@ -1,28 +1,292 @@
+from datetime import datetime, timedelta, timezone
 import os
 import unittest
-from zentral.core.stores.backends.postgres import EventStore as PostgresEventStore
-from . import BaseTestEventStore
+from unittest.mock import call, Mock
+import psycopg2
+from zentral.core.events.base import EventMetadata
+from zentral.core.probes.models import ProbeSource
+from zentral.core.stores.backends.postgres import EventStore as PostgresEventStore, PoolTimeout
+from . import BaseTestEventStore, TestEvent1, TestEvent2
+
+
+def make_probe(body):
+    return ProbeSource(model="BaseProbe", name="probe", slug="probe", body=body).load()
 
 
 class TestPostgresEventStore(unittest.TestCase, BaseTestEventStore):
 
     def setUp(self):
         # use the django default test db
-        store_settings = {'database': 'test_{}'.format(os.environ.get('POSTGRES_DB', 'zentral')),
-                          'user': os.environ.get('POSTGRES_USER', 'zentral'),
-                          'store_name': 'postgres_test'}
+        self.store_settings = {'database': 'test_{}'.format(os.environ.get('POSTGRES_DB', 'zentral')),
+                               'user': os.environ.get('POSTGRES_USER', 'zentral'),
+                               'store_name': 'postgres_test'}
         host = os.environ.get('POSTGRES_HOST')
         if host:
-            store_settings['host'] = host
+            self.store_settings['host'] = host
         password = os.environ.get('POSTGRES_PASSWORD')
         if password:
-            store_settings['password'] = password
-        self.event_store = PostgresEventStore(store_settings)
+            self.store_settings['password'] = password
+        self.event_store = PostgresEventStore(self.store_settings)
 
-    def tearDown(self):
-        with self.event_store._conn:
-            with self.event_store._conn.cursor() as cur:
+    def _store(self, payload, first_type=True, created_at=None, serial_number="012356789", **metadata):
+        event_cls = TestEvent1 if first_type else TestEvent2
+        event = event_cls(EventMetadata(event_cls.event_type,
+                                        machine_serial_number=serial_number,
+                                        created_at=created_at,
+                                        **metadata),
+                          payload)
+        self.event_store.store(event)
+        return event
+
+    def _partitions(self):
+        self.event_store._load_partitions()
+        return [(start, end) for start, end, _ in self.event_store._partitions]
+
+    def _terminate_backend(self, conn):
+        kwargs = {k: v for k, v in self.store_settings.items() if k != "store_name"}
+        with psycopg2.connect(**kwargs) as admin_conn:
+            with admin_conn.cursor() as cur:
+                cur.execute("select pg_terminate_backend(%s)", [conn.get_backend_pid()])
+        admin_conn.close()
+
+    def test_partitions(self):
+        self.event_store.wait_and_configure()
+        self.assertTrue(self.event_store.partitioned)
+        now = datetime.utcnow()
+        partitions = self._partitions()
+        self.assertTrue(any(start <= now < end for start, end in partitions))
+        self.assertTrue(any(start <= now + timedelta(days=31) < end for start, end in partitions))
+        # on demand
+        created_at = datetime(2001, 2, 3, 4, 5, 6)
+        self._store({"idx": 1}, created_at=created_at)
+        self.assertIn((datetime(2001, 2, 1), datetime(2001, 3, 1)), self._partitions())
+        self.assertEqual([e.metadata.created_at for e in self.event_store.machine_events_fetch("012356789")],
+                         [created_at])
+        # retention
+        self.event_store.retention_days = 30
+        self.event_store._run_maintenance()
+        self.assertNotIn((datetime(2001, 2, 1), datetime(2001, 3, 1)), self._partitions())
+        self.assertEqual(self.event_store.machine_events_count("012356789"), 0)
+
+    def test_aware_created_at(self):
+        self.event_store.wait_and_configure()
+        created_at = datetime(2001, 2, 28, 23, 30, tzinfo=timezone(timedelta(hours=-2)))
+        self._store({"idx": 1}, created_at=created_at)
+        self.event_store.bulk_store([TestEvent1(EventMetadata(TestEvent1.event_type,
+                                                              machine_serial_number="012356789",
+                                                              created_at=created_at,
+                                                              index=1),
+                                                {"idx": 2})])
+        self.assertIn((datetime(2001, 3, 1), datetime(2001, 4, 1)), self._partitions())
+        self.assertEqual([e.metadata.created_at for e in self.event_store.machine_events_fetch("012356789")],
+                         2 * [datetime(2001, 3, 1, 1, 30)])
+
+    def test_partition_bounds_no_overlap(self):
+        self.event_store.wait_and_configure()
+        self.event_store._partitions = [(datetime(2001, 2, 1), datetime(2001, 3, 1), "events_20010201")]
+        self.event_store._partition_starts = [datetime(2001, 2, 1)]
+        self.event_store.partition_interval = "week"
+        self.assertIsNone(self.event_store._get_missing_partition_bounds(datetime(2001, 2, 28, 12)))
+        # week starting on Monday 2001-02-26
+        self.assertEqual(self.event_store._get_missing_partition_bounds(datetime(2001, 3, 2)),
+                         (datetime(2001, 3, 1), datetime(2001, 3, 5)))
+        # week starting on Monday 2001-01-29
+        self.assertEqual(self.event_store._get_missing_partition_bounds(datetime(2001, 1, 30)),
+                         (datetime(2001, 1, 29), datetime(2001, 2, 1)))
+
+    def test_probe_events_payload_filters(self):
+        self._store({"name": "yolo", "nested": [{"value": 1}, {"value": 2}], "flag": True})
+        self._store({"name": "fomo", "nested": {"value": 3}, "flag": False})
+        self._store({"name": "other"}, first_type=False)
+        for filters, expected_names in (
+            ({"payload": [[{"attribute": "name", "operator": "IN", "values": ["yolo", "fomo"]}]]},
+             ["fomo", "yolo"]),
+            ({"payload": [[{"attribute": "nested.value", "operator": "IN", "values": ["2"]}]]},
+             ["yolo"]),
+            ({"payload": [[{"attribute": "flag", "operator": "IN", "values": ["True"]}]]},
+             ["yolo"]),
+            ({"payload": [[{"attribute": "name", "operator": "NOT_IN", "values": ["yolo"]}]]},
+             ["fomo", "other"]),
+            # OR between the payload filters, AND between the items
+            ({"payload": [[{"attribute": "name", "operator": "IN", "values": ["yolo"]},
+                           {"attribute": "nested.value", "operator": "IN", "values": ["3"]}],
+                          [{"attribute": "name", "operator": "IN", "values": ["other"]}]]},
+             ["other"]),
+            ({"metadata": [{"event_types": ["event_type_2"]}]},
+             ["other"]),
+            ({"metadata": [{"event_types": ["event_type_1"]}],
+              "payload": [[{"attribute": "name", "operator": "IN", "values": ["yolo", "other"]}]]},
+             ["yolo"]),
+        ):
+            probe = make_probe({"filters": filters})
+            self.assertEqual(self.event_store.probe_events_count(probe), len(expected_names))
+            self.assertEqual(sorted(e.payload["name"] for e in self.event_store.probe_events_fetch(probe)),
+                             expected_names)
+
+    def test_probe_events_metadata_filters(self):
+        self._store({"name": "tagged"}, tags=["yolo"],
+                    machine={"platform": "MACOS", "meta_business_units": [{"id": 1, "name": "MBU"}]})
+        self._store({"name": "untagged"}, machine={"platform": "LINUX"})
+        for filters, expected_names in (
+            ({"metadata": [{"event_tags": ["yolo"]}]}, ["tagged"]),
+            ({"inventory": [{"platforms": ["MACOS"]}]}, ["tagged"]),
+            ({"inventory": [{"meta_business_unit_ids": [1, 2]}]}, ["tagged"]),
+            ({"inventory": [{"meta_business_unit_ids": [1], "platforms": ["LINUX"]}]}, []),
+            ({"inventory": [{"meta_business_unit_ids": [1]}, {"platforms": ["LINUX"]}]}, ["tagged", "untagged"]),
+        ):
+            probe = make_probe({"filters": filters})
+            self.assertEqual(sorted(e.payload["name"] for e in self.event_store.probe_events_fetch(probe)),
+                             expected_names)
+
+    def test_probe_events_search_dict(self):
+        self._store({"name": "pack_0123_yolo_4567", "probe": {"id": 12}})
+        self._store({"name": "fomo_4567", "probe": {"id": 13}})
+        probe = make_probe({"filters": {"metadata": [{"event_types": ["event_type_1"]}]}})
+        for search_dict, expected_names in (
+            ({"event_type": "event_type_1", "name__regexp": "(pack_[0-9]{4}_)?yolo_[0-9]{4}"},
+             ["pack_0123_yolo_4567"]),
+            ({"event_type": "event_type_1", "name__regexp": "yolo_[0-9]{4}"}, []),
+            ({"event_type": "event_type_1", "name__startswith": "fomo"}, ["fomo_4567"]),
+            ({"event_type": "event_type_1", "probe.id": 13}, ["fomo_4567"]),
+        ):
+            self.assertEqual([e.payload["name"] for e in self.event_store.probe_events_fetch(probe, **search_dict)],
+                             expected_names)
+
+    def test_probe_events_aggregations(self):
+        for idx in range(5):
+            self._store({"name": "name{}".format(idx % 2), "version": str(idx % 3), "tags": ["a", "b"]})
+        probe = make_probe({"filters": {"metadata": [{"event_types": ["event_type_1", "event_type_2"]}]}})
+        probe.get_aggregations = Mock(return_value={
+            "created_at": {"type": "date_histogram", "interval": "day", "bucket_number": 3, "label": "Events"},
+            "tags": {"type": "terms", "bucket_number": 1},
+            "event_type": {"type": "terms", "bucket_number": 10},
+            "bundles": {"type": "table", "bucket_number": 1, "columns": [("name", "Name"), ("version", "Version")]},
+        })
+        results = self.event_store.probe_events_aggregations(probe)
+        histogram = results["created_at"]
+        self.assertEqual(histogram["interval"], "day")
+        self.assertEqual([count for _, count in histogram["values"]], [0, 0, 5])
+        self.assertEqual(histogram["values"][-1][0].date(), datetime.utcnow().date())
+        self.assertEqual(results["tags"]["values"], [("a", 5), (None, 5)])
+        self.assertEqual(results["event_type"]["values"], [("event_type_1", 5)])
+        self.assertEqual(results["bundles"]["values"],
+                         [{"name": "name0", "version": "0", "event_count": 1},
+                          {"name": "…", "version": "…", "event_count": 4}])
+
+    def test_incident_events(self):
+        incident = Mock(pk=123)
+        self._store({"name": "trigger"}, incidents=[{"pk": 123, "name": "incident"}])
+        self._store({"incident": {"pk": 123}, "name": "incident"}, first_type=False)
+        self._store({"machine_incident": {"pk": 1, "incident": {"pk": 123}}, "name": "machine incident"},
+                    first_type=False)
+        self._store({"incident": {"pk": 456}, "name": "other incident"}, first_type=False)
+        self.assertEqual(self.event_store.incident_events_count(incident), 3)
+        events = list(self.event_store.incident_events_fetch(incident, limit=2))
+        self.assertEqual([e.payload["name"] for e in events], ["machine incident", "incident"])
+        events = list(self.event_store.incident_events_fetch(incident, offset=2))
+        self.assertEqual(events[0].metadata.incidents, [{"pk": 123, "name": "incident"}])
+
+    def test_app_hist_data(self):
+        self._store({"idx": 1}, serial_number="1")
+        self._store({"idx": 2}, serial_number="1")
+        self._store({"idx": 3}, serial_number="2", tags=["yolo"])
+        self._store({"idx": 4}, first_type=False, serial_number="3")
+        self._store({"idx": 5}, created_at=datetime.utcnow() - timedelta(hours=3))
+        data = self.event_store.get_app_hist_data("hour", 2, event_type="event_type_1")
+        self.assertEqual(len(data), 2)
+        self.assertEqual(data[-1][1:], (3, 2))
+        data = self.event_store.get_app_hist_data("month", 12, tag="yolo")
+        self.assertEqual(len(data), 12)
+        self.assertEqual(data[-1][1:], (1, 1))
+        self.assertEqual(data[-1][0].day, 1)
+        data = self.event_store.get_app_hist_data("week", 2, event_type=["event_type_1", "event_type_2"])
+        self.assertEqual(data[-1][0].weekday(), 0)
+        self.assertEqual(data[-1][1] + data[0][1], 5)
+
+    def test_last_machine_heartbeats(self):
+        self._store({"source": {"name": "yolo"}}, first_type=False)
+        self.event_store.wait_and_configure()
+        with self.event_store._writer.cursor() as cur:
+            cur.execute("update events set event_type = 'inventory_heartbeat'")
+        self.assertEqual([(event_cls.event_type, source_name)
+                          for event_cls, source_name, _ in self.event_store.get_last_machine_heartbeats("012356789")],
+                         [("inventory_heartbeat", "yolo")])
+
+    def test_pool_reuse(self):
+        self._store({"idx": 1})
+        for _ in range(3):
+            self.assertEqual(self.event_store.machine_events_count("012356789"), 1)
+        self.assertIs(self.event_store._reader, self.event_store._writer)
+        self.assertEqual(self.event_store._writer._size, 1)
+        self.assertEqual(len(self.event_store._writer._idle), 1)
+
+    def test_pool_reconnect(self):
+        metrics_exporter = Mock()
+        self.event_store.setup_metrics_exporter(metrics_exporter)
+        self._store({"idx": 1})
+        conn, _ = self.event_store._writer._idle[-1]
+        self._terminate_backend(conn)
+        # broken connection discarded, query retried with a new connection
+        self.assertEqual(self.event_store.machine_events_count("012356789"), 1)
+        self.assertTrue(conn.closed)
+        self.assertEqual(self.event_store._writer._size, 1)
+        metrics_exporter.inc.assert_called_once_with("postgres_event_store_pool_broken_connections",
+                                                     "postgres_test", "writer")
+        metrics_exporter.set.assert_has_calls([
+            call("postgres_event_store_pool_connections", "postgres_test", "writer", "idle", value=1),
+            call("postgres_event_store_pool_connections", "postgres_test", "writer", "in_use", value=0),
+        ])
+        metrics_exporter.observe.assert_called_with("postgres_event_store_pool_wait_seconds",
+                                                    "postgres_test", "writer", value=unittest.mock.ANY)
+
+    def test_pool_write_error_not_retried(self):
+        self._store({"idx": 1})
+        conn, _ = self.event_store._writer._idle[-1]
+        self._terminate_backend(conn)
+        with self.assertRaises(psycopg2.OperationalError):
+            self._store({"idx": 2})
+        # broken connection discarded, the next write gets a new connection
+        self.assertEqual(self.event_store._writer._size, 0)
+        self._store({"idx": 3})
+        self.assertEqual(sorted(e.payload["idx"] for e in self.event_store.machine_events_fetch("012356789")),
+                         [1, 3])
+
+    def test_pool_health_check(self):
+        self._store({"idx": 1})
+        conn, _ = self.event_store._writer._idle[-1]
+        self._terminate_backend(conn)
+        self.event_store._writer.health_check_interval = 0
+        new_conn = self.event_store._writer.getconn()
+        self.assertIsNot(new_conn, conn)
+        self.assertTrue(conn.closed)
+        self.event_store._writer.putconn(new_conn)
+
+    def test_pool_timeout(self):
+        self.event_store._writer.max_size = 1
+        self.event_store._writer.max_wait = 0.01
+        conn = self.event_store._writer.getconn()
+        with self.assertRaises(PoolTimeout):
+            self.event_store._writer.getconn()
+        self.event_store._writer.putconn(conn)
+        self.assertIs(self.event_store._writer.getconn(), conn)
+        self.event_store._writer.putconn(conn)
+
+    def test_reader_dsn(self):
+        self.event_store.close()
+        dsn = " ".join("{}={}".format("dbname" if k == "database" else k, v)
+                       for k, v in self.store_settings.items() if k != "store_name")
+        self.event_store = PostgresEventStore(dict(self.store_settings, reader_dsn=dsn))
+        self.assertIsNot(self.event_store._reader, self.event_store._writer)
+        self._store({"idx": 1})
+        self.assertEqual(self.event_store.machine_events_count("012356789"), 1)
+        self.assertEqual(self.event_store._reader._size, 1)
+        with self.event_store._reader.cursor() as cur:
+            with self.assertRaises(psycopg2.errors.ReadOnlySqlTransaction):
                 cur.execute("delete from events *;")
+
+    def tearDown(self):
+        with self.event_store._writer.cursor() as cur:
+            cur.execute("delete from events *;")
         self.event_store.close()
 
 
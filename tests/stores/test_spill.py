@@ -0,0 +1,118 @@
+import os
+import shutil
+import tempfile
+import time
+from django.test import SimpleTestCase
+from zentral.core.stores.spill import CircuitBreaker, SpillLog
+
+
+def build_event_d(idx):
+    return {"_zentral": {"id": "e7e2b5fa-3b5c-4c5b-8a47-5c1d5b3e6f{:02d}".format(idx % 100),
+                         "index": idx,
+                         "type": "base"},
+            "idx": idx}
+
+
+class SpillLogTestCase(SimpleTestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _read_all(self, spill_log):
+        event_ds = []
+        while True:
+            record_event_ds, position = spill_log.read()
+            if record_event_ds is None:
+                break
+            event_ds.extend(record_event_ds)
+            spill_log.commit(position)
+        return event_ds
+
+    def test_append_read(self):
+        spill_log = SpillLog(self.directory)
+        self.assertTrue(spill_log.is_empty())
+        self.assertTrue(spill_log.append([build_event_d(0), build_event_d(1)]))
+        self.assertTrue(spill_log.append([build_event_d(2)]))
+        self.assertFalse(spill_log.is_empty())
+        self.assertEqual([event_d["idx"] for event_d in self._read_all(spill_log)], [0, 1, 2])
+        self.assertTrue(spill_log.is_empty())
+        self.assertEqual(spill_log.read(), (None, None))
+        spill_log.close()
+
+    def test_segment_rotation(self):
+        spill_log = SpillLog(self.directory, max_segment_size=256)
+        for idx in range(20):
+            self.assertTrue(spill_log.append([build_event_d(idx)]))
+        segments = [f for f in os.listdir(self.directory) if f.endswith(SpillLog.SEGMENT_SUFFIX)]
+        self.assertTrue(len(segments) > 1)
+        self.assertEqual([event_d["idx"] for event_d in self._read_all(spill_log)], list(range(20)))
+        self.assertEqual([f for f in os.listdir(self.directory) if f.endswith(SpillLog.SEGMENT_SUFFIX)], [])
+        spill_log.close()
+
+    def test_max_size(self):
+        spill_log = SpillLog(self.directory, max_size=200)
+        self.assertTrue(spill_log.append([build_event_d(0)]))
+        self.assertFalse(spill_log.append([build_event_d(idx) for idx in range(1, 20)]))
+        spill_log.close()
+
+    def test_checkpoint(self):
+        spill_log = SpillLog(self.directory)
+        for idx in range(3):
+            spill_log.append([build_event_d(idx)])
+        event_ds, position = spill_log.read()
+        spill_log.commit(position)
+        # read, but not committed
+        spill_log.read()
+        spill_log.close()
+        spill_log = SpillLog(self.directory)
+        spill_log.append([build_event_d(3)])
+        self.assertEqual([event_d["idx"] for event_d in self._read_all(spill_log)], [1, 2, 3])
+        spill_log.close()
+
+    def test_truncated_record(self):
+        spill_log = SpillLog(self.directory)
+        spill_log.append([build_event_d(0)])
+        spill_log.append([build_event_d(1)])
+        spill_log.close()
+        segment_path = os.path.join(self.directory, sorted(f for f in os.listdir(self.directory)
+                                                           if f.endswith(SpillLog.SEGMENT_SUFFIX))[0])
+        with open(segment_path, "r+b") as f:
+            f.truncate(os.path.getsize(segment_path) - 3)
+        spill_log = SpillLog(self.directory)
+        spill_log.append([build_event_d(2)])
+        self.assertEqual([event_d["idx"] for event_d in self._read_all(spill_log)], [0, 2])
+        spill_log.close()
+
+    def test_lock(self):
+        spill_log = SpillLog.open_for_store(self.directory, "yolo store")
+        self.assertEqual(spill_log.directory, os.path.join(self.directory, "yolo_store", "0"))
+        with self.assertRaises(BlockingIOError):
+            SpillLog(spill_log.directory)
+        spill_log2 = SpillLog.open_for_store(self.directory, "yolo store")
+        self.assertEqual(spill_log2.directory, os.path.join(self.directory, "yolo_store", "1"))
+        spill_log.close()
+        spill_log2.close()
+
+
+class CircuitBreakerTestCase(SimpleTestCase):
+    def test_open_close(self):
+        circuit_breaker = CircuitBreaker(failure_threshold=2, retry_delay=0.05)
+        self.assertTrue(circuit_breaker.allow_request())
+        circuit_breaker.record_failure()
+        self.assertTrue(circuit_breaker.allow_request())
+        circuit_breaker.record_failure()
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(circuit_breaker.allow_request())
+        time.sleep(0.06)
+        self.assertTrue(circuit_breaker.allow_request())
+        self.assertEqual(circuit_breaker.state, CircuitBreaker.HALF_OPEN)
+        # a single failure re-opens the circuit
+        circuit_breaker.record_failure()
+        self.assertFalse(circuit_breaker.allow_request())
+        time.sleep(0.06)
+        self.assertTrue(circuit_breaker.allow_request())
+        circuit_breaker.record_success()
+        self.assertTrue(circuit_breaker.is_closed())
+        self.assertEqual(circuit_breaker.failures, 0)
@@ -0,0 +1,51 @@
+from django.test import SimpleTestCase
+from zentral.utils.lru import LRUCache
+
+
+class LRUCacheTestCase(SimpleTestCase):
+    def test_get_set(self):
+        cache = LRUCache(2)
+        self.assertIsNone(cache.get("un"))
+        cache.set("un", 1)
+        self.assertEqual(cache.get("un"), 1)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+    def test_eviction(self):
+        cache = LRUCache(2)
+        cache.set("un", 1)
+        cache.set("deux", 2)
+        cache.get("un")
+        cache.set("trois", 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get("un"), 1)
+        self.assertIsNone(cache.get("deux"))
+        self.assertEqual(cache.get("trois"), 3)
+
+    def test_get_or_set_none(self):
+        cache = LRUCache(2)
+        calls = []
+
+        def getter():
+            calls.append(1)
+            return None
+
+        self.assertIsNone(cache.get_or_set("un", getter))
+        self.assertIsNone(cache.get_or_set("un", getter))
+        self.assertEqual(len(calls), 1)
+
+    def test_get_or_set_invalidated(self):
+        cache = LRUCache(2)
+
+        def getter():
+            # invalidation while the value is computed
+            cache.delete("un")
+            return 1
+
+        self.assertEqual(cache.get_or_set("un", getter), 1)
+        self.assertEqual(len(cache), 0)
+
+    def test_clear(self):
+        cache = LRUCache(2)
+        cache.set("un", 1)
+        cache.clear()
+        self.assertIsNone(cache.get("un"))
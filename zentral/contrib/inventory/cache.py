@@ -0,0 +1,96 @@
+import logging
+import os
+import threading
+import weakref
+from zentral.conf import settings
+from zentral.core.probes.conf import zentral_probes_sync
+from zentral.core.probes.sync import PostgresNotificationListener
+from zentral.utils.lru import LRUCache
+
+
+logger = logging.getLogger("zentral.contrib.inventory.cache")
+
+
+# see the inventory 0052 migration for the triggers sending the notifications
+machine_change_channel = "inventory_machine_change"
+ALL_MACHINES = "*"
+
+
+class ProbeFilteringValuesSync(PostgresNotificationListener):
+    channel = machine_change_channel
+
+    def __init__(self, cache):
+        self.cache = weakref.ref(cache)
+        super().__init__()
+
+    def handle_error_recovery(self):
+        cache = self.cache()
+        if cache is None:
+            logger.error("Could not get probe filtering values cache.")
+            return False
+        # we might have missed some updates
+        logger.info("DB error recovery. Clear probe filtering values cache.")
+        cache.clear()
+        return True
+
+    def handle_notifications(self, payloads):
+        cache = self.cache()
+        if cache is None:
+            logger.error("Could not get probe filtering values cache.")
+            return False
+        for serial_number in set(payloads):
+            if serial_number == ALL_MACHINES:
+                cache.clear()
+                break
+            cache.delete(serial_number)
+        return True
+
+
+class ProbeFilteringValuesCache(object):
+    """
+    Process local machine serial number → probe filtering values cache.
+
+    Only active when the cache can be invalidated, i.e. when the sync thread is listening
+    to the machine change notifications.
+    """
+    def __init__(self, maxsize, with_sync):
+        self._lru = LRUCache(maxsize)
+        self.with_sync = with_sync
+        self.sync = None
+        self._sync_pid = None
+        self._sync_lock = threading.Lock()
+
+    def _start_sync(self):
+        with self._sync_lock:
+            pid = os.getpid()
+            if self.sync is not None and self._sync_pid == pid:
+                if self.sync.is_alive():
+                    return
+                else:
+                    logger.error("Sync thread is not alive. Last heartbeat %s.", self.sync.last_heartbeat or "-")
+            # forked process, or dead thread → we might have missed some updates
+            self.clear()
+            self.sync = ProbeFilteringValuesSync(self)
+            self._sync_pid = pid
+            self.sync.start()
+
+    def is_active(self):
+        if not self.with_sync:
+            return False
+        self._start_sync()
+        return self.sync.listening
+
+    def get(self, serial_number, getter):
+        return self._lru.get_or_set(serial_number, getter)
+
+    def delete(self, serial_number):
+        self._lru.delete(serial_number)
+
+    def clear(self):
+        self._lru.clear()
+
+
+probe_filtering_values_cache = ProbeFilteringValuesCache(
+    int(settings['apps']['zentral.contrib.inventory'].get("probe_filtering_values_cache_size", 10000)),
+    zentral_probes_sync
+)
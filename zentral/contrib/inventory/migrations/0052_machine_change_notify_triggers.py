@@ -0,0 +1,66 @@
+from django.db import migrations
+
+
+# NOTIFY the probe filtering values changes on the "inventory_machine_change" channel
+# see zentral.contrib.inventory.cache
+
+
+CREATE_TRIGGERS = """
+CREATE OR REPLACE FUNCTION inventory_machine_change_notify() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP = 'DELETE' THEN
+    PERFORM pg_notify('inventory_machine_change', OLD.serial_number);
+  ELSE
+    PERFORM pg_notify('inventory_machine_change', NEW.serial_number);
+    IF TG_OP = 'UPDATE' AND OLD.serial_number <> NEW.serial_number THEN
+      PERFORM pg_notify('inventory_machine_change', OLD.serial_number);
+    END IF;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION inventory_all_machines_change_notify() RETURNS trigger AS $$
+BEGIN
+  PERFORM pg_notify('inventory_machine_change', '*');
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER inventory_machinetag_change_notify
+AFTER INSERT OR UPDATE OR DELETE ON inventory_machinetag
+FOR EACH ROW EXECUTE PROCEDURE inventory_machine_change_notify();
+
+CREATE TRIGGER inventory_currentmachinesnapshot_change_notify
+AFTER INSERT OR UPDATE OR DELETE ON inventory_currentmachinesnapshot
+FOR EACH ROW EXECUTE PROCEDURE inventory_machine_change_notify();
+
+CREATE TRIGGER inventory_metabusinessunittag_change_notify
+AFTER INSERT OR UPDATE OR DELETE ON inventory_metabusinessunittag
+FOR EACH STATEMENT EXECUTE PROCEDURE inventory_all_machines_change_notify();
+
+CREATE TRIGGER inventory_businessunit_change_notify
+AFTER UPDATE OF meta_business_unit_id ON inventory_businessunit
+FOR EACH STATEMENT EXECUTE PROCEDURE inventory_all_machines_change_notify();
+"""
+
+
+DROP_TRIGGERS = """
+DROP TRIGGER IF EXISTS inventory_businessunit_change_notify ON inventory_businessunit;
+DROP TRIGGER IF EXISTS inventory_metabusinessunittag_change_notify ON inventory_metabusinessunittag;
+DROP TRIGGER IF EXISTS inventory_currentmachinesnapshot_change_notify ON inventory_currentmachinesnapshot;
+DROP TRIGGER IF EXISTS inventory_machinetag_change_notify ON inventory_machinetag;
+DROP FUNCTION IF EXISTS inventory_all_machines_change_notify();
+DROP FUNCTION IF EXISTS inventory_machine_change_notify();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0051_auto_20201202_1025'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_TRIGGERS, DROP_TRIGGERS),
+    ]
@@ -22,6 +22,7 @@ from zentral.conf import settings
 from zentral.core.incidents.models import MachineIncident, OPEN_STATUSES
 from zentral.utils.model_extras import find_all_related_objects
 from zentral.utils.mt_models import AbstractMTObject, prepare_commit_tree, MTObjectManager, MTOError
+from .cache import probe_filtering_values_cache
 from .conf import (has_deb_packages,
                    update_ms_tree_platform, update_ms_tree_type,
                    PLATFORM_CHOICES, PLATFORM_CHOICES_DICT,
@@ -733,6 +734,7 @@ class MetaMachine(object):
     """Simplified access to the ms."""
     def __init__(self, serial_number, snapshots=None):
         self.serial_number = serial_number
+        self._probe_filtering_values = None
 
     @classmethod
     def from_urlsafe_serial_number(cls, urlsafe_serial_number):
@@ -964,12 +966,20 @@ class MetaMachine(object):
                     tag_ids)
 
     def get_cached_probe_filtering_values(self):
-        filtering_values_cache_key = "probe_filtering_values_{}".format(self.get_urlsafe_serial_number())
-        filtering_values = cache.get(filtering_values_cache_key)
-        if filtering_values is None:
-            filtering_values = self.get_probe_filtering_values()
-            cache.set(filtering_values_cache_key, filtering_values, 60)  # TODO: Hard coded timeout value
-        return filtering_values
+        # memoized, because it is called for each probe with inventory filters
+        if self._probe_filtering_values is None:
+            if probe_filtering_values_cache.is_active():
+                # process local cache, invalidated by the machine change notifications
+                filtering_values = probe_filtering_values_cache.get(self.serial_number,
+                                                                    self.get_probe_filtering_values)
+            else:
+                filtering_values_cache_key = "probe_filtering_values_{}".format(self.get_urlsafe_serial_number())
+                filtering_values = cache.get(filtering_values_cache_key)
+                if filtering_values is None:
+                    filtering_values = self.get_probe_filtering_values()
+                    cache.set(filtering_values_cache_key, filtering_values, 60)  # TODO: Hard coded timeout value
+            self._probe_filtering_values = filtering_values
+        return self._probe_filtering_values
 
 
 class MACAddressBlockAssignmentOrganization(models.Model):
@@ -436,59 +436,41 @@ class ArchiveMachineView(LoginRequiredMixin, TemplateView):
         return redirect('inventory:index')
 
 
-class MachineEventSet(object):
-    def __init__(self, machine_serial_number, event_type=None):
-        self.machine_serial_number = machine_serial_number
-        self.event_type = event_type
-        self.store = frontend_store
-        self._count = None
-
-    def count(self):
-        if self._count is None:
-            self._count = self.store.machine_events_count(self.machine_serial_number, self.event_type)
-        return self._count
-
-    def __len__(self):
-        return self.count()
-
-    def __getitem__(self, k):
-        if isinstance(k, slice):
-            start = int(k.start or 0)
-            stop = int(k.stop or start + 1)
-        else:
-            start = k
-            stop = k + 1
-        for event in self.store.machine_events_fetch(self.machine_serial_number, start, stop - start, self.event_type):
-            if not self.event_type:
-                link = "?event_type={}".format(event.event_type)
-            else:
-                link = None
-            yield event, link
-
-
-class MachineEventsView(LoginRequiredMixin, ListView):
+class MachineEventsView(LoginRequiredMixin, TemplateView):
     template_name = "inventory/machine_events.html"
     paginate_by = 10
 
     def get_context_data(self, **kwargs):
         context = super(MachineEventsView, self).get_context_data(**kwargs)
+        self.machine = MetaMachine.from_urlsafe_serial_number(self.kwargs["urlsafe_serial_number"])
+        self.serial_number = self.machine.serial_number
         context["machine"] = self.machine
         context["serial_number"] = self.serial_number
+        request_event_type = self.request.GET.get('event_type')
+
+        # events page
+        events, next_cursor, previous_cursor = frontend_store.machine_events_fetch_page(
+            self.serial_number,
+            cursor=self.request.GET.get('cursor'),
+            limit=self.paginate_by,
+            event_type=request_event_type
+        )
+        context["object_list"] = [(event, None if request_event_type else "?event_type={}".format(event.event_type))
+                                  for event in events]
+
         # pagination
-        page = context['page_obj']
-        if page.has_next():
+        if next_cursor:
             qd = self.request.GET.copy()
-            qd['page'] = page.next_page_number()
+            qd['cursor'] = next_cursor
             context['next_url'] = "?{}".format(qd.urlencode())
-        if page.has_previous():
+        if previous_cursor:
             qd = self.request.GET.copy()
-            qd['page'] = page.previous_page_number()
+            qd['cursor'] = previous_cursor
             context['previous_url'] = "?{}".format(qd.urlencode())
         event_types = []
         total_events = 0
 
         # event types selection
-        request_event_type = self.request.GET.get('event_type')
         for event_type, count in frontend_store.machine_events_types_with_usage(
                 self.serial_number).items():
             total_events += count
@@ -502,12 +484,6 @@ class MachineEventsView(LoginRequiredMixin, ListView):
         context['event_types'] = event_types
         return context
 
-    def get_queryset(self):
-        self.machine = MetaMachine.from_urlsafe_serial_number(self.kwargs["urlsafe_serial_number"])
-        self.serial_number = self.machine.serial_number
-        et = self.request.GET.get('event_type')
-        return MachineEventSet(self.serial_number, et)
-
 
 class MachineMacOSAppInstancesView(LoginRequiredMixin, TemplateView):
     template_name = "inventory/machine_macos_app_instances.html"
@@ -1,4 +1,6 @@
+import threading
 from django import forms
+import requests
 from zentral.conf import contact_groups
 
 
@@ -17,7 +19,18 @@ class BaseAction(object):
 
     def __init__(self, config_d):
         self.name = config_d.pop("action_name")
+        # action dispatcher options, to override the events.action_dispatcher ones
+        self.dispatcher_config = config_d.pop("dispatcher", None)
         self.config_d = config_d
+        self._local = threading.local()
+
+    @property
+    def session(self):
+        # one requests session per thread, to reuse the HTTP connections
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+        return session
 
     def can_be_updated(self):
         return self.action_form_class != BaseActionForm
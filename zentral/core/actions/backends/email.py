@@ -1,6 +1,7 @@
 from email.mime.text import MIMEText
 import logging
-from smtplib import SMTP, SMTP_SSL, SMTPException
+from smtplib import SMTP, SMTP_SSL, SMTPServerDisconnected
+import threading
 from zentral.conf import contact_groups
 from zentral.core.actions.backends.base import BaseAction, ContactGroupForm
 
@@ -13,6 +14,8 @@ class Action(BaseAction):
     def __init__(self, config_d):
         super(Action, self).__init__(config_d)
         self.conn = None
+        # the SMTP connection is kept open, and shared by the action dispatcher threads
+        self._conn_lock = threading.Lock()
 
     def _open(self):
         if self.conn:
@@ -53,9 +56,20 @@ class Action(BaseAction):
         msg['Subject'] = ' - '.join(event.get_notification_subject(probe).splitlines())
         msg['From'] = email_from
         msg['To'] = ",".join(recipients)
-        try:
-            self._open()
-            self.conn.sendmail(email_from, recipients, msg.as_string())
-            self._close()
-        except SMTPException:
-            logger.exception("SMTP exception")
+        with self._conn_lock:
+            try:
+                self._open()
+                try:
+                    self.conn.sendmail(email_from, recipients, msg.as_string())
+                except SMTPServerDisconnected:
+                    # stale persistent connection, retry once with a new one
+                    self.conn = None
+                    self._open()
+                    self.conn.sendmail(email_from, recipients, msg.as_string())
+            except Exception:
+                # the errors are logged, and the transient ones retried, by the caller
+                try:
+                    self._close()
+                except OSError:
+                    pass
+                raise
@@ -2,7 +2,6 @@
 import json
 import logging
 from django import forms
-import requests
 from zentral.utils.forms import CommaSeparatedQuotedStringField
 from .base import BaseAction, BaseActionForm
 
@@ -59,8 +58,8 @@ class Action(BaseAction):
         if tags:
             args['tags'] = tags
         args.update(action_config_d)
-        r = requests.post(self.url, headers={'Content-Type': 'application/json'},
-                          data=json.dumps(args), auth=self.auth)
+        r = self.session.post(self.url, headers={'Content-Type': 'application/json'},
+                              data=json.dumps(args), auth=self.auth)
         if not r.ok:
             logger.error(r.text)
         r.raise_for_status()
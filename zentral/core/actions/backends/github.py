@@ -43,8 +43,8 @@ class Action(BaseAction):
         if "labels" in action_config_d:
             args["labels"] = action_config_d["labels"]
 
-        r = requests.post(url,
-                          auth=(self.config_d["user"], self.config_d["access_token"]),
-                          headers={'Accept': "application/vnd.github.v3+json"}, data=json.dumps(args)
-                          )
+        r = self.session.post(url,
+                              auth=(self.config_d["user"], self.config_d["access_token"]),
+                              headers={'Accept': "application/vnd.github.v3+json"}, data=json.dumps(args)
+                              )
         r.raise_for_status()
@@ -1,4 +1,3 @@
-import requests
 from .base import BaseAction
 
 
@@ -8,5 +7,5 @@ class Action(BaseAction):
         payload = {'text': '\n\n'.join([event.get_notification_subject(probe),
                                         event.get_notification_body(probe)])}
         url = self.config_d['webhook']
-        r = requests.post(url, json=payload)
+        r = self.session.post(url, json=payload)
         r.raise_for_status()
@@ -1,5 +1,4 @@
 import json
-import requests
 from .base import BaseAction
 
 
@@ -14,8 +13,8 @@ class Action(BaseAction):
                     self.config_d["basic_auth"]["password"])
         headers = {'Accept': 'application/json'}
         headers.update(self.config_d.get("headers", {}))
-        r = requests.post(url,
-                          auth=auth,
-                          headers=headers,
-                          data=json.dumps(event.serialize()))
+        r = self.session.post(url,
+                              auth=auth,
+                              headers=headers,
+                              data=json.dumps(event.serialize()))
         r.raise_for_status()
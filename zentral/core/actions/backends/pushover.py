@@ -1,4 +1,3 @@
-import requests
 from zentral.conf import contact_groups
 from .base import BaseAction, ContactGroupForm
 
@@ -18,4 +17,4 @@ class Action(BaseAction):
                 pushover_user_token = contact_d.get('pushover_user_token', None)
                 if pushover_user_token:
                     args['user'] = pushover_user_token
-                    requests.post(API_ENDPOINT, data=args)
+                    self.session.post(API_ENDPOINT, data=args)
@@ -1,5 +1,4 @@
 import json
-import requests
 from .base import BaseAction
 
 API_ENDPOINT_TMPL = "https://slack.com/api/{}"
@@ -11,7 +10,7 @@ class Action(BaseAction):
         args = {'text': '\n\n'.join([event.get_notification_subject(probe),
                                      event.get_notification_body(probe)])}
         url = self.config_d['webhook']
-        r = requests.post(url,
-                          headers={'Accept': 'application/json'},
-                          data=json.dumps(args))
+        r = self.session.post(url,
+                              headers={'Accept': 'application/json'},
+                              data=json.dumps(args))
         r.raise_for_status()
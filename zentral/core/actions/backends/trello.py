@@ -10,8 +10,9 @@ class TrelloClient(object):
     """Trello API Client"""
     API_BASE_URL = "https://api.trello.com/1"
 
-    def __init__(self, app_key, token):
+    def __init__(self, app_key, token, session=None):
         super(TrelloClient, self).__init__()
+        self.session = session or requests.Session()
         self.common_args = {
             "key": app_key,
             "token": token
@@ -21,7 +22,7 @@ class TrelloClient(object):
         url = "%s/members/me/boards" % self.API_BASE_URL
         args = self.common_args.copy()
         args["fields"] = "name"
-        r = requests.get(url, data=args)
+        r = self.session.get(url, data=args)
         if not r.ok:
             logger.error(r.text)
             r.raise_for_status()
@@ -35,7 +36,7 @@ class TrelloClient(object):
         url = "%s/boards/%s/lists" % (self.API_BASE_URL, board_id)
         args = self.common_args.copy()
         args["fields"] = "name"
-        r = requests.get(url, data=args)
+        r = self.session.get(url, data=args)
         if not r.ok:
             logger.error(r.text)
             r.raise_for_status()
@@ -47,7 +48,7 @@ class TrelloClient(object):
 
     def get_or_create_label(self, board_id, color, text):
         url = "%s/boards/%s/labels" % (self.API_BASE_URL, board_id)
-        r = requests.get(url, data=self.common_args)
+        r = self.session.get(url, data=self.common_args)
         if not r.ok:
             logger.error(r.text)
             r.raise_for_status()
@@ -59,7 +60,7 @@ class TrelloClient(object):
         args = self.common_args.copy()
         args["name"] = text
         args["color"] = color
-        r = requests.post(url, data=args)
+        r = self.session.post(url, data=args)
         if not r.ok:
             logger.error(r.text)
             r.raise_for_status()
@@ -85,7 +86,7 @@ class TrelloClient(object):
                      "idLabels": id_labels,
                      "pos": "top"})
         url = "%s/cards" % self.API_BASE_URL
-        r = requests.post(url, data=args)
+        r = self.session.post(url, data=args)
         if not r.ok:
             logger.error(r.text)
             r.raise_for_status()
@@ -108,8 +109,8 @@ class Action(BaseAction):
 
     def __init__(self, config_d):
         super(Action, self).__init__(config_d)
-        self.client = TrelloClient(config_d["application_key"],
-                                   config_d["token"])
+        self.application_key = config_d["application_key"]
+        self.token = config_d["token"]
         self.default_board = config_d.get("default_board", None)
         self.default_list = config_d.get("default_list", None)
 
@@ -121,7 +122,8 @@ class Action(BaseAction):
         list_name = action_config_d.get("list", self.default_list)
         if not list_name:
             raise ValueError("No list name")
-        self.client.create_card(board_name, list_name,
-                                event.get_notification_subject(probe),
-                                event.get_notification_body(probe),
-                                action_config_d.get('labels', []))
+        client = TrelloClient(self.application_key, self.token, self.session)
+        client.create_card(board_name, list_name,
+                           event.get_notification_subject(probe),
+                           event.get_notification_body(probe),
+                           action_config_d.get('labels', []))
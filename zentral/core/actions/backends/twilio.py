@@ -1,4 +1,3 @@
-import requests
 from .base import BaseAction, ContactGroupForm
 from zentral.conf import contact_groups
 
@@ -25,5 +24,5 @@ class Action(BaseAction):
                 cell_number = contact_d.get('cell', None)
                 if cell_number:
                     args['To'] = cell_number
-                    r = requests.post(self.url, data=args, auth=self.auth)
+                    r = self.session.post(self.url, data=args, auth=self.auth)
                     r.raise_for_status()
@@ -0,0 +1,274 @@
+import atexit
+import json
+import logging
+import queue
+import random
+from smtplib import SMTPException, SMTPResponseException, SMTPServerDisconnected
+import threading
+import time
+from django.db import close_old_connections, connection
+import requests
+from zentral.conf import settings
+
+
+logger = logging.getLogger("zentral.core.actions.dispatcher")
+
+
+class TokenBucket(object):
+    """Thread safe token bucket rate limiter.
+
+    rate tokens are added every second, up to burst tokens.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = max(float(burst or rate), 1)
+        self.tokens = self.burst
+        self.last_ts = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        """Take a token, and return the number of seconds to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last_ts) * self.rate)
+            self.last_ts = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def acquire(self, stop_event=None):
+        """Block until a token is available. Returns the number of seconds waited."""
+        delay = self._reserve()
+        if delay > 0:
+            if stop_event:
+                stop_event.wait(delay)
+            else:
+                time.sleep(delay)
+        return delay
+
+
+def is_retryable_exception(exception):
+    if isinstance(exception, requests.HTTPError) and exception.response is not None:
+        status_code = exception.response.status_code
+        return status_code == 429 or status_code >= 500
+    if isinstance(exception, SMTPResponseException):
+        # 4xx transient errors, 5xx permanent errors
+        return 400 <= exception.smtp_code < 500
+    if isinstance(exception, SMTPException):
+        # the recipients refused errors are permanent
+        return isinstance(exception, SMTPServerDisconnected)
+    return True
+
+
+class ActionExecutor(object):
+    """Trigger the actions of a backend in a bounded pool of threads."""
+
+    def __init__(self, action, max_workers=2, max_queue_size=1000, enqueue_timeout=1,
+                 rate_limit=None, burst=None,
+                 max_retries=3, retry_backoff=1, max_retry_backoff=60,
+                 coalesce_window=0,
+                 metrics_exporter=None):
+        self.action = action
+        self.max_workers = max(int(max_workers), 1)
+        self.queue = queue.Queue(maxsize=max(int(max_queue_size), 1))
+        self.enqueue_timeout = float(enqueue_timeout)
+        self.rate_limiter = TokenBucket(rate_limit, burst) if rate_limit else None
+        self.max_retries = max(int(max_retries), 0)
+        self.retry_backoff = float(retry_backoff)
+        self.max_retry_backoff = float(max_retry_backoff)
+        self.coalesce_window = float(coalesce_window)
+        self._coalesce_keys = {}
+        self._coalesce_lock = threading.Lock()
+        self.metrics_exporter = metrics_exporter
+        self._stop_event = threading.Event()
+        self._threads = []
+
+    # metrics
+
+    def inc_counter(self, status, value=1):
+        if self.metrics_exporter:
+            self.metrics_exporter.inc("dispatched_actions", self.action.name, status, value=value)
+
+    def update_queue_depth(self):
+        if self.metrics_exporter:
+            self.metrics_exporter.set("dispatched_actions_queue_depth", self.action.name, value=self.queue.qsize())
+
+    # coalescing
+
+    @staticmethod
+    def get_coalesce_key(event, probe, action_config_d):
+        return (probe.pk,
+                event.event_type,
+                event.metadata.machine_serial_number,
+                json.dumps(action_config_d, sort_keys=True, default=str))
+
+    def is_coalesced(self, event, probe, action_config_d):
+        """Return True if an identical notification has been dispatched during the coalesce window."""
+        if self.coalesce_window <= 0:
+            return False
+        key = self.get_coalesce_key(event, probe, action_config_d)
+        now = time.monotonic()
+        with self._coalesce_lock:
+            if len(self._coalesce_keys) > 10000:
+                self._coalesce_keys = {k: ts for k, ts in self._coalesce_keys.items()
+                                       if now - ts < self.coalesce_window}
+            last_ts = self._coalesce_keys.get(key)
+            if last_ts is not None and now - last_ts < self.coalesce_window:
+                return True
+            self._coalesce_keys[key] = now
+        return False
+
+    def forget_coalesce_key(self, event, probe, action_config_d):
+        """Forget a notification that could not be queued, to not coalesce the next identical ones."""
+        if self.coalesce_window <= 0:
+            return
+        with self._coalesce_lock:
+            self._coalesce_keys.pop(self.get_coalesce_key(event, probe, action_config_d), None)
+
+    # threads
+
+    def start(self):
+        for idx in range(self.max_workers):
+            thread = threading.Thread(target=self.run,
+                                      name="{} action #{}".format(self.action.name, idx),
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=10):
+        """Wait for the queued actions to be triggered, and stop the threads."""
+        deadline = time.monotonic() + timeout
+        for _ in self._threads:
+            try:
+                self.queue.put(None, timeout=max(deadline - time.monotonic(), 0))
+            except queue.Full:
+                break
+        for thread in self._threads:
+            thread.join(max(deadline - time.monotonic(), 0))
+        self._stop_event.set()
+        self._threads = []
+
+    def submit(self, event, probe, action_config_d):
+        """Queue an action. Returns False if the action was coalesced or dropped."""
+        if self.is_coalesced(event, probe, action_config_d):
+            self.inc_counter("coalesced")
+            return False
+        try:
+            self.queue.put((time.monotonic(), event, probe, action_config_d), timeout=self.enqueue_timeout)
+        except queue.Full:
+            logger.error("Action %s queue full. Notification dropped.", self.action.name)
+            self.forget_coalesce_key(event, probe, action_config_d)
+            self.inc_counter("dropped")
+            return False
+        self.inc_counter("queued")
+        self.update_queue_depth()
+        return True
+
+    def trigger(self, event, probe, action_config_d):
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.acquire(self._stop_event)
+            try:
+                self.action.trigger(event, probe, action_config_d)
+            except Exception as exception:
+                if attempt >= self.max_retries or not is_retryable_exception(exception):
+                    raise
+                delay = min(self.retry_backoff * 2 ** attempt, self.max_retry_backoff)
+                delay *= random.uniform(0.5, 1)
+                logger.warning("Could not trigger action %s: %s. Retry in %.1fs.",
+                               self.action.name, exception, delay)
+                self.inc_counter("retried")
+                attempt += 1
+                if self._stop_event.wait(delay):
+                    raise
+            else:
+                return
+
+    def run(self):
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                queued_ts, event, probe, action_config_d = item
+                self.update_queue_depth()
+                try:
+                    self.trigger(event, probe, action_config_d)
+                except Exception:
+                    logger.exception("Could not trigger action %s", self.action.name)
+                    self.inc_counter("failed")
+                else:
+                    self.inc_counter("succeeded")
+                finally:
+                    if self.metrics_exporter:
+                        self.metrics_exporter.observe("dispatched_actions_latency_seconds", self.action.name,
+                                                      value=time.monotonic() - queued_ts)
+                    # the notification bodies can require some DB queries
+                    close_old_connections()
+        finally:
+            connection.close()
+
+
+class ActionDispatcher(object):
+    """Queue the triggered actions, to keep the outbound requests out of the process worker loop.
+
+    One executor per action backend, started on the first dispatched action,
+    to only start the threads in the worker processes.
+    """
+
+    def __init__(self, config=None):
+        self.config = dict(config or {})
+        self.config.pop("enabled", None)
+        self.executors = {}
+        self.metrics_exporter = None
+        self._lock = threading.Lock()
+        self._atexit_registered = False
+
+    def setup_metrics_exporter(self, metrics_exporter):
+        self.metrics_exporter = metrics_exporter
+        if metrics_exporter:
+            metrics_exporter.add_counter("dispatched_actions", ["action", "status"])
+            metrics_exporter.add_histogram("dispatched_actions_latency_seconds", ["action"])
+            metrics_exporter.add_gauge("dispatched_actions_queue_depth", ["action"])
+
+    def get_executor(self, action):
+        executor = self.executors.get(action.name)
+        if executor is None:
+            with self._lock:
+                executor = self.executors.get(action.name)
+                if executor is None:
+                    executor_config = self.config.copy()
+                    executor_config.update(action.dispatcher_config or {})
+                    executor = ActionExecutor(action, metrics_exporter=self.metrics_exporter, **executor_config)
+                    executor.start()
+                    self.executors[action.name] = executor
+                    if not self._atexit_registered:
+                        atexit.register(self.stop)
+                        self._atexit_registered = True
+        return executor
+
+    def dispatch(self, action, event, probe, action_config_d):
+        return self.get_executor(action).submit(event, probe, action_config_d)
+
+    def stop(self, timeout=10):
+        """Wait for the queued actions to be triggered, and stop the executors.
+
+        Called by the process workers when they stop. The atexit handler only covers the main process.
+        """
+        with self._lock:
+            executors = list(self.executors.values())
+            self.executors = {}
+        for executor in executors:
+            executor.stop(timeout)
+
+
+def get_action_dispatcher():
+    config = settings.get("events", {}).get("action_dispatcher")
+    if config and config.get("enabled", True):
+        return ActionDispatcher(config)
+
+
+action_dispatcher = get_action_dispatcher()
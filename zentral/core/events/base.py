@@ -1,3 +1,4 @@
+import copy
 from datetime import datetime
 import logging
 import os.path
@@ -10,6 +11,7 @@ from django.contrib.contenttypes.models import ContentType
 from django.utils.functional import cached_property
 from django.utils.text import slugify
 from geoip2.models import City
+from zentral.conf import settings
 from zentral.contrib.inventory.models import MetaMachine
 from zentral.core.queues import queues
 from zentral.utils.http import user_agent_and_ip_address_from_request
@@ -22,6 +24,25 @@ logger = logging.getLogger('zentral.core.events.base')
 template_loader = TemplateLoader([os.path.join(os.path.dirname(__file__), 'templates')])
 
 
+# timeout of the serialized machine metadata cache entries
+machine_metadata_cache_timeout = int(settings.get("events", {}).get("machine_metadata_cache_timeout", 60))
+
+# max number of machine request payloads posted in a single event envelope message. 0 → no envelopes.
+event_envelope_max_payloads = int(settings.get("events", {}).get("envelope_max_payloads", 0))
+
+EVENT_ENVELOPE_KEY = "_zentral_envelope"
+
+
+def parse_created_at(value):
+    """Parse an ISO 8601 datetime string.
+
+    Fast path for the datetime.isoformat() output, used in the serialized events."""
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return parser.parse(value)
+
+
 def render_notification_part(ctx, event_type, part):
     template = template_loader.load(event_type, part)
     if template:
@@ -33,6 +54,8 @@ def render_notification_part(ctx, event_type, part):
 
 
 class EventObserver(object):
+    __slots__ = ("hostname", "vendor", "type", "content_type", "pk")
+
     def __init__(self, hostname, vendor, type, content_type, pk):
         self.hostname = hostname
         self.vendor = vendor
@@ -70,6 +93,7 @@ class EventRequestUser(object):
     user_attr_list = ["id", "username", "email",
                       "has_verification_device",
                       "is_remote", "is_superuser"]
+    __slots__ = tuple(user_attr_list)
 
     def __init__(self, **kwargs):
         for attr in self.user_attr_list:
@@ -95,6 +119,7 @@ class EventRequestGeo(object):
                      "country_iso_code", "country_name",
                      "location",
                      "region_iso_code", "region_name"]
+    __slots__ = tuple(geo_attr_list)
 
     def __init__(self, **kwargs):
         for attr in self.geo_attr_list:
@@ -137,6 +162,7 @@ class EventRequestGeo(object):
 
 class EventRequest(object):
     user_agent_str_length = 50
+    __slots__ = ("user_agent", "ip", "geo", "user")
 
     def __init__(self, user_agent, ip, user=None, geo=None):
         self.user_agent = user_agent
@@ -191,41 +217,90 @@ class EventRequest(object):
 
 
 class EventMetadata(object):
+    # created_at, observer and request are kept serialized by deserialize,
+    # and only deserialized when accessed, to speed up the workers.
+    __slots__ = ("event_type", "uuid", "index", "_created_at",
+                 "machine_serial_number", "machine",
+                 "_observer", "_request",
+                 "tags", "incidents", "machine_d", "timing")
+
     def __init__(self, event_type, **kwargs):
         self.event_type = event_type
-        self.uuid = kwargs.pop('uuid', uuid.uuid4())
-        if isinstance(self.uuid, str):
+        self.uuid = kwargs.pop('uuid', None)
+        if self.uuid is None:
+            self.uuid = uuid.uuid4()
+        elif isinstance(self.uuid, str):
             self.uuid = uuid.UUID(self.uuid)
         self.index = int(kwargs.pop('index', 0))
-        self.created_at = kwargs.pop('created_at', None)
-        if self.created_at is None:
-            self.created_at = datetime.utcnow()
-        elif isinstance(self.created_at, str):
-            self.created_at = parser.parse(self.created_at)
+        self._created_at = kwargs.pop('created_at', None)
+        if self._created_at is None:
+            self._created_at = datetime.utcnow()
+        elif isinstance(self._created_at, str):
+            self._created_at = parse_created_at(self._created_at)
         self.machine_serial_number = kwargs.pop('machine_serial_number', None)
         if self.machine_serial_number:
             self.machine = MetaMachine(self.machine_serial_number)
         else:
             self.machine = None
-        self.observer = kwargs.pop('observer', None)
-        self.request = kwargs.pop('request', None)
+        self._observer = kwargs.pop('observer', None)
+        self._request = kwargs.pop('request', None)
         self.tags = kwargs.pop('tags', [])
         self.incidents = kwargs.pop('incidents', [])
+        # serialized machine metadata, computed once in the enrich stage
+        self.machine_d = kwargs.pop('machine', None)
+        # timestamps of the event in the pipeline, see zentral.core.events.timing
+        self.timing = kwargs.pop('timing', None) or {}
 
     @classmethod
     def deserialize(cls, event_d_metadata):
         kwargs = event_d_metadata.copy()
         kwargs['event_type'] = kwargs.pop('type')
         kwargs['uuid'] = kwargs.pop('id')
+        created_at = kwargs.pop('created_at', None)
         observer_d = kwargs.pop('observer', None)
-        if observer_d:
-            kwargs['observer'] = EventObserver.deserialize(observer_d)
         request_d = kwargs.pop('request', None)
-        if request_d:
-            kwargs['request'] = EventRequest.deserialize(request_d)
-        return cls(**kwargs)
+        metadata = cls(**kwargs)
+        # deserialized on first access
+        if created_at:
+            metadata._created_at = created_at
+        metadata._observer = observer_d
+        metadata._request = request_d
+        return metadata
+
+    @property
+    def created_at(self):
+        if isinstance(self._created_at, str):
+            self._created_at = parse_created_at(self._created_at)
+        return self._created_at
+
+    @created_at.setter
+    def created_at(self, value):
+        self._created_at = value
+
+    @property
+    def observer(self):
+        if isinstance(self._observer, dict):
+            self._observer = EventObserver.deserialize(self._observer)
+        return self._observer
+
+    @observer.setter
+    def observer(self, value):
+        self._observer = value
+
+    @property
+    def request(self):
+        if isinstance(self._request, dict):
+            self._request = EventRequest.deserialize(self._request)
+        return self._request
+
+    @request.setter
+    def request(self, value):
+        self._request = value
 
     def serialize_machine(self):
+        if self.machine_d is not None:
+            # already computed, and shipped with the enriched event
+            return self.machine_d
         machine_d_cache_key = "machine_d_{}".format(self.machine.get_urlsafe_serial_number())
         machine_d = cache.get(machine_d_cache_key)
         if not machine_d:
@@ -261,25 +336,32 @@ class EventMetadata(object):
                 machine_d['platform'] = self.machine.platform
             if self.machine.type:
                 machine_d['type'] = self.machine.type
-            cache.set(machine_d_cache_key, machine_d, 60)  # TODO: Hard coded timeout value
+            cache.set(machine_d_cache_key, machine_d, machine_metadata_cache_timeout)
+        self.machine_d = machine_d
         return machine_d
 
-    def serialize(self, machine_metadata=True):
-        d = {'created_at': self.created_at.isoformat(),
+    def serialize(self, machine_metadata=True, timing=False):
+        # the attributes that have not been deserialized are passed through
+        created_at = self._created_at
+        if not isinstance(created_at, str):
+            created_at = created_at.isoformat()
+        d = {'created_at': created_at,
              'id': str(self.uuid),
              'index': self.index,
              'type': self.event_type,
              }
-        if self.observer:
-            d['observer'] = self.observer.serialize()
-        if self.request:
-            d['request'] = self.request.serialize()
+        if self._observer:
+            d['observer'] = self._observer if isinstance(self._observer, dict) else self._observer.serialize()
+        if self._request:
+            d['request'] = self._request if isinstance(self._request, dict) else self._request.serialize()
         if self.tags:
             d['tags'] = self.tags
         if self.incidents:
             d['incidents'] = self.incidents
         if self.machine_serial_number:
             d['machine_serial_number'] = self.machine_serial_number
+        if timing and self.timing:
+            d['timing'] = self.timing
         if not machine_metadata or not self.machine:
             return d
         machine_d = self.serialize_machine()
@@ -291,6 +373,58 @@ class EventMetadata(object):
         self.incidents.append(incident.serialize_for_event_metadata())
 
 
+class EventEnvelope(object):
+    """Payloads of the same event type, sharing the same metadata, posted in a single message.
+
+    Expanded in the enrich stage, with iter_event_envelope_event_ds.
+    """
+
+    def __init__(self, metadata, payloads, created_ats=None):
+        self.metadata = metadata
+        self.payloads = payloads
+        self.created_ats = created_ats
+
+    @property
+    def event_type(self):
+        return self.metadata.event_type
+
+    def serialize(self, machine_metadata=False, timing=False):
+        # the machine metadata is added to each event in the enrich stage
+        envelope_d = {"payloads": self.payloads}
+        if self.created_ats:
+            envelope_d["created_at"] = [created_at.isoformat() if created_at else None
+                                        for created_at in self.created_ats]
+        return {"_zentral": self.metadata.serialize(machine_metadata=False, timing=timing),
+                EVENT_ENVELOPE_KEY: envelope_d}
+
+    def post(self):
+        queues.post_event(self)
+
+
+def is_event_envelope_d(event_d):
+    return EVENT_ENVELOPE_KEY in event_d
+
+
+def iter_event_envelope_event_ds(envelope_d):
+    """Yield the serialized events of a serialized event envelope."""
+    metadata_d = envelope_d["_zentral"]
+    index = int(metadata_d.get("index", 0))
+    envelope = envelope_d[EVENT_ENVELOPE_KEY]
+    created_ats = envelope.get("created_at") or []
+    for offset, payload in enumerate(envelope["payloads"]):
+        event_metadata_d = copy.deepcopy(metadata_d)
+        event_metadata_d["index"] = index + offset
+        try:
+            created_at = created_ats[offset]
+        except IndexError:
+            created_at = None
+        if created_at:
+            event_metadata_d["created_at"] = created_at
+        event_d = dict(payload)
+        event_d["_zentral"] = event_metadata_d
+        yield event_d
+
+
 class BaseEvent(object):
     event_type = "base"
     tags = []
@@ -298,18 +432,22 @@ class BaseEvent(object):
     payload_aggregations = []
 
     @classmethod
-    def build_from_machine_request_payloads(cls, msn, ua, ip, payloads, get_created_at=None, observer=None):
+    def _build_machine_request_metadata(cls, msn, ua, ip, observer=None):
         if ua or ip:
             request = EventRequest(ua, ip)
         else:
             request = None
         if observer:
             observer = EventObserver.deserialize(observer)
-        metadata = EventMetadata(cls.event_type,
-                                 machine_serial_number=msn,
-                                 observer=observer,
-                                 request=request,
-                                 tags=cls.tags)
+        return EventMetadata(cls.event_type,
+                             machine_serial_number=msn,
+                             observer=observer,
+                             request=request,
+                             tags=cls.tags)
+
+    @classmethod
+    def build_from_machine_request_payloads(cls, msn, ua, ip, payloads, get_created_at=None, observer=None):
+        metadata = cls._build_machine_request_metadata(msn, ua, ip, observer)
         for index, payload in enumerate(payloads):
             metadata.index = index
             if get_created_at:
@@ -319,14 +457,64 @@ class BaseEvent(object):
                     logger.exception("Could not extract created_at from payload")
             yield cls(metadata, payload)
 
+    @classmethod
+    def build_envelopes_from_machine_request_payloads(cls, msn, ua, ip, payloads, get_created_at=None, observer=None,
+                                                      max_payloads=None):
+        if max_payloads is None:
+            max_payloads = event_envelope_max_payloads
+        max_payloads = max(max_payloads, 1)
+        metadata = cls._build_machine_request_metadata(msn, ua, ip, observer)
+        index = 0
+        chunk = []
+        created_ats = []
+        for payload in payloads:
+            chunk.append(payload)
+            created_at = None
+            if get_created_at:
+                try:
+                    created_at = get_created_at(payload)
+                except Exception:
+                    logger.exception("Could not extract created_at from payload")
+            created_ats.append(created_at)
+            if len(chunk) == max_payloads:
+                yield cls._build_envelope(metadata, index, chunk, created_ats)
+                index += len(chunk)
+                chunk = []
+                created_ats = []
+        if chunk:
+            yield cls._build_envelope(metadata, index, chunk, created_ats)
+
+    @classmethod
+    def _build_envelope(cls, metadata, index, payloads, created_ats):
+        metadata = copy.copy(metadata)
+        metadata.index = index
+        metadata.timing = {}
+        if not any(created_ats):
+            created_ats = None
+        elif created_ats[0]:
+            metadata.created_at = created_ats[0]
+        if len(payloads) == 1:
+            # single payload → regular event
+            return cls(metadata, payloads[0])
+        return EventEnvelope(metadata, payloads, created_ats)
+
     @classmethod
     def post_machine_request_payloads(cls, msn, user_agent, ip, payloads, get_created_at=None, observer=None):
+        if event_envelope_max_payloads > 1:
+            # fewer, bigger messages, expanded in the enrich stage
+            for event_or_envelope in cls.build_envelopes_from_machine_request_payloads(
+                msn, user_agent, ip, payloads, get_created_at, observer
+            ):
+                event_or_envelope.post()
+            return
         for event in cls.build_from_machine_request_payloads(msn, user_agent, ip, payloads, get_created_at, observer):
             event.post()
 
     def __init__(self, metadata, payload):
         self.metadata = metadata
         self.payload = payload
+        # flattened payload values, shared by the probe payload filters
+        self.flattened_payload_values = {}
 
     def _key(self):
         return (self.event_type, self.metadata.uuid, self.metadata.index)
@@ -358,9 +546,9 @@ class BaseEvent(object):
         metadata = EventMetadata.deserialize(payload.pop('_zentral'))
         return cls(metadata, payload)
 
-    def serialize(self, machine_metadata=True):
+    def serialize(self, machine_metadata=True, timing=False):
         event_d = self.payload.copy()
-        event_d['_zentral'] = self.metadata.serialize(machine_metadata)
+        event_d['_zentral'] = self.metadata.serialize(machine_metadata, timing)
         return event_d
 
     def post(self):
@@ -0,0 +1,24 @@
+import threading
+from zentral.conf import settings
+from zentral.utils.lru import LRUCache
+
+
+# process local cache of the EventRequestGeo objects, or None if not found, by IP address
+geo_cache = LRUCache(maxsize=int(settings.get("events", {}).get("geoip2_city_cache_size", 4096)))
+
+
+# geo cache totals already exported, for the process
+_exported_geo_cache_totals = {}
+_exported_geo_cache_totals_lock = threading.Lock()
+
+
+def inc_geo_cache_counters(metrics_exporter):
+    """Increment the geoip2_city_cache_lookups counters with the geo cache lookups since the last call."""
+    if not metrics_exporter:
+        return
+    with _exported_geo_cache_totals_lock:
+        for result, total in (("hit", geo_cache.hits), ("miss", geo_cache.misses)):
+            value = total - _exported_geo_cache_totals.get(result, 0)
+            if value > 0:
+                _exported_geo_cache_totals[result] = total
+                metrics_exporter.inc("geoip2_city_cache_lookups", result, value=value)
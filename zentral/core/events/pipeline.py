@@ -1,10 +1,13 @@
 import logging
 import geoip2.database
 from . import event_from_event_d
+from .base import EventRequestGeo, is_event_envelope_d, iter_event_envelope_event_ds
+from .geo import geo_cache
 from zentral.conf import settings
+from zentral.core.actions.dispatcher import action_dispatcher
 from zentral.core.probes.conf import all_probes
+from zentral.core.incidents.cache import open_incident_cache
 from zentral.core.incidents.events import build_incident_events
-from zentral.core.incidents.utils import update_or_create_open_incident, update_or_create_open_machine_incident
 
 logger = logging.getLogger('zentral.core.events.pipeline')
 
@@ -15,8 +18,14 @@ try:
 except KeyError:
     pass
 else:
+    # MMAP or MMAP_EXT to share the database pages between the forked worker processes
+    city_db_mode_name = "MODE_{}".format(settings["events"].get("geoip2_city_db_mode", "AUTO").upper())
+    city_db_mode = getattr(geoip2.database, city_db_mode_name, None)
+    if city_db_mode is None:
+        logger.error("Unknown Geolite2 city database mode %s", city_db_mode_name)
+        city_db_mode = geoip2.database.MODE_AUTO
     try:
-        city_db_reader = geoip2.database.Reader(city_db_path)
+        city_db_reader = geoip2.database.Reader(city_db_path, mode=city_db_mode)
     except Exception:
         logger.info("Could not open Geolite2 city database")
 
@@ -28,27 +37,45 @@ def get_city(ip):
         pass
 
 
+def get_geo(ip):
+    def getter():
+        city = get_city(ip)
+        if city:
+            return EventRequestGeo.build_from_city(city)
+    return geo_cache.get_or_set(ip, getter)
+
+
 def enrich_event(event):
+    if isinstance(event, dict) and is_event_envelope_d(event):
+        # expanded lazily, the envelope message is acked as a unit by the workers
+        for event_d in iter_event_envelope_event_ds(event):
+            yield from _enrich_event(event_d)
+    else:
+        yield from _enrich_event(event)
+
+
+def _enrich_event(event):
     if isinstance(event, dict):
         event = event_from_event_d(event)
     if event.metadata.request and event.metadata.request.ip and not event.metadata.request.geo and city_db_reader:
-        city = get_city(event.metadata.request.ip)
-        if city:
-            event.metadata.request.set_geo_from_city(city)
+        geo = get_geo(event.metadata.request.ip)
+        if geo:
+            event.metadata.request.geo = geo
     for probe in all_probes.event_filtered(event):
         incident_severity = probe.get_matching_event_incident_severity(event)
         if incident_severity is None:
             continue
         if event.metadata.machine_serial_number is not None:
-            machine_incident, incident_event_payloads = update_or_create_open_machine_incident(
+            machine_incident, incident_event_payloads = open_incident_cache.update_or_create_open_machine_incident(
                 probe.source,
                 incident_severity,
                 event.metadata.machine_serial_number,
                 event.metadata.uuid
             )
-            event.metadata.add_incident(machine_incident)
+            if machine_incident is not None:
+                event.metadata.add_incident(machine_incident)
         else:
-            incident, incident_event_payloads = update_or_create_open_incident(
+            incident, incident_event_payloads = open_incident_cache.update_or_create_open_incident(
                 probe.source,
                 incident_severity,
                 event.metadata.uuid
@@ -66,6 +93,10 @@ def process_event(event):
         event = event_from_event_d(event)
     for probe in all_probes.event_filtered(event):
         for action, action_config_d in probe.actions:
+            if action_dispatcher:
+                # triggered in the action dispatcher threads
+                action_dispatcher.dispatch(action, event, probe, action_config_d)
+                continue
             try:
                 action.trigger(event, probe, action_config_d)
             except Exception:
@@ -0,0 +1,57 @@
+from datetime import datetime
+import time
+
+
+# Timestamps of the event in the pipeline, in the _zentral.timing metadata.
+# Wall clock timestamps (seconds since the epoch), to be comparable between processes and hosts.
+# Only shipped in the internal queues, removed before the events are stored.
+
+
+INGESTED = "ingested"
+
+EVENT_LAG_HISTOGRAMS = (
+    # time since the event creation
+    ("event_created_lag_seconds", "event_type"),
+    # time since the event has entered the pipeline
+    ("event_ingested_lag_seconds", "event_type"),
+    # time since the last stage, i.e. spent waiting in the queue
+    ("event_queued_seconds", "event_type"),
+)
+
+
+def stamp_event(event, stage):
+    """Stamp an event before publishing it in the queue of the next stage."""
+    now = time.time()
+    timing = event.metadata.timing
+    timing.setdefault(INGESTED, now)
+    timing[stage] = now
+
+
+def pop_event_d_timing(event_d):
+    """Remove the timing metadata from a serialized event, before storing it."""
+    return event_d.get("_zentral", {}).pop("timing", None) or {}
+
+
+def iter_event_d_lags(event_d, timing=None):
+    """Yield the lag histogram names and values, in seconds, for a serialized event."""
+    metadata = event_d.get("_zentral", {})
+    if timing is None:
+        timing = metadata.get("timing") or {}
+    now = time.time()
+    created_at = metadata.get("created_at")
+    if created_at:
+        try:
+            # naive UTC datetime
+            created_at = datetime.strptime(created_at[:26], "%Y-%m-%dT%H:%M:%S.%f")
+        except ValueError:
+            try:
+                created_at = datetime.strptime(created_at[:19], "%Y-%m-%dT%H:%M:%S")
+            except ValueError:
+                created_at = None
+        if created_at:
+            yield "event_created_lag_seconds", max((datetime.utcnow() - created_at).total_seconds(), 0)
+    ingested_at = timing.get(INGESTED)
+    if ingested_at:
+        yield "event_ingested_lag_seconds", max(now - ingested_at, 0)
+    if timing:
+        yield "event_queued_seconds", max(now - max(timing.values()), 0)
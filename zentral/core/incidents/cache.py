@@ -0,0 +1,135 @@
+import logging
+import os
+import threading
+import time
+from zentral.conf import settings
+from zentral.core.probes.conf import zentral_probes_sync
+from zentral.utils.lru import LRUCache
+from .models import STATUS_OPEN
+from .sync import OpenIncidentCacheSync
+from .utils import update_or_create_open_incident, update_or_create_open_machine_incident
+
+
+logger = logging.getLogger("zentral.core.incidents.cache")
+
+
+MISSING = object()
+
+
+class OpenIncidentCache(object):
+    """Process local cache of the open incidents and machine incidents, by probe source.
+
+    Used in the enrich step, to skip the DB transactions when a probe keeps matching events
+    for an incident already open at an equal or higher severity.
+    The entries of a probe source are invalidated when one of its incidents is created, updated
+    or closed, in any process (postgres notifications on a dedicated listening connection, see the
+    workers configuration documentation). They also expire after ttl seconds.
+    With a ttl of 0, the cache is disabled.
+    """
+
+    def __init__(self, ttl=60, max_size=8192, with_sync=True):
+        self.ttl = ttl
+        self._cache = LRUCache(maxsize=max_size)
+        # probe source pk → version, incremented to invalidate the probe source entries
+        self._versions = {}
+        self._lock = threading.Lock()
+        self.with_sync = with_sync
+        self.sync = None
+        self._sync_pid = None
+        self._sync_lock = threading.Lock()
+
+    def _start_sync(self):
+        if not self.with_sync:
+            return
+        with self._sync_lock:
+            self._start_sync_thread()
+
+    def _start_sync_thread(self):
+        pid = os.getpid()
+        if self.sync is not None and self._sync_pid == pid:
+            if self.sync.is_alive():
+                return
+            else:
+                logger.error("Sync thread is not alive. Last heartbeat %s.", self.sync.last_heartbeat or "-")
+        # forked process, or dead thread → the cache could have missed some updates
+        self.clear()
+        # separate thread, with its own persistent DB connection, to listen to the incident change signal
+        self.sync = OpenIncidentCacheSync(self)
+        self._sync_pid = pid
+        self.sync.start()
+
+    def clear(self):
+        self._cache.clear()
+
+    def invalidate(self, probe_source_pk):
+        with self._lock:
+            self._versions[probe_source_pk] = self._versions.get(probe_source_pk, 0) + 1
+
+    def _get_key(self, probe_source_pk, serial_number=None):
+        # with the version, the values computed before an invalidation are never returned
+        return probe_source_pk, self._versions.get(probe_source_pk, 0), serial_number
+
+    def _get(self, key):
+        entry = self._cache.get(key)
+        if entry is None:
+            return MISSING
+        expiry, value = entry
+        if expiry < time.monotonic():
+            return MISSING
+        return value
+
+    def _set(self, key, value):
+        self._cache.set(key, (time.monotonic() + self.ttl, value))
+
+    def update_or_create_open_incident(self, probe_source, severity, event_id):
+        if not self.ttl:
+            return update_or_create_open_incident(probe_source, severity, event_id)
+        self._start_sync()
+        key = self._get_key(probe_source.pk)
+        incident = self._get(key)
+        if incident is not MISSING and incident.severity >= severity:
+            return incident, []
+        incident, event_payloads = update_or_create_open_incident(probe_source, severity, event_id)
+        if event_payloads:
+            # the other cached entries of this probe source could be stale
+            self.invalidate(probe_source.pk)
+            key = self._get_key(probe_source.pk)
+        self._set(key, incident)
+        return incident, event_payloads
+
+    def update_or_create_open_machine_incident(self, probe_source, severity, serial_number, event_id):
+        if not self.ttl:
+            return update_or_create_open_machine_incident(probe_source, severity, serial_number, event_id)
+        self._start_sync()
+        key = self._get_key(probe_source.pk, serial_number)
+        machine_incident = self._get(key)
+        if machine_incident is not MISSING:
+            if severity == 0:
+                if machine_incident is None or machine_incident.status != STATUS_OPEN:
+                    # no machine incident that can be automatically closed
+                    return None, []
+            elif machine_incident is not None and machine_incident.incident.severity >= severity:
+                return machine_incident, []
+        machine_incident, event_payloads = update_or_create_open_machine_incident(
+            probe_source, severity, serial_number, event_id
+        )
+        if event_payloads:
+            # the other cached entries of this probe source could be stale
+            self.invalidate(probe_source.pk)
+            key = self._get_key(probe_source.pk, serial_number)
+        if severity == 0:
+            # closed, or nothing to close
+            self._set(key, None)
+        else:
+            self._set(key, machine_incident)
+        return machine_incident, event_payloads
+
+
+def get_open_incident_cache():
+    config = settings["apps"]["zentral.core.incidents"].get("open_incident_cache", {})
+    return OpenIncidentCache(ttl=int(config.get("ttl", 60)),
+                             max_size=int(config.get("max_size", 8192)),
+                             with_sync=zentral_probes_sync)
+
+
+open_incident_cache = get_open_incident_cache()
@@ -0,0 +1,74 @@
+import json
+import logging
+import weakref
+from django.db import connection
+from zentral.core.probes.sync import PostgresNotificationListener
+
+
+logger = logging.getLogger("zentral.core.incidents.sync")
+
+
+postgresql_channel = "incident_change"
+
+
+class OpenIncidentCacheSync(PostgresNotificationListener):
+    channel = postgresql_channel
+
+    def __init__(self, open_incident_cache):
+        self.open_incident_cache = weakref.ref(open_incident_cache)
+        super().__init__()
+
+    def _get_open_incident_cache(self):
+        open_incident_cache = self.open_incident_cache()
+        if open_incident_cache is None:
+            logger.error("Could not get open incident cache.")
+        return open_incident_cache
+
+    def handle_error_recovery(self):
+        # need to clear the cache. We might have missed some updates
+        logger.info("DB error recovery. Clear open incident cache.")
+        open_incident_cache = self._get_open_incident_cache()
+        if open_incident_cache is None:
+            return False
+        open_incident_cache.clear()
+        return True
+
+    @staticmethod
+    def _parse_payloads(payloads):
+        """Return the set of changed probe source pks, or None if the cache needs to be cleared."""
+        probe_source_pks = set()
+        for payload in payloads:
+            try:
+                probe_source_pks.add(int(json.loads(payload)["probe_source_id"]))
+            except (TypeError, ValueError, KeyError):
+                # empty payload, or unknown format
+                return
+        return probe_source_pks
+
+    def handle_notifications(self, payloads):
+        open_incident_cache = self._get_open_incident_cache()
+        if open_incident_cache is None:
+            return False
+        probe_source_pks = self._parse_payloads(payloads)
+        if probe_source_pks is None:
+            open_incident_cache.clear()
+        else:
+            for probe_source_pk in probe_source_pks:
+                open_incident_cache.invalidate(probe_source_pk)
+        return True
+
+
+def signal_incident_change(probe_source_id=None):
+    """Notify the open incident caches of an incident or machine incident change.
+
+    Without a probe source id, the caches are cleared."""
+    payload = ""
+    if probe_source_id is not None:
+        payload = json.dumps({"probe_source_id": probe_source_id})
+    try:
+        cur = connection.cursor()
+        cur.execute('SELECT pg_notify(%s, %s)', [postgresql_channel, payload])
+        connection.commit()
+    except Exception as db_err:
+        logger.error("Could not signal incident change: %s", db_err)
+        connection.close_if_unusable_or_obsolete()
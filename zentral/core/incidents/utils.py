@@ -1,14 +1,21 @@
+from functools import partial
 import logging
 from django.db import connection, IntegrityError, transaction
 from prometheus_client import CollectorRegistry, Gauge
 from .models import (Incident, MachineIncident,
                      OPEN_STATUSES, SEVERITY_CHOICES_DICT,
                      STATUS_CLOSED, STATUS_CHOICES_DICT, STATUS_OPEN)
+from .sync import signal_incident_change
 
 
 logger = logging.getLogger("zentral.core.incidents.utils")
 
 
+def _signal_incident_change(probe_source_id):
+    # invalidate the open incident caches of the other processes
+    transaction.on_commit(partial(signal_incident_change, probe_source_id))
+
+
 def _update_or_create_open_incident(probe_source, severity, event_id):
     action = event_payload = None
     extra_event_payload = {}
@@ -52,6 +59,7 @@ def update_or_create_open_incident(probe_source, severity, event_id):
         incident, incident_event_payload = _update_or_create_open_incident(probe_source, severity, event_id)
     if incident_event_payload:
         event_payloads.append(incident_event_payload)
+        _signal_incident_change(probe_source.pk)
     return incident, event_payloads
 
 
@@ -113,6 +121,8 @@ def update_or_create_open_machine_incident(probe_source, severity, serial_number
                 machine_incident_event_payload = machine_incident.serialize_for_event()
                 machine_incident_event_payload["action"] = "created"
                 event_payloads.append(machine_incident_event_payload)
+    if event_payloads:
+        _signal_incident_change(probe_source.pk)
     return machine_incident, event_payloads
 
 
@@ -133,6 +143,7 @@ def update_incident_status(incident, new_status):
         incident_event_payload["action"] = "updated"
         incident_event_payload["diff"] = diff
         event_payloads.append(incident_event_payload)
+    _signal_incident_change(incident.probe_source_id)
     return incident, event_payloads
 
 
@@ -154,6 +165,7 @@ def update_machine_incident_status(machine_incident, new_status):
         machine_incident_event_payload["action"] = "updated"
         machine_incident_event_payload["diff"] = diff
         event_payloads.append(machine_incident_event_payload)
+    _signal_incident_change(machine_incident.incident.probe_source_id)
     return machine_incident, event_payloads
 
 
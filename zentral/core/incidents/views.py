@@ -2,7 +2,7 @@ import logging
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.shortcuts import get_object_or_404
 from django.urls import reverse
-from django.views.generic import DetailView, ListView, UpdateView
+from django.views.generic import DetailView, ListView, TemplateView, UpdateView
 from zentral.core.stores import frontend_store, stores
 from zentral.utils.prometheus import BasePrometheusMetricsView
 from .forms import IncidentSearchForm, UpdateIncidentForm, UpdateMachineIncidentForm
@@ -82,31 +82,7 @@ class UpdateIncidentView(LoginRequiredMixin, UpdateView):
         return ctx
 
 
-class IncidentEventSet(object):
-    def __init__(self, incident):
-        self.incident = incident
-        self.store = frontend_store
-        self._count = None
-
-    def count(self):
-        if self._count is None:
-            self._count = self.store.incident_events_count(self.incident)
-        return self._count
-
-    def __len__(self):
-        return self.count()
-
-    def __getitem__(self, k):
-        if isinstance(k, slice):
-            start = int(k.start or 0)
-            stop = int(k.stop or start + 1)
-        else:
-            start = k
-            stop = k + 1
-        return self.store.incident_events_fetch(self.incident, start, stop - start)
-
-
-class IncidentEventsView(LoginRequiredMixin, ListView):
+class IncidentEventsView(LoginRequiredMixin, TemplateView):
     template_name = "incidents/incident_events.html"
     paginate_by = 10
 
@@ -118,38 +94,37 @@ class IncidentEventsView(LoginRequiredMixin, ListView):
         ctx = super().get_context_data(**kwargs)
         ctx["incidents"] = True
         ctx["incident"] = self.incident
+        # events page
+        cursor = self.request.GET.get("cursor")
+        ctx["object_list"], next_cursor, previous_cursor = frontend_store.incident_events_fetch_page(
+            self.incident, cursor=cursor, limit=self.paginate_by
+        )
         # pagination
-        page = ctx['page_obj']
-        if page.has_next():
+        if next_cursor:
             qd = self.request.GET.copy()
-            qd['page'] = page.next_page_number()
+            qd['cursor'] = next_cursor
             ctx['next_url'] = "?{}".format(qd.urlencode())
-        if page.has_previous():
+        if previous_cursor:
             qd = self.request.GET.copy()
-            qd['page'] = page.previous_page_number()
+            qd['cursor'] = previous_cursor
             ctx['previous_url'] = "?{}".format(qd.urlencode())
         bc = [(reverse('incidents:index'), 'Incidents'),
               (reverse('incidents:incident', args=(self.incident.pk,)), self.incident.name)]
-        if page.number > 1:
+        if cursor:
             qd = self.request.GET.copy()
-            qd.pop("page", None)
+            qd.pop("cursor", None)
             reset_link = "?{}".format(qd.urlencode())
         else:
             reset_link = None
-        paginator = page.paginator
-        if paginator.count:
-            count = paginator.count
+        count = frontend_store.incident_events_count(self.incident)
+        if count:
             pluralize = min(1, count - 1) * 's'
-            bc.extend([(reset_link, '{} event{}'.format(count, pluralize)),
-                       (None, "page {} of {}".format(page.number, paginator.num_pages))])
+            bc.append((reset_link, '{} event{}'.format(count, pluralize)))
         else:
             bc.append((None, "no events"))
         ctx['breadcrumbs'] = bc
         return ctx
 
-    def get_queryset(self):
-        return IncidentEventSet(self.incident)
-
 
 class UpdateMachineIncidentView(LoginRequiredMixin, UpdateView):
     form_class = UpdateMachineIncidentForm
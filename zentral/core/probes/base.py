@@ -136,24 +136,27 @@ class MetadataFiltersSerializer(serializers.Serializer):
         raise serializers.ValidationError("No event types or tags")
 
 
-def get_flattened_payload_values(payload, attrs):
+def _iter_flattened_payload_values(payload, path, idx):
     if isinstance(payload, list):
         for nested_payload in payload:
-            yield from get_flattened_payload_values(nested_payload, list(attrs))
+            yield from _iter_flattened_payload_values(nested_payload, path, idx)
     elif isinstance(payload, dict):
-        attr = attrs.pop(0)
-        val = payload.get(attr)
+        val = payload.get(path[idx])
         if val is None:
             return
-        if not attrs:
+        if idx == len(path) - 1:
             if isinstance(val, (set, list)):
                 yield from (str(v) for v in val)
             else:
                 yield str(val)
         else:
-            yield from get_flattened_payload_values(val, attrs)
+            yield from _iter_flattened_payload_values(val, path, idx + 1)
     else:
-        logger.warning("Wrong payload filter attribute %s", attrs)
+        logger.warning("Wrong payload filter attribute %s", list(path[idx:]))
+
+
+def get_flattened_payload_values(payload, attrs):
+    yield from _iter_flattened_payload_values(payload, tuple(attrs), 0)
 
 
 class PayloadFilter(object):
@@ -177,12 +180,28 @@ class PayloadFilter(object):
                 continue
             self.items.append((attribute, operator, values))
         self.items.sort()
+        # attributes compiled to paths, to avoid splitting them for each event
+        self.compiled_items = [(tuple(attribute.split(".")), operator == self.IN, frozenset(values))
+                               for attribute, operator, values in self.items]
 
-    def test_event_payload(self, payload):
-        for payload_attribute, operator, filter_value_set in self.items:
-            payload_value_set = set(get_flattened_payload_values(payload, payload_attribute.split(".")))
-            common_values = filter_value_set & payload_value_set
-            if (operator == self.IN and not common_values) or (operator == self.NOT_IN and common_values):
+    def test_event_payload(self, payload, flattened_payload_values=None):
+        """
+        Test if the event payload is a match for this filter.
+
+        flattened_payload_values is an optional dict, used to share the flattened payload values
+        between all the payload filters tested on the same event.
+        """
+        for path, is_in, filter_value_set in self.compiled_items:
+            if flattened_payload_values is None:
+                payload_value_set = set(_iter_flattened_payload_values(payload, path, 0))
+            else:
+                try:
+                    payload_value_set = flattened_payload_values[path]
+                except KeyError:
+                    payload_value_set = flattened_payload_values[path] = set(
+                        _iter_flattened_payload_values(payload, path, 0)
+                    )
+            if filter_value_set.isdisjoint(payload_value_set) == is_in:
                 # AND: all items of a payload filter must match
                 return False
         return True
@@ -351,11 +370,11 @@ class BaseProbe(object):
                 return True
         return False
 
-    def _test_event_payload(self, payload):
+    def _test_event_payload(self, payload, flattened_payload_values=None):
         if not self.payload_filters:
             return True
         for payload_filter in self.payload_filters:
-            if payload_filter.test_event_payload(payload):
+            if payload_filter.test_event_payload(payload, flattened_payload_values):
                 # no need to check the other filters (OR)
                 return True
         return False
@@ -376,7 +395,7 @@ class BaseProbe(object):
                 return False
         elif not self._test_event_metadata(metadata):
             return False
-        if not self._test_event_payload(event.payload):
+        if not self._test_event_payload(event.payload, event.flattened_payload_values):
             return False
         return True
 
@@ -1,9 +1,10 @@
+from bisect import bisect
 import logging
 import os
 import threading
 import weakref
 from .models import ProbeSource
-from .sync import ProbeViewSync
+from .sync import ProbeViewSync, PROBE_DELETE
 
 
 logger = logging.getLogger("zentral.core.probes.conf")
@@ -21,6 +22,25 @@ class ProbeView(object):
         with self._lock:
             self._probes = None
 
+    def update_probes(self, changes):
+        """Patch the view with the changed probe sources.
+
+        changes is a probe source pk → PROBE_UPSERT or PROBE_DELETE dict.
+        Only the upserted probe sources are loaded from the DB."""
+        if self.parent is not None:
+            raise ValueError("Only the root probe views can be updated")
+        probes = {pk: None for pk in changes}
+        upserted_pks = [pk for pk, action in changes.items() if action != PROBE_DELETE]
+        if upserted_pks:
+            # inactive probe sources are removed
+            for probe_source in ProbeSource.objects.active().filter(pk__in=upserted_pks):
+                probes[probe_source.pk] = probe_source.load()
+        self._patch(probes)
+
+    def _patch(self, probes):
+        """Patch the view with a probe source pk → probe or None dict."""
+        raise NotImplementedError
+
     def iter_parent_probes(self):
         if self.parent is None:
             for p in ProbeSource.objects.active():
@@ -70,6 +90,11 @@ class ProbesDict(ProbeView):
                     else:
                         self._probes.setdefault(key, []).append(val)
 
+    def _patch(self, probes):
+        # the keys and values of the dict cannot be mapped to the probes.
+        # The dict is rebuilt from the already loaded parent probes.
+        self.clear()
+
     def __getitem__(self, key):
         with self._lock:
             self._load()
@@ -86,15 +111,66 @@ class ProbesDict(ProbeView):
             return self._probes.get(*args, **kwargs)
 
 
+class ProbeEventIndex(object):
+    """
+    Event type / event tag → candidate probes index.
+
+    Used to only test the probes that could match the event metadata.
+    """
+    def __init__(self, probes):
+        self.unfiltered = []  # probes without metadata filters
+        self.by_event_type = {}
+        self.by_event_tag = {}
+        for position, probe in enumerate(probes):
+            if not probe.loaded:
+                # never a match
+                continue
+            item = (position, probe)
+            if probe.forced_event_type:
+                self.by_event_type.setdefault(probe.forced_event_type, []).append(item)
+                continue
+            event_types = set()
+            event_tags = set()
+            for metadata_filter in probe.metadata_filters:
+                if metadata_filter.event_types:
+                    # the event type must match, the tags are checked by the probe
+                    event_types.update(metadata_filter.event_types)
+                elif metadata_filter.event_tags:
+                    event_tags.update(metadata_filter.event_tags)
+                else:
+                    # empty metadata filter, matches all events
+                    break
+            else:
+                if event_types or event_tags:
+                    for event_type in event_types:
+                        self.by_event_type.setdefault(event_type, []).append(item)
+                    for event_tag in event_tags:
+                        self.by_event_tag.setdefault(event_tag, []).append(item)
+                    continue
+            self.unfiltered.append(item)
+
+    def candidates(self, event):
+        metadata = event.metadata
+        candidates = {}
+        for items in ([self.unfiltered, self.by_event_type.get(metadata.event_type, [])]
+                      + [self.by_event_tag.get(tag, []) for tag in metadata.tags]):
+            for position, probe in items:
+                candidates[position] = probe
+        # same order as in the probe list
+        return [candidates[position] for position in sorted(candidates)]
+
+
 class ProbeList(ProbeView):
     def __init__(self, parent=None, filter_func=None, with_sync=False):
         super(ProbeList, self).__init__(parent, with_sync=with_sync)
         self.filter_func = filter_func
         self._children = weakref.WeakSet()
+        self._event_index = None
 
     def clear(self):
         with self._lock:
             self._probes = None
+            self._event_index = None
             for child in self._children:
                 child.clear()
 
@@ -102,10 +178,38 @@ class ProbeList(ProbeView):
         self._start_sync()
         if self._probes is None:
             self._probes = []
+            self._event_index = None
             for probe in self.iter_parent_probes():
                 if self.filter_func is None or self.filter_func(probe):
                     self._probes.append(probe)
 
+    @staticmethod
+    def _sort_key(probe):
+        # same order as the ProbeSource objects
+        return (probe.name, probe.pk)
+
+    def _patch(self, probes):
+        with self._lock:
+            if self._probes is None:
+                # not loaded, nothing to patch
+                return
+            patched_probes = [probe for probe in self._probes if probe.pk not in probes]
+            sort_keys = [self._sort_key(probe) for probe in patched_probes]
+            for probe in probes.values():
+                if probe is None or (self.filter_func is not None and not self.filter_func(probe)):
+                    continue
+                sort_key = self._sort_key(probe)
+                position = bisect(sort_keys, sort_key)
+                sort_keys.insert(position, sort_key)
+                patched_probes.insert(position, probe)
+            self._probes = patched_probes
+            # derived from the patched list, rebuilt without DB queries on the next access
+            self._event_index = None
+            children = list(self._children)
+        # the children can read the parent probes while holding their lock
+        for child in children:
+            child._patch(probes)
+
     def filter(self, filter_func):
         child = self.__class__(self, filter_func)
         self._children.add(child)
@@ -132,9 +236,13 @@ class ProbeList(ProbeView):
         return self.filter(_filter)
 
     def event_filtered(self, event):
-        def _filter(probe):
-            return probe.test_event(event)
-        return self.filter(_filter)
+        with self._lock:
+            self._load()
+            if self._event_index is None:
+                self._event_index = ProbeEventIndex(self._probes)
+            candidates = self._event_index.candidates(event)
+        # tests done outside of the lock, they can require DB queries
+        return [probe for probe in candidates if probe.test_event(event)]
 
 
 # used for the tests, to avoid having an extra DB connection
@@ -1,3 +1,4 @@
+from functools import partial
 import logging
 from django.contrib.postgres.fields import ArrayField, JSONField
 from django.urls import reverse
@@ -5,7 +6,7 @@ from django.db import models, transaction
 from django.db.models import F, Func
 from django.utils.text import slugify
 from zentral.core.events import event_types
-from zentral.core.probes.sync import signal_probe_change
+from zentral.core.probes.sync import signal_probe_change, PROBE_DELETE, PROBE_UPSERT
 from zentral.utils.dict import dict_diff
 from . import probe_classes
 
@@ -127,7 +128,7 @@ class ProbeSource(models.Model):
         # TODO: Json filtering in the query ?
         self.event_types = [etc.event_type for etc in probe.get_event_type_classes()]
         super(ProbeSource, self).save(*args, **kwargs)
-        transaction.on_commit(signal_probe_change)
+        transaction.on_commit(partial(signal_probe_change, self.pk, PROBE_UPSERT))
 
     def get_probe_class(self):
         return probe_classes.get(self.model, None)
@@ -146,8 +147,9 @@ class ProbeSource(models.Model):
         return [etc.get_event_type_display() for etc in self.get_event_type_classes()]
 
     def delete(self, *args, **kwargs):
+        pk = self.pk
         super(ProbeSource, self).delete(*args, **kwargs)
-        transaction.on_commit(signal_probe_change)
+        transaction.on_commit(partial(signal_probe_change, pk, PROBE_DELETE))
 
     def get_absolute_url(self, anchor=None):
         url = reverse("probes:probe", args=(self.pk,))
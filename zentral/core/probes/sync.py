@@ -1,3 +1,4 @@
+import json
 import logging
 import random
 import select
@@ -12,26 +13,48 @@ logger = logging.getLogger("zentral.core.probes.sync")
 
 
 postgresql_channel = "probe_change"
+PROBE_UPSERT = "upsert"
+PROBE_DELETE = "delete"
 
 
-class ProbeViewSync(threading.Thread):
-    def __init__(self, probe_view):
-        self.probe_view = weakref.ref(probe_view)
+class PostgresNotificationListener(threading.Thread):
+    """
+    Listen to the notifications on a postgresql channel, in a separate thread.
+
+    The sub classes must set the channel, and implement the handle_* methods.
+    """
+    channel = None
+
+    def __init__(self):
         super().__init__(daemon=True)
         self.error_state = False
+        self.listening = False
         self.last_heartbeat = None
 
+    def handle_error_recovery(self):
+        """Called after a DB error. Some notifications might have been missed.
+
+        Must return False to stop the thread."""
+        return True
+
+    def handle_notifications(self, payloads):
+        """Called with the payloads of the received notifications.
+
+        Must return False to stop the thread."""
+        return True
+
     def run(self):
         while True:
             self.last_heartbeat = datetime.utcnow()
             # LISTEN query
             try:
                 cur = connection.cursor()
-                cur.execute('LISTEN {}'.format(postgresql_channel))
+                cur.execute('LISTEN {}'.format(self.channel))
                 connection.commit()
             except Exception as db_err:
                 connection.close_if_unusable_or_obsolete()
                 self.error_state = True
+                self.listening = False
                 sleep_time = 2 * (1 + random.random())
                 logger.error("Could not execute the LISTEN query: %s. Sleep %ss.", db_err, sleep_time)
                 time.sleep(sleep_time)
@@ -39,19 +62,14 @@ class ProbeViewSync(threading.Thread):
 
             # are we recovering from an error ?
             if self.error_state:
-                # need to clear the probe_view. We might have missed some updates
-                probe_view = self.probe_view()
-                if probe_view is not None:
-                    logger.info("DB error recovery. Clear probe view.")
-                    probe_view.clear()
-                else:
-                    logger.error("Could not get probe view. "
-                                 "Stop error recovery for notifications on channel '%s'.",
-                                 postgresql_channel)
+                if not self.handle_error_recovery():
+                    self.listening = False
+                    logger.error("Stop error recovery for notifications on channel '%s'.", self.channel)
                     break
                 self.error_state = False
 
-            logger.info("Waiting for notifications on channel '%s'", postgresql_channel)
+            self.listening = True
+            logger.info("Waiting for notifications on channel '%s'", self.channel)
             pg_con = connection.connection
             while True:
                 self.last_heartbeat = datetime.utcnow()
@@ -63,27 +81,86 @@ class ProbeViewSync(threading.Thread):
                     except Exception as db_err:
                         connection.close_if_unusable_or_obsolete()
                         self.error_state = True
+                        self.listening = False
                         logger.error("Could not poll() the DB connection: %s", db_err)
                         break
                     if pg_con.notifies:
                         # clear notifications
+                        payloads = []
                         while pg_con.notifies:
-                            pg_con.notifies.pop()
-                        logger.info("Received notification on channel '%s'", postgresql_channel)
-                        probe_view = self.probe_view()
-                        if probe_view is not None:
-                            probe_view.clear()
-                        else:
-                            logger.error("Could not get probe view. "
-                                         "Stop waiting for notifications on channel '%s'.",
-                                         postgresql_channel)
+                            payloads.append(pg_con.notifies.pop(0).payload)
+                        logger.info("Received %s notification(s) on channel '%s'", len(payloads), self.channel)
+                        if not self.handle_notifications(payloads):
+                            self.listening = False
+                            logger.error("Stop waiting for notifications on channel '%s'.", self.channel)
                             return
 
 
-def signal_probe_change():
+class ProbeViewSync(PostgresNotificationListener):
+    channel = postgresql_channel
+
+    def __init__(self, probe_view):
+        self.probe_view = weakref.ref(probe_view)
+        super().__init__()
+
+    def _clear_probe_view(self):
+        probe_view = self.probe_view()
+        if probe_view is None:
+            logger.error("Could not get probe view.")
+            return False
+        probe_view.clear()
+        return True
+
+    def handle_error_recovery(self):
+        # need to clear the probe_view. We might have missed some updates
+        logger.info("DB error recovery. Clear probe view.")
+        return self._clear_probe_view()
+
+    @staticmethod
+    def _parse_payloads(payloads):
+        """Return a probe source pk → action dict, or None if a full reload is required."""
+        changes = {}
+        for payload in payloads:
+            try:
+                change = json.loads(payload)
+                pk = int(change["id"])
+                action = change["action"]
+            except (TypeError, ValueError, KeyError):
+                # empty payload, or unknown format
+                return
+            if action not in (PROBE_UPSERT, PROBE_DELETE):
+                return
+            # the last notification wins
+            changes[pk] = action
+        return changes
+
+    def handle_notifications(self, payloads):
+        changes = self._parse_payloads(payloads)
+        if changes is None:
+            return self._clear_probe_view()
+        probe_view = self.probe_view()
+        if probe_view is None:
+            logger.error("Could not get probe view.")
+            return False
+        try:
+            probe_view.update_probes(changes)
+        except Exception:
+            logger.exception("Could not update the probe view. Clear probe view.")
+            connection.close_if_unusable_or_obsolete()
+            probe_view.clear()
+        return True
+
+
+def signal_probe_change(probe_source_id=None, action=PROBE_UPSERT):
+    """Notify the probe views of a probe source change.
+
+    Without a probe source id, the probe views are fully reloaded."""
+    payload = ""
+    if probe_source_id is not None:
+        payload = json.dumps({"id": probe_source_id, "action": action})
     try:
         cur = connection.cursor()
-        cur.execute('NOTIFY {}'.format(postgresql_channel))
+        cur.execute('SELECT pg_notify(%s, %s)', [postgresql_channel, payload])
         connection.commit()
     except Exception as db_err:
         logger.error("Could not signal probe change: %s", db_err)
@@ -177,33 +177,7 @@ class ProbeDashboardDataView(LoginRequiredMixin, View):
         return JsonResponse(charts)
 
 
-class ProbeEventSet(object):
-    def __init__(self, probe):
-        self.probe = probe
-        self.store = frontend_store
-        self._count = None
-
-    def count(self):
-        if self._count is None:
-            self._count = self.store.probe_events_count(self.probe,
-                                                        **self.probe.get_extra_event_search_dict())
-        return self._count
-
-    def __len__(self):
-        return self.count()
-
-    def __getitem__(self, k):
-        if isinstance(k, slice):
-            start = int(k.start or 0)
-            stop = int(k.stop or start + 1)
-        else:
-            start = k
-            stop = k + 1
-        return self.store.probe_events_fetch(self.probe, start, stop - start,
-                                             **self.probe.get_extra_event_search_dict())
-
-
-class ProbeEventsView(LoginRequiredMixin, ListView):
+class ProbeEventsView(LoginRequiredMixin, TemplateView):
     template_name = "core/probes/probe_events.html"
     paginate_by = 10
 
@@ -213,13 +187,22 @@ class ProbeEventsView(LoginRequiredMixin, ListView):
         return super().dispatch(request, *args, **kwargs)
 
     def get_context_data(self, **kwargs):
-        ctx = {
+        ctx = super().get_context_data(**kwargs)
+        ctx.update({
             "probes": True,
             "probe_source": self.probe_source,
             "probe": self.probe
-        }
+        })
+        cursor = self.request.GET.get("cursor")
+        next_cursor = previous_cursor = None
+        count = 0
         try:
-            ctx.update(super().get_context_data(**kwargs))
+            ctx["object_list"], next_cursor, previous_cursor = frontend_store.probe_events_fetch_page(
+                self.probe, cursor=cursor, limit=self.paginate_by,
+                **self.probe.get_extra_event_search_dict()
+            )
+            if ctx["object_list"]:
+                count = frontend_store.probe_events_count(self.probe, **self.probe.get_extra_event_search_dict())
         except Exception:
             # probably a store error
             logger.exception("Could not fetch probe %s events", self.probe_source.pk)
@@ -227,30 +210,27 @@ class ProbeEventsView(LoginRequiredMixin, ListView):
 
         # pagination
         # previous / next links
-        page = ctx.get('page_obj')
-        if page is not None and page.has_next():
+        if next_cursor:
             qd = self.request.GET.copy()
-            qd['page'] = page.next_page_number()
+            qd['cursor'] = next_cursor
             ctx['next_url'] = "?{}".format(qd.urlencode())
-        if page is not None and page.has_previous():
+        if previous_cursor:
             qd = self.request.GET.copy()
-            qd['page'] = page.previous_page_number()
+            qd['cursor'] = previous_cursor
             ctx['previous_url'] = "?{}".format(qd.urlencode())
 
         # breadcrumbs
         bc = [(reverse('probes:index'), 'Probes'),
               (reverse('probes:probe', args=(self.probe.pk,)), self.probe.name)]
-        if page is not None and page.number > 1:
+        if cursor:
             qd = self.request.GET.copy()
-            qd.pop("page", None)
+            qd.pop("cursor", None)
             reset_link = "?{}".format(qd.urlencode())
         else:
             reset_link = None
-        if page is not None and page.paginator.count:
-            count = page.paginator.count
+        if count:
             pluralize = min(1, count - 1) * 's'
-            bc.extend([(reset_link, '{} event{}'.format(count, pluralize)),
-                       (None, "page {} of {}".format(page.number, page.paginator.num_pages))])
+            bc.append((reset_link, '{} event{}'.format(count, pluralize)))
         else:
             # no events
             if "error" not in ctx:
@@ -263,9 +243,6 @@ class ProbeEventsView(LoginRequiredMixin, ListView):
 
         return ctx
 
-    def get_queryset(self):
-        return ProbeEventSet(self.probe)
-
 
 class UpdateProbeView(LoginRequiredMixin, UpdateView):
     model = ProbeSource
@@ -11,7 +11,12 @@ from botocore.config import Config
 from django.utils.functional import cached_property
 from django.utils.text import slugify
 from zentral.conf import settings
-from .consumer import Consumer, ConsumerProducer
+from zentral.core.actions.dispatcher import action_dispatcher
+from zentral.core.events.geo import inc_geo_cache_counters
+from zentral.core.events.timing import (EVENT_LAG_HISTOGRAMS, INGESTED,
+                                        iter_event_d_lags, pop_event_d_timing, stamp_event)
+from zentral.core.stores.backends.base import get_event_key
+from .consumer import BatchConsumer, Consumer, ConsumerProducer
 from .sns import SNSPublishThread
 from .sqs import SQSSendThread
 
@@ -31,17 +36,41 @@ logger = logging.getLogger('zentral.core.queues.backends.aws_sns_sqs')
 class BaseWorker:
     name = "UNDEFINED"
     counters = []
+    histograms = []
 
     def setup_metrics_exporter(self, *args, **kwargs):
         self.metrics_exporter = kwargs.pop("metrics_exporter", None)
         if self.metrics_exporter:
             for name, label in self.counters:
                 self.metrics_exporter.add_counter(name, [label])
+            for name, label in self.histograms:
+                self.metrics_exporter.add_histogram(name, [label])
             self.metrics_exporter.start()
 
-    def inc_counter(self, name, label):
+    def inc_counter(self, name, label, value=1):
         if self.metrics_exporter:
-            self.metrics_exporter.inc(name, label)
+            self.metrics_exporter.inc(name, label, value=value)
+
+    def observe_histogram(self, name, label, value):
+        if self.metrics_exporter:
+            self.metrics_exporter.observe(name, label, value=value)
+
+    def observe_event_lags(self, event_d, timing=None):
+        if not self.metrics_exporter:
+            return
+        event_type = event_d['_zentral']['type']
+        for name, value in iter_event_d_lags(event_d, timing):
+            self.metrics_exporter.observe(name, event_type, value=value)
+
+    def setup_action_dispatcher_metrics(self):
+        if self.metrics_exporter and action_dispatcher:
+            action_dispatcher.setup_metrics_exporter(self.metrics_exporter)
+
+    def stop_action_dispatcher(self):
+        # the atexit handlers are not called in the worker processes
+        if action_dispatcher:
+            self.log_info("wait for the dispatched actions")
+            action_dispatcher.stop()
 
     def log(self, msg, level, *args):
         logger.log(level, "{} - {}".format(self.name, msg), *args)
@@ -62,15 +91,21 @@ class PreprocessWorker(ConsumerProducer, BaseWorker):
         ("preprocessed_events", "routing_key"),
         ("produced_events", "event_type"),
     )
+    histograms = (
+        ("raw_event_processing_seconds", "routing_key"),
+    )
 
     def __init__(self, event_queues):
-        super().__init__(event_queues.setup_queue("raw-events"), event_queues.client_kwargs)
+        super().__init__(event_queues.setup_queue("raw-events"), event_queues.client_kwargs,
+                         publish_buffer_size=event_queues.publish_buffer_size,
+                         **event_queues.consumer_kwargs)
         self._threads.append(
             SQSSendThread(
                 event_queues.setup_queue("events"),
                 self.stop_event,
                 self.publish_message_queue,
-                event_queues.client_kwargs
+                event_queues.client_kwargs,
+                **event_queues.send_kwargs
             )
         )
         # preprocessors
@@ -94,6 +129,7 @@ class PreprocessWorker(ConsumerProducer, BaseWorker):
         super().run(*args, **kwargs)
 
     def generate_events(self, routing_key, event_d):
+        start_ts = time.monotonic()
         if not routing_key:
             logger.error("Message w/o routing key")
         else:
@@ -102,9 +138,11 @@ class PreprocessWorker(ConsumerProducer, BaseWorker):
                 logger.error("No preprocessor for routing key %s", routing_key)
             else:
                 for event in preprocessor.process_raw_event(event_d):
-                    yield None, event.serialize(machine_metadata=False)
+                    stamp_event(event, "preprocess")
+                    yield None, event.serialize(machine_metadata=False, timing=True)
                     self.inc_counter("produced_events", event.event_type)
         self.inc_counter("preprocessed_events", routing_key or "UNKNOWN")
+        self.observe_histogram("raw_event_processing_seconds", routing_key or "UNKNOWN", time.monotonic() - start_ts)
 
 
 class EnrichWorker(ConsumerProducer, BaseWorker):
@@ -112,16 +150,23 @@ class EnrichWorker(ConsumerProducer, BaseWorker):
     counters = (
         ("enriched_events", "event_type"),
         ("produced_events", "event_type"),
+        ("geoip2_city_cache_lookups", "result"),
+    )
+    histograms = EVENT_LAG_HISTOGRAMS + (
+        ("event_processing_seconds", "event_type"),
     )
 
     def __init__(self, event_queues, enrich_event):
-        super().__init__(event_queues.setup_queue("events"), event_queues.client_kwargs)
+        super().__init__(event_queues.setup_queue("events"), event_queues.client_kwargs,
+                         publish_buffer_size=event_queues.publish_buffer_size,
+                         **event_queues.consumer_kwargs)
         self._threads.append(
             SNSPublishThread(
                 event_queues.setup_topic("enriched-events"),
                 self.stop_event,
                 self.publish_message_queue,
-                event_queues.client_kwargs
+                event_queues.client_kwargs,
+                **event_queues.send_kwargs
             )
         )
         self._enrich_event = enrich_event
@@ -133,10 +178,16 @@ class EnrichWorker(ConsumerProducer, BaseWorker):
 
     def generate_events(self, routing_key, event_d):
         self.log_debug("enrich event")
+        start_ts = time.monotonic()
+        self.observe_event_lags(event_d)
         for event in self._enrich_event(event_d):
-            yield None, event.serialize(machine_metadata=False)
+            stamp_event(event, "enrich")
+            # machine metadata computed once, and shipped to the process and store workers
+            yield None, event.serialize(machine_metadata=True, timing=True)
             self.inc_counter("produced_events", event.event_type)
         self.inc_counter("enriched_events", event.event_type)
+        self.observe_histogram("event_processing_seconds", event_d['_zentral']['type'], time.monotonic() - start_ts)
+        inc_geo_cache_counters(self.metrics_exporter)
 
 
 class ProcessWorker(Consumer, BaseWorker):
@@ -144,6 +195,9 @@ class ProcessWorker(Consumer, BaseWorker):
     counters = (
         ("processed_events", "event_type"),
     )
+    histograms = EVENT_LAG_HISTOGRAMS + (
+        ("event_processing_seconds", "event_type"),
+    )
 
     def __init__(self, event_queues, process_event):
         super().__init__(
@@ -151,26 +205,37 @@ class ProcessWorker(Consumer, BaseWorker):
                 "process-enriched-events",
                 "enriched-events"
             ),
-            event_queues.client_kwargs
+            event_queues.client_kwargs,
+            **event_queues.consumer_kwargs
         )
         self._process_event = process_event
 
     def run(self, *args, **kwargs):
         self.log_info("run")
         super().setup_metrics_exporter(*args, **kwargs)
-        super().run(*args, **kwargs)
+        self.setup_action_dispatcher_metrics()
+        try:
+            super().run(*args, **kwargs)
+        finally:
+            self.stop_action_dispatcher()
 
     def process_event(self, routing_key, event_d):
         self.log_debug("process event")
+        start_ts = time.monotonic()
+        self.observe_event_lags(event_d)
         event_type = event_d['_zentral']['type']
         self._process_event(event_d)
         self.inc_counter("processed_events", event_type)
+        self.observe_histogram("event_processing_seconds", event_type, time.monotonic() - start_ts)
 
 
-class StoreWorker(Consumer, BaseWorker):
+class StoreWorker(BatchConsumer, BaseWorker):
     counters = (
         ("stored_events", "event_type"),
     )
+    histograms = EVENT_LAG_HISTOGRAMS + (
+        ("batch_processing_seconds", "event_store"),
+    )
 
     def __init__(self, event_queues, event_store):
         super().__init__(
@@ -178,7 +243,10 @@ class StoreWorker(Consumer, BaseWorker):
                 "store-enriched-events-{}".format(slugify(event_store.name)),
                 "enriched-events"
             ),
-            event_queues.client_kwargs
+            event_store.batch_size,
+            event_store.batch_delay,
+            event_queues.client_kwargs,
+            **event_queues.consumer_kwargs
         )
         self.event_store = event_store
         self.name = "store worker {}".format(self.event_store.name)
@@ -186,13 +254,39 @@ class StoreWorker(Consumer, BaseWorker):
     def run(self, *args, **kwargs):
         self.log_info("run")
         super().setup_metrics_exporter(*args, **kwargs)
+        self.event_store.setup_metrics_exporter(self.metrics_exporter)
         super().run(*args, **kwargs)
 
-    def process_event(self, routing_key, event_d):
-        self.log_debug("store event")
-        event_type = event_d['_zentral']['type']
-        self.event_store.store(event_d)
-        self.inc_counter("stored_events", event_type)
+    def process_events(self, batch):
+        self.log_debug("store %s event(s)", len(batch))
+        start_ts = time.monotonic()
+        for _, _, event_d in batch:
+            # the timing metadata is not stored
+            self.observe_event_lags(event_d, pop_event_d_timing(event_d))
+        if self.event_store.batch_size > 1:
+            try:
+                stored_event_keys = set(self.event_store.bulk_store([event_d for _, _, event_d in batch]))
+            except Exception:
+                logger.exception("Could not add events to store %s", self.event_store.name)
+                stored_event_keys = set()
+        else:
+            stored_event_keys = set()
+            for _, _, event_d in batch:
+                try:
+                    self.event_store.store(event_d)
+                except Exception:
+                    logger.exception("Could not add event to store %s", self.event_store.name)
+                else:
+                    stored_event_keys.add(get_event_key(event_d))
+        self.observe_histogram("batch_processing_seconds", self.event_store.name, time.monotonic() - start_ts)
+        for receipt_handle, _, event_d in batch:
+            if get_event_key(event_d) in stored_event_keys:
+                yield receipt_handle
+                self.inc_counter("stored_events", event_d['_zentral']['type'])
+            else:
+                # not deleted → redelivered by SQS after the visibility timeout,
+                # or moved to the dead-letter queue by the redrive policy.
+                self.log_error("could not store event %s", get_event_key(event_d))
 
 
 class EventQueues(object):
@@ -215,6 +309,19 @@ class EventQueues(object):
             val = config_d.get(kwarg)
             if val:
                 self.client_kwargs[kwarg] = val
+        # in-process buffers, between the SQS/SNS threads and the workers
+        self.consumer_kwargs = {
+            "receive_buffer_size": int(config_d.get("receive_buffer_size", 15)),
+            "delete_buffer_size": int(config_d.get("delete_buffer_size", 15)),
+        }
+        self.publish_buffer_size = int(config_d.get("publish_buffer_size", 20))
+        # batches of the SQS send & SNS publish threads
+        publish_batch_delay = config_d.get("publish_batch_delay")
+        compression_threshold = config_d.get("compression_threshold")
+        self.send_kwargs = {
+            "batch_delay": None if publish_batch_delay is None else float(publish_batch_delay),
+            "compression_threshold": None if compression_threshold is None else int(compression_threshold),
+        }
         self._known_queues = {}
         for queue_basename, queue_url in config_d.get("predefined_queues", {}).items():
             self._known_queues[queue_basename] = queue_url
@@ -335,12 +442,13 @@ class EventQueues(object):
     def post_raw_event(self, routing_key, raw_event):
         self._setup_gracefull_stop()
         if self._raw_events_queue is None:
-            self._raw_events_queue = queue.Queue(maxsize=20)
+            self._raw_events_queue = queue.Queue(maxsize=self.publish_buffer_size)
             thread = SQSSendThread(
                 self.setup_queue("raw-events"),
                 self._stop_event,
                 self._raw_events_queue,
-                self.client_kwargs
+                self.client_kwargs,
+                **self.send_kwargs
             )
             thread.start()
             self._threads.append(thread)
@@ -349,13 +457,15 @@ class EventQueues(object):
     def post_event(self, event):
         self._setup_gracefull_stop()
         if self._events_queue is None:
-            self._events_queue = queue.Queue(maxsize=20)
+            self._events_queue = queue.Queue(maxsize=self.publish_buffer_size)
             thread = SQSSendThread(
                 self.setup_queue("events"),
                 self._stop_event,
                 self._events_queue,
-                self.client_kwargs
+                self.client_kwargs,
+                **self.send_kwargs
             )
             thread.start()
             self._threads.append(thread)
-        self._events_queue.put((None, event.serialize(machine_metadata=False), time.time()))
+        stamp_event(event, INGESTED)
+        self._events_queue.put((None, event.serialize(machine_metadata=False, timing=True), time.time()))
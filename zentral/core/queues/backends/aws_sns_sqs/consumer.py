@@ -10,11 +10,11 @@ logger = logging.getLogger("zentral.core.queues.backends.aws_sns_sqs.consumer")
 
 
 class Consumer:
-    def __init__(self, queue_url, client_kwargs=None):
+    def __init__(self, queue_url, client_kwargs=None, receive_buffer_size=15, delete_buffer_size=15):
         if client_kwargs is None:
             client_kwargs = {}
-        self.process_message_queue = queue.Queue(maxsize=15)
-        self.delete_message_queue = queue.Queue(maxsize=15)
+        self.process_message_queue = queue.Queue(maxsize=receive_buffer_size)
+        self.delete_message_queue = queue.Queue(maxsize=delete_buffer_size)
         self.signal_received_event = threading.Event()
         self.stop_event = threading.Event()
         self._threads = [
@@ -67,10 +67,64 @@ class Consumer:
         self._gracefull_stop()
 
 
+class BatchConsumer(Consumer):
+    def __init__(self, queue_url, batch_size, batch_delay, client_kwargs=None, **kwargs):
+        super().__init__(queue_url, client_kwargs, **kwargs)
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+
+    def process_events(self, batch):
+        """Process a list of (receipt_handle, routing_key, event_d) tuples.
+
+        Must yield the receipt handles of the processed events.
+        """
+        return []
+
+    def _process_batch(self, batch):
+        logger.debug("process batch of %s message(s)", len(batch))
+        try:
+            for receipt_handle in self.process_events(batch):
+                logger.debug("queue message for deletion %s", receipt_handle)
+                self.delete_message_queue.put((receipt_handle, time.time()))
+        except Exception:
+            logger.exception("could not process events")
+
+    def run(self, *args, **kwargs):
+        self.log_info("run")
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        signal.signal(signal.SIGINT, self._handle_signal)
+        for thread in self._threads:
+            thread.start()
+        batch = []
+        batch_start_ts = None
+        while True:
+            timeout = 1
+            if batch:
+                timeout = max(0, min(timeout, batch_start_ts + self.batch_delay - time.monotonic()))
+            try:
+                receipt_handle, routing_key, event_d = self.process_message_queue.get(block=True, timeout=timeout)
+            except queue.Empty:
+                logger.debug("no new event to process")
+                if self.signal_received_event.is_set():
+                    break
+            else:
+                logger.debug("add new message %s to batch", receipt_handle)
+                if not batch:
+                    batch_start_ts = time.monotonic()
+                batch.append((receipt_handle, routing_key, event_d))
+            if batch and (len(batch) >= self.batch_size or time.monotonic() - batch_start_ts >= self.batch_delay):
+                self._process_batch(batch)
+                batch = []
+                batch_start_ts = None
+        if batch:
+            self._process_batch(batch)
+        self._gracefull_stop()
+
+
 class ConsumerProducer(Consumer):
-    def __init__(self, queue_url, client_kwargs=None):
-        super().__init__(queue_url, client_kwargs)
-        self.publish_message_queue = queue.Queue(maxsize=20)
+    def __init__(self, queue_url, client_kwargs=None, publish_buffer_size=20, **kwargs):
+        super().__init__(queue_url, client_kwargs, **kwargs)
+        self.publish_message_queue = queue.Queue(maxsize=publish_buffer_size)
 
     def generate_events(self, routing_key, event_d):
         return []
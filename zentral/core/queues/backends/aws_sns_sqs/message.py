@@ -0,0 +1,73 @@
+import base64
+import zlib
+from kombu.utils import json
+
+
+# SNS & SQS message bodies and attributes
+#
+# The bodies bigger than the compression threshold are zlib compressed and base64 encoded,
+# and marked with the zentral.content_encoding message attribute.
+# The attributes are forwarded by SNS to the SQS queues (raw message delivery).
+
+
+ROUTING_KEY_ATTRIBUTE = "zentral.routing_key"
+CONTENT_ENCODING_ATTRIBUTE = "zentral.content_encoding"
+ZLIB_BASE64_CONTENT_ENCODING = "zlib+base64"
+
+# SNS & SQS limit, for a single message, and for the total payload of a batch request
+MAX_PAYLOAD_SIZE = 262144
+
+
+class MessageDecodingError(Exception):
+    pass
+
+
+def _string_attribute(value):
+    return {"DataType": "String", "StringValue": value}
+
+
+def encode_message(routing_key, event_d, compression_threshold=None):
+    """Return the body and the attributes of the message of an event."""
+    body = json.dumps(event_d)
+    message_attributes = {}
+    if routing_key:
+        message_attributes[ROUTING_KEY_ATTRIBUTE] = _string_attribute(routing_key)
+    if compression_threshold is not None:
+        data = body.encode("utf-8")
+        if len(data) >= compression_threshold:
+            body = base64.b64encode(zlib.compress(data)).decode("ascii")
+            message_attributes[CONTENT_ENCODING_ATTRIBUTE] = _string_attribute(ZLIB_BASE64_CONTENT_ENCODING)
+    return body, message_attributes
+
+
+def get_message_size(body, message_attributes):
+    """Return the size of a message, as counted by SNS & SQS for the payload limits."""
+    size = len(body.encode("utf-8"))
+    for name, attribute in message_attributes.items():
+        size += len(name.encode("utf-8"))
+        size += len(attribute["DataType"].encode("utf-8"))
+        size += len(attribute["StringValue"].encode("utf-8"))
+    return size
+
+
+def _get_string_attribute(message_attributes, name):
+    try:
+        return message_attributes[name]["StringValue"]
+    except KeyError:
+        return None
+
+
+def decode_message(message):
+    """Return the routing key and the event of a received SQS message."""
+    message_attributes = message.get("MessageAttributes") or {}
+    routing_key = _get_string_attribute(message_attributes, ROUTING_KEY_ATTRIBUTE)
+    content_encoding = _get_string_attribute(message_attributes, CONTENT_ENCODING_ATTRIBUTE)
+    body = message["Body"]
+    try:
+        if content_encoding == ZLIB_BASE64_CONTENT_ENCODING:
+            body = zlib.decompress(base64.b64decode(body)).decode("utf-8")
+        elif content_encoding:
+            raise MessageDecodingError("Unknown content encoding {}".format(content_encoding))
+        return routing_key, json.loads(body)
+    except (ValueError, zlib.error) as e:
+        raise MessageDecodingError(str(e))
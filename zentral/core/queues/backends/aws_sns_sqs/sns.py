@@ -1,48 +1,38 @@
 import logging
-import queue
-import threading
 import boto3
-from kombu.utils import json
+from .sqs import BatchSendThread
 
 
 logger = logging.getLogger("zentral.core.queues.backends.aws_sns_sqs.sns")
 
 
-class SNSPublishThread(threading.Thread):
-    def __init__(self, topic_arn, stop_event, in_queue, client_kwargs=None):
+class SNSPublishThread(BatchSendThread):
+    max_event_age_seconds = 1
+    dead_letter_suffix = "sns event too large"
+
+    def __init__(self, topic_arn, stop_event, in_queue, client_kwargs=None,
+                 batch_delay=None, compression_threshold=None):
         if client_kwargs is None:
             client_kwargs = {}
         self.client = boto3.client("sns", **client_kwargs)
         self.topic_arn = topic_arn
-        self.stop_event = stop_event
-        self.in_queue = in_queue
-        super().__init__()
+        super().__init__(stop_event, in_queue, batch_delay, compression_threshold)
+
+    def build_entry(self, entry_id, body, message_attributes):
+        entry = {"Id": entry_id,
+                 "Message": body}
+        if message_attributes:
+            entry["MessageAttributes"] = message_attributes
+        return entry
 
-    def run(self):
-        while True:
-            try:
-                routing_key, event_d, event_ts = self.in_queue.get(block=True, timeout=1)
-            except queue.Empty:
-                logger.debug("no new event to publish")
-                if self.stop_event.is_set():
-                    logger.debug("publish thread gracefull exit")
-                    break
-            else:
-                logger.debug("new event to publish %s %s", routing_key, event_ts)
-                message = json.dumps(event_d)
-                message_attributes = {}
-                if routing_key:
-                    message_attributes["zentral.routing_key"] = {
-                        "DataType": "String",
-                        "StringValue": routing_key,
-                    }
-                try:
-                    response = self.client.publish(
-                        TopicArn=self.topic_arn,
-                        Message=message,
-                        MessageAttributes=message_attributes
-                    )
-                except Exception:
-                    logger.exception("could not publish event")
-                else:
-                    logger.debug("event with MessageID %s published", response["MessageId"])
+    def send_entries(self, entries):
+        logger.debug("publish %s event(s)", len(entries))
+        try:
+            response = self.client.publish_batch(
+                TopicArn=self.topic_arn,
+                PublishBatchRequestEntries=list(entries.values())
+            )
+        except Exception:
+            logger.exception("could not publish event(s)")
+        else:
+            self.log_response(entries, response)
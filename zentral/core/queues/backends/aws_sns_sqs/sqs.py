@@ -5,7 +5,8 @@ import threading
 import time
 import uuid
 import boto3
-from kombu.utils import json
+from zentral.utils.json import save_dead_letter
+from .message import MAX_PAYLOAD_SIZE, MessageDecodingError, decode_message, encode_message, get_message_size
 
 
 logger = logging.getLogger("zentral.core.queues.backends.aws_sns_sqs.sqs")
@@ -58,10 +59,11 @@ class SQSReceiveThread(threading.Thread):
                     i += 1
                     receipt_handle = message['ReceiptHandle']
                     try:
-                        routing_key = message['MessageAttributes']['zentral.routing_key']['StringValue']
-                    except KeyError:
-                        routing_key = None
-                    event_d = json.loads(message['Body'])
+                        routing_key, event_d = decode_message(message)
+                    except MessageDecodingError:
+                        # not deleted → moved to the dead-letter queue by the redrive policy
+                        logger.exception("could not decode message %s", message.get("MessageId"))
+                        continue
                     while True:
                         try:
                             self.out_queue.put((receipt_handle, routing_key, event_d), timeout=1)
@@ -142,61 +144,106 @@ class SQSDeleteThread(threading.Thread):
                 logger.error("%s/%s event deletion error(s)", i, total_entries)
 
 
-class SQSSendThread(threading.Thread):
+class BatchSendThread(threading.Thread):
+    """Base class for the threads sending the queued events in batches.
+
+    A batch is sent when it is full, when the total payload limit would be exceeded,
+    or when its oldest event is older than batch_delay seconds.
+    """
     max_number_of_messages = 10
     max_event_age_seconds = 5
+    dead_letter_suffix = "event too large"
 
-    def __init__(self, queue_url, stop_event, in_queue, client_kwargs=None):
-        if client_kwargs is None:
-            client_kwargs = {}
-        self.client = boto3.client("sqs", **client_kwargs)
-        self.queue_url = queue_url
+    def __init__(self, stop_event, in_queue, batch_delay=None, compression_threshold=None):
         self.stop_event = stop_event
         self.in_queue = in_queue
+        self.batch_delay = self.max_event_age_seconds if batch_delay is None else batch_delay
+        self.compression_threshold = compression_threshold
         super().__init__()
 
+    def build_entry(self, entry_id, body, message_attributes):
+        raise NotImplementedError
+
+    def send_entries(self, entries):
+        raise NotImplementedError
+
     def run(self):
         entries = {}
+        entries_size = 0
         min_event_ts = None
         while True:
             logger.debug("%s event(s) to send", len(entries))
+            timeout = 1
+            if entries:
+                timeout = max(0, min(timeout, min_event_ts + self.batch_delay - time.time()))
             try:
-                routing_key, event_d, event_ts = self.in_queue.get(block=True, timeout=1)
+                routing_key, event_d, event_ts = self.in_queue.get(block=True, timeout=timeout)
             except queue.Empty:
                 logger.debug("no new event to send")
-                if entries:
-                    if self.stop_event.is_set():
+                if self.stop_event.is_set():
+                    if entries:
                         logger.debug("send current event(s) before gracefull exit")
                         self.send_entries(entries)
-                        entries = {}
-                        min_event_ts = None
-                    else:
-                        if time.time() > min_event_ts + self.max_event_age_seconds:
-                            logger.debug("send %s event(s) because max event age reached", len(entries))
-                            self.send_entries(entries)
-                            entries = {}
-                            min_event_ts = None
-                if self.stop_event.is_set():
                     logger.debug("send thread gracefull exit")
                     break
             else:
                 logger.debug("new event to send %s %s", routing_key, event_ts)
+                body, message_attributes = encode_message(routing_key, event_d, self.compression_threshold)
+                entry_size = get_message_size(body, message_attributes)
+                if entry_size > MAX_PAYLOAD_SIZE:
+                    logger.error("event message too large: %s bytes", entry_size)
+                    save_dead_letter(event_d, self.dead_letter_suffix)
+                    continue
+                if entries and entries_size + entry_size > MAX_PAYLOAD_SIZE:
+                    logger.debug("send %s event(s) because max payload size reached", len(entries))
+                    self.send_entries(entries)
+                    entries = {}
+                    entries_size = 0
+                    min_event_ts = None
                 entry_id = str(uuid.uuid4())
-                entry = {"Id": entry_id,
-                         "MessageBody": json.dumps(event_d)}
-                if routing_key:
-                    entry["MessageAttributes"] = {
-                        "zentral.routing_key": {
-                            "DataType": "String",
-                            "StringValue": routing_key
-                        }
-                    }
-                entries[entry_id] = entry
+                entries[entry_id] = self.build_entry(entry_id, body, message_attributes)
+                entries_size += entry_size
                 min_event_ts = min(min_event_ts or event_ts, event_ts)
                 if len(entries) == self.max_number_of_messages:
                     self.send_entries(entries)
                     entries = {}
+                    entries_size = 0
                     min_event_ts = None
+            if entries and time.time() >= min_event_ts + self.batch_delay:
+                logger.debug("send %s event(s) because max event age reached", len(entries))
+                self.send_entries(entries)
+                entries = {}
+                entries_size = 0
+                min_event_ts = None
+
+    def log_response(self, entries, response):
+        total_entries = len(entries)
+        logger.debug("%s/%s event(s) sent", len(response.get("Successful", [])), total_entries)
+        i = 0
+        for failed_entry in response.get("Failed", []):
+            i += 1
+            logger.debug("event sending error: %s", failed_entry)
+        if i:
+            logger.error("%s/%s event sending error(s)", i, total_entries)
+
+
+class SQSSendThread(BatchSendThread):
+    dead_letter_suffix = "sqs event too large"
+
+    def __init__(self, queue_url, stop_event, in_queue, client_kwargs=None,
+                 batch_delay=None, compression_threshold=None):
+        if client_kwargs is None:
+            client_kwargs = {}
+        self.client = boto3.client("sqs", **client_kwargs)
+        self.queue_url = queue_url
+        super().__init__(stop_event, in_queue, batch_delay, compression_threshold)
+
+    def build_entry(self, entry_id, body, message_attributes):
+        entry = {"Id": entry_id,
+                 "MessageBody": body}
+        if message_attributes:
+            entry["MessageAttributes"] = message_attributes
+        return entry
 
     def send_entries(self, entries):
         logger.debug("send %s event(s)", len(entries))
@@ -208,11 +255,4 @@ class SQSSendThread(threading.Thread):
         except Exception:
             logger.exception("could not send event(s)")
         else:
-            total_entries = len(entries)
-            logger.debug("%s/%s event(s) sent", len(response.get("Successful", [])), total_entries)
-            i = 0
-            for failed_entry in response.get("Failed", []):
-                i += 1
-                logger.debug("event sending error: %s", failed_entry)
-            if i:
-                logger.error("%s/%s event sending error(s)", i, total_entries)
+            self.log_response(entries, response)
@@ -1,31 +1,108 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
 from importlib import import_module
 import logging
+import threading
 import time
 from django.utils.text import slugify
 from kombu.utils import json
 from google.api_core.exceptions import AlreadyExists
 from google.cloud import pubsub_v1
+from google.cloud.pubsub_v1.subscriber.scheduler import ThreadScheduler
 from google.oauth2 import service_account
 from zentral.conf import settings
+from zentral.core.actions.dispatcher import action_dispatcher
+from zentral.core.events.geo import inc_geo_cache_counters
+from zentral.core.events.timing import (EVENT_LAG_HISTOGRAMS, INGESTED,
+                                        iter_event_d_lags, pop_event_d_timing, stamp_event)
+from zentral.core.stores.backends.base import get_event_key
 
 
 logger = logging.getLogger('zentral.core.queues.backends.google_pubsub')
 
 
+def ack_when_published(message, publish_futures):
+    """Ack the message when all the publish futures are done, nack it if one of them has failed."""
+    if not publish_futures:
+        message.ack()
+        return
+    lock = threading.Lock()
+    state = {"pending": len(publish_futures), "failed": False}
+
+    def done_callback(future):
+        with lock:
+            state["pending"] -= 1
+            if future.exception() is not None:
+                state["failed"] = True
+            if state["pending"] > 0:
+                return
+        if state["failed"]:
+            logger.error("Could not publish all the new messages. Nack.")
+            message.nack()
+        else:
+            message.ack()
+
+    for publish_future in publish_futures:
+        publish_future.add_done_callback(done_callback)
+
+
+def get_publisher_client(credentials, batch_settings=None):
+    publisher_kwargs = {"credentials": credentials}
+    if batch_settings:
+        publisher_kwargs["batch_settings"] = pubsub_v1.types.BatchSettings(**batch_settings)
+    return pubsub_v1.PublisherClient(**publisher_kwargs)
+
+
 class BaseWorker:
     name = "UNDEFINED"
     counters = []
+    histograms = []
+    subscriber_settings = None
+    batch_settings = None
+
+    def get_subscribe_kwargs(self):
+        subscribe_kwargs = {}
+        subscriber_settings = self.subscriber_settings or {}
+        flow_control = subscriber_settings.get("flow_control")
+        if flow_control:
+            subscribe_kwargs["flow_control"] = pubsub_v1.types.FlowControl(**flow_control)
+        callback_threads = subscriber_settings.get("callback_threads")
+        if callback_threads:
+            # bounded pool of threads for the message callbacks
+            executor = ThreadPoolExecutor(max_workers=int(callback_threads),
+                                          thread_name_prefix="{} callback".format(self.name))
+            subscribe_kwargs["scheduler"] = ThreadScheduler(executor=executor)
+        return subscribe_kwargs
+
+    def get_publisher_client(self):
+        return get_publisher_client(self.credentials, self.batch_settings)
 
     def setup_metrics_exporter(self, *args, **kwargs):
         self.metrics_exporter = kwargs.pop("metrics_exporter", None)
         if self.metrics_exporter:
             for name, label in self.counters:
                 self.metrics_exporter.add_counter(name, [label])
+            for name, label in self.histograms:
+                self.metrics_exporter.add_histogram(name, [label])
             self.metrics_exporter.start()
 
-    def inc_counter(self, name, label):
+    def inc_counter(self, name, label, value=1):
+        if self.metrics_exporter:
+            self.metrics_exporter.inc(name, label, value=value)
+
+    def observe_histogram(self, name, label, value):
         if self.metrics_exporter:
-            self.metrics_exporter.inc(name, label)
+            self.metrics_exporter.observe(name, label, value=value)
+
+    def observe_event_lags(self, event_d, timing=None):
+        if not self.metrics_exporter:
+            return
+        event_type = event_d['_zentral']['type']
+        for name, value in iter_event_d_lags(event_d, timing):
+            self.metrics_exporter.observe(name, event_type, value=value)
+
+    def setup_action_dispatcher_metrics(self):
+        if self.metrics_exporter and action_dispatcher:
+            action_dispatcher.setup_metrics_exporter(self.metrics_exporter)
 
     def log(self, msg, level, *args):
         logger.log(level, "{} - {}".format(self.name, msg), *args)
@@ -46,11 +123,16 @@ class PreprocessWorker(BaseWorker):
         ("preprocessed_events", "routing_key"),
         ("produced_events", "event_type"),
     )
+    histograms = (
+        ("raw_event_processing_seconds", "routing_key"),
+    )
 
-    def __init__(self, raw_events_topic, events_topic, credentials):
+    def __init__(self, raw_events_topic, events_topic, credentials, subscriber_settings=None, batch_settings=None):
         self.raw_events_topic = raw_events_topic
         self.events_topic = events_topic
         self.credentials = credentials
+        self.subscriber_settings = subscriber_settings
+        self.batch_settings = batch_settings
         # preprocessors
         self.preprocessors = {
             preprocessor.routing_key: preprocessor
@@ -86,11 +168,11 @@ class PreprocessWorker(BaseWorker):
 
         # publisher client
         self.log_info("initialize publisher")
-        self.publisher_client = pubsub_v1.PublisherClient(credentials=self.credentials)
+        self.publisher_client = self.get_publisher_client()
 
         # async pull
         self.log_info("start async pull")
-        pull_future = subscriber_client.subscribe(sub_path, self.callback)
+        pull_future = subscriber_client.subscribe(sub_path, self.callback, **self.get_subscribe_kwargs())
         with subscriber_client:
             try:
                 pull_future.result()
@@ -98,7 +180,9 @@ class PreprocessWorker(BaseWorker):
                 pull_future.cancel()
 
     def callback(self, message):
+        start_ts = time.monotonic()
         routing_key = message.attributes.get("routing_key")
+        publish_futures = []
         if not routing_key:
             self.log_error("Message w/o routing key")
         else:
@@ -107,11 +191,14 @@ class PreprocessWorker(BaseWorker):
                 self.log_error("No preprocessor for routing key %s", routing_key)
             else:
                 for event in preprocessor.process_raw_event(json.loads(message.data)):
-                    new_message = json.dumps(event.serialize(machine_metadata=False)).encode("utf-8")
-                    self.publisher_client.publish(self.events_topic, new_message)
+                    stamp_event(event, "preprocess")
+                    new_message = json.dumps(event.serialize(machine_metadata=False, timing=True)).encode("utf-8")
+                    publish_futures.append(self.publisher_client.publish(self.events_topic, new_message))
                     self.inc_counter("produced_events", event.event_type)
-        message.ack()
+        # published in batches by the client, acked when all the new messages are published
+        ack_when_published(message, publish_futures)
         self.inc_counter("preprocessed_events", routing_key or "UNKNOWN")
+        self.observe_histogram("raw_event_processing_seconds", routing_key or "UNKNOWN", time.monotonic() - start_ts)
 
 
 class EnrichWorker(BaseWorker):
@@ -119,13 +206,20 @@ class EnrichWorker(BaseWorker):
     counters = (
         ("enriched_events", "event_type"),
         ("produced_events", "event_type"),
+        ("geoip2_city_cache_lookups", "result"),
+    )
+    histograms = EVENT_LAG_HISTOGRAMS + (
+        ("event_processing_seconds", "event_type"),
     )
 
-    def __init__(self, events_topic, enriched_events_topic, credentials, enrich_event):
+    def __init__(self, events_topic, enriched_events_topic, credentials, enrich_event,
+                 subscriber_settings=None, batch_settings=None):
         self.events_topic = events_topic
         self.enriched_events_topic = enriched_events_topic
         self.credentials = credentials
         self.enrich_event = enrich_event
+        self.subscriber_settings = subscriber_settings
+        self.batch_settings = batch_settings
 
     def run(self, *args, **kwargs):
         self.log_info("run")
@@ -147,11 +241,11 @@ class EnrichWorker(BaseWorker):
 
         # publisher client
         self.log_info("initialize publisher")
-        self.publisher_client = pubsub_v1.PublisherClient(credentials=self.credentials)
+        self.publisher_client = self.get_publisher_client()
 
         # async pull
         self.log_info("start async pull")
-        pull_future = subscriber_client.subscribe(sub_path, self.callback)
+        pull_future = subscriber_client.subscribe(sub_path, self.callback, **self.get_subscribe_kwargs())
         with subscriber_client:
             try:
                 pull_future.result()
@@ -159,19 +253,28 @@ class EnrichWorker(BaseWorker):
                 pull_future.cancel()
 
     def callback(self, message):
+        start_ts = time.monotonic()
         event_dict = json.loads(message.data)
+        self.observe_event_lags(event_dict)
+        publish_futures = []
         try:
             for event in self.enrich_event(event_dict):
-                new_message = json.dumps(event.serialize(machine_metadata=False)).encode("utf-8")
-                self.publisher_client.publish(self.enriched_events_topic, new_message)
+                stamp_event(event, "enrich")
+                # machine metadata computed once, and shipped to the process and store workers
+                new_message = json.dumps(event.serialize(machine_metadata=True, timing=True)).encode("utf-8")
+                publish_futures.append(self.publisher_client.publish(self.enriched_events_topic, new_message))
                 self.inc_counter("produced_events", event.event_type)
         except Exception as exception:
             logger.exception("Requeuing message with 1s delay: %s", exception)
             time.sleep(1)
             message.nack()
         else:
-            message.ack()
+            # published in batches by the client, acked when all the new messages are published
+            ack_when_published(message, publish_futures)
             self.inc_counter("enriched_events", event_dict['_zentral']['type'])
+            self.observe_histogram("event_processing_seconds", event_dict['_zentral']['type'],
+                                   time.monotonic() - start_ts)
+        inc_geo_cache_counters(self.metrics_exporter)
 
 
 class ProcessWorker(BaseWorker):
@@ -179,15 +282,20 @@ class ProcessWorker(BaseWorker):
     counters = (
         ("processed_events", "event_type"),
     )
+    histograms = EVENT_LAG_HISTOGRAMS + (
+        ("event_processing_seconds", "event_type"),
+    )
 
-    def __init__(self, enriched_events_topic, credentials, process_event):
+    def __init__(self, enriched_events_topic, credentials, process_event, subscriber_settings=None):
         self.enriched_events_topic = enriched_events_topic
         self.credentials = credentials
         self.process_event = process_event
+        self.subscriber_settings = subscriber_settings
 
     def run(self, *args, **kwargs):
         self.log_info("run")
         super().setup_metrics_exporter(*args, **kwargs)
+        self.setup_action_dispatcher_metrics()
 
         # subscriber client
         self.log_info("initialize subscriber")
@@ -205,7 +313,7 @@ class ProcessWorker(BaseWorker):
 
         # async pull
         self.log_info("start async pull")
-        pull_future = subscriber_client.subscribe(sub_path, self.callback)
+        pull_future = subscriber_client.subscribe(sub_path, self.callback, **self.get_subscribe_kwargs())
         with subscriber_client:
             try:
                 pull_future.result()
@@ -213,26 +321,39 @@ class ProcessWorker(BaseWorker):
                 pull_future.cancel()
 
     def callback(self, message):
+        start_ts = time.monotonic()
         event_dict = json.loads(message.data)
+        self.observe_event_lags(event_dict)
         self.process_event(event_dict)
         message.ack()
         self.inc_counter("processed_events", event_dict['_zentral']['type'])
+        self.observe_histogram("event_processing_seconds", event_dict['_zentral']['type'],
+                               time.monotonic() - start_ts)
 
 
 class StoreWorker(BaseWorker):
     counters = (
         ("stored_events", "event_type"),
     )
+    histograms = EVENT_LAG_HISTOGRAMS + (
+        ("batch_processing_seconds", "event_store"),
+    )
 
-    def __init__(self, enriched_events_topic, credentials, event_store):
+    def __init__(self, enriched_events_topic, credentials, event_store, subscriber_settings=None):
         self.enriched_events_topic = enriched_events_topic
         self.credentials = credentials
         self.event_store = event_store
         self.name = "store worker {}".format(self.event_store.name)
+        self.subscriber_settings = subscriber_settings
+        # batch of (event_dict, message) tuples, used if the store batch size > 1
+        self.batch_lock = threading.Lock()
+        self.batch = []
+        self.batch_start_ts = None
 
     def run(self, *args, **kwargs):
         self.log_info("run")
         super().setup_metrics_exporter(*args, **kwargs)
+        self.event_store.setup_metrics_exporter(self.metrics_exporter)
 
         # subscriber client
         self.log_info("initialize subscriber")
@@ -259,25 +380,86 @@ class StoreWorker(BaseWorker):
 
         # async pull
         self.log_info("start async pull")
-        pull_future = subscriber_client.subscribe(sub_path, self.callback)
+        if self.event_store.batch_size > 1:
+            callback = self.batch_callback
+        else:
+            callback = self.callback
+        subscribe_kwargs = self.get_subscribe_kwargs()
+        flow_control = subscribe_kwargs.get("flow_control")
+        if flow_control and flow_control.max_messages < self.event_store.batch_size:
+            logger.warning("Flow control max messages < store %s batch size", self.event_store.name)
+        pull_future = subscriber_client.subscribe(sub_path, callback, **subscribe_kwargs)
         with subscriber_client:
             try:
-                pull_future.result()
+                if self.event_store.batch_size > 1:
+                    while True:
+                        try:
+                            pull_future.result(timeout=self.event_store.batch_delay)
+                        except TimeoutError:
+                            # flush the batch if it is too old
+                            self.flush_batch(max_age=self.event_store.batch_delay)
+                        else:
+                            break
+                else:
+                    pull_future.result()
             except Exception:
                 pull_future.cancel()
 
+    def pop_timing_and_observe_lags(self, event_dict):
+        # the timing metadata is not stored
+        self.observe_event_lags(event_dict, pop_event_d_timing(event_dict))
+
     def callback(self, message):
         self.log_debug("store event")
         event_dict = json.loads(message.data)
+        self.pop_timing_and_observe_lags(event_dict)
+        start_ts = time.monotonic()
         try:
             self.event_store.store(event_dict)
         except Exception:
-            logger.exception("Could add event to store %s", self.event_store.name)
+            logger.exception("Could not add event to store %s", self.event_store.name)
             message.nack()
         else:
+            self.observe_histogram("batch_processing_seconds", self.event_store.name, time.monotonic() - start_ts)
             message.ack()
             self.inc_counter("stored_events", event_dict['_zentral']['type'])
 
+    def batch_callback(self, message):
+        self.log_debug("add event to batch")
+        event_dict = json.loads(message.data)
+        self.pop_timing_and_observe_lags(event_dict)
+        with self.batch_lock:
+            if not self.batch:
+                self.batch_start_ts = time.monotonic()
+            self.batch.append((event_dict, message))
+            full_batch = len(self.batch) >= self.event_store.batch_size
+        if full_batch:
+            self.flush_batch()
+
+    def flush_batch(self, max_age=None):
+        with self.batch_lock:
+            if not self.batch:
+                return
+            if max_age is not None and time.monotonic() - self.batch_start_ts < max_age:
+                return
+            batch = self.batch
+            self.batch = []
+            self.batch_start_ts = None
+        self.log_debug("store %s event(s)", len(batch))
+        start_ts = time.monotonic()
+        try:
+            stored_event_keys = set(self.event_store.bulk_store([event_dict for event_dict, _ in batch]))
+        except Exception:
+            logger.exception("Could not add events to store %s", self.event_store.name)
+            stored_event_keys = set()
+        self.observe_histogram("batch_processing_seconds", self.event_store.name, time.monotonic() - start_ts)
+        for event_dict, message in batch:
+            if get_event_key(event_dict) in stored_event_keys:
+                message.ack()
+                self.inc_counter("stored_events", event_dict['_zentral']['type'])
+            else:
+                message.nack()
+
 
 class EventQueues(object):
     def __init__(self, config_d):
@@ -294,29 +476,58 @@ class EventQueues(object):
             credentials = service_account.Credentials.from_service_account_file(credentials_file)
             self.credentials = credentials.with_scopes(["https://www.googleapis.com/auth/cloud-platform"])
 
+        # subscriber flow control & callback threads, with optional overrides per worker type
+        self.subscriber_settings = {}
+        for key in ("flow_control", "callback_threads"):
+            val = config_d.get(key)
+            if val:
+                self.subscriber_settings[key] = val
+        self.worker_subscriber_settings = {
+            worker_type: dict(worker_settings)
+            for worker_type, worker_settings in config_d.get("workers", {}).items()
+        }
+
+        # publisher batch settings
+        self.batch_settings = config_d.get("batch_settings")
+        if self.batch_settings:
+            self.batch_settings = dict(self.batch_settings)
+
         # publisher client
         self.publisher_client = None
 
+    def _get_subscriber_settings(self, worker_type):
+        subscriber_settings = self.subscriber_settings.copy()
+        subscriber_settings.update(self.worker_subscriber_settings.get(worker_type, {}))
+        flow_control = subscriber_settings.get("flow_control")
+        if flow_control:
+            subscriber_settings["flow_control"] = dict(flow_control)
+        return subscriber_settings
+
     def _publish(self, topic, event_dict, **kwargs):
         message = json.dumps(event_dict).encode("utf-8")
         if self.publisher_client is None:
-            self.publisher_client = pubsub_v1.PublisherClient(credentials=self.credentials)
+            self.publisher_client = get_publisher_client(self.credentials, self.batch_settings)
         self.publisher_client.publish(topic, message, **kwargs)
 
     def get_preprocess_worker(self):
-        return PreprocessWorker(self.raw_events_topic, self.events_topic, self.credentials)
+        return PreprocessWorker(self.raw_events_topic, self.events_topic, self.credentials,
+                                self._get_subscriber_settings("preprocess"), self.batch_settings)
 
     def get_enrich_worker(self, enrich_event):
-        return EnrichWorker(self.events_topic, self.enriched_events_topic, self.credentials, enrich_event)
+        return EnrichWorker(self.events_topic, self.enriched_events_topic, self.credentials, enrich_event,
+                            self._get_subscriber_settings("enrich"), self.batch_settings)
 
     def get_process_worker(self, process_event):
-        return ProcessWorker(self.enriched_events_topic, self.credentials, process_event)
+        return ProcessWorker(self.enriched_events_topic, self.credentials, process_event,
+                             self._get_subscriber_settings("process"))
 
     def get_store_worker(self, event_store):
-        return StoreWorker(self.enriched_events_topic, self.credentials, event_store)
+        return StoreWorker(self.enriched_events_topic, self.credentials, event_store,
+                           self._get_subscriber_settings("store"))
 
     def post_raw_event(self, routing_key, raw_event):
         self._publish(self.raw_events_topic, raw_event, routing_key=routing_key)
 
     def post_event(self, event):
-        self._publish(self.events_topic, event.serialize(machine_metadata=False))
+        stamp_event(event, INGESTED)
+        self._publish(self.events_topic, event.serialize(machine_metadata=False, timing=True))
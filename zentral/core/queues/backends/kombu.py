@@ -1,10 +1,19 @@
 from importlib import import_module
 import logging
+import signal
+import socket
 import time
 from zentral.conf import settings
-from kombu import Connection, Consumer, Exchange, Queue
+from zentral.core.actions.dispatcher import action_dispatcher
+from zentral.core.events.geo import inc_geo_cache_counters
+from zentral.core.events.timing import (EVENT_LAG_HISTOGRAMS, INGESTED,
+                                        iter_event_d_lags, pop_event_d_timing, stamp_event)
+from zentral.core.queues.publisher import BackgroundPublisher
+from kombu import Connection, Consumer, Exchange, Producer, Queue
 from kombu.mixins import ConsumerMixin, ConsumerProducerMixin
 from kombu.pools import producers
+from zentral.core.stores.backends.base import get_event_key
+from zentral.core.stores.spill import get_circuit_breaker, get_spill_log
 from zentral.utils.json import save_dead_letter
 
 
@@ -22,21 +31,82 @@ process_events_queue = Queue('process_events',
                              exchange=enriched_events_exchange,
                              durable=True)
 
+# exchanges used by the background publisher
+published_exchanges = {exchange.name: exchange for exchange in (raw_events_exchange, events_exchange)}
+
+
+def get_preprocessors():
+    for app in settings['apps']:
+        try:
+            preprocessors_module = import_module("{}.preprocessors".format(app))
+        except ImportError:
+            pass
+        else:
+            yield from getattr(preprocessors_module, "get_preprocessors")()
+
+
+def get_raw_events_queue(routing_key):
+    return Queue(routing_key, exchange=raw_events_exchange, routing_key=routing_key, durable=True)
+
+
+def get_store_worker_name(event_store):
+    return "store worker {}".format(event_store.name)
+
+
+def get_store_events_queue(event_store):
+    return Queue(('store_events_{}'.format(event_store.name)).replace(" ", "_"),
+                 exchange=enriched_events_exchange,
+                 durable=True)
+
 
 class BaseWorker:
     name = "UNDEFINED"
     counters = []
+    histograms = []
 
     def setup_metrics_exporter(self, *args, **kwargs):
         self.metrics_exporter = kwargs.pop("metrics_exporter", None)
         if self.metrics_exporter:
             for name, label in self.counters:
                 self.metrics_exporter.add_counter(name, [label])
+            for name, label in self.histograms:
+                self.metrics_exporter.add_histogram(name, [label])
             self.metrics_exporter.start()
 
-    def inc_counter(self, name, label):
+    def inc_counter(self, name, label, value=1):
+        if self.metrics_exporter:
+            self.metrics_exporter.inc(name, label, value=value)
+
+    def observe_histogram(self, name, label, value):
         if self.metrics_exporter:
-            self.metrics_exporter.inc(name, label)
+            self.metrics_exporter.observe(name, label, value=value)
+
+    def observe_event_lags(self, event_d, timing=None):
+        if not self.metrics_exporter:
+            return
+        event_type = event_d['_zentral']['type']
+        for name, value in iter_event_d_lags(event_d, timing):
+            self.metrics_exporter.observe(name, event_type, value=value)
+
+    def setup_action_dispatcher_metrics(self):
+        if self.metrics_exporter and action_dispatcher:
+            action_dispatcher.setup_metrics_exporter(self.metrics_exporter)
+
+    def stop_action_dispatcher(self):
+        # the atexit handlers are not called in the worker processes
+        if action_dispatcher:
+            self.log_info("wait for the dispatched actions")
+            action_dispatcher.stop()
+
+    def _handle_signal(self, signum, frame):
+        if not self.should_stop:
+            self.log_error("signal %s. Initiate graceful stop.", signal.Signals(signum).name)
+            self.should_stop = True
+
+    def setup_graceful_stop(self):
+        # SIGTERM is sent to the daemon worker processes when the runworkers command exits
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._handle_signal)
 
     def log(self, msg, level, *args):
         logger.log(level, "{} - {}".format(self.name, msg), *args)
@@ -51,30 +121,192 @@ class BaseWorker:
         self.log(msg, logging.ERROR, *args)
 
 
-class PreprocessWorker(ConsumerProducerMixin, BaseWorker):
+class HighThroughputMixin:
+    """Prefetch, batched acks, and publisher confirms for the preprocess, enrich, process and fused workers.
+
+    With the default settings, the messages are acked one by one, like before.
+    With an ack_batch_size > 1, the acks are delayed until ack_batch_size messages have been processed,
+    or ack_batch_delay seconds have elapsed. On an AMQP connection, a single ack(multiple=True) is sent.
+    With the publisher confirms, the acks are only sent once the published events have been confirmed.
+    The pending messages are redelivered after a connection error.
+    """
+    prefetch_count = None
+    ack_batch_size = 1
+    ack_batch_delay = 1  # seconds
+    publisher_confirms = False
+    publisher_confirms_timeout = 30  # seconds
+
+    def setup_high_throughput(self, settings=None):
+        settings = settings or {}
+        prefetch_count = settings.get("prefetch_count")
+        if prefetch_count:
+            self.prefetch_count = int(prefetch_count)
+        self.ack_batch_size = max(int(settings.get("ack_batch_size", self.ack_batch_size)), 1)
+        if self.prefetch_count and self.ack_batch_size > self.prefetch_count:
+            # the broker would stop delivering the messages before the end of the batch
+            logger.warning("%s: ack batch size %s > prefetch count %s",
+                           self.name, self.ack_batch_size, self.prefetch_count)
+            self.ack_batch_size = self.prefetch_count
+        self.ack_batch_delay = float(settings.get("ack_batch_delay", self.ack_batch_delay))
+        self.publisher_confirms = bool(settings.get("publisher_confirms", self.publisher_confirms))
+        self.publisher_confirms_timeout = float(settings.get("publisher_confirms_timeout",
+                                                             self.publisher_confirms_timeout))
+        self.pending_acks = []
+        self.pending_acks_start_ts = None
+        self.multiple_acks = False
+        # producer, declared exchanges and queues, and confirms, per producer connection
+        self.publishing_connection = None
+        self.publishing_producer = None
+        self.declared_entities = set()
+        self.confirms_enabled = False
+        self.unconfirmed_tags = set()
+        self.last_published_tag = 0
+        self.nacked = False
+
+    # kombu ConsumerMixin callbacks
+
+    def on_consume_ready(self, connection, channel, consumers, **kwargs):
+        # new connection or channel → the pending messages will be redelivered
+        self.pending_acks = []
+        self.pending_acks_start_ts = None
+        # the other transports only ack the message itself
+        self.multiple_acks = connection.transport.driver_type == "amqp"
+        super().on_consume_ready(connection, channel, consumers, **kwargs)
+
+    def on_consume_end(self, connection, channel):
+        if self.pending_acks:
+            try:
+                self.flush_acks()
+            except Exception:
+                logger.exception("%s: could not flush the acks", self.name)
+        super().on_consume_end(connection, channel)
+
+    def on_iteration(self):
+        # called at least every second by the ConsumerMixin
+        if self.pending_acks and time.monotonic() - self.pending_acks_start_ts >= self.ack_batch_delay:
+            self.flush_acks()
+        super().on_iteration()
+
+    # acks
+
+    def ack_message(self, message):
+        if self.ack_batch_size < 2 and not self.confirms_enabled:
+            message.ack()
+            return
+        if not self.pending_acks:
+            self.pending_acks_start_ts = time.monotonic()
+        self.pending_acks.append(message)
+        if len(self.pending_acks) >= self.ack_batch_size:
+            self.flush_acks()
+
+    def flush_acks(self):
+        messages = self.pending_acks
+        self.pending_acks = []
+        self.pending_acks_start_ts = None
+        if not messages:
+            return
+        if self.confirms_enabled and not self.wait_for_publisher_confirms():
+            # the published events could have been lost
+            logger.error("%s: requeuing %s message(s)", self.name, len(messages))
+            for message in messages:
+                message.requeue()
+            return
+        self.log_debug("ack %s message(s)", len(messages))
+        if self.multiple_acks:
+            messages[-1].ack(multiple=True)
+        else:
+            for message in messages:
+                message.ack()
+
+    # publish
+
+    def _setup_publishing(self, producer_connection):
+        self.publishing_connection = producer_connection
+        self.publishing_producer = Producer(producer_connection)
+        self.declared_entities = set()
+        self.confirms_enabled = False
+        self.unconfirmed_tags = set()
+        self.last_published_tag = 0
+        self.nacked = False
+        if not self.publisher_confirms:
+            return
+        channel = self.publishing_producer.channel
+        if producer_connection.transport.driver_type != "amqp" or not hasattr(channel, "confirm_select"):
+            logger.warning("%s: publisher confirms not supported by the %s transport",
+                           self.name, producer_connection.transport.driver_type)
+            return
+        channel.confirm_select()
+        channel.events["basic_ack"].add(self._on_publisher_ack)
+        channel.events["basic_nack"].add(self._on_publisher_nack)
+        self.confirms_enabled = True
+
+    def _on_publisher_ack(self, delivery_tag, multiple):
+        if multiple:
+            self.unconfirmed_tags = {tag for tag in self.unconfirmed_tags if tag > delivery_tag}
+        else:
+            self.unconfirmed_tags.discard(delivery_tag)
+
+    def _on_publisher_nack(self, delivery_tag, multiple):
+        self._on_publisher_ack(delivery_tag, multiple)
+        self.nacked = True
+
+    def wait_for_publisher_confirms(self):
+        deadline = time.monotonic() + self.publisher_confirms_timeout
+        while self.unconfirmed_tags and not self.nacked:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                self.publishing_connection.drain_events(timeout=remaining)
+            except socket.timeout:
+                pass
+        confirmed = not self.unconfirmed_tags and not self.nacked
+        if not confirmed:
+            logger.error("%s: %s published message(s) not confirmed", self.name,
+                         len(self.unconfirmed_tags) or "some")
+        self.unconfirmed_tags = set()
+        self.nacked = False
+        return confirmed
+
+    def publish_event_d(self, event_d, exchange=None, queue=None):
+        """Publish a serialized event to an exchange, or directly to a queue, via the default exchange."""
+        producer_connection = self.producer_connection
+        if producer_connection is not self.publishing_connection:
+            self._setup_publishing(producer_connection)
+        entity = queue or exchange
+        entity_key = (type(entity).__name__, entity.name)
+        if entity_key not in self.declared_entities:
+            # declared once per producer connection
+            self.publishing_producer.maybe_declare(entity)
+            self.declared_entities.add(entity_key)
+        if queue:
+            self.publishing_producer.publish(event_d, serializer='json', exchange='', routing_key=queue.name)
+        else:
+            self.publishing_producer.publish(event_d, serializer='json', exchange=exchange)
+        if self.confirms_enabled:
+            self.last_published_tag += 1
+            self.unconfirmed_tags.add(self.last_published_tag)
+
+
+class PreprocessWorker(HighThroughputMixin, ConsumerProducerMixin, BaseWorker):
     name = "preprocess worker"
     counters = (
         ("preprocessed_events", "routing_key"),
         ("produced_events", "event_type"),
     )
+    histograms = (
+        ("raw_event_processing_seconds", "routing_key"),
+    )
 
-    def __init__(self, connection):
+    def __init__(self, connection, high_throughput_settings=None):
         self.connection = connection
+        self.setup_high_throughput(high_throughput_settings)
         # preprocessors
         self.preprocessors = {
             preprocessor.routing_key: preprocessor
-            for preprocessor in self._get_preprocessors()
+            for preprocessor in get_preprocessors()
         }
 
-    def _get_preprocessors(self):
-        for app in settings['apps']:
-            try:
-                preprocessors_module = import_module("{}.preprocessors".format(app))
-            except ImportError:
-                pass
-            else:
-                yield from getattr(preprocessors_module, "get_preprocessors")()
-
     def run(self, *args, **kwargs):
         self.log_info("run")
         super().setup_metrics_exporter(*args, **kwargs)
@@ -82,16 +314,17 @@ class PreprocessWorker(ConsumerProducerMixin, BaseWorker):
 
     def get_consumers(self, _, default_channel):
         queues = [
-            Queue(preprocessor.routing_key, exchange=raw_events_exchange,
-                  routing_key=preprocessor.routing_key, durable=True)
-            for routing_key, preprocessor in self.preprocessors.items()
+            get_raw_events_queue(routing_key)
+            for routing_key in self.preprocessors
         ]
         return [Consumer(default_channel,
                          queues=queues,
                          accept=['json'],
+                         prefetch_count=self.prefetch_count,
                          callbacks=[self.do_preprocess_raw_event])]
 
     def do_preprocess_raw_event(self, body, message):
+        start_ts = time.monotonic()
         routing_key = message.delivery_info.get("routing_key")
         if not routing_key:
             logger.error("Message w/o routing key")
@@ -101,26 +334,30 @@ class PreprocessWorker(ConsumerProducerMixin, BaseWorker):
                 logger.error("No preprocessor for routing key %s", routing_key)
             else:
                 for event in preprocessor.process_raw_event(body):
-                    self.producer.publish(event.serialize(machine_metadata=False),
-                                          serializer='json',
-                                          exchange=events_exchange,
-                                          declare=[events_exchange])
+                    stamp_event(event, "preprocess")
+                    self.publish_event_d(event.serialize(machine_metadata=False, timing=True), events_exchange)
                     self.inc_counter("produced_events", event.event_type)
-        message.ack()
+        self.ack_message(message)
         self.inc_counter("preprocessed_events", routing_key or "UNKNOWN")
+        self.observe_histogram("raw_event_processing_seconds", routing_key or "UNKNOWN", time.monotonic() - start_ts)
 
 
-class EnrichWorker(ConsumerProducerMixin, BaseWorker):
+class EnrichWorker(HighThroughputMixin, ConsumerProducerMixin, BaseWorker):
     name = "enrich worker"
     counters = (
         ("enriched_events", "event_type"),
         ("produced_events", "event_type"),
+        ("geoip2_city_cache_lookups", "result"),
+    )
+    histograms = EVENT_LAG_HISTOGRAMS + (
+        ("event_processing_seconds", "event_type"),
     )
 
-    def __init__(self, connection, enrich_event):
+    def __init__(self, connection, enrich_event, high_throughput_settings=None):
         self.connection = connection
         self.enrich_event = enrich_event
         self.name = "enrich worker"
+        self.setup_high_throughput(high_throughput_settings)
 
     def run(self, *args, **kwargs):
         self.log_info("run")
@@ -131,125 +368,552 @@ class EnrichWorker(ConsumerProducerMixin, BaseWorker):
         return [Consumer(default_channel,
                          queues=[enrich_events_queue],
                          accept=['json'],
+                         prefetch_count=self.prefetch_count,
                          callbacks=[self.do_enrich_event])]
 
     def do_enrich_event(self, body, message):
         self.log_debug("enrich event")
+        start_ts = time.monotonic()
+        self.observe_event_lags(body)
         try:
             for event in self.enrich_event(body):
-                self.producer.publish(event.serialize(machine_metadata=False),
-                                      serializer='json',
-                                      exchange=enriched_events_exchange,
-                                      declare=[enriched_events_exchange])
+                stamp_event(event, "enrich")
+                # machine metadata computed once, and shipped to the process and store workers
+                self.publish_event_d(event.serialize(machine_metadata=True, timing=True), enriched_events_exchange)
                 self.inc_counter("produced_events", event.event_type)
         except Exception as exception:
             logger.exception("Requeuing message with 1s delay: %s", exception)
             time.sleep(1)
             message.requeue()
         else:
-            message.ack()
+            self.ack_message(message)
             self.inc_counter("enriched_events", event.event_type)
+            self.observe_histogram("event_processing_seconds", body['_zentral']['type'],
+                                   time.monotonic() - start_ts)
+        inc_geo_cache_counters(self.metrics_exporter)
 
 
-class ProcessWorker(ConsumerMixin, BaseWorker):
+class ProcessWorker(HighThroughputMixin, ConsumerMixin, BaseWorker):
     name = "process worker"
     counters = (
         ("processed_events", "event_type"),
     )
+    histograms = EVENT_LAG_HISTOGRAMS + (
+        ("event_processing_seconds", "event_type"),
+    )
 
-    def __init__(self, connection, process_event):
+    def __init__(self, connection, process_event, high_throughput_settings=None):
         self.connection = connection
         self.process_event = process_event
+        self.setup_high_throughput(high_throughput_settings)
 
     def run(self, *args, **kwargs):
         self.log_info("run")
         super().setup_metrics_exporter(*args, **kwargs)
-        super().run(*args, **kwargs)
+        self.setup_action_dispatcher_metrics()
+        self.setup_graceful_stop()
+        try:
+            super().run(*args, **kwargs)
+        finally:
+            self.stop_action_dispatcher()
 
     def get_consumers(self, _, default_channel):
         return [Consumer(default_channel,
                          queues=[process_events_queue],
                          accept=['json'],
+                         prefetch_count=self.prefetch_count,
                          callbacks=[self.do_process_event])]
 
     def do_process_event(self, body, message):
         self.log_debug("process event")
+        start_ts = time.monotonic()
+        self.observe_event_lags(body)
         event_type = body['_zentral']['type']
         self.process_event(body)
-        message.ack()
+        self.ack_message(message)
         self.inc_counter("processed_events", event_type)
+        self.observe_histogram("event_processing_seconds", event_type, time.monotonic() - start_ts)
+
+
+class EventStoreWriter(object):
+    """Store the events in an event store, for the store workers and the fused worker.
+
+    During the backend outages, the events are written to the spill log if one is configured,
+    and replayed later. Only the backend unavailability errors feed the circuit breaker.
+    The events rejected by the backend are saved as dead letters.
+    """
+    max_replay_duration = 0.5  # seconds spent replaying the spill log, per call
+
+    def __init__(self, event_store):
+        self.event_store = event_store
+        # spill log & circuit breaker, opened in the worker process
+        self.spill_log = None
+        self.circuit_breaker = None
+
+    def open_spill_log(self):
+        self.spill_log = get_spill_log(self.event_store)
+        if self.spill_log:
+            self.circuit_breaker = get_circuit_breaker(self.event_store)
+        return self.spill_log
+
+    def _serialize(self, event):
+        if isinstance(event, dict):
+            return event
+        return event.serialize(machine_metadata=True)
+
+    def _save_dead_letter(self, event):
+        save_dead_letter(self._serialize(event), "event store {} error".format(self.event_store.name))
+
+    def _store_one_by_one(self, events, stored_event_keys):
+        for event in events:
+            try:
+                self.event_store.store(event)
+            except Exception as exception:
+                if self.event_store.is_unavailable_error(exception):
+                    raise
+                logger.exception("Could not add event to store %s", self.event_store.name)
+            else:
+                stored_event_keys.add(get_event_key(event))
+
+    def _store(self, events):
+        """Store the events. Returns the keys of the stored events, and True if the backend is unavailable.
+
+        Nothing is stored if the circuit breaker is open.
+        """
+        stored_event_keys = set()
+        if self.circuit_breaker and not self.circuit_breaker.allow_request():
+            return stored_event_keys, True
+        unavailable = False
+        try:
+            if self.event_store.batch_size > 1:
+                try:
+                    stored_event_keys.update(self.event_store.bulk_store(events))
+                except Exception as exception:
+                    if self.event_store.is_unavailable_error(exception):
+                        raise
+                    # batch rejected → the events are stored one by one, to only dead-letter the rejected ones
+                    logger.exception("Could not add events to store %s", self.event_store.name)
+                    self._store_one_by_one([event for event in events
+                                            if get_event_key(event) not in stored_event_keys],
+                                           stored_event_keys)
+            else:
+                self._store_one_by_one(events, stored_event_keys)
+        except Exception:
+            logger.exception("Store %s unavailable", self.event_store.name)
+            unavailable = True
+        if self.circuit_breaker:
+            if unavailable:
+                self.circuit_breaker.record_failure()
+            else:
+                self.circuit_breaker.record_success()
+        return stored_event_keys, unavailable
+
+    def store(self, events):
+        """Store a list of events or serialized events.
+
+        Returns the keys of the stored events, and the keys of the spilled events.
+        The other events are saved as dead letters.
+        """
+        stored_event_keys, unavailable = self._store(events)
+        failed_events = [event for event in events if get_event_key(event) not in stored_event_keys]
+        spilled_event_keys = set()
+        if not failed_events:
+            return stored_event_keys, spilled_event_keys
+        if unavailable and self.spill_log:
+            try:
+                spilled = self.spill_log.append([self._serialize(event) for event in failed_events])
+            except Exception:
+                logger.exception("Could not write to spill log %s", self.spill_log.directory)
+                spilled = False
+            if spilled:
+                spilled_event_keys.update(get_event_key(event) for event in failed_events)
+                return stored_event_keys, spilled_event_keys
+            logger.error("Store %s: spill log full", self.event_store.name)
+        for event in failed_events:
+            self._save_dead_letter(event)
+        return stored_event_keys, spilled_event_keys
+
+    def replay_spill_log(self):
+        """Replay the spill log for at most max_replay_duration seconds. Returns the stored events."""
+        replayed_event_ds = []
+        if not self.spill_log or self.spill_log.is_empty():
+            return replayed_event_ds
+        deadline = time.monotonic() + self.max_replay_duration
+        while time.monotonic() < deadline:
+            if not self.circuit_breaker.allow_request():
+                break
+            event_ds, position = self.spill_log.read()
+            if event_ds is None:
+                break
+            stored_event_keys, unavailable = self._store(event_ds)
+            if unavailable:
+                # retry later
+                break
+            for event_d in event_ds:
+                if get_event_key(event_d) in stored_event_keys:
+                    replayed_event_ds.append(event_d)
+                else:
+                    self._save_dead_letter(event_d)
+            self.spill_log.commit(position)
+        return replayed_event_ds
 
 
 class StoreWorker(ConsumerMixin, BaseWorker):
     counters = (
         ("stored_events", "event_type"),
+        ("spilled_events", "event_type"),
+        ("replayed_events", "event_type"),
+    )
+    histograms = EVENT_LAG_HISTOGRAMS + (
+        ("batch_processing_seconds", "event_store"),
     )
 
     def __init__(self, connection, event_store):
         self.connection = connection
         self.event_store = event_store
-        self.name = "store worker {}".format(self.event_store.name)
-        self.input_queue = Queue(('store_events_{}'.format(self.event_store.name)).replace(" ", "_"),
-                                 exchange=enriched_events_exchange,
-                                 durable=True)
+        self.name = get_store_worker_name(self.event_store)
+        self.input_queue = get_store_events_queue(self.event_store)
+        self.writer = EventStoreWriter(self.event_store)
+        # batch of (body, message) tuples, used if the store batch size > 1
+        self.batch = []
+        self.batch_start_ts = None
 
     def run(self, *args, **kwargs):
         self.log_info("run")
         super().setup_metrics_exporter(*args, **kwargs)
+        self.event_store.setup_metrics_exporter(self.metrics_exporter)
+        spill_log = self.writer.open_spill_log()
+        if spill_log:
+            self.log_info("spill log %s", spill_log.directory)
         super().run(*args, **kwargs)
 
     def get_consumers(self, _, default_channel):
+        if self.event_store.batch_size > 1:
+            callback = self.do_add_event_to_batch
+        else:
+            callback = self.do_store_event
         return [Consumer(default_channel,
                          queues=[self.input_queue],
                          accept=['json'],
-                         callbacks=[self.do_store_event])]
+                         callbacks=[callback])]
+
+    def on_consume_ready(self, connection, channel, consumers, **kwargs):
+        # new connection or channel → the pending messages will be redelivered
+        self.batch = []
+        self.batch_start_ts = None
+
+    def on_iteration(self):
+        # called at least every second by the ConsumerMixin
+        if self.batch and time.monotonic() - self.batch_start_ts >= self.event_store.batch_delay:
+            self.flush_batch()
+        self.replay_spill_log()
+
+    def pop_timing_and_observe_lags(self, body):
+        # the timing metadata is not stored
+        self.observe_event_lags(body, pop_event_d_timing(body))
 
     def do_store_event(self, body, message):
         self.log_debug("store event")
-        event_type = body['_zentral']['type']
+        self.pop_timing_and_observe_lags(body)
+        self.store_events([(body, message)])
+
+    def do_add_event_to_batch(self, body, message):
+        self.log_debug("add event to batch")
+        self.pop_timing_and_observe_lags(body)
+        if not self.batch:
+            self.batch_start_ts = time.monotonic()
+        self.batch.append((body, message))
+        if len(self.batch) >= self.event_store.batch_size:
+            self.flush_batch()
+
+    def flush_batch(self):
+        batch = self.batch
+        self.batch = []
+        self.batch_start_ts = None
+        self.log_debug("store %s event(s)", len(batch))
+        self.store_events(batch)
+
+    def store_events(self, batch):
+        start_ts = time.monotonic()
+        stored_event_keys, spilled_event_keys = self.writer.store([body for body, _ in batch])
+        self.observe_histogram("batch_processing_seconds", self.event_store.name, time.monotonic() - start_ts)
+        for body, message in batch:
+            event_key = get_event_key(body)
+            if event_key in stored_event_keys:
+                message.ack()
+                self.inc_counter("stored_events", body['_zentral']['type'])
+            elif event_key in spilled_event_keys:
+                message.ack()
+                self.inc_counter("spilled_events", body['_zentral']['type'])
+            else:
+                # dead letter saved by the writer
+                message.reject()
+
+    def replay_spill_log(self):
+        for event_d in self.writer.replay_spill_log():
+            self.inc_counter("replayed_events", event_d['_zentral']['type'])
+
+
+class FusedWorker(HighThroughputMixin, ConsumerProducerMixin, BaseWorker):
+    """Run the preprocess, enrich, process and store steps in a single process.
+
+    The events are kept in memory between the fused steps. The events are only
+    published to the queues of the workers that are explicitly left unfused.
+    """
+    name = "fused worker"
+    counters = (
+        ("preprocessed_events", "routing_key"),
+        ("enriched_events", "event_type"),
+        ("processed_events", "event_type"),
+        ("stored_events", "store"),
+        ("spilled_events", "store"),
+        ("replayed_events", "store"),
+        ("published_events", "worker"),
+        ("geoip2_city_cache_lookups", "result"),
+    )
+    histograms = EVENT_LAG_HISTOGRAMS + (
+        ("batch_processing_seconds", "worker"),
+    )
+
+    def __init__(self, connection, enrich_event, process_event, event_stores, unfused_stages=None,
+                 high_throughput_settings=None):
+        self.connection = connection
+        self.setup_high_throughput(high_throughput_settings)
+        self.unfused_stages = set(unfused_stages or [])
+        if EnrichWorker.name in self.unfused_stages:
+            logger.error("The %s cannot be left unfused", EnrichWorker.name)
+            self.unfused_stages.remove(EnrichWorker.name)
+        # preprocess
+        if PreprocessWorker.name in self.unfused_stages:
+            self.preprocessors = {}
+        else:
+            self.preprocessors = {
+                preprocessor.routing_key: preprocessor
+                for preprocessor in get_preprocessors()
+            }
+        # enrich
+        self.enrich_event = enrich_event
+        # process and stores, fused or published to the queues of the unfused workers
+        self.process_event = None
+        self.store_writers = []
+        self.output_queues = []
+        if ProcessWorker.name in self.unfused_stages:
+            self.output_queues.append((ProcessWorker.name, process_events_queue))
+        else:
+            self.process_event = process_event
+        for event_store in event_stores:
+            store_worker_name = get_store_worker_name(event_store)
+            if store_worker_name in self.unfused_stages:
+                self.output_queues.append((store_worker_name, get_store_events_queue(event_store)))
+            else:
+                self.store_writers.append(EventStoreWriter(event_store))
+        # batch of (events, message) tuples, sized for the fused stores
+        fused_event_stores = [store_writer.event_store for store_writer in self.store_writers]
+        self.batch_size = max([1] + [event_store.batch_size for event_store in fused_event_stores])
+        self.batch_delay = min([event_store.batch_delay
+                                for event_store in fused_event_stores
+                                if event_store.batch_size > 1] or [0])
+        self.batch = []
+        self.batch_start_ts = None
+
+    def replaces(self, worker):
+        return worker.name not in self.unfused_stages
+
+    def run(self, *args, **kwargs):
+        self.log_info("run")
+        super().setup_metrics_exporter(*args, **kwargs)
+        if self.process_event:
+            self.setup_action_dispatcher_metrics()
+        for store_writer in self.store_writers:
+            spill_log = store_writer.open_spill_log()
+            if spill_log:
+                self.log_info("store %s spill log %s", store_writer.event_store.name, spill_log.directory)
+        self.setup_graceful_stop()
         try:
-            self.event_store.store(body)
-        except Exception:
-            logger.exception("Could add event to store %s", self.event_store.name)
-            save_dead_letter(body, "event store {} error".format(self.event_store.name))
-            message.reject()
+            super().run(*args, **kwargs)
+        finally:
+            if self.process_event:
+                self.stop_action_dispatcher()
+
+    def get_consumers(self, _, default_channel):
+        consumers = [Consumer(default_channel,
+                              queues=[enrich_events_queue],
+                              accept=['json'],
+                              prefetch_count=self.prefetch_count,
+                              callbacks=[self.do_add_event_to_batch])]
+        if self.preprocessors:
+            consumers.append(Consumer(default_channel,
+                                      queues=[get_raw_events_queue(routing_key)
+                                              for routing_key in self.preprocessors],
+                                      accept=['json'],
+                                      prefetch_count=self.prefetch_count,
+                                      callbacks=[self.do_add_raw_event_to_batch]))
+        return consumers
+
+    def on_consume_ready(self, connection, channel, consumers, **kwargs):
+        # new connection or channel → the pending messages will be redelivered
+        self.batch = []
+        self.batch_start_ts = None
+        super().on_consume_ready(connection, channel, consumers, **kwargs)
+
+    def on_iteration(self):
+        # called at least every second by the ConsumerMixin
+        if self.batch and time.monotonic() - self.batch_start_ts >= self.batch_delay:
+            self.flush_batch()
+        self.replay_spill_logs()
+        super().on_iteration()
+
+    def replay_spill_logs(self):
+        for store_writer in self.store_writers:
+            replayed_event_ds = store_writer.replay_spill_log()
+            if replayed_event_ds:
+                self.inc_counter("replayed_events", store_writer.event_store.name, len(replayed_event_ds))
+
+    def add_to_batch(self, events, message):
+        if not self.batch:
+            self.batch_start_ts = time.monotonic()
+        self.batch.append((events, message))
+        if len(self.batch) >= self.batch_size:
+            self.flush_batch()
+
+    def do_add_raw_event_to_batch(self, body, message):
+        self.log_debug("preprocess raw event")
+        routing_key = message.delivery_info.get("routing_key")
+        events = []
+        if not routing_key:
+            logger.error("Message w/o routing key")
         else:
-            message.ack()
-            self.inc_counter("stored_events", event_type)
+            preprocessor = self.preprocessors.get(routing_key)
+            if not preprocessor:
+                logger.error("No preprocessor for routing key %s", routing_key)
+            else:
+                events = list(preprocessor.process_raw_event(body))
+        self.inc_counter("preprocessed_events", routing_key or "UNKNOWN")
+        self.add_to_batch(events, message)
+
+    def do_add_event_to_batch(self, body, message):
+        self.log_debug("add event to batch")
+        self.observe_event_lags(body)
+        self.add_to_batch([body], message)
+
+    def store_events(self, store_writer, events):
+        if not events:
+            return
+        event_store = store_writer.event_store
+        # the events are stored one by one by the writer if the store batch size is 1
+        chunk_size = event_store.batch_size if event_store.batch_size > 1 else len(events)
+        for i in range(0, len(events), chunk_size):
+            stored_event_keys, spilled_event_keys = store_writer.store(events[i:i + chunk_size])
+            if stored_event_keys:
+                self.inc_counter("stored_events", event_store.name, len(stored_event_keys))
+            if spilled_event_keys:
+                self.inc_counter("spilled_events", event_store.name, len(spilled_event_keys))
+
+    def flush_batch(self):
+        batch = self.batch
+        self.batch = []
+        self.batch_start_ts = None
+        self.log_debug("run the fused steps for %s message(s)", len(batch))
+        start_ts = time.monotonic()
+        messages_to_ack = []
+        requeue = False
+        enriched_events = []
+        for events, message in batch:
+            try:
+                message_enriched_events = [
+                    enriched_event
+                    for event in events
+                    for enriched_event in self.enrich_event(event)
+                ]
+            except Exception as exception:
+                logger.exception("Requeuing message: %s", exception)
+                message.requeue()
+                requeue = True
+                continue
+            for event in message_enriched_events:
+                self.inc_counter("enriched_events", event.event_type)
+                if self.process_event:
+                    self.process_event(event)
+                    self.inc_counter("processed_events", event.event_type)
+                if self.output_queues:
+                    stamp_event(event, "enrich")
+                    # machine metadata computed once, and shipped to the unfused workers
+                    event_d = event.serialize(machine_metadata=True, timing=True)
+                    for worker_name, queue in self.output_queues:
+                        self.publish_event_d(event_d, queue=queue)
+                        self.inc_counter("published_events", worker_name)
+            enriched_events.extend(message_enriched_events)
+            messages_to_ack.append(message)
+        inc_geo_cache_counters(self.metrics_exporter)
+        for store_writer in self.store_writers:
+            self.store_events(store_writer, enriched_events)
+        for message in messages_to_ack:
+            self.ack_message(message)
+        self.observe_histogram("batch_processing_seconds", self.name, time.monotonic() - start_ts)
+        if requeue:
+            time.sleep(1)
 
 
 class EventQueues(object):
     def __init__(self, config_d):
         self.backend_url = config_d['backend_url']
         self.transport_options = config_d.get('transport_options')
+        self.fused_worker_config = config_d.get('fused_worker')
+        self.high_throughput_settings = None
+        high_throughput_config = config_d.get('high_throughput')
+        if high_throughput_config:
+            self.high_throughput_settings = dict(high_throughput_config)
         self.connection = self._get_connection()
+        self.background_publisher = None
+        background_publisher_config = config_d.get('background_publisher')
+        if background_publisher_config and background_publisher_config.get('enabled', True):
+            background_publisher_config = dict(background_publisher_config)
+            background_publisher_config.pop('enabled', None)
+            self.background_publisher = BackgroundPublisher("kombu events", self._publish_batch,
+                                                            **background_publisher_config)
 
     def _get_connection(self):
         return Connection(self.backend_url, transport_options=self.transport_options)
 
     def get_preprocess_worker(self):
-        return PreprocessWorker(self._get_connection())
+        return PreprocessWorker(self._get_connection(), self.high_throughput_settings)
 
     def get_enrich_worker(self, enrich_event):
-        return EnrichWorker(self._get_connection(), enrich_event)
+        return EnrichWorker(self._get_connection(), enrich_event, self.high_throughput_settings)
 
     def get_process_worker(self, process_event):
-        return ProcessWorker(self._get_connection(), process_event)
+        return ProcessWorker(self._get_connection(), process_event, self.high_throughput_settings)
 
     def get_store_worker(self, event_store):
         return StoreWorker(self._get_connection(), event_store)
 
-    def post_raw_event(self, routing_key, raw_event):
+    def get_fused_worker(self, enrich_event, process_event, event_stores):
+        if not self.fused_worker_config:
+            return
+        return FusedWorker(self._get_connection(), enrich_event, process_event, event_stores,
+                           self.fused_worker_config.get('unfused_stages'), self.high_throughput_settings)
+
+    def _publish_batch(self, messages):
         with producers[self.connection].acquire(block=True) as producer:
-            producer.publish(raw_event,
-                             serializer='json',
-                             exchange=raw_events_exchange,
-                             routing_key=routing_key,
-                             declare=[raw_events_exchange])
+            for exchange_name, routing_key, body in messages:
+                exchange = published_exchanges[exchange_name]
+                producer.publish(body,
+                                 serializer='json',
+                                 exchange=exchange,
+                                 routing_key=routing_key,
+                                 declare=[exchange])
+
+    def _publish(self, exchange, routing_key, body):
+        message = (exchange.name, routing_key, body)
+        if self.background_publisher:
+            # buffered, published in batches by the background thread
+            self.background_publisher.publish(message)
+        else:
+            self._publish_batch([message])
+
+    def post_raw_event(self, routing_key, raw_event):
+        self._publish(raw_events_exchange, routing_key, raw_event)
 
     def post_event(self, event):
-        with producers[self.connection].acquire(block=True) as producer:
-            producer.publish(event.serialize(machine_metadata=False),
-                             serializer='json',
-                             exchange=events_exchange,
-                             declare=[events_exchange])
+        stamp_event(event, INGESTED)
+        self._publish(events_exchange, None, event.serialize(machine_metadata=False, timing=True))
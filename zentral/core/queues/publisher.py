@@ -0,0 +1,175 @@
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from zentral.core.stores.spill import CircuitBreaker, SpillLog
+from zentral.utils.json import save_dead_letter
+
+
+logger = logging.getLogger("zentral.core.queues.publisher")
+
+
+class BackgroundPublisher(object):
+    """Publish the messages in batches, from a background thread.
+
+    Used to take the broker round trips out of the web requests.
+    The messages are buffered in memory. When the buffer stays full, or when the broker is failing,
+    they are appended to a local spill log, and replayed when the broker is available again.
+    A message is published at least once.
+
+    The thread is started with the first published message, to only start it in the web worker processes.
+    """
+
+    def __init__(self, name, publish_batch,
+                 max_buffer_size=10000, enqueue_timeout=0.1,
+                 max_batch_size=100, batch_delay=0.05,
+                 spill_log_directory="/tmp/zentral_spill_logs", max_spill_log_size=2**30,
+                 failure_threshold=3, retry_delay=10,
+                 shutdown_timeout=10):
+        self.name = name
+        self.publish_batch = publish_batch
+        self.max_buffer_size = max(int(max_buffer_size), 1)
+        self.enqueue_timeout = float(enqueue_timeout)
+        self.max_batch_size = max(int(max_batch_size), 1)
+        self.batch_delay = float(batch_delay)
+        self.spill_log_directory = spill_log_directory
+        self.max_spill_log_size = int(max_spill_log_size)
+        self.circuit_breaker = CircuitBreaker(failure_threshold, retry_delay)
+        self.shutdown_timeout = float(shutdown_timeout)
+        self._pid = None
+        self._start_lock = threading.Lock()
+        self._spill_lock = threading.Lock()
+        self._stop_event = threading.Event()
+
+    # start & stop
+
+    def _start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            # new process
+            self._pid = os.getpid()
+            self._buffer = queue.Queue(maxsize=self.max_buffer_size)
+            self._stop_event = threading.Event()
+            self._spill_log = None
+            if self.spill_log_directory:
+                try:
+                    self._spill_log = SpillLog.open_for_store(self.spill_log_directory, self.name,
+                                                              max_size=self.max_spill_log_size)
+                except OSError:
+                    logger.exception("Could not open %s spill log", self.name)
+            self._thread = threading.Thread(target=self.run, name="{} publisher".format(self.name), daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def stop(self):
+        """Publish the buffered messages, and stop the thread."""
+        if self._pid != os.getpid() or self._stop_event.is_set():
+            return
+        self._stop_event.set()
+        self._thread.join(self.shutdown_timeout)
+        # spill what could not be published in time
+        messages = self._drain_buffer()
+        if messages:
+            self._spill(messages)
+        if self._spill_log and not self._thread.is_alive():
+            with self._spill_lock:
+                self._spill_log.close()
+
+    # spill log
+
+    def _spill(self, batch):
+        with self._spill_lock:
+            try:
+                if self._spill_log and self._spill_log.append(batch):
+                    logger.warning("%s: %s message(s) spilled", self.name, len(batch))
+                    return
+            except Exception:
+                logger.exception("%s: spill log error", self.name)
+        logger.error("%s: could not spill %s message(s)", self.name, len(batch))
+        save_dead_letter(batch, "{} publisher".format(self.name))
+
+    def _replay_spill_log(self):
+        """Publish the next spill log record. Returns True if a record has been published."""
+        with self._spill_lock:
+            if not self._spill_log or self._spill_log.is_empty():
+                return False
+            batch, position = self._spill_log.read()
+        if batch is None:
+            return False
+        try:
+            self.publish_batch(batch)
+        except Exception:
+            logger.exception("%s: could not replay spilled message(s)", self.name)
+            self.circuit_breaker.record_failure()
+            return False
+        self.circuit_breaker.record_success()
+        with self._spill_lock:
+            self._spill_log.commit(position)
+        logger.info("%s: %s spilled message(s) replayed", self.name, len(batch))
+        return True
+
+    # publish
+
+    def publish(self, message):
+        """Buffer a message. Blocks up to enqueue_timeout seconds if the buffer is full."""
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self._buffer.put(message, timeout=self.enqueue_timeout)
+        except queue.Full:
+            logger.error("%s: buffer full", self.name)
+            self._spill([message])
+
+    def _get_batch(self, timeout):
+        """Wait up to timeout seconds for a first message, then up to batch_delay seconds for the others."""
+        try:
+            batch = [self._buffer.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.batch_delay
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            waiting = remaining > 0 and not self._stop_event.is_set()
+            try:
+                if waiting:
+                    batch.append(self._buffer.get(timeout=min(remaining, 0.1)))
+                else:
+                    batch.append(self._buffer.get_nowait())
+            except queue.Empty:
+                if not waiting:
+                    break
+        return batch
+
+    def _drain_buffer(self):
+        messages = []
+        while True:
+            try:
+                messages.append(self._buffer.get_nowait())
+            except queue.Empty:
+                return messages
+
+    def _send(self, batch):
+        if self.circuit_breaker.allow_request():
+            try:
+                self.publish_batch(batch)
+            except Exception:
+                logger.exception("%s: could not publish %s message(s)", self.name, len(batch))
+                self.circuit_breaker.record_failure()
+            else:
+                self.circuit_breaker.record_success()
+                return
+        self._spill(batch)
+
+    def run(self):
+        while True:
+            batch = self._get_batch(timeout=1)
+            if batch:
+                self._send(batch)
+            elif self._stop_event.is_set():
+                break
+            # replay the spilled messages, the new messages first
+            while self._buffer.empty() and self.circuit_breaker.allow_request() and self._replay_spill_log():
+                pass
@@ -6,11 +6,22 @@ from zentral.core.events.pipeline import enrich_event, process_event
 
 
 def get_workers():
-    yield queues.get_preprocess_worker()
-    yield queues.get_enrich_worker(enrich_event)
-    yield queues.get_process_worker(process_event)
-    for store in stores:
-        yield queues.get_store_worker(store)
+    workers = [
+        queues.get_preprocess_worker(),
+        queues.get_enrich_worker(enrich_event),
+        queues.get_process_worker(process_event),
+    ]
+    workers.extend(queues.get_store_worker(store) for store in stores)
+    # optional fused worker, only available with some queues backends
+    fused_worker = None
+    if hasattr(queues, "get_fused_worker"):
+        fused_worker = queues.get_fused_worker(enrich_event, process_event, stores)
+    if fused_worker:
+        yield fused_worker
+    for worker in workers:
+        if fused_worker and fused_worker.replaces(worker):
+            continue
+        yield worker
     # extra apps workers
     for app in settings['apps']:
         try:
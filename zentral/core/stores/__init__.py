@@ -37,6 +37,11 @@ def get_frontend_store(stores):
             fe_store = stores[0]
         except IndexError:
             logger.error('No stores')
+            return
+    read_cache_config = fe_store.read_cache_config or {}
+    if read_cache_config.get('enabled', False):
+        from .cache import CachedEventStore
+        fe_store = CachedEventStore(fe_store, read_cache_config)
     return fe_store
 
 
@@ -8,7 +8,7 @@ import logging
 import pytz
 import requests
 from zentral.core.events import event_from_event_d
-from zentral.core.stores.backends.base import BaseEventStore
+from zentral.core.stores.backends.base import BaseEventStore, get_event_key
 
 
 logger = logging.getLogger('zentral.core.stroes.backends.azure_log_analytics')
@@ -45,6 +45,7 @@ class EventStore(BaseEventStore):
     content_type = "application/json"
     resource = "/api/logs"
     url_template = "https://{customer_id}.ods.opinsights.azure.com/api/logs?api-version=2016-04-01"
+    max_batch_size = 500  # 30MB per post max.
 
     def __init__(self, config_d):
         super().__init__(config_d)
@@ -76,6 +77,8 @@ class EventStore(BaseEventStore):
         return dict(items)
 
     def _prepare_event(self, event):
+        if isinstance(event, dict):
+            event = event_from_event_d(event)
         event_d = event.serialize()
 
         metadata = event_d.pop("_zentral")
@@ -88,7 +91,7 @@ class EventStore(BaseEventStore):
 
         # add the rest of the data
         azure_event["Properties"] = event_d
-        return [azure_event]
+        return azure_event
 
     def _build_signature(self, rfc1123_date, content_length):
         # Build the API signature
@@ -106,11 +109,9 @@ class EventStore(BaseEventStore):
                 digestmod=hashlib.sha256).digest()
         )
 
-    def store(self, event):
+    def _post_azure_events(self, azure_events):
         # Build and send a request to the POST API
-        if isinstance(event, dict):
-            event = event_from_event_d(event)
-        data = json.dumps(self._prepare_event(event)).encode("utf-8")
+        data = json.dumps(azure_events).encode("utf-8")
         rfc1123_date = datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S GMT')
         signature = self._build_signature(rfc1123_date, len(data))
         self._session.headers.update({
@@ -119,3 +120,16 @@ class EventStore(BaseEventStore):
         })
         r = self._session.post(self._url, data=data)
         r.raise_for_status()
+
+    def store(self, event):
+        self._post_azure_events([self._prepare_event(event)])
+
+    def bulk_store(self, events):
+        event_keys = []
+        azure_events = []
+        for event in events:
+            event_keys.append(get_event_key(event))
+            azure_events.append(self._prepare_event(event))
+        if azure_events:
+            self._post_azure_events(azure_events)
+        return event_keys
@@ -1,8 +1,57 @@
+import base64
+import json
+import logging
+
+
+logger = logging.getLogger('zentral.core.stores.backends.base')
+
+
+def get_event_key(event):
+    """Return the (uuid, index) tuple identifying an event or a serialized event."""
+    if isinstance(event, dict):
+        metadata_d = event["_zentral"]
+        return str(metadata_d["id"]), int(metadata_d.get("index", 0))
+    else:
+        return str(event.metadata.uuid), event.metadata.index
+
+
+def encode_cursor(cursor_d):
+    """Encode a dict into an opaque, URL safe, pagination cursor."""
+    return base64.urlsafe_b64encode(json.dumps(cursor_d, separators=(",", ":")).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """Decode a pagination cursor. Returns None if the cursor is invalid."""
+    if not cursor:
+        return
+    try:
+        cursor_d = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (TypeError, ValueError):
+        logger.warning("Invalid cursor")
+        return
+    if isinstance(cursor_d, dict):
+        return cursor_d
+
+
 class BaseEventStore(object):
+    max_batch_size = 1
+    default_batch_delay = 1  # seconds
+
     def __init__(self, config_d):
         self.name = config_d['store_name']
         self.frontend = config_d.get('frontend', False)
         self.configured = False
+        # batches
+        batch_size = int(config_d.get('batch_size', 1))
+        self.batch_size = min(max(batch_size, 1), self.max_batch_size)
+        if batch_size > self.batch_size:
+            logger.warning("Store %s: batch size %s > max batch size %s",
+                           self.name, batch_size, self.max_batch_size)
+        self.batch_delay = float(config_d.get('batch_delay', self.default_batch_delay))
+        # local spill log, used by the store workers during the backend outages
+        self.spill_log_config = config_d.get('spill_log')
+        # frontend store aggregations cache, see zentral.core.stores.cache
+        self.read_cache_config = config_d.get('read_cache')
 
     def wait_and_configure(self):
         self.configured = True
@@ -11,6 +60,67 @@ class BaseEventStore(object):
         if not self.configured:
             self.wait_and_configure()
 
+    def setup_metrics_exporter(self, metrics_exporter):
+        """Register the store metrics. Called in the store worker processes."""
+        pass
+
+    # store
+
+    def store(self, event):
+        raise NotImplementedError
+
+    def bulk_store(self, events):
+        """Store a list of events or serialized events.
+
+        Yields the keys of the stored events (see get_event_key).
+        The events that are not yielded have not been stored.
+        The backends with a native batch API must override this method.
+        """
+        for event in events:
+            try:
+                self.store(event)
+            except Exception as exception:
+                if self.is_unavailable_error(exception):
+                    raise
+                logger.exception("Store %s: could not store event", self.name)
+            else:
+                yield get_event_key(event)
+
+    def is_unavailable_error(self, exception):
+        """Return True if the exception means that the backend is unavailable.
+
+        Connection errors, timeouts, throttling and server errors → the events can be stored later.
+        The other exceptions are rejections of the events by the backend.
+        """
+        status_code = getattr(getattr(exception, "response", None), "status_code", None)
+        if isinstance(status_code, int):
+            return status_code == 429 or status_code >= 500
+        return isinstance(exception, OSError)
+
+    # cursor pagination
+
+    def _fetch_page_with_offset(self, fetch, cursor, limit):
+        """Default cursor pagination, built on the offset fetch methods.
+
+        The backends that can do better (constant time deep pages) must override the *_fetch_page methods.
+        """
+        offset = 0
+        cursor_d = decode_cursor(cursor)
+        if cursor_d:
+            try:
+                offset = max(int(cursor_d.get("offset", 0)), 0)
+            except (TypeError, ValueError):
+                pass
+        # one extra event to know if there is a next page
+        events = list(fetch(offset, limit + 1))
+        next_cursor = previous_cursor = None
+        if len(events) > limit:
+            events = events[:limit]
+            next_cursor = encode_cursor({"offset": offset + limit})
+        if offset > 0:
+            previous_cursor = encode_cursor({"offset": max(offset - limit, 0)})
+        return events, next_cursor, previous_cursor
+
     # machine events
 
     def machine_events_count(self, machine_serial_number, event_type=None):
@@ -22,6 +132,16 @@ class BaseEventStore(object):
     def machine_events_types_with_usage(self, machine_serial_number):
         return {}
 
+    def machine_events_fetch_page(self, machine_serial_number, cursor=None, limit=10, event_type=None):
+        """Return a page of events, the cursor of the next (older) page, and the cursor of the previous page.
+
+        The cursors are None if there is no next or previous page.
+        """
+        return self._fetch_page_with_offset(
+            lambda offset, limit: self.machine_events_fetch(machine_serial_number, offset, limit, event_type),
+            cursor, limit
+        )
+
     # probe events
 
     def probe_events_fetch(self, probe, offset=0, limit=0, **search_dict):
@@ -33,6 +153,12 @@ class BaseEventStore(object):
     def probe_events_aggregations(self, probe, **search_dict):
         return {}
 
+    def probe_events_fetch_page(self, probe, cursor=None, limit=10, **search_dict):
+        return self._fetch_page_with_offset(
+            lambda offset, limit: self.probe_events_fetch(probe, offset, limit, **search_dict),
+            cursor, limit
+        )
+
     def get_vis_url(self, probe, **search_dict):
         return None
 
@@ -44,6 +170,12 @@ class BaseEventStore(object):
     def incident_events_count(self, incident):
         return 0
 
+    def incident_events_fetch_page(self, incident, cursor=None, limit=10):
+        return self._fetch_page_with_offset(
+            lambda offset, limit: self.incident_events_fetch(incident, offset, limit),
+            cursor, limit
+        )
+
     def get_incident_vis_url(self, incident):
         return None
 
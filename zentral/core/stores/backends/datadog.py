@@ -3,13 +3,14 @@ import json
 import logging
 import re
 import requests
-from zentral.core.stores.backends.base import BaseEventStore
+from zentral.core.stores.backends.base import BaseEventStore, get_event_key
 
 logger = logging.getLogger('zentral.core.stores.backends.datadog')
 
 
 class EventStore(BaseEventStore):
     tag_component_cleanup_re = re.compile(r'[^\w\-/\.]+')
+    max_batch_size = 500  # 1000 entries / 5MB per request max.
 
     def __init__(self, config_d):
         super(EventStore, self).__init__(config_d)
@@ -33,10 +34,13 @@ class EventStore(BaseEventStore):
         value = self.tag_component_cleanup_re.sub("_", value)
         return "{}:{}".format(key, value)[:200]
 
-    def store(self, event):
-        if not isinstance(event, dict):
+    def _prepare_event(self, event):
+        if isinstance(event, dict):
+            # do not modify the original event, it could be needed for a dead letter
+            event = event.copy()
+        else:
             event = event.serialize()
-        ddevent = event.pop("_zentral")
+        ddevent = event.pop("_zentral").copy()
         event_type = ddevent.pop("type")
         ddevent[event_type] = event
         ddevent["service"] = self.service
@@ -51,6 +55,10 @@ class EventStore(BaseEventStore):
                            or ddevent.get("observer", {}).get("hostname")
                            or "Zentral")
         request = ddevent.get("request")
+        if request:
+            request = ddevent["request"] = request.copy()
+            if "user" in request:
+                request["user"] = request["user"].copy()
         network_client = {}
         http = {}
         usr = {}
@@ -79,9 +87,24 @@ class EventStore(BaseEventStore):
             ddevent["http"] = http
         if usr:
             ddevent["usr"] = usr
+        return ddevent
 
+    def _post_ddevents(self, ddevents):
         r = self._session.post(
             self.base_url,
-            data=zlib.compress(json.dumps([ddevent]).encode("utf-8"))
+            data=zlib.compress(json.dumps(ddevents).encode("utf-8"))
         )
         r.raise_for_status()
+
+    def store(self, event):
+        self._post_ddevents([self._prepare_event(event)])
+
+    def bulk_store(self, events):
+        event_keys = []
+        ddevents = []
+        for event in events:
+            event_keys.append(get_event_key(event))
+            ddevents.append(self._prepare_event(event))
+        if ddevents:
+            self._post_ddevents(ddevents)
+        return event_keys
@@ -5,11 +5,11 @@ import time
 import urllib.parse
 from dateutil import parser
 from elasticsearch import Elasticsearch, RequestsHttpConnection
-from elasticsearch.exceptions import ConnectionError, RequestError
+from elasticsearch.exceptions import ConnectionError, NotFoundError, RequestError, TransportError
 from zentral.core.events import event_from_event_d, event_tags, event_types
 from zentral.core.exceptions import ImproperlyConfigured
 from zentral.core.probes.base import PayloadFilter
-from zentral.core.stores.backends.base import BaseEventStore
+from zentral.core.stores.backends.base import BaseEventStore, decode_cursor, encode_cursor, get_event_key
 from zentral.utils.rison import dumps as rison_dumps
 
 logger = logging.getLogger('zentral.core.stores.backends.elasticsearch')
@@ -23,6 +23,7 @@ except NotImplementedError:
 class EventStore(BaseEventStore):
     LEGACY_DOC_TYPE = "doc"  # _type used with 5.6 < ES < 7
     MAX_CONNECTION_ATTEMPTS = 20
+    max_batch_size = 500
     MAPPINGS = {
         "dynamic_templates": [
             {"zentral_ip_address": {
@@ -67,6 +68,13 @@ class EventStore(BaseEventStore):
         "week": "w",
         "month": "M",
     }
+    INTERVAL_MAX_MS = {
+        "hour": 3600 * 1000,
+        "day": 24 * 3600 * 1000,
+        "week": 7 * 24 * 3600 * 1000,
+        "month": 31 * 24 * 3600 * 1000,
+    }
+    INDEX_MAX_CREATED_AT_TTL = 300  # seconds
 
     def __init__(self, config_d, test=False):
         super(EventStore, self).__init__(config_d)
@@ -114,9 +122,28 @@ class EventStore(BaseEventStore):
         self.use_mapping_types = None
 
         self.index = config_d['index']
-        self.read_index = config_d.get('read_index', self.index)
+        # optional time based rollover indices, behind a write alias, with a lifecycle policy
+        rollover = config_d.get('rollover')
+        if rollover:
+            self.rollover_conditions = {k: rollover[k] for k in ("max_age", "max_size", "max_docs")
+                                        if rollover.get(k)}
+            if not self.rollover_conditions:
+                self.rollover_conditions = {"max_age": "1d", "max_size": "50gb"}
+            self.retention = rollover.get('retention')
+            self.write_index = "{}-write".format(self.index)
+            # alias added to all the rollover indices by the index template
+            self.read_index = config_d.get('read_index', "{}-read".format(self.index))
+        else:
+            self.rollover_conditions = self.retention = None
+            self.write_index = self.index
+            self.read_index = config_d.get('read_index', self.index)
+        # rollover index → max created_at (epoch ms), to restrict the time bounded queries
+        self._index_max_created_at = {}
+        self._index_max_created_at_expiry = None
         self.kibana_base_url = config_d.get('kibana_base_url', None)
         self.kibana_index_pattern_uuid = config_d.get('kibana_index_pattern_uuid')
+        # keep alive of the point in time used for the deep pages. Empty to disable it.
+        self.point_in_time_keep_alive = config_d.get('point_in_time_keep_alive', '5m')
         self.index_settings = {
             "index.mapping.total_fields.limit": config_d.get("index.mapping.total_fields.limit", 2000),
             "number_of_shards": config_d.get("number_of_shards", 1),
@@ -140,7 +167,9 @@ class EventStore(BaseEventStore):
             try:
                 info = self._es.info()
                 self.version = [int(i) for i in info["version"]["number"].split(".")]
-                if not self._es.indices.exists(self.index):
+                if self.rollover_conditions:
+                    self._configure_rollover()
+                elif not self._es.indices.exists(self.index):
                     self._es.indices.create(self.index, body=self.get_index_conf())
                     self.use_mapping_types = False
                     logger.info("Index %s created", self.index)
@@ -160,8 +189,9 @@ class EventStore(BaseEventStore):
             # wait for index recovery
             waiting_for_recovery = False
             while True:
-                recovery = self._es.indices.recovery(self.index, params={"active_only": "true"})
-                shards = recovery.get(self.index, {}).get("shards", [])
+                recovery = self._es.indices.recovery(self.write_index, params={"active_only": "true"})
+                # keyed by concrete index, even for an alias
+                shards = [shard for index_d in recovery.values() for shard in index_d.get("shards", [])]
                 if any(c["stage"] != "DONE" for c in shards):
                     waiting_for_recovery = True
                     s = 1000 / random.randint(1000, 3000)
@@ -184,6 +214,85 @@ class EventStore(BaseEventStore):
                 mappings = set(list(self._es.indices.get_mapping(self.index).values())[0]['mappings'])
                 self.use_mapping_types = self.LEGACY_DOC_TYPE not in mappings
 
+    # rollover
+
+    def get_lifecycle_policy(self):
+        phases = {"hot": {"actions": {"rollover": dict(self.rollover_conditions)}}}
+        if self.retention:
+            phases["delete"] = {"min_age": self.retention, "actions": {"delete": {}}}
+        return {"policy": {"phases": phases}}
+
+    def get_index_template(self):
+        index_conf = self.get_index_conf()
+        settings = dict(index_conf["settings"])
+        settings["index.lifecycle.name"] = self.index
+        settings["index.lifecycle.rollover_alias"] = self.write_index
+        return {"index_patterns": ["{}-*".format(self.index)],
+                "settings": settings,
+                "mappings": index_conf["mappings"],
+                "aliases": {self.read_index: {}}}
+
+    def _configure_rollover(self):
+        if self.version < [7]:
+            raise ImproperlyConfigured("Elasticsearch >= 7 required for the rollover indices")
+        # the store config is the source of truth for the policy and the template
+        self._es.ilm.put_lifecycle(policy=self.index, body=self.get_lifecycle_policy())
+        self._es.indices.put_template(name=self.index, body=self.get_index_template())
+        if not self._es.indices.exists_alias(name=self.write_index):
+            # bootstrap the first index. The next ones are created by the lifecycle policy.
+            index = "{}-000001".format(self.index)
+            self._es.indices.create(index, body={"aliases": {self.write_index: {"is_write_index": True}}})
+            logger.info("Index %s created", index)
+        self.use_mapping_types = False
+
+    def _update_index_max_created_at(self):
+        aliases = self._es.indices.get_alias(index=self.read_index)
+        index_max_created_at = {}
+        missing_indices = []
+        for index, index_d in aliases.items():
+            if index_d["aliases"].get(self.write_index, {}).get("is_write_index"):
+                index_max_created_at[index] = float("inf")
+            else:
+                max_created_at = self._index_max_created_at.get(index)
+                if max_created_at is None or max_created_at == float("inf"):
+                    # new index, or previous write index
+                    missing_indices.append(index)
+                else:
+                    # rolled over → read only
+                    index_max_created_at[index] = max_created_at
+        if missing_indices:
+            body = []
+            for index in missing_indices:
+                body.append({"index": index})
+                body.append({"size": 0, "aggs": {"max_created_at": {"max": {"field": "created_at"}}}})
+            r = self._es.msearch(body=body)
+            for index, response in zip(missing_indices, r["responses"]):
+                if "error" in response:
+                    logger.error("Could not get index %s max created at: %s", index, response["error"])
+                    continue
+                value = response["aggregations"]["max_created_at"]["value"]
+                index_max_created_at[index] = float("-inf") if value is None else value
+        self._index_max_created_at = index_max_created_at
+        self._index_max_created_at_expiry = time.monotonic() + self.INDEX_MAX_CREATED_AT_TTL
+
+    def _get_time_bounded_read_index(self, gte):
+        """Return the indices that can contain events created after gte (epoch ms)."""
+        if not self.rollover_conditions:
+            return self.read_index
+        if self._index_max_created_at_expiry is None or self._index_max_created_at_expiry < time.monotonic():
+            try:
+                self._update_index_max_created_at()
+            except TransportError:
+                logger.exception("Could not update the index max created at")
+                return self.read_index
+        indices = []
+        for index, max_created_at in sorted(self._index_max_created_at.items()):
+            if max_created_at >= gte:
+                indices.append(index)
+        if not indices:
+            return self.read_index
+        return ",".join(indices)
+
     def _get_type_field(self):
         if not self.use_mapping_types:
             return "type"
@@ -225,9 +334,42 @@ class EventStore(BaseEventStore):
         kwargs = {"body": body}
         if self.version < [7]:
             kwargs["doc_type"] = doc_type
-        self._es.index(index=self.index, **kwargs)
+        self._es.index(index=self.write_index, **kwargs)
+        if self.test:
+            self._es.indices.refresh(self.write_index)
+
+    def is_unavailable_error(self, exception):
+        if isinstance(exception, TransportError):
+            # "N/A" status code for the connection errors and timeouts
+            status_code = exception.status_code
+            return not isinstance(status_code, int) or status_code == 429 or status_code >= 500
+        return super().is_unavailable_error(exception)
+
+    def bulk_store(self, events):
+        self.wait_and_configure_if_necessary()
+        body = []
+        for event in events:
+            if isinstance(event, dict):
+                event = event_from_event_d(event)
+            doc_type, doc = self._serialize_event(event)
+            # deterministic _id to make the retries idempotent
+            action = {"_index": self.write_index, "_id": "{}:{}".format(*get_event_key(event))}
+            if self.version < [7]:
+                action["_type"] = doc_type
+            body.append({"index": action})
+            body.append(doc)
+        if not body:
+            return
+        r = self._es.bulk(body=body)
         if self.test:
-            self._es.indices.refresh(self.index)
+            self._es.indices.refresh(self.write_index)
+        for item in r["items"]:
+            result = item["index"]
+            if result.get("status", 500) < 300:
+                uuid, index = result["_id"].rsplit(":", 1)
+                yield uuid, int(index)
+            else:
+                logger.error("Could not index event %s: %s", result.get("_id"), result.get("error"))
 
     def _build_kibana_url(self, body):
         if not self.kibana_base_url:
@@ -247,6 +389,77 @@ class EventStore(BaseEventStore):
                    query=urllib.parse.urlencode(query, safe='/:,')
                )
 
+    # cursor pagination
+
+    def _get_page_sort(self, reverse=False, point_in_time=False):
+        # (created_at, id, index) is unique → stable pages
+        order = "asc" if reverse else "desc"
+        sort = [{"created_at": order},
+                {"id": {"order": order, "unmapped_type": "keyword"}},
+                {"index": {"order": order, "unmapped_type": "long"}}]
+        if point_in_time:
+            sort.append({"_shard_doc": order})
+        return sort
+
+    def _point_in_time_supported(self):
+        return bool(self.point_in_time_keep_alive) and self.version >= [7, 12]
+
+    def _open_point_in_time(self):
+        try:
+            return self._es.open_point_in_time(index=self.read_index,
+                                               params={"keep_alive": self.point_in_time_keep_alive})["id"]
+        except TransportError:
+            logger.exception("Could not open point in time")
+
+    def _fetch_page(self, body, cursor, limit):
+        """Fetch a page of events with search_after, and a point in time for the pages after the first one."""
+        cursor_d = decode_cursor(cursor) or {}
+        search_after = cursor_d.get("search_after")
+        if not isinstance(search_after, list) or not search_after:
+            # first page
+            search_after = None
+        reverse = bool(search_after and cursor_d.get("reverse"))
+        pit_id = None
+        if search_after and self._point_in_time_supported():
+            pit_id = cursor_d.get("pit_id")
+            if not pit_id:
+                pit_id = self._open_point_in_time()
+                if pit_id and len(search_after) == 3:
+                    # the document of the cursor must be excluded
+                    search_after = search_after + [2**63 - 1 if reverse else -1]
+        body['size'] = limit + 1
+        r = None
+        if pit_id:
+            body['sort'] = self._get_page_sort(reverse, point_in_time=True)
+            body['pit'] = {"id": pit_id, "keep_alive": self.point_in_time_keep_alive}
+            body['search_after'] = search_after
+            try:
+                r = self._es.search(body=body)
+            except NotFoundError:
+                logger.info("Point in time expired")
+                pit_id = None
+                body.pop('pit')
+        if r is None:
+            body['sort'] = self._get_page_sort(reverse)
+            if search_after:
+                body['search_after'] = search_after[:3]
+            r = self._es.search(index=self.read_index, body=body)
+        if pit_id:
+            pit_id = r.get("pit_id", pit_id)
+        hits = r['hits']['hits']
+        more = len(hits) > limit
+        hits = hits[:limit]
+        if reverse:
+            hits.reverse()
+        events = [self._deserialize_event(hit['_type'], hit['_source']) for hit in hits]
+        next_cursor = previous_cursor = None
+        if hits:
+            if more or reverse:
+                next_cursor = encode_cursor({"search_after": hits[-1]['sort'], "pit_id": pit_id})
+            if (search_after and not reverse) or (reverse and more):
+                previous_cursor = encode_cursor({"search_after": hits[0]['sort'], "reverse": True, "pit_id": pit_id})
+        return events, next_cursor, previous_cursor
+
     # machine events
 
     def _get_machine_events_body(self, machine_serial_number, event_type=None, tag=None):
@@ -290,6 +503,9 @@ class EventStore(BaseEventStore):
         for hit in r['hits']['hits']:
             yield self._deserialize_event(hit['_type'], hit['_source'])
 
+    def machine_events_fetch_page(self, machine_serial_number, cursor=None, limit=10, event_type=None):
+        return self._fetch_page(self._get_machine_events_body(machine_serial_number, event_type), cursor, limit)
+
     def machine_events_types_with_usage(self, machine_serial_number):
         body = self._get_machine_events_body(machine_serial_number)
         body.update({
@@ -526,6 +742,9 @@ class EventStore(BaseEventStore):
         for hit in r['hits']['hits']:
             yield self._deserialize_event(hit['_type'], hit['_source'])
 
+    def probe_events_fetch_page(self, probe, cursor=None, limit=10, **search_dict):
+        return self._fetch_page(self._get_probe_events_body(probe, **search_dict), cursor, limit)
+
     def probe_events_count(self, probe, **search_dict):
         # TODO: count could work from first fetch with elasticsearch.
         body = self._get_probe_events_body(probe, **search_dict)
@@ -690,6 +909,9 @@ class EventStore(BaseEventStore):
         for hit in r['hits']['hits']:
             yield self._deserialize_event(hit['_type'], hit['_source'])
 
+    def incident_events_fetch_page(self, incident, cursor=None, limit=10):
+        return self._fetch_page(self._get_incident_events_body(incident), cursor, limit)
+
     def get_incident_vis_url(self, incident):
         return self._build_kibana_url(self._get_incident_events_body(incident))
 
@@ -750,7 +972,10 @@ class EventStore(BaseEventStore):
                     }
                   }
                 }}
-        r = self._es.search(index=self.read_index, body=body)
+        # superset of the histogram range, to skip the indices with only older events
+        gte = time.time() * 1000 - bucket_number * self.INTERVAL_MAX_MS[interval]
+        r = self._es.search(index=self._get_time_bounded_read_index(gte), body=body,
+                            params={"ignore_unavailable": "true"})
         return [(parser.parse(b["key_as_string"]), b["doc_count"], b["unique_msn"]["value"])
                 for b in r['aggregations']['buckets']['buckets']]
 
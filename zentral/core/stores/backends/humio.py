@@ -1,12 +1,13 @@
 import logging
 from urllib.parse import urljoin
 import requests
-from zentral.core.stores.backends.base import BaseEventStore
+from zentral.core.stores.backends.base import BaseEventStore, get_event_key
 
 logger = logging.getLogger('zentral.core.stores.backends.humio')
 
 
 class EventStore(BaseEventStore):
+    max_batch_size = 500
 
     def __init__(self, config_d):
         super(EventStore, self).__init__(config_d)
@@ -23,15 +24,36 @@ class EventStore(BaseEventStore):
             'Authorization': "Bearer {}".format(ingest_token)
         })
 
-    def store(self, event):
-        if not isinstance(event, dict):
+    def _prepare_event(self, event):
+        if isinstance(event, dict):
+            event = event.copy()
+        else:
             event = event.serialize()
-        humio_attributes = event.pop("_zentral")
+        humio_attributes = event.pop("_zentral").copy()
         event_type = humio_attributes.pop("type")
-        humio_tags = {"event_type": event_type}
         humio_attributes[event_type] = event
         created_at = humio_attributes.pop("created_at")
         timestamp = "{}Z".format(created_at[:-3])
-        data = [{"tags": humio_tags, "events": [{"timestamp": timestamp, "attributes": humio_attributes}]}]
+        return event_type, {"timestamp": timestamp, "attributes": humio_attributes}
+
+    def store(self, event):
+        event_type, humio_event = self._prepare_event(event)
+        data = [{"tags": {"event_type": event_type}, "events": [humio_event]}]
+        r = self._session.post(self.ingest_url, json=data)
+        r.raise_for_status()
+
+    def bulk_store(self, events):
+        event_keys = []
+        events_by_type = {}
+        for event in events:
+            event_keys.append(get_event_key(event))
+            event_type, humio_event = self._prepare_event(event)
+            events_by_type.setdefault(event_type, []).append(humio_event)
+        if not events_by_type:
+            return event_keys
+        # one list of events per event_type tag
+        data = [{"tags": {"event_type": event_type}, "events": humio_events}
+                for event_type, humio_events in events_by_type.items()]
         r = self._session.post(self.ingest_url, json=data)
         r.raise_for_status()
+        return event_keys
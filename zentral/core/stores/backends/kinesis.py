@@ -1,12 +1,15 @@
 import json
 import logging
 import boto3
-from zentral.core.stores.backends.base import BaseEventStore
+from botocore.exceptions import ClientError, ConnectionError, HTTPClientError
+from zentral.core.stores.backends.base import BaseEventStore, get_event_key
 
 logger = logging.getLogger('zentral.core.stores.backends.kinesis')
 
 
 class EventStore(BaseEventStore):
+    max_batch_size = 500  # PutRecords limit
+
     def __init__(self, config_d):
         super(EventStore, self).__init__(config_d)
         self.stream = config_d["stream"]
@@ -29,3 +32,31 @@ class EventStore(BaseEventStore):
         self.client.put_record(StreamName=self.stream,
                                Data=data,
                                PartitionKey=event['_zentral']['id'])
+
+    def is_unavailable_error(self, exception):
+        if isinstance(exception, ClientError):
+            return (exception.response.get('Error', {}).get('Code') == 'ProvisionedThroughputExceededException'
+                    or exception.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 500) >= 500)
+        return isinstance(exception, (ConnectionError, HTTPClientError)) or super().is_unavailable_error(exception)
+
+    def bulk_store(self, events):
+        self.wait_and_configure_if_necessary()
+        event_keys = []
+        records = []
+        for event in events:
+            if not isinstance(event, dict):
+                event = event.serialize()
+            event_keys.append(get_event_key(event))
+            records.append({'Data': json.dumps(event).encode('utf-8'),
+                            'PartitionKey': event['_zentral']['id']})
+        if not records:
+            return
+        response = self.client.put_records(StreamName=self.stream, Records=records)
+        # the response records are in the same order as the request records
+        for event_key, record in zip(event_keys, response['Records']):
+            error_code = record.get('ErrorCode')
+            if error_code:
+                logger.error("Could not put record %s: %s %s",
+                             event_key, error_code, record.get('ErrorMessage'))
+            else:
+                yield event_key
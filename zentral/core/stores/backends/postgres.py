@@ -1,16 +1,236 @@
+from bisect import bisect_right
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+import json
 import logging
+import os
+import re
+import threading
+import time
+from dateutil.relativedelta import relativedelta
 import psycopg2
-from psycopg2.extras import Json
-from zentral.core.events import event_cls_from_type, event_from_event_d
+from psycopg2 import sql
+from psycopg2.extensions import QueryCanceledError, TRANSACTION_STATUS_IDLE
+from psycopg2.extras import execute_values, Json
+from zentral.core.events import event_cls_from_type, event_from_event_d, event_tags, event_types
 from zentral.core.events.base import EventMetadata, EventRequest
-from zentral.core.stores.backends.base import BaseEventStore
+from zentral.core.exceptions import ImproperlyConfigured
+from zentral.core.probes.base import PayloadFilter
+from zentral.core.stores.backends.base import BaseEventStore, get_event_key
 
 logger = logging.getLogger('zentral.core.stores.backends.postgres')
 
 psycopg2.extras.register_uuid()
 
 
+INTERVAL_STEP = {
+    "hour": relativedelta(hours=1),
+    "day": relativedelta(days=1),
+    "week": relativedelta(weeks=1),
+    "month": relativedelta(months=1),
+}
+
+
+def truncate_datetime(dt, interval):
+    """Truncate a datetime like the postgres date_trunc function."""
+    dt = dt.replace(minute=0, second=0, microsecond=0)
+    if interval == "hour":
+        return dt
+    dt = dt.replace(hour=0)
+    if interval == "week":
+        dt -= timedelta(days=dt.weekday())
+    elif interval == "month":
+        dt = dt.replace(day=1)
+    return dt
+
+
+# partition bounds, as returned by pg_get_expr
+PARTITION_BOUND_RE = re.compile(r"^FOR VALUES FROM \((?P<start>.+)\) TO \((?P<end>.+)\)$")
+JSON_NUMBER_RE = re.compile(r"^-?(0|[1-9][0-9]*)(\.[0-9]+)?([eE][+-]?[0-9]+)?$")
+
+
+def _parse_partition_bound(value):
+    if value == "MINVALUE":
+        return datetime.min
+    elif value == "MAXVALUE":
+        return datetime.max
+    return datetime.strptime(value.strip("'"), "%Y-%m-%d %H:%M:%S")
+
+
+def _jsonpath_accessor(attribute):
+    # lax mode → the arrays are unwrapped, like in the probe payload filters
+    return "$" + "".join(".{}".format(json.dumps(key)) for key in attribute.split("."))
+
+
+def _jsonpath_literals(value):
+    # the probe payload filter values are compared as strings
+    if not isinstance(value, str):
+        return [json.dumps(value)]
+    literals = [json.dumps(value)]
+    if value.lower() in ("true", "false"):
+        literals.append(value.lower())
+    elif JSON_NUMBER_RE.match(value):
+        literals.append(value)
+    return literals
+
+
+def _join_conditions(conditions, operator):
+    if len(conditions) > 1:
+        return "({})".format(" {} ".format(operator).join(conditions))
+    return conditions[0]
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    """Thread-safe pool of psycopg2 connections.
+
+    The connections are opened on demand, and discarded when they are broken.
+    The connections idle for more than health_check_interval seconds are checked before being reused.
+    """
+
+    def __init__(self, name, connect_args, connect_kwargs,
+                 max_size=4, max_wait=30, health_check_interval=30, readonly=False):
+        self.name = name
+        self.connect_args = connect_args
+        self.connect_kwargs = connect_kwargs
+        self.max_size = max(1, max_size)
+        self.max_wait = max_wait
+        self.health_check_interval = health_check_interval
+        self.readonly = readonly
+        self._available = threading.Condition(threading.Lock())
+        self._reset()
+        # see EventStore.setup_metrics_exporter
+        self.metrics_exporter = None
+        self.metric_labels = ()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = []  # (connection, last use), last used at the end
+        self._size = 0
+
+    def _update_connections_gauge(self):
+        if self.metrics_exporter:
+            idle = len(self._idle)
+            for state, value in (("idle", idle), ("in_use", self._size - idle)):
+                self.metrics_exporter.set("postgres_event_store_pool_connections", *self.metric_labels, state,
+                                          value=value)
+
+    def _connect(self):
+        conn = psycopg2.connect(*self.connect_args, **self.connect_kwargs)
+        if self.readonly:
+            conn.set_session(readonly=True)
+        return conn
+
+    def _is_healthy(self, conn, last_use):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_use < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("select 1;")
+            conn.rollback()
+        except psycopg2.Error:
+            return False
+        return True
+
+    def getconn(self):
+        start = time.monotonic()
+        conn = last_use = None
+        with self._available:
+            if self._pid != os.getpid():
+                # forked → the connections of the parent process must not be used or closed
+                self._reset()
+            while True:
+                if self._idle:
+                    conn, last_use = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = self.max_wait - (time.monotonic() - start)
+                if remaining <= 0:
+                    raise PoolTimeout("Could not get a {} connection after {}s".format(self.name, self.max_wait))
+                self._available.wait(remaining)
+            self._update_connections_gauge()
+        if self.metrics_exporter:
+            self.metrics_exporter.observe("postgres_event_store_pool_wait_seconds", *self.metric_labels,
+                                          value=time.monotonic() - start)
+        if conn is not None and not self._is_healthy(conn, last_use):
+            logger.warning("Pool %s: discard broken connection", self.name)
+            self._close(conn)
+            conn = None
+            self._inc_broken_connections()
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                self._discard()
+                raise
+        return conn
+
+    def _inc_broken_connections(self):
+        if self.metrics_exporter:
+            self.metrics_exporter.inc("postgres_event_store_pool_broken_connections", *self.metric_labels)
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _discard(self):
+        with self._available:
+            self._size -= 1
+            self._update_connections_gauge()
+            self._available.notify()
+
+    def putconn(self, conn):
+        if self._pid != os.getpid():
+            # connection of the parent process
+            return
+        if not conn.closed and conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                self._close(conn)
+        if conn.closed:
+            self._inc_broken_connections()
+            self._discard()
+            return
+        with self._available:
+            self._idle.append((conn, time.monotonic()))
+            self._update_connections_gauge()
+            self._available.notify()
+
+    @contextmanager
+    def cursor(self):
+        """Yield a cursor, in a transaction committed on exit."""
+        conn = self.getconn()
+        try:
+            with conn.cursor() as cur:
+                yield cur
+            conn.commit()
+        finally:
+            # rollback if necessary, or discard the connection if it is broken
+            self.putconn(conn)
+
+    def close(self):
+        with self._available:
+            if self._pid == os.getpid():
+                for conn, _ in self._idle:
+                    self._close(conn)
+            self._reset()
+            self._update_connections_gauge()
+
+
 class EventStore(BaseEventStore):
+    max_batch_size = 1000
+    INSERT_COLUMNS = ('machine_serial_number', 'event_type', 'uuid', 'index',
+                      'user_agent', 'ip', 'user', 'payload', 'metadata', 'created_at')
     CREATE_TABLE = """
     CREATE TABLE events (
         machine_serial_number varchar(100),
@@ -21,11 +241,16 @@ class EventStore(BaseEventStore):
         ip                    inet,
         "user"                jsonb,
         payload               jsonb,
-        created_at            timestamp,
+        metadata              jsonb,
+        created_at            timestamp NOT NULL,
         stored_at             timestamp default current_timestamp
-    );
-    CREATE INDEX events_machine_serial_number ON events(machine_serial_number);
+    ) PARTITION BY RANGE (created_at);
+    CREATE INDEX events_machine_serial_number_created_at ON events(machine_serial_number, created_at);
+    CREATE INDEX events_event_type_created_at ON events(event_type, created_at);
+    CREATE INDEX events_payload ON events USING gin (payload jsonb_path_ops);
+    CREATE INDEX events_metadata ON events USING gin (metadata jsonb_path_ops);
     """
+    MAINTENANCE_INTERVAL = 3600  # seconds
 
     def __init__(self, config_d):
         super(EventStore, self).__init__(config_d)
@@ -40,30 +265,166 @@ class EventStore(BaseEventStore):
                            "postgres event store is deprecated. Please use the "
                            "'database' attribute.")
             kwargs['database'] = config_d['db_name']
-        self._conn = psycopg2.connect(**kwargs)
+        # connection pools. The connections are opened on demand.
+        pool_kwargs = {"max_size": int(config_d.get('pool_max_size', 4)),
+                       "max_wait": float(config_d.get('pool_max_wait', 30)),
+                       "health_check_interval": float(config_d.get('pool_health_check_interval', 30))}
+        dsn = config_d.get('dsn')
+        self._writer = ConnectionPool("writer", [dsn] if dsn else [], kwargs, **pool_kwargs)
+        reader_dsn = config_d.get('reader_dsn')
+        if reader_dsn:
+            # read-only frontend queries, on a replica for example
+            self._reader = ConnectionPool("reader", [reader_dsn], {}, readonly=True, **pool_kwargs)
+        else:
+            self._reader = self._writer
+        # partitions
+        self.partition_interval = config_d.get('partition_interval', 'month')
+        if self.partition_interval not in ("day", "week", "month"):
+            raise ImproperlyConfigured("Unknown partition interval {}".format(self.partition_interval))
+        self.retention_days = config_d.get('retention_days')
+        if self.retention_days is not None:
+            self.retention_days = int(self.retention_days)
+        self.partitioned = None
+        self._partitions = []
+        self._partition_starts = []
+        self._next_maintenance = None
 
     def wait_and_configure(self):
         # TODO: WAIT !
-        table_count = 0
-        with self._conn:
-            with self._conn.cursor() as cur:
-                cur.execute("select count(*) from pg_tables "
-                            "where schemaname='public' and tablename='events';")
-                table_count = cur.fetchone()[0]
-        if not table_count:
+        relkind = None
+        with self._writer.cursor() as cur:
+            cur.execute("select c.relkind from pg_class c "
+                        "join pg_namespace n on (n.oid = c.relnamespace) "
+                        "where n.nspname='public' and c.relname='events';")
+            t = cur.fetchone()
+            if t:
+                relkind = t[0]
+        if relkind is None:
             # create table
-            with self._conn:
-                with self._conn.cursor() as cur:
-                    cur.execute(self.CREATE_TABLE)
+            with self._writer.cursor() as cur:
+                if cur.connection.server_version < 120000:
+                    raise ImproperlyConfigured("PostgreSQL >= 12 required for the events table")
+                cur.execute(self.CREATE_TABLE)
+            self.partitioned = True
+        elif relkind == "p":
+            self.partitioned = True
+        else:
+            # table created by a previous version
+            logger.warning("Postgres event store %s: events table not partitioned", self.name)
+            with self._writer.cursor() as cur:
+                cur.execute("alter table events add column if not exists metadata jsonb;")
+            self.partitioned = False
+        if self.partitioned:
+            self._run_maintenance()
         self.configured = True
 
+    # partitions
+
+    def _load_partitions(self):
+        partitions = []
+        with self._writer.cursor() as cur:
+            cur.execute("select c.relname, pg_get_expr(c.relpartbound, c.oid) "
+                        "from pg_inherits i join pg_class c on (c.oid = i.inhrelid) "
+                        "where i.inhparent = 'events'::regclass;")
+            for name, bound in cur.fetchall():
+                m = PARTITION_BOUND_RE.match(bound)
+                if not m:
+                    # default partition
+                    continue
+                partitions.append((_parse_partition_bound(m.group("start")),
+                                   _parse_partition_bound(m.group("end")),
+                                   name))
+        partitions.sort()
+        self._partitions = partitions
+        self._partition_starts = [start for start, _, _ in partitions]
+
+    def _get_missing_partition_bounds(self, dt):
+        start = truncate_datetime(dt, self.partition_interval)
+        end = start + INTERVAL_STEP[self.partition_interval]
+        idx = bisect_right(self._partition_starts, dt)
+        if idx > 0:
+            _, previous_end, _ = self._partitions[idx - 1]
+            if dt < previous_end:
+                # covered
+                return
+            # the partition interval could have changed → no overlap
+            start = max(start, previous_end)
+        if idx < len(self._partitions):
+            end = min(end, self._partition_starts[idx])
+        return start, end
+
+    def _create_partitions(self, bounds):
+        for start, end in sorted(bounds):
+            name = "events_{:%Y%m%d}".format(start)
+            try:
+                with self._writer.cursor() as cur:
+                    cur.execute(
+                        sql.SQL("create table if not exists {} partition of events "
+                                "for values from (%s) to (%s);").format(sql.Identifier(name)),
+                        [start, end]
+                    )
+            except psycopg2.Error:
+                # probably created by another process
+                logger.exception("Postgres event store %s: could not create partition %s", self.name, name)
+            else:
+                logger.info("Postgres event store %s: partition %s created", self.name, name)
+        self._load_partitions()
+
+    def _ensure_partitions(self, created_at_list):
+        if not self.partitioned:
+            return
+        if self._next_maintenance is None or self._next_maintenance < time.monotonic():
+            self._run_maintenance()
+        bounds = set()
+        for created_at in set(created_at_list):
+            missing_bounds = self._get_missing_partition_bounds(created_at)
+            if missing_bounds:
+                bounds.add(missing_bounds)
+        if bounds:
+            self._create_partitions(bounds)
+
+    def _drop_old_partitions(self):
+        if not self.retention_days:
+            return
+        min_created_at = datetime.utcnow() - timedelta(days=self.retention_days)
+        dropped_partitions = False
+        for _, end, name in self._partitions:
+            if end > min_created_at:
+                break
+            with self._writer.cursor() as cur:
+                cur.execute(sql.SQL("drop table if exists {};").format(sql.Identifier(name)))
+            logger.info("Postgres event store %s: partition %s dropped", self.name, name)
+            dropped_partitions = True
+        if dropped_partitions:
+            self._load_partitions()
+
+    def _run_maintenance(self):
+        self._load_partitions()
+        self._drop_old_partitions()
+        # current and next partitions
+        now = datetime.utcnow()
+        bounds = set()
+        for dt in (now, now + INTERVAL_STEP[self.partition_interval]):
+            missing_bounds = self._get_missing_partition_bounds(dt)
+            if missing_bounds:
+                bounds.add(missing_bounds)
+        if bounds:
+            self._create_partitions(bounds)
+        self._next_maintenance = time.monotonic() + self.MAINTENANCE_INTERVAL
+
+    # serialization
+
     def _serialize_event(self, event):
         metadata = event.metadata
+        created_at = metadata.created_at
+        if created_at.tzinfo is not None:
+            # naive UTC column & partition bounds
+            created_at = created_at.astimezone(timezone.utc).replace(tzinfo=None)
         doc = {'machine_serial_number': metadata.machine_serial_number,
                'event_type': event.event_type,
                'uuid': metadata.uuid,
                'index': metadata.index,
-               'created_at': metadata.created_at}
+               'created_at': created_at}
         if metadata.request is not None:
             doc['user_agent'] = metadata.request.user_agent
             doc['ip'] = metadata.request.ip
@@ -75,12 +436,19 @@ class EventStore(BaseEventStore):
             doc['ip'] = None
             doc['user'] = None
         doc['payload'] = Json(event.payload)
+        # tags, incidents, observer and machine, for the probe and incident queries
+        metadata_d = {k: v for k, v in metadata.serialize().items()
+                      if k in ("tags", "incidents", "observer", "machine")}
+        doc['metadata'] = Json(metadata_d) if metadata_d else None
         return doc
 
     def _deserialize_event(self, doc):
         doc.pop('stored_at')
         event_type = doc.pop('event_type')
         payload = doc.pop('payload')
+        metadata_d = doc.pop('metadata', None)
+        if metadata_d:
+            doc.update(metadata_d)
         request_d = {k: v for k, v in ((a, doc.pop(a)) for a in ('user_agent', 'ip', 'user')) if v}
         if request_d:
             doc['request'] = EventRequest.deserialize(request_d)
@@ -95,67 +463,355 @@ class EventStore(BaseEventStore):
         self.wait_and_configure_if_necessary()
         if isinstance(event, dict):
             event = event_from_event_d(event)
-        with self._conn:
+        doc = self._serialize_event(event)
+        self._ensure_partitions([doc['created_at']])
+        with self._writer.cursor() as cur:
+            cur.execute('insert into events (machine_serial_number, '
+                        'event_type, uuid, index, user_agent, ip, "user", payload, metadata, created_at) '
+                        'values (%(machine_serial_number)s, %(event_type)s, '
+                        '%(uuid)s, %(index)s, %(user_agent)s, %(ip)s, %(user)s, %(payload)s, '
+                        '%(metadata)s, %(created_at)s)',
+                        doc)
+
+    def is_unavailable_error(self, exception):
+        # connection lost, server shutting down, statement timeout, … or no connection available in the pool
+        return (isinstance(exception, (psycopg2.OperationalError, psycopg2.InterfaceError, PoolTimeout))
+                or super().is_unavailable_error(exception))
+
+    def bulk_store(self, events):
+        self.wait_and_configure_if_necessary()
+        event_keys = []
+        rows = []
+        for event in events:
+            if isinstance(event, dict):
+                event = event_from_event_d(event)
             doc = self._serialize_event(event)
-            with self._conn.cursor() as cur:
-                cur.execute('insert into events (machine_serial_number, '
-                            'event_type, uuid, index, user_agent, ip, "user", payload, created_at) '
-                            'values (%(machine_serial_number)s, %(event_type)s, '
-                            '%(uuid)s, %(index)s, %(user_agent)s, %(ip)s, %(user)s, %(payload)s, %(created_at)s)',
-                            doc)
+            rows.append(tuple(doc[column] for column in self.INSERT_COLUMNS))
+            event_keys.append(get_event_key(event))
+        if not rows:
+            return event_keys
+        self._ensure_partitions([row[-1] for row in rows])
+        # one multi-row INSERT per batch, in a single transaction → all or nothing
+        with self._writer.cursor() as cur:
+            execute_values(cur,
+                           'insert into events (machine_serial_number, '
+                           'event_type, uuid, index, user_agent, ip, "user", payload, metadata, created_at) '
+                           'values %s',
+                           rows,
+                           page_size=len(rows))
+        return event_keys
 
-    # machine events
+    # queries
 
-    def machine_events_count(self, machine_serial_number, event_type=None):
+    def _read(self, query, args, with_columns=False):
+        """Run a read-only query with the reader pool, and return the rows.
+
+        The query is retried once with a new connection if the connection was lost
+        (database restart, replica failover, …).
+        """
+        for attempt in range(2):
+            try:
+                with self._reader.cursor() as cur:
+                    cur.execute(query, args)
+                    rows = cur.fetchall()
+                    if with_columns:
+                        return [t.name for t in cur.description], rows
+                    return rows
+            except QueryCanceledError:
+                raise
+            except (psycopg2.OperationalError, psycopg2.InterfaceError):
+                if attempt:
+                    raise
+                logger.warning("Postgres event store %s: connection error, retry", self.name, exc_info=True)
+
+    def _count(self, where, args):
         self.wait_and_configure_if_necessary()
-        with self._conn:
-            query = "select count(*) from events where machine_serial_number = %s"
-            args = [machine_serial_number]
-            if event_type:
-                query = "{} and event_type = %s".format(query)
-                args.append(event_type)
-            with self._conn.cursor() as cur:
-                cur.execute(query, args)
-                return cur.fetchone()[0]
+        return self._read("select count(*) from events where {}".format(where), args)[0][0]
 
-    def machine_events_fetch(self, machine_serial_number, offset=0, limit=0, event_type=None):
+    def _fetch(self, where, args, offset=0, limit=0):
         self.wait_and_configure_if_necessary()
-        query = "select * from events where machine_serial_number = %s"
-        args = [machine_serial_number]
-        if event_type:
-            query = "{} and event_type = %s".format(query)
-            args.append(event_type)
-        query = "{} order by created_at desc".format(query)
+        query = "select * from events where {} order by created_at desc".format(where)
+        args = list(args)
         if offset:
             query = "{} offset %s".format(query)
             args.append(offset)
         if limit:
             query = "{} limit %s".format(query)
             args.append(limit)
-        with self._conn:
-            with self._conn.cursor() as cur:
-                cur.execute(query, args)
-                columns = [t.name for t in cur.description]
-                for t in cur.fetchall():
-                    yield self._deserialize_event(dict(zip(columns, t)))
+        columns, rows = self._read(query, args, with_columns=True)
+        for t in rows:
+            yield self._deserialize_event(dict(zip(columns, t)))
+
+    def _get_date_histogram(self, where, args, interval, bucket_number):
+        """Return the event counts and unique machine counts of the last bucket_number intervals."""
+        self.wait_and_configure_if_necessary()
+        step = INTERVAL_STEP[interval]
+        last_bucket = truncate_datetime(datetime.utcnow(), interval)
+        first_bucket = last_bucket - (bucket_number - 1) * step
+        query = (
+            "select b.bucket, coalesce(e.event_count, 0), coalesce(e.unique_msn, 0) "
+            "from generate_series(%s::timestamp, %s::timestamp, %s::interval) b(bucket) "
+            "left join ("
+            "select date_trunc(%s, created_at) bucket, count(*) event_count, "
+            "count(distinct machine_serial_number) unique_msn "
+            "from events where created_at >= %s and created_at < %s and {} group by 1"
+            ") e on (e.bucket = b.bucket) "
+            "order by b.bucket"
+        ).format(where)
+        rows = self._read(query, [first_bucket, last_bucket, "1 {}".format(interval),
+                                  interval, first_bucket, last_bucket + step] + list(args))
+        return [(bucket.replace(tzinfo=timezone.utc), event_count, unique_msn)
+                for bucket, event_count, unique_msn in rows]
+
+    # machine events
+
+    def _get_machine_events_where(self, machine_serial_number, event_type=None):
+        where = "machine_serial_number = %s"
+        args = [machine_serial_number]
+        if event_type:
+            where = "{} and event_type = %s".format(where)
+            args.append(event_type)
+        return where, args
+
+    def machine_events_count(self, machine_serial_number, event_type=None):
+        return self._count(*self._get_machine_events_where(machine_serial_number, event_type))
+
+    def machine_events_fetch(self, machine_serial_number, offset=0, limit=0, event_type=None):
+        yield from self._fetch(*self._get_machine_events_where(machine_serial_number, event_type),
+                               offset=offset, limit=limit)
 
     def machine_events_types_with_usage(self, machine_serial_number):
         self.wait_and_configure_if_necessary()
         query = "select event_type, count(*) from events where machine_serial_number = %s group by event_type"
-        types_d = {}
-        with self._conn.cursor() as cur:
-            cur.execute(query, [machine_serial_number])
-            for t in cur.fetchall():
-                types_d[t[0]] = t[1]
-        return types_d
+        return dict(self._read(query, [machine_serial_number]))
+
+    def get_last_machine_heartbeats(self, machine_serial_number):
+        self.wait_and_configure_if_necessary()
+        heartbeat_event_types = [et for et, et_cls in event_types.items()
+                                 if 'heartbeat' in et_cls.tags and et != 'inventory_heartbeat']
+        heartbeats = []
+        for source_name, max_created_at in self._read("select payload #>> '{source,name}', max(created_at) "
+                                                      "from events where machine_serial_number = %s "
+                                                      "and event_type = 'inventory_heartbeat' group by 1",
+                                                      [machine_serial_number]):
+            heartbeats.append((event_types["inventory_heartbeat"],
+                               source_name,
+                               [(None, max_created_at.replace(tzinfo=timezone.utc))]))
+        ua_max_dates = {}
+        for event_type, user_agent, max_created_at in self._read("select event_type, user_agent, max(created_at) "
+                                                                 "from events where machine_serial_number = %s "
+                                                                 "and event_type = ANY(%s) group by 1, 2",
+                                                                 [machine_serial_number, heartbeat_event_types]):
+            ua_list = ua_max_dates.setdefault(event_type, [])
+            if user_agent:
+                ua_list.append((user_agent, max_created_at.replace(tzinfo=timezone.utc)))
+        for event_type, ua_list in ua_max_dates.items():
+            heartbeats.append((event_types[event_type], None, ua_list))
+        return heartbeats
 
     # probe events
 
-    # TODO: not implemented
+    def _get_probe_events_where(self, probe, **search_dict):
+        conditions = []
+        args = []
+
+        # inventory filters, on the machine metadata
+        inventory_should = []
+        for inventory_filter in probe.inventory_filters:
+            inventory_filter_must = []
+            for filter_attribute, build_machine_d in (
+                ("meta_business_unit_ids", lambda v: {"meta_business_units": [{"id": v}]}),
+                ("tag_ids", lambda v: {"tags": [{"id": v}]}),
+                ("platforms", lambda v: {"platform": v}),
+                ("types", lambda v: {"type": v}),
+            ):
+                values = getattr(inventory_filter, filter_attribute, None)
+                if values:
+                    values = sorted(values)
+                    inventory_filter_must.append(_join_conditions(["metadata @> %s"] * len(values), "or"))
+                    args.extend(Json({"machine": build_machine_d(v)}) for v in values)
+            if inventory_filter_must:
+                inventory_should.append(_join_conditions(inventory_filter_must, "and"))
+        if inventory_should:
+            conditions.append(_join_conditions(inventory_should, "or"))
+
+        # metadata filters
+        metadata_should = []
+        for metadata_filter in probe.metadata_filters:
+            metadata_filter_must = []
+            if metadata_filter.event_types:
+                metadata_filter_must.append("event_type = ANY(%s)")
+                args.append(sorted(metadata_filter.event_types))
+            if metadata_filter.event_tags:
+                # event tags of the event classes, or added to the event metadata
+                metadata_filter_must.append("(event_type = ANY(%s) or metadata->'tags' ?| %s)")
+                args.append(sorted(set(event_cls.event_type
+                                       for tag in metadata_filter.event_tags
+                                       for event_cls in event_tags.get(tag, []))))
+                args.append(sorted(metadata_filter.event_tags))
+            if metadata_filter_must:
+                metadata_should.append(_join_conditions(metadata_filter_must, "and"))
+        if metadata_should:
+            conditions.append(_join_conditions(metadata_should, "or"))
+
+        # payload filters
+        payload_should = []
+        for payload_filter in probe.payload_filters:
+            payload_filter_must = []
+            for attribute, operator, values in payload_filter.items:
+                jsonpath = "{} ? ({})".format(
+                    _jsonpath_accessor(attribute),
+                    " || ".join("@ == {}".format(literal)
+                                for value in sorted(values)
+                                for literal in _jsonpath_literals(value))
+                )
+                if operator == PayloadFilter.NOT_IN:
+                    payload_filter_must.append("not coalesce(payload @? %s::jsonpath, false)")
+                else:
+                    payload_filter_must.append("payload @? %s::jsonpath")
+                args.append(jsonpath)
+            if payload_filter_must:
+                payload_should.append(_join_conditions(payload_filter_must, "and"))
+        if payload_should:
+            conditions.append(_join_conditions(payload_should, "or"))
+
+        # search dict
+        search_dict.pop('event_type', None)
+        for attribute, values in search_dict.items():
+            if values is None:
+                continue
+            if not isinstance(values, list):
+                values = [values]
+            elif not values:
+                continue
+            if attribute.endswith('__startswith'):
+                attribute = attribute.replace('__startswith', '')
+                filters = ["@ starts with {}".format(json.dumps(v)) for v in values]
+            elif attribute.endswith('__regexp'):
+                attribute = attribute.replace('__regexp', '')
+                # anchored, like the elasticsearch regexp queries
+                filters = ["@ like_regex {}".format(json.dumps("^({})$".format(v))) for v in values]
+            else:
+                filters = ["@ == {}".format(literal) for v in values for literal in _jsonpath_literals(v)]
+            conditions.append("payload @? %s::jsonpath")
+            args.append("{} ? ({})".format(_jsonpath_accessor(attribute), " || ".join(filters)))
+
+        if not conditions:
+            return "true", args
+        return " and ".join(conditions), args
+
+    def probe_events_fetch(self, probe, offset=0, limit=0, **search_dict):
+        yield from self._fetch(*self._get_probe_events_where(probe, **search_dict), offset=offset, limit=limit)
 
-    # app hist
+    def probe_events_count(self, probe, **search_dict):
+        return self._count(*self._get_probe_events_where(probe, **search_dict))
+
+    def probe_events_aggregations(self, probe, **search_dict):
+        self.wait_and_configure_if_necessary()
+        where, args = self._get_probe_events_where(probe, **search_dict)
+        results = {}
+        for field, aggregation in probe.get_aggregations().items():
+            a_type = aggregation["type"]
+            bucket_number = aggregation["bucket_number"]
+            if a_type == "date_histogram":
+                values = [(bucket, event_count)
+                          for bucket, event_count, _ in self._get_date_histogram(where, args,
+                                                                                 aggregation["interval"],
+                                                                                 bucket_number)]
+            elif a_type == "terms":
+                if field == "event_type":
+                    query = ("select event_type, count(*) c, (sum(count(*)) over ())::bigint from events "
+                             "where {} group by 1 order by c desc, 1 limit %s").format(where)
+                    query_args = list(args)
+                else:
+                    # like the elasticsearch terms aggregations, one bucket per array item
+                    query = ("select v #>> '{{}}' k, count(*) c, (sum(count(*)) over ())::bigint "
+                             "from events, jsonb_path_query(payload, %s::jsonpath) v "
+                             "where {} and v #>> '{{}}' is not null "
+                             "group by 1 order by c desc, 1 limit %s").format(where)
+                    query_args = ["{}[*]".format(_jsonpath_accessor(field))] + list(args)
+                rows = self._read(query, query_args + [bucket_number])
+                values = [(key, count) for key, count, _ in rows]
+                if rows:
+                    sum_other_doc_count = rows[0][2] - sum(values_count for _, values_count in values)
+                    if sum_other_doc_count:
+                        values.append((None, sum_other_doc_count))
+            elif a_type == "table":
+                columns = [fn for fn, _ in aggregation["columns"]]
+                positions = ", ".join(str(i + 1) for i in range(len(columns)))
+                query = ("select {}, count(*) c, (sum(count(*)) over ())::bigint from events "
+                         "where {} and {} group by {} order by c desc, {} limit %s").format(
+                    ", ".join(["payload #>> %s"] * len(columns)),
+                    where,
+                    " and ".join(["payload #>> %s is not null"] * len(columns)),
+                    positions, positions
+                )
+                paths = [column.split(".") for column in columns]
+                rows = self._read(query, paths + list(args) + paths + [bucket_number])
+                values = []
+                for row in rows:
+                    value_d = dict(zip(columns, row))
+                    value_d["event_count"] = row[-2]
+                    values.append(value_d)
+                if rows:
+                    sum_other_doc_count = rows[0][-1] - sum(value_d["event_count"] for value_d in values)
+                    if sum_other_doc_count:
+                        other_doc_value_d = {fn: "…" for fn in columns}
+                        other_doc_value_d["event_count"] = sum_other_doc_count
+                        values.append(other_doc_value_d)
+            else:
+                logger.error("Unknown aggregation type %s", a_type)
+                continue
+            results[field] = {"label": aggregation.get("label", field.capitalize()),
+                              "type": a_type,
+                              "values": values}
+            interval = aggregation.get("interval")
+            if interval:
+                results[field]["interval"] = interval
+        return results
+
+    # incident events
+
+    def _get_incident_events_where(self, incident):
+        # see incident and machine incident serialization in zentral.core.incidents.models
+        return ("(metadata @> %s or payload @> %s or payload @> %s)",
+                [Json({"incidents": [{"pk": incident.pk}]}),
+                 Json({"incident": {"pk": incident.pk}}),
+                 Json({"machine_incident": {"incident": {"pk": incident.pk}}})])
+
+    def incident_events_fetch(self, incident, offset=0, limit=0):
+        yield from self._fetch(*self._get_incident_events_where(incident), offset=offset, limit=limit)
+
+    def incident_events_count(self, incident):
+        return self._count(*self._get_incident_events_where(incident))
+
+    # zentral apps data
+
+    def get_app_hist_data(self, interval, bucket_number, tag=None, event_type=None):
+        conditions = []
+        args = []
+        if tag:
+            conditions.append("(event_type = ANY(%s) or metadata->'tags' ? %s)")
+            args.append(sorted(event_cls.event_type for event_cls in event_tags.get(tag, [])))
+            args.append(tag)
+        if event_type:
+            if not isinstance(event_type, list):
+                event_type = [event_type]
+            conditions.append("event_type = ANY(%s)")
+            args.append(event_type)
+        return self._get_date_histogram(" and ".join(conditions) or "true", args, interval, bucket_number)
 
-    # TODO: not implemented
+    def setup_metrics_exporter(self, metrics_exporter):
+        if not metrics_exporter:
+            return
+        metrics_exporter.add_gauge("postgres_event_store_pool_connections", ["event_store", "pool", "state"])
+        metrics_exporter.add_histogram("postgres_event_store_pool_wait_seconds", ["event_store", "pool"])
+        metrics_exporter.add_counter("postgres_event_store_pool_broken_connections", ["event_store", "pool"])
+        for pool in set([self._writer, self._reader]):
+            pool.metrics_exporter = metrics_exporter
+            pool.metric_labels = (self.name, pool.name)
 
     def close(self):
-        self._conn.close()
+        self._writer.close()
+        if self._reader is not self._writer:
+            self._reader.close()
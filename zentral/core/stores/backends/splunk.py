@@ -1,11 +1,14 @@
+import json
 import logging
 import requests
-from zentral.core.stores.backends.base import BaseEventStore
+from zentral.core.stores.backends.base import BaseEventStore, get_event_key
 
 logger = logging.getLogger('zentral.core.stores.backends.splunk')
 
 
 class EventStore(BaseEventStore):
+    max_batch_size = 100
+
     def __init__(self, config_d):
         super(EventStore, self).__init__(config_d)
         self.base_url = config_d.get("base_url")
@@ -24,3 +27,19 @@ class EventStore(BaseEventStore):
             event = event.serialize()
         r = self._session.post(self.base_url, json=event)
         r.raise_for_status()
+
+    def bulk_store(self, events):
+        event_keys = []
+        data = []
+        for event in events:
+            if not isinstance(event, dict):
+                event = event.serialize()
+            event_keys.append(get_event_key(event))
+            data.append(json.dumps(event))
+        if not data:
+            return event_keys
+        # HEC batch: the JSON events are simply concatenated in the request body
+        r = self._session.post(self.base_url, data="\n".join(data).encode("utf-8"),
+                               headers={"Content-Type": "application/json"})
+        r.raise_for_status()
+        return event_keys
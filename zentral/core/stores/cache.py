@@ -0,0 +1,164 @@
+from collections import Counter as TotalCounter
+import copy
+import functools
+import hashlib
+import json
+import logging
+import threading
+import time
+from prometheus_client import CollectorRegistry, Counter, Gauge
+from zentral.utils.lru import LRUCache
+
+
+logger = logging.getLogger("zentral.core.stores.cache")
+
+
+# cached method → (default TTL in seconds, background refresh)
+CACHED_METHODS = {
+    # home dashboard
+    "get_app_hist_data": (60, True),
+    # machine view
+    "get_last_machine_heartbeats": (30, False),
+    "machine_events_types_with_usage": (30, False),
+    # probe dashboard
+    "probe_events_aggregations": (60, False),
+}
+
+# stale values are returned during the background refreshes, if not older than MAX_STALE_FACTOR × TTL
+MAX_STALE_FACTOR = 10
+
+
+def _serialize_key_item(obj):
+    source = getattr(obj, "source", None)
+    if source is not None:
+        # probe → the filters and the aggregations depend on the source body
+        return {"probe": obj.pk, "body": source.body}
+    return str(obj)
+
+
+def make_cache_key(method, args, kwargs):
+    data = json.dumps([method, args, kwargs], sort_keys=True, default=_serialize_key_item)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+class Flight(object):
+    """Store query in progress. The other callers wait for its result."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.exception = None
+
+
+class CachedEventStore(object):
+    """
+    Read-through, process local cache for the expensive frontend store aggregations.
+
+    Only one query per cache key is sent to the store at a time (single flight).
+    Expired values of the methods with background refresh are returned while a new value is fetched.
+    All the other attributes are proxied to the event store.
+    """
+
+    def __init__(self, event_store, config=None):
+        config = config or {}
+        self.event_store = event_store
+        self.ttls = {}
+        ttls_config = config.get("ttls", {})
+        for method, (default_ttl, _) in CACHED_METHODS.items():
+            ttl = float(ttls_config.get(method, default_ttl))
+            if ttl > 0:
+                self.ttls[method] = ttl
+        self._lru = LRUCache(int(config.get("max_size", 1024)))
+        self._flights = {}
+        self._lock = threading.Lock()
+        self._totals = TotalCounter()  # (method, result) → total
+
+    def __getattr__(self, name):
+        if name.startswith("__") or name == "event_store":
+            raise AttributeError(name)
+        attr = getattr(self.event_store, name)
+        if name in self.ttls:
+            return functools.partial(self._get, name, attr)
+        return attr
+
+    def _inc(self, method, result):
+        with self._lock:
+            self._totals[(method, result)] += 1
+
+    def _get_flight(self, key):
+        """Return the flight for the key, and whether the caller is responsible for it."""
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None:
+                return flight, False
+            flight = self._flights[key] = Flight()
+            return flight, True
+
+    def _run_flight(self, key, flight, func, args, kwargs):
+        try:
+            flight.value = func(*args, **kwargs)
+        except Exception as e:
+            flight.exception = e
+        else:
+            self._lru.set(key, (flight.value, time.monotonic()))
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+    def _refresh_in_background(self, method, key, func, args, kwargs):
+        flight, leader = self._get_flight(key)
+        if not leader:
+            # refresh already in progress
+            return
+
+        def refresh():
+            self._run_flight(key, flight, func, args, kwargs)
+            if flight.exception:
+                logger.error("Could not refresh %s cached value", method, exc_info=flight.exception)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+    def _get(self, method, func, *args, **kwargs):
+        key = make_cache_key(method, args, kwargs)
+        entry = self._lru.get(key)
+        if entry is not None:
+            value, created_at = entry
+            age = time.monotonic() - created_at
+            ttl = self.ttls[method]
+            if age < ttl:
+                self._inc(method, "hit")
+                return copy.deepcopy(value)
+            if CACHED_METHODS[method][1] and age < MAX_STALE_FACTOR * ttl:
+                self._inc(method, "stale")
+                self._refresh_in_background(method, key, func, args, kwargs)
+                return copy.deepcopy(value)
+        flight, leader = self._get_flight(key)
+        if leader:
+            self._inc(method, "miss")
+            self._run_flight(key, flight, func, args, kwargs)
+        else:
+            self._inc(method, "coalesced")
+            flight.done.wait()
+        if flight.exception:
+            raise flight.exception
+        # the values are modified in some views
+        return copy.deepcopy(flight.value)
+
+    def clear(self):
+        self._lru.clear()
+
+    def get_prometheus_metrics(self):
+        registry = CollectorRegistry()
+        c = Counter("zentral_frontend_store_cache_requests", "Zentral frontend store cache requests",
+                    ["store", "method", "result"],
+                    registry=registry)
+        with self._lock:
+            totals = list(self._totals.items())
+        for (method, result), total in totals:
+            c.labels(self.event_store.name, method, result).inc(total)
+        g = Gauge("zentral_frontend_store_cache_entries", "Zentral frontend store cache entries",
+                  ["store"],
+                  registry=registry)
+        g.labels(self.event_store.name).set(len(self._lru))
+        return registry
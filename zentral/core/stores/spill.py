@@ -0,0 +1,260 @@
+import errno
+import fcntl
+import json
+import logging
+import os
+import struct
+import time
+import zlib
+from django.utils.text import get_valid_filename
+
+
+logger = logging.getLogger("zentral.core.stores.spill")
+
+
+class CircuitBreaker(object):
+    """Track the health of a store backend.
+
+    CLOSED: the requests are sent to the backend.
+    OPEN: the backend is failing, the requests are not sent, until retry_delay seconds have passed.
+    HALF_OPEN: a request is allowed, to test the backend. Its outcome closes or opens the circuit.
+    """
+    CLOSED = "CLOSED"
+    OPEN = "OPEN"
+    HALF_OPEN = "HALF_OPEN"
+
+    def __init__(self, failure_threshold=3, retry_delay=30):
+        self.failure_threshold = max(int(failure_threshold), 1)
+        self.retry_delay = float(retry_delay)
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+
+    def allow_request(self):
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.retry_delay:
+            self.state = self.HALF_OPEN
+        return self.state != self.OPEN
+
+    def is_closed(self):
+        return self.state == self.CLOSED
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            logger.info("Circuit closed")
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.error("Circuit open after %s failure(s)", self.failures)
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+
+class SpillLog(object):
+    """Append-only, segmented, compressed log of serialized events.
+
+    Each record is a zlib compressed JSON list of events, prefixed by its length.
+    The segments are rotated when they reach max_segment_size bytes.
+    The read position is checkpointed, and the fully read segments are removed.
+    The log directory is locked, to be used by a single process at a time.
+    """
+    RECORD_HEADER = struct.Struct(">I")
+    SEGMENT_SUFFIX = ".seg"
+    CHECKPOINT_FILENAME = "checkpoint.json"
+    LOCK_FILENAME = "lock"
+
+    def __init__(self, directory, max_segment_size=16 * 2**20, max_size=2**30):
+        self.directory = directory
+        self.max_segment_size = max_segment_size
+        self.max_size = max_size
+        os.makedirs(self.directory, exist_ok=True)
+        self._lock_file = open(os.path.join(self.directory, self.LOCK_FILENAME), "w")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as e:
+            self._lock_file.close()
+            if e.errno in (errno.EACCES, errno.EAGAIN):
+                raise BlockingIOError("Spill log {} locked".format(self.directory))
+            raise
+        self._read_segment, self._read_offset = self._load_checkpoint()
+        # always start a new segment, the last one could have a truncated record
+        self._write_segment = max(self._get_segments() + [self._read_segment]) + 1
+        self._write_file = None
+        self._size = sum(os.path.getsize(self._segment_path(segment)) for segment in self._get_segments())
+
+    @classmethod
+    def open_for_store(cls, base_directory, store_name, max_instances=64, **kwargs):
+        """Open the first unlocked spill log of a store.
+
+        One sub-directory per concurrent store worker process."""
+        store_directory = os.path.join(base_directory, get_valid_filename(store_name))
+        for idx in range(max_instances):
+            try:
+                return cls(os.path.join(store_directory, str(idx)), **kwargs)
+            except BlockingIOError:
+                continue
+        raise BlockingIOError("All the spill logs of store {} are locked".format(store_name))
+
+    def close(self):
+        if self._write_file:
+            self._write_file.close()
+            self._write_file = None
+        self._lock_file.close()
+
+    # segments & checkpoint
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, "{:012d}{}".format(segment, self.SEGMENT_SUFFIX))
+
+    def _get_segments(self):
+        segments = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith(self.SEGMENT_SUFFIX):
+                try:
+                    segments.append(int(filename[:-len(self.SEGMENT_SUFFIX)]))
+                except ValueError:
+                    pass
+        return sorted(segments)
+
+    def _load_checkpoint(self):
+        try:
+            with open(os.path.join(self.directory, self.CHECKPOINT_FILENAME), "r") as f:
+                checkpoint = json.load(f)
+            return int(checkpoint["segment"]), int(checkpoint["offset"])
+        except FileNotFoundError:
+            pass
+        except (ValueError, KeyError, TypeError):
+            logger.error("Invalid spill log checkpoint in %s", self.directory)
+        segments = self._get_segments()
+        return (segments[0] if segments else 0), 0
+
+    def _save_checkpoint(self):
+        path = os.path.join(self.directory, self.CHECKPOINT_FILENAME)
+        tmp_path = "{}.tmp".format(path)
+        with open(tmp_path, "w") as f:
+            json.dump({"segment": self._read_segment, "offset": self._read_offset}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    # write
+
+    @property
+    def size(self):
+        return self._size
+
+    def is_empty(self):
+        return self._size == 0
+
+    def append(self, events):
+        """Append a list of serialized events. Returns False if the log is full."""
+        data = zlib.compress(json.dumps(events).encode("utf-8"))
+        record = self.RECORD_HEADER.pack(len(data)) + data
+        if self._size + len(record) > self.max_size:
+            return False
+        if self._write_file and self._write_file.tell() + len(record) > self.max_segment_size:
+            self._write_file.close()
+            self._write_file = None
+            self._write_segment += 1
+        if not self._write_file:
+            self._write_file = open(self._segment_path(self._write_segment), "ab")
+        self._write_file.write(record)
+        self._write_file.flush()
+        os.fsync(self._write_file.fileno())
+        self._size += len(record)
+        return True
+
+    # read
+
+    def _remove_read_segment(self):
+        path = self._segment_path(self._read_segment)
+        try:
+            self._size -= os.path.getsize(path)
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def _read_record(self, segment, offset):
+        """Return the record data, or None, and a truncated record flag."""
+        try:
+            with open(self._segment_path(segment), "rb") as f:
+                f.seek(offset)
+                header = f.read(self.RECORD_HEADER.size)
+                if len(header) < self.RECORD_HEADER.size:
+                    return None, bool(header)
+                length = self.RECORD_HEADER.unpack(header)[0]
+                data = f.read(length)
+                if len(data) < length:
+                    return None, True
+                return data, False
+        except FileNotFoundError:
+            return None, False
+
+    def read(self):
+        """Return the events of the next record, and the position after it, or (None, None)."""
+        while True:
+            segment, offset = self._read_segment, self._read_offset
+            data, truncated = self._read_record(segment, offset)
+            if data is not None:
+                try:
+                    events = json.loads(zlib.decompress(data).decode("utf-8"))
+                except (zlib.error, ValueError):
+                    logger.error("Spill log %s: corrupted record in segment %s at offset %s",
+                                 self.directory, segment, offset)
+                    events = []
+                return events, (segment, offset + self.RECORD_HEADER.size + len(data))
+            if segment >= self._write_segment:
+                # nothing more to read
+                return None, None
+            # end of a segment that will not be written to anymore
+            if truncated:
+                logger.error("Spill log %s: truncated record in segment %s at offset %s",
+                             self.directory, segment, offset)
+            self._remove_read_segment()
+            self._read_segment, self._read_offset = segment + 1, 0
+            self._save_checkpoint()
+
+    def commit(self, position):
+        """Move the checkpointed read position after a read record."""
+        self._read_segment, self._read_offset = position
+        self._save_checkpoint()
+        if self._read_segment == self._write_segment and self._read_offset == self._size_of_write_segment():
+            # everything has been read, start a new segment to reclaim the disk space
+            if self._write_file:
+                self._write_file.close()
+                self._write_file = None
+            self._remove_read_segment()
+            self._write_segment += 1
+            self._read_segment, self._read_offset = self._write_segment, 0
+            self._save_checkpoint()
+
+    def _size_of_write_segment(self):
+        try:
+            return os.path.getsize(self._segment_path(self._write_segment))
+        except FileNotFoundError:
+            return 0
+
+
+def get_spill_log(event_store):
+    """Open the spill log of a store, if configured."""
+    config = event_store.spill_log_config
+    if not config:
+        return
+    try:
+        return SpillLog.open_for_store(
+            config.get("directory", "/tmp/zentral_spill_logs"),
+            event_store.name,
+            max_segment_size=int(config.get("max_segment_size", 16 * 2**20)),
+            max_size=int(config.get("max_size", 2**30)),
+        )
+    except OSError:
+        logger.exception("Could not open spill log for store %s", event_store.name)
+
+
+def get_circuit_breaker(event_store):
+    config = event_store.spill_log_config or {}
+    return CircuitBreaker(config.get("failure_threshold", 3), config.get("retry_delay", 30))
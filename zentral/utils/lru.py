@@ -0,0 +1,75 @@
+from collections import OrderedDict
+import logging
+import threading
+
+
+logger = logging.getLogger("zentral.utils.lru")
+
+
+class LRUCache(object):
+    """Thread safe, bounded, process local cache."""
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # incremented on each invalidation, to avoid caching values computed before it
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            else:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_set(self, key, getter):
+        """Return the cached value, or call the getter and cache its result.
+
+        The getter is called outside of the lock, and its result can be None.
+        The result is not cached if the cache has been invalidated in the meantime.
+        """
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                generation = self._generation
+            else:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+        value = getter()
+        with self._lock:
+            if generation == self._generation:
+                self._data[key] = value
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+        return value
+
+    def delete(self, key):
+        with self._lock:
+            self._generation += 1
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._data.clear()
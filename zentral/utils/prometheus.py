@@ -1,17 +1,23 @@
 import logging
 from django.http import HttpResponse, HttpResponseForbidden
 from django.views import View
-from prometheus_client import generate_latest, start_http_server, Counter, CONTENT_TYPE_LATEST
+from prometheus_client import generate_latest, start_http_server, Counter, Gauge, Histogram, CONTENT_TYPE_LATEST
 from zentral.conf import settings
 
 
 logger = logging.getLogger("zentral.utils.prometheus")
 
 
+# seconds, from the processing time of an event to the lag of a stalled pipeline
+DEFAULT_HISTOGRAM_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600, float("inf"))
+
+
 class PrometheusMetricsExporter:
     def __init__(self, port):
         self.port = port
         self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
 
     def start(self):
         logger.info("Starting prometheus http server on port %s", self.port)
@@ -21,12 +27,32 @@ class PrometheusMetricsExporter:
         description = name.replace("_", " ").capitalize()
         self.counters[name] = Counter(name, description, labels)
 
-    def inc(self, counter_name, *label_values):
+    def inc(self, counter_name, *label_values, value=1):
         try:
-            self.counters[counter_name].labels(*label_values).inc()
+            self.counters[counter_name].labels(*label_values).inc(value)
         except KeyError:
             logger.error("Missing counter %s", counter_name)
 
+    def add_gauge(self, name, labels):
+        description = name.replace("_", " ").capitalize()
+        self.gauges[name] = Gauge(name, description, labels)
+
+    def set(self, gauge_name, *label_values, value):
+        try:
+            self.gauges[gauge_name].labels(*label_values).set(value)
+        except KeyError:
+            logger.error("Missing gauge %s", gauge_name)
+
+    def add_histogram(self, name, labels, buckets=None):
+        description = name.replace("_", " ").capitalize()
+        self.histograms[name] = Histogram(name, description, labels, buckets=buckets or DEFAULT_HISTOGRAM_BUCKETS)
+
+    def observe(self, histogram_name, *label_values, value):
+        try:
+            self.histograms[histogram_name].labels(*label_values).observe(value)
+        except KeyError:
+            logger.error("Missing histogram %s", histogram_name)
+
 
 class BasePrometheusMetricsView(View):
     def get_registry(self):
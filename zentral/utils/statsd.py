@@ -15,6 +15,8 @@ class StatsdMetricsExporter:
         self._ipv6 = ipv6
         self._socket = None
         self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
 
     def _open_socket(self):
         family, _, _, _, self._addr = socket.getaddrinfo(
@@ -31,15 +33,34 @@ class StatsdMetricsExporter:
     def add_counter(self, name, labels):
         self._counters[name] = [label.replace(":", ".") for label in labels]
 
-    def inc(self, counter_name, *label_values):
-        counter_name = counter_name.replace(":", ".")
-        data = "{}{}:1|c".format(self._prefix, counter_name)
+    def add_gauge(self, name, labels):
+        self._gauges[name] = [label.replace(":", ".") for label in labels]
+
+    def add_histogram(self, name, labels, buckets=None):
+        # the buckets are computed by the statsd server
+        self._histograms[name] = [label.replace(":", ".") for label in labels]
+
+    def _send(self, name, metric_type, labels, label_values, value):
+        data = "{}{}:{}|{}".format(self._prefix, name, value, metric_type)
         if label_values:
-            tags = zip(self._counters.get(counter_name, []),
-                       (s.replace(",", ".") for s in label_values))
+            tags = zip(labels, (s.replace(",", ".") for s in label_values))
             tags_data = ",".join("{}:{}".format(t, v) for t, v in tags)
             data = "{}|#{}".format(data, tags_data)
         try:
             self._socket.sendto(data.encode('ascii'), self._addr)
         except (socket.error, RuntimeError):
             pass
+
+    def inc(self, counter_name, *label_values, value=1):
+        counter_name = counter_name.replace(":", ".")
+        self._send(counter_name, "c", self._counters.get(counter_name, []), label_values, value)
+
+    def set(self, gauge_name, *label_values, value):
+        gauge_name = gauge_name.replace(":", ".")
+        self._send(gauge_name, "g", self._gauges.get(gauge_name, []), label_values, value)
+
+    def observe(self, histogram_name, *label_values, value):
+        # seconds → timer in milliseconds
+        histogram_name = histogram_name.replace(":", ".")
+        self._send(histogram_name, "ms", self._histograms.get(histogram_name, []), label_values,
+                   round(value * 1000, 3))